@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.utils.translation import gettext_lazy as _
-from .models import Artist, Album, Track, User, Playlist, Like, Dislike, Skip, Recommendation
+from .models import (
+    Artist, Album, Track, User, Playlist, Like, Dislike, Skip, Recommendation,
+    VectorChange, VectorSyncCheckpoint
+)
 from django.db.models import Max
 
 @admin.register(User)
@@ -238,3 +241,15 @@ class RecommendationAdmin(admin.ModelAdmin):
         updated = queryset.update(is_viewed=True, is_clicked=True)
         self.message_user(request, f'Отмечено {updated} рекомендаций как кликнутые')
     mark_as_clicked.short_description = 'Отметить как кликнутые'
+
+@admin.register(VectorChange)
+class VectorChangeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'track_id', 'operation', 'created_at')
+    list_filter = ('operation', 'created_at')
+    search_fields = ('track_id',)
+    readonly_fields = ('track_id', 'operation', 'created_at')
+
+@admin.register(VectorSyncCheckpoint)
+class VectorSyncCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('name', 'source', 'applied_count', 'last_event_at', 'updated_at')
+    readonly_fields = ('updated_at',)
@@ -1,11 +1,20 @@
 import os
+import json
+import time
+import fcntl
+import shutil
 import logging
+import resource
+import threading
 import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from annoy import AnnoyIndex
 from django.conf import settings
 from datetime import datetime
 
-from .mongodb import TrackVectors
+from .vector_store import get_vector_store
+from .quantization import ScalarQuantizer, quantized_search
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +26,41 @@ except ImportError:
     logger.warning("Numpy недоступен. Annoy-индексация будет отключена.")
     NUMPY_AVAILABLE = False
 
+def get_peak_rss_mb():
+    """Возвращает пиковое потребление памяти (RSS) текущим процессом в МБ"""
+    # ru_maxrss измеряется в килобайтах на Linux и в байтах на macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    divisor = 1024 * 1024 if os.uname().sysname == 'Darwin' else 1024
+    return round(peak_rss / divisor, 1)
+
+
+class AnnoyItemVectors:
+    """
+    Векторы элементов Annoy-индекса с доступом как к строкам матрицы (vectors[rows]).
+    
+    Annoy хранит векторы элементов в файле деревьев, поэтому поколению режима
+    'quantized' отдельная float32-матрица не нужна: int8-коды заменяют ее при
+    переборе, а точные векторы читаются из деревьев только для кандидатов.
+    """
+    def __init__(self, index, dim):
+        self.index = index
+        self.shape = (index.get_n_items(), dim)
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __getitem__(self, rows):
+        if np.ndim(rows) == 0:
+            return np.asarray(self.index.get_item_vector(int(rows)), dtype=np.float32)
+        rows = np.arange(self.shape[0])[rows] if isinstance(rows, slice) else np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        matrix = np.empty((len(rows), self.shape[1]), dtype=np.float32)
+        for i, row in enumerate(rows):
+            matrix[i] = self.index.get_item_vector(int(row))
+        return matrix
+
+
 class TrackAnnoyIndex:
     """
     Класс для создания и использования Annoy-индекса для быстрого поиска похожих треков
@@ -27,8 +71,35 @@ class TrackAnnoyIndex:
     # Настройки индекса
     EMBEDDING_DIM = 512  # Размерность эмбеддингов CLAP
     N_TREES = 50         # Количество деревьев (больше - точнее, но медленнее)
+    SEARCH_K = -1        # Число просматриваемых узлов при поиске (-1 - по умолчанию Annoy: n * N_TREES)
+    SEARCH_MODE = 'annoy'  # Режим поиска: 'annoy' - деревья Annoy, 'quantized' - int8-коды вместо float32-матрицы
+    RERANK_FACTOR = 10     # Во сколько раз больше кандидатов переранжировать точно в режиме 'quantized'
+    FILTER_EXACT_SCAN_RATIO = 0.05  # При меньшей доле подходящих под фильтр треков - точный перебор вместо Annoy
+    BUILD_JOBS = -1        # Количество потоков построения деревьев (-1 - все ядра)
+    BUILD_BATCH_SIZE = 10000  # Размер пачки векторов при потоковом построении индекса
+    NEIGHBORS_K = 50       # Количество предвычисленных соседей на трек (0 - не вычислять при построении)
     INDEX_DIR = 'annoy_indices'  # Директория для хранения индексов
     INDEX_FILE = 'tracks_index.ann'  # Имя файла индекса
+    GENERATIONS_DIR = 'generations'  # Поддиректория с опубликованными поколениями индекса
+    CURRENT_LINK = 'current'         # Симлинк на текущее поколение
+    MANIFEST_FILE = 'manifest.json'  # Манифест поколения (записывается последним)
+    SIDECAR_LOCK_FILE = '.sidecars.lock'  # Файл блокировки изменения дельты и удаленных элементов
+    REBUILD_LOCK_FILE = '.rebuild.lock'   # Файл блокировки перестроения (одно построение на INDEX_DIR)
+    REBUILD_REMOVED_FILE = '.removed_during_rebuild.npy'  # ID треков, удаленных во время перестроения
+    KEEP_GENERATIONS = 3             # Сколько последних поколений хранить на диске
+    RELOAD_CHECK_INTERVAL = 2.0      # Минимальный интервал (сек) между проверками нового поколения
+    DELTA_MERGE_THRESHOLD = 1000  # Размер дельта-сегмента, после которого запускается слияние
+    COMPACTION_THRESHOLD = 0.2    # Доля удаленных элементов, после которой индекс перестраивается
+    
+    # Атрибуты экземпляра, загружаемые из файлов поколения и подменяемые
+    # в load_index только после успешной загрузки всех файлов
+    GENERATION_STATE = (
+        'generation', 'generation_dir', 'index', 'idx_to_id', 'sorted_track_ids',
+        'sorted_idx', 'next_idx', 'quantizer', 'codes', 'vectors', 'attributes',
+        '_bitmap_cache', 'neighbor_rows', 'neighbor_scores', 'tombstones',
+        'delta_track_ids', 'delta_vectors', 'delta_attributes', '_sidecar_mtimes',
+        'is_loaded',
+    )
     
     def __new__(cls):
         if cls._instance is None:
@@ -39,11 +110,61 @@ class TrackAnnoyIndex:
     def _init(self):
         """Инициализация атрибутов класса"""
         self.index = None
-        self.id_to_idx = {}  # Маппинг ID трека на индекс в Annoy
-        self.idx_to_id = {}  # Обратный маппинг: индекс -> ID трека
-        self.index_path = self._get_index_path()
+        # Маппинги хранятся в виде int64-массивов, открытых через mmap:
+        # idx_to_id - ID трека для каждого элемента Annoy (строка = ID элемента),
+        # sorted_track_ids/sorted_idx - ID треков по возрастанию и соответствующие
+        # им элементы Annoy для обратного поиска через np.searchsorted
+        self.idx_to_id = np.zeros(0, dtype=np.int64)
+        self.sorted_track_ids = np.zeros(0, dtype=np.int64)
+        self.sorted_idx = np.zeros(0, dtype=np.int64)
+        self.index_dir = self._get_index_dir()
         self.is_loaded = False
+        
+        # Каждое построение публикуется как отдельное поколение - директория
+        # с индексом, маппингами, матрицей векторов и манифестом. Текущее
+        # поколение задается симлинком, который подменяется атомарно.
+        self.generation = None
+        self.generation_dir = self.index_dir
+        self._sidecar_mtimes = {}
+        self._last_reload_check = 0.0
         self.next_idx = 0  # Следующий доступный индекс для инкрементального обновления
+        
+        # Дельта-сегмент: треки, добавленные после построения базового индекса.
+        # Annoy-индекс неизменяем после build(), поэтому новые векторы хранятся
+        # рядом в виде нормализованной матрицы и ищутся полным перебором.
+        self.delta_track_ids = []
+        self.delta_vectors = np.zeros((0, self.EMBEDDING_DIM), dtype=np.float32)
+        self.delta_attributes = []  # Атрибуты треков дельты для фильтрации
+        
+        # Матрица нормализованных float32-векторов базового индекса (строка = ID элемента
+        # Annoy), открытая через np.memmap. В поколении режима 'quantized' матрицы нет,
+        # и векторы читаются из файла деревьев (AnnoyItemVectors)
+        self.vectors = None
+        
+        # Битовая карта удаленных элементов базового индекса (tombstones).
+        # Векторы удаленных треков остаются в деревьях Annoy до перестроения.
+        self.tombstones = np.zeros(0, dtype=bool)
+        
+        # Скалярно квантованные int8-коды векторов (4 раза компактнее float32).
+        # Кандидаты оцениваются по кодам, а затем точно переранжируются по векторам
+        # из файла деревьев.
+        self.quantizer = None
+        self.codes = None
+        
+        # Атрибуты треков по элементам Annoy (жанр, explicit, исполнитель) и кэш
+        # построенных по ним битовых карт для фильтрованного поиска
+        self.attributes = None
+        self._bitmap_cache = {}
+        
+        self._lock = threading.RLock()
+        self._merge_thread = None
+        self._query_pool = None
+        self.last_build_stats = None
+        
+        # Предвычисленная таблица соседей поколения: строка = ID элемента Annoy,
+        # значения - ID элементов соседей (-1 - пусто) и оценки сходства
+        self.neighbor_rows = None
+        self.neighbor_scores = None
     
     def is_index_loaded(self):
         """
@@ -55,19 +176,323 @@ class TrackAnnoyIndex:
         return self.is_loaded
     
     @staticmethod
-    def _get_index_path():
-        """Возвращает путь к файлу индекса"""
+    def _get_index_dir():
+        """Возвращает директорию для хранения индексов"""
         index_dir = os.path.join(settings.BASE_DIR, TrackAnnoyIndex.INDEX_DIR)
         if not os.path.exists(index_dir):
             os.makedirs(index_dir)
-        return os.path.join(index_dir, TrackAnnoyIndex.INDEX_FILE)
+        return index_dir
+    
+    @property
+    def index_path(self):
+        """Путь к файлу индекса текущего поколения"""
+        return os.path.join(self.generation_dir, self.INDEX_FILE)
+    
+    @property
+    def ids_path(self):
+        """Путь к массиву ID треков по элементам Annoy текущего поколения"""
+        return self.index_path + '.ids.npy'
+    
+    @property
+    def sorted_ids_path(self):
+        """Путь к отсортированному массиву ID треков текущего поколения"""
+        return self.index_path + '.sorted_ids.npy'
+    
+    @property
+    def sorted_idx_path(self):
+        """Путь к массиву элементов Annoy в порядке отсортированных ID треков"""
+        return self.index_path + '.sorted_idx.npy'
+    
+    @property
+    def vectors_path(self):
+        """Путь к матрице векторов текущего поколения"""
+        return self.index_path + '.vectors.npy'
+    
+    @property
+    def codes_path(self):
+        """Путь к int8-кодам векторов текущего поколения"""
+        return self.index_path + '.codes.npy'
+    
+    @property
+    def quantizer_path(self):
+        """Путь к параметрам квантования текущего поколения"""
+        return self.index_path + '.quantizer.npz'
+    
+    @property
+    def attributes_path(self):
+        """Путь к атрибутам треков текущего поколения"""
+        return self.index_path + '.attributes.npz'
+    
+    @property
+    def neighbors_path(self):
+        """Путь к таблице предвычисленных соседей текущего поколения"""
+        return self.index_path + '.neighbors.npy'
+    
+    @property
+    def neighbor_scores_path(self):
+        """Путь к оценкам сходства предвычисленных соседей текущего поколения"""
+        return self.index_path + '.neighbor_scores.npy'
+    
+    @property
+    def tombstones_path(self):
+        """Путь к битовой карте удаленных элементов текущего поколения"""
+        return self.index_path + '.tombstones.npy'
+    
+    @property
+    def delta_path(self):
+        """Путь к дельта-сегменту текущего поколения"""
+        return self.index_path + '.delta.npz'
+    
+    @property
+    def current_link(self):
+        """Путь к симлинку на текущее поколение"""
+        return os.path.join(self.index_dir, self.CURRENT_LINK)
+    
+    def _resolve_current_generation(self):
+        """
+        Определяет текущее опубликованное поколение индекса.
+        
+        Returns:
+            tuple: (ID поколения, директория поколения). Для индекса старого формата
+                   (файлы прямо в INDEX_DIR) возвращается (None, INDEX_DIR).
+                   Если индекса нет - (None, None).
+        """
+        if os.path.islink(self.current_link):
+            generation_dir = os.path.realpath(self.current_link)
+            if os.path.exists(os.path.join(generation_dir, self.MANIFEST_FILE)):
+                return os.path.basename(generation_dir), generation_dir
+        
+        if os.path.exists(os.path.join(self.index_dir, self.INDEX_FILE)):
+            return None, self.index_dir
+        
+        return None, None
+    
+    @staticmethod
+    def _atomic_write(path, write):
+        """
+        Записывает файл через временный файл и атомарную подмену,
+        чтобы читатели никогда не видели частично записанных данных.
+        
+        Args:
+            path: Итоговый путь файла
+            write: Функция, принимающая открытый бинарный файл
+        """
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    
+    def _write_manifest(self, source, generation, generation_dir, items_count, build_stats):
+        """Записывает манифест поколения. Поколение считается полным только при наличии манифеста."""
+        manifest = {
+            "generation": generation,
+            "created_at": datetime.now().isoformat(),
+            "items_count": items_count,
+            "embedding_dim": self.EMBEDDING_DIM,
+            "trees_count": self._get_n_trees(),
+            "metric": "angular",
+            "source": source,
+            "build": build_stats,
+            "files": sorted(os.listdir(generation_dir)),
+        }
+        self._atomic_write(
+            os.path.join(generation_dir, self.MANIFEST_FILE),
+            lambda f: f.write(json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+        )
+    
+    def _publish_generation(self, generation, generation_dir):
+        """
+        Делает поколение активным: атомарно подменяет симлинк current
+        и удаляет старые поколения сверх KEEP_GENERATIONS. Процессы, которые
+        еще используют удаленные файлы через mmap, продолжают читать их до перезагрузки.
+        """
+        tmp_link = f"{self.current_link}.tmp-{os.getpid()}"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(generation_dir, self.index_dir), tmp_link)
+        os.replace(tmp_link, self.current_link)
+        
+        generations_root = os.path.join(self.index_dir, self.GENERATIONS_DIR)
+        generations = sorted(os.listdir(generations_root))
+        for old_generation in generations[:-self.KEEP_GENERATIONS]:
+            if old_generation != generation:
+                shutil.rmtree(os.path.join(generations_root, old_generation), ignore_errors=True)
+        
+        logger.info(f"Опубликовано поколение индекса {generation}")
+    
+    def _get_sidecar_mtimes(self):
+        """Возвращает время изменения изменяемых файлов поколения (дельта, удаленные элементы, соседи)"""
+        mtimes = {}
+        for path in (self.delta_path, self.tombstones_path, self.neighbors_path):
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+    
+    def refresh_if_stale(self, force=False):
+        """
+        Дешево проверяет, не опубликовано ли новое поколение индекса другим
+        процессом, и при необходимости перезагружает индекс (через mmap).
+        Изменения дельта-сегмента и удаленных элементов текущего поколения
+        подгружаются без перезагрузки деревьев.
+        
+        Проверка выполняется не чаще, чем раз в ANNOY_RELOAD_CHECK_INTERVAL секунд.
+        
+        Args:
+            force: Проверить без учета интервала
+            
+        Returns:
+            bool: True, если состояние индекса было обновлено
+        """
+        now = time.monotonic()
+        interval = getattr(settings, 'ANNOY_RELOAD_CHECK_INTERVAL', self.RELOAD_CHECK_INTERVAL)
+        if not force and now - self._last_reload_check < interval:
+            return False
+        self._last_reload_check = now
+        
+        try:
+            generation, generation_dir = self._resolve_current_generation()
+            if generation_dir is None:
+                return False
+            
+            if not self.is_loaded or generation != self.generation:
+                logger.info(f"Обнаружено новое поколение индекса: {generation}")
+                return self.load_index()
+            
+            mtimes = self._get_sidecar_mtimes()
+            if mtimes != self._sidecar_mtimes:
+                with self._lock:
+                    self._load_tombstones()
+                    self._load_delta()
+                    self._open_neighbors()
+                    self._sidecar_mtimes = mtimes
+                return True
+            
+            return False
+        except Exception as e:
+            logger.error(f"Ошибка при проверке поколения индекса: {str(e)}")
+            return False
+    
+    @contextmanager
+    def _sidecar_lock(self, reload=True):
+        """
+        Межпроцессная блокировка изменения дельта-сегмента и битовой карты
+        удаленных элементов (flock на файле в INDEX_DIR).
+        
+        Под блокировкой состояние перечитывается с диска, поэтому изменения
+        применяются к последней записанной версии файлов и не затирают
+        изменения других процессов. Блокировка файла берется раньше self._lock
+        и не берется повторно внутри себя.
+        
+        Args:
+            reload: Перечитать текущее поколение с диска
+        """
+        with open(os.path.join(self.index_dir, self.SIDECAR_LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with self._lock:
+                    generation, generation_dir = self._resolve_current_generation()
+                    if reload and generation_dir is not None:
+                        if generation != self.generation or not self.is_loaded:
+                            if not self.load_index():
+                                raise RuntimeError("Не удалось загрузить текущее поколение индекса")
+                        else:
+                            self._load_tombstones()
+                            self._load_delta()
+                            self._sidecar_mtimes = self._get_sidecar_mtimes()
+                    yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def _rebuild_lock_held(self):
+        """
+        Проверяет, держит ли какой-либо процесс блокировку перестроения.
+        Вызывается только под _sidecar_lock: под ней же берется блокировка
+        перестроения, поэтому проверка не мешает ее захвату.
+        """
+        with open(os.path.join(self.index_dir, self.REBUILD_LOCK_FILE), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+    
+    def is_rebuild_running(self):
+        """
+        Проверяет, идет ли перестроение индекса в каком-либо процессе.
+        
+        Returns:
+            bool: True, если перестроение выполняется
+        """
+        with self._sidecar_lock(reload=False):
+            return self._rebuild_lock_held()
+    
+    def _read_removed_during_rebuild(self):
+        """Читает ID треков, удаленных во время текущего перестроения"""
+        path = os.path.join(self.index_dir, self.REBUILD_REMOVED_FILE)
+        if not os.path.exists(path):
+            return np.zeros(0, dtype=np.int64)
+        return np.load(path)
+    
+    def _note_removed_during_rebuild(self, track_ids):
+        """
+        Запоминает удаленные треки, если сейчас идет перестроение: новое поколение
+        может содержать их векторы, прочитанные до удаления. Вызывается под _sidecar_lock.
+        
+        Args:
+            track_ids: ID удаленных треков
+        """
+        if not track_ids or not self._rebuild_lock_held():
+            return
+        removed = np.union1d(self._read_removed_during_rebuild(), np.fromiter(track_ids, dtype=np.int64))
+        self._atomic_write(
+            os.path.join(self.index_dir, self.REBUILD_REMOVED_FILE),
+            lambda f: np.save(f, removed.astype(np.int64))
+        )
+    
+    def _clear_removed_during_rebuild(self):
+        """Удаляет список треков, удаленных во время перестроения"""
+        path = os.path.join(self.index_dir, self.REBUILD_REMOVED_FILE)
+        if os.path.exists(path):
+            os.remove(path)
     
-    def build_index(self, force=False):
+    def _snapshot_state(self):
         """
-        Строит Annoy-индекс на основе векторов треков из MongoDB.
+        Снимок текущего поколения для перестроения (вызывается под _sidecar_lock).
+        
+        Returns:
+            dict: Маппинг, матрица векторов, удаленные элементы и дельта-сегмент
+                  или None, если индекса еще нет
+        """
+        if not self.is_loaded:
+            return None
+        return {
+            "idx_to_id": self.idx_to_id,
+            "vectors": self.vectors,
+            "tombstones": self.tombstones.copy(),
+            "delta_track_ids": list(self.delta_track_ids),
+            "delta_vectors": self.delta_vectors.copy(),
+        }
+    
+    def build_index(self, force=False, source='mongodb', n_jobs=None, on_disk=False, progress=None):
+        """
+        Строит Annoy-индекс на основе векторов треков.
+        
+        В режиме on_disk деревья строятся прямо в файле нового поколения
+        (AnnoyIndex.on_disk_build), а эмбеддинги из хранилища векторов потоково, пачками,
+        записываются в матрицу векторов через mmap. Ни документы, ни матрица
+        целиком в памяти не держатся, поэтому индекс может быть больше RAM.
         
         Args:
             force: Принудительное построение индекса, даже если он уже существует
+            source: Источник векторов: 'mongodb' - полная выгрузка из хранилища векторов (TRACK_VECTORS_STORE),
+                    'local' - матрица векторов текущего индекса и дельта-сегмент
+                    с локального диска (без обращения к MongoDB)
+            n_jobs: Количество потоков построения деревьев (по умолчанию ANNOY_BUILD_JOBS, -1 - все ядра)
+            on_disk: Строить индекс на диске с потоковой загрузкой векторов
+            progress: Функция progress(stage, done, total) для отчета о ходе построения
             
         Returns:
             bool: Успешность построения индекса
@@ -77,113 +502,864 @@ class TrackAnnoyIndex:
             return False
         
         # Проверяем, существует ли индекс и не требуется ли принудительное обновление
-        if os.path.exists(self.index_path) and not force:
-            logger.info(f"Индекс уже существует: {self.index_path}. Пропускаем построение.")
+        if self._resolve_current_generation()[1] is not None and not force:
+            logger.info(f"Индекс уже существует в {self.index_dir}. Пропускаем построение.")
             return self.load_index()
         
+        if n_jobs is None:
+            n_jobs = self._get_build_jobs()
+        progress = progress or (lambda stage, done, total: None)
+        
+        # Одновременно строится только одно поколение. Блокировка перестроения
+        # берется под блокировкой дельты, под которой с диска снимается снимок текущего
+        # поколения: изменения после снимка переносятся в новое поколение при публикации.
+        # Текущее поколение может быть недоступно (например, повреждено) - тогда
+        # индекс строится без снимка.
+        rebuild_lock = open(os.path.join(self.index_dir, self.REBUILD_LOCK_FILE), 'a')
         try:
-            # Получаем все треки из MongoDB
-            collection = TrackVectors.get_collection()
-            all_tracks = list(collection.find())
+            with self._sidecar_lock(reload=False):
+                try:
+                    fcntl.flock(rebuild_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    logger.info("Индекс уже перестраивается другим процессом, пропускаем построение.")
+                    return False
+                snapshot = self._snapshot_state() if self.load_index() else None
+                self._clear_removed_during_rebuild()
             
-            if not all_tracks:
-                logger.warning("Нет треков для построения индекса.")
-                return False
+            return self._build_generation(snapshot, source, n_jobs, on_disk, progress)
+        finally:
+            # Закрытие файла снимает блокировку перестроения
+            rebuild_lock.close()
+    
+    def _build_generation(self, snapshot, source, n_jobs, on_disk, progress):
+        """
+        Строит и публикует новое поколение индекса (под блокировкой перестроения).
+        
+        Все файлы поколения записываются в его директорию, а состояние экземпляра
+        не изменяется до публикации: после подмены симлинка новое поколение
+        загружается через load_index().
+        
+        Args:
+            snapshot: Снимок текущего поколения (_snapshot_state) или None
+            source, n_jobs, on_disk, progress: См. build_index
             
+        Returns:
+            bool: Успешность построения индекса
+        """
+        started = time.monotonic()
+        
+        # Новое поколение записывается в отдельную директорию, поэтому
+        # файлы, которые сейчас читают другие процессы, не изменяются
+        generation = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        generation_dir = os.path.join(self.index_dir, self.GENERATIONS_DIR, generation)
+        os.makedirs(generation_dir)
+        index_path = os.path.join(generation_dir, self.INDEX_FILE)
+        published = False
+        
+        try:
             # Создаем новый индекс с нужной размерностью
             index = AnnoyIndex(self.EMBEDDING_DIM, 'angular')  # angular для косинусного расстояния
+            if on_disk:
+                index.on_disk_build(index_path)
             
-            # Очищаем старые маппинги
-            self.id_to_idx = {}
-            self.idx_to_id = {}
-            
-            # Добавляем каждый трек в индекс
-            idx = 0
-            for track_doc in all_tracks:
-                track_id = track_doc.get('track_id')
-                vector_data = track_doc.get('vector', {})
-                embedding = vector_data.get('embedding', [])
-                
-                # Пропускаем треки без эмбеддингов
-                if not embedding or len(embedding) != self.EMBEDDING_DIM:
-                    continue
-                
-                # Добавляем вектор в индекс
-                index.add_item(idx, embedding)
+            if on_disk and source != 'local':
+                track_ids, vectors = self._stream_vectors_to_disk(
+                    index, index_path + '.vectors.npy', progress
+                )
+            else:
+                if source == 'local' and snapshot is not None and snapshot['vectors'] is not None:
+                    track_ids, vectors = self._collect_local_vectors(snapshot)
+                else:
+                    # Потоково загружаем эмбеддинги из хранилища в float32-матрицу
+                    track_ids, vectors = get_vector_store().load_vectors_matrix(self.EMBEDDING_DIM)
                 
-                # Сохраняем соответствие между ID трека и его индексом
-                self.id_to_idx[track_id] = idx
-                self.idx_to_id[idx] = track_id
+                vectors = self._normalize(vectors)
                 
-                idx += 1
+                # Добавляем каждый трек в индекс: ID элемента Annoy = номер строки,
+                # поэтому track_ids сразу служит маппингом элемент -> ID трека
+                for idx, embedding in enumerate(vectors):
+                    index.add_item(idx, embedding)
+                    if (idx + 1) % self.BUILD_BATCH_SIZE == 0:
+                        progress('load', idx + 1, len(vectors))
+                progress('load', len(vectors), len(vectors))
             
-            if idx == 0:
+            if len(track_ids) == 0:
                 logger.warning("Не найдено треков с валидными эмбеддингами для построения индекса.")
+                shutil.rmtree(generation_dir, ignore_errors=True)
                 return False
             
-            # Сохраняем следующий индекс для инкрементальных обновлений
-            self.next_idx = idx
+            idx = len(track_ids)
             
-            # Строим индекс
-            logger.info(f"Строим Annoy-индекс с {idx} треками и {self.N_TREES} деревьями.")
-            index.build(self.N_TREES)
+            # Строим индекс: деревья строятся параллельно в n_jobs потоках
+            n_trees = self._get_n_trees()
+            logger.info(f"Строим Annoy-индекс с {idx} треками и {n_trees} деревьями (потоков: {n_jobs}, на диске: {on_disk}).")
+            progress('build', 0, n_trees)
+            index.build(n_trees, n_jobs=n_jobs)
+            progress('build', n_trees, n_trees)
             
-            # Сохраняем индекс
-            index.save(self.index_path)
+            # Таблица соседей вычисляется до публикации, чтобы поколение сразу было полным
+            neighbors_k = self._get_neighbors_k()
+            if neighbors_k > 0:
+                self._compute_neighbors(index, index_path, neighbors_k, n_jobs, progress)
             
-            # Сохраняем маппинги
-            self._save_mappings()
+            # Сохраняем индекс (при построении на диске он уже записан в файл)
+            if not on_disk:
+                index.save(index_path)
+            index.unload()
             
-            # Устанавливаем индекс для текущего экземпляра
-            self.index = index
-            self.is_loaded = True
+            # Сохраняем матрицу векторов или, в режиме 'quantized', ее int8-коды вместо
+            # нее: точные векторы для переранжирования есть в файле деревьев
+            progress('save', 0, 1)
+            quantized = self._get_search_mode() == 'quantized'
+            if quantized:
+                self._save_codes(vectors, index_path)
+            elif not os.path.exists(index_path + '.vectors.npy'):
+                self._save_vectors(vectors, index_path)
+            sorted_track_ids, sorted_idx = self._save_mappings(track_ids, index_path)
+            self._save_attributes(track_ids, sorted_track_ids, sorted_idx, index_path)
+            progress('save', 1, 1)
+            
+            build_stats = {
+                "duration_s": round(time.monotonic() - started, 1),
+                "n_jobs": n_jobs,
+                "on_disk": on_disk,
+                "peak_rss_mb": get_peak_rss_mb(),
+            }
+            
+            # Текущее поколение перечитывается под блокировкой дельты: изменения,
+            # сделанные в нем любыми процессами за время построения, переносятся
+            # в новое поколение, и до публикации новых изменений в нем уже не будет
+            with self._sidecar_lock(reload=False):
+                if snapshot is not None and not self.load_index():
+                    raise RuntimeError("Не удалось перечитать текущее поколение индекса перед публикацией")
+                self._carry_over_changes(snapshot, vectors, sorted_track_ids, sorted_idx, index_path)
+                if quantized and os.path.exists(index_path + '.vectors.npy'):
+                    # Матрица, записанная при потоковом построении, нужна была только до этого момента
+                    os.remove(index_path + '.vectors.npy')
+                
+                # Манифест записывается последним, после чего поколение публикуется
+                self._write_manifest(source, generation, generation_dir, idx, build_stats)
+                self._publish_generation(generation, generation_dir)
+                published = True
+                self._clear_removed_during_rebuild()
+                
+                # Состояние экземпляра подменяется только опубликованным поколением
+                self.last_build_stats = build_stats
+                if not self.load_index():
+                    logger.warning(f"Поколение {generation} опубликовано, но не загружено в текущем процессе")
             
-            logger.info(f"Индекс успешно построен и сохранен в {self.index_path}")
+            logger.info(
+                f"Индекс успешно построен и сохранен в {index_path} за {build_stats['duration_s']} с, "
+                f"пиковое потребление памяти: {build_stats['peak_rss_mb']} МБ"
+            )
             return True
             
         except Exception as e:
             logger.error(f"Ошибка при построении индекса: {str(e)}")
+            if not published:
+                shutil.rmtree(generation_dir, ignore_errors=True)
+            return False
+    
+    def _carry_over_changes(self, snapshot, vectors, sorted_track_ids, sorted_idx, index_path):
+        """
+        Переносит в новое поколение изменения текущего поколения, сделанные
+        после снимка (вызывается под _sidecar_lock, текущее поколение только что
+        перечитано с диска), и записывает дельту и удаленные элементы нового поколения.
+        
+        Треки, добавленные или измененные в дельте после снимка, остаются в дельте
+        (их элементы в новом базовом индексе помечаются удаленными), а треки,
+        удаленные во время построения, помечаются удаленными.
+        
+        Args:
+            snapshot: Снимок текущего поколения или None
+            vectors: Нормализованная матрица векторов нового поколения
+            sorted_track_ids, sorted_idx: Маппинги нового поколения для поиска элементов
+            index_path: Путь к файлу деревьев нового поколения
+        """
+        tombstones = np.zeros(len(sorted_track_ids), dtype=bool)
+        rows = []
+        snapshot_delta = {}
+        delta_track_ids = []
+        if snapshot is not None:
+            snapshot_delta = dict(zip(snapshot['delta_track_ids'], snapshot['delta_vectors']))
+            delta_track_ids = self.delta_track_ids
+        
+        for row, track_id in enumerate(delta_track_ids):
+            vector = self.delta_vectors[row]
+            previous = snapshot_delta.get(track_id)
+            if previous is not None and np.allclose(previous, vector, atol=1e-6):
+                continue
+            
+            idx = self._searchsorted_lookup(sorted_track_ids, sorted_idx, track_id)
+            if idx is not None:
+                if np.allclose(vectors[idx], vector, atol=1e-6):
+                    continue
+                tombstones[idx] = True
+            rows.append(row)
+        
+        # Удаленные треки: записанные во время построения и пропавшие из дельты после снимка
+        live = set(delta_track_ids)
+        removed = set(self._read_removed_during_rebuild().tolist())
+        removed.update(snapshot_delta)
+        for track_id in removed - live:
+            idx = self._searchsorted_lookup(sorted_track_ids, sorted_idx, track_id)
+            if idx is not None:
+                tombstones[idx] = True
+        
+        self._write_tombstones(index_path + '.tombstones.npy', tombstones)
+        self._write_delta(
+            index_path + '.delta.npz',
+            [self.delta_track_ids[row] for row in rows],
+            self.delta_vectors[rows],
+            [self.delta_attributes[row] for row in rows]
+        )
+        if rows or tombstones.any():
+            logger.info(
+                f"В новое поколение перенесено изменений, сделанных во время построения: "
+                f"{len(rows)} в дельте, {int(np.count_nonzero(tombstones))} удаленных"
+            )
+    
+    def _stream_vectors_to_disk(self, index, vectors_path, progress):
+        """
+        Потоково загружает эмбеддинги из хранилища векторов: каждая пачка нормализуется,
+        записывается в матрицу векторов на диске (через mmap) и добавляется
+        в Annoy-индекс. В памяти одновременно находится только одна пачка.
+        
+        Args:
+            index: AnnoyIndex, подготовленный через on_disk_build
+            vectors_path: Путь к файлу матрицы векторов нового поколения
+            progress: Функция progress(stage, done, total)
+            
+        Returns:
+            tuple: (track_ids, vectors) - массив int64 и матрица, открытая через mmap
+        """
+        capacity = get_vector_store().count_vectors()
+        if capacity == 0:
+            return np.zeros(0, dtype=np.int64), None
+        
+        vectors = np.lib.format.open_memmap(
+            vectors_path, mode='w+', dtype=np.float32, shape=(capacity, self.EMBEDDING_DIM)
+        )
+        track_ids = np.empty(capacity, dtype=np.int64)
+        count = 0
+        batch_ids = []
+        batch_vectors = []
+        
+        def flush():
+            nonlocal count
+            rows = self._normalize(np.asarray(batch_vectors, dtype=np.float32))
+            vectors[count:count + len(rows)] = rows
+            track_ids[count:count + len(rows)] = batch_ids
+            for offset, row in enumerate(rows):
+                index.add_item(count + offset, row)
+            count += len(rows)
+            batch_ids.clear()
+            batch_vectors.clear()
+            progress('load', count, capacity)
+        
+        for track_id, embedding in get_vector_store().iter_embeddings(batch_size=self.BUILD_BATCH_SIZE):
+            if len(embedding) != self.EMBEDDING_DIM:
+                continue
+            if count + len(batch_ids) >= capacity:
+                # Треки, добавленные во время выгрузки, попадут в дельта-сегмент
+                logger.warning("Количество эмбеддингов выросло во время построения индекса, лишние пропущены")
+                break
+            batch_ids.append(int(track_id))
+            batch_vectors.append(embedding)
+            if len(batch_ids) >= self.BUILD_BATCH_SIZE:
+                flush()
+        if batch_ids:
+            flush()
+        
+        vectors.flush()
+        del vectors
+        
+        if count < capacity:
+            # Часть документов без валидных эмбеддингов: переписываем матрицу
+            # под фактический размер блоками, без загрузки в память
+            self._truncate_vectors_file(vectors_path, count)
+        
+        return track_ids[:count], np.load(vectors_path, mmap_mode='r')
+    
+    def _truncate_vectors_file(self, vectors_path, count):
+        """Переписывает матрицу векторов на диске, оставляя первые count строк"""
+        source = np.load(vectors_path, mmap_mode='r')
+        tmp_path = f"{vectors_path}.tmp-{os.getpid()}"
+        target = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=np.float32, shape=(count, self.EMBEDDING_DIM)
+        )
+        for start in range(0, count, self.BUILD_BATCH_SIZE):
+            target[start:start + self.BUILD_BATCH_SIZE] = source[start:min(start + self.BUILD_BATCH_SIZE, count)]
+        target.flush()
+        del target, source
+        os.replace(tmp_path, vectors_path)
+    
+    def _compute_neighbors(self, index, index_path, k, n_jobs=-1, progress=None):
+        """
+        Вычисляет top-K соседей для каждого элемента индекса и сохраняет их
+        рядом с деревьями поколения: ID элементов соседей (int32, -1 - пусто)
+        и оценки сходства (float16). Запросы к Annoy выполняются блоками
+        в пуле потоков, результаты пишутся в файлы через mmap.
+        
+        Args:
+            index: Построенный AnnoyIndex
+            index_path: Путь к файлу деревьев поколения
+            k: Количество соседей на трек
+            n_jobs: Количество потоков (-1 - все ядра)
+            progress: Функция progress(stage, done, total)
+        """
+        progress = progress or (lambda stage, done, total: None)
+        n_items = index.get_n_items()
+        search_k = self._get_search_k()
+        block_size = 1000
+        
+        neighbors_path = index_path + '.neighbors.npy'
+        scores_path = index_path + '.neighbor_scores.npy'
+        rows_tmp = f"{neighbors_path}.tmp-{os.getpid()}"
+        scores_tmp = f"{scores_path}.tmp-{os.getpid()}"
+        rows = np.lib.format.open_memmap(rows_tmp, mode='w+', dtype=np.int32, shape=(n_items, k))
+        scores = np.lib.format.open_memmap(scores_tmp, mode='w+', dtype=np.float16, shape=(n_items, k))
+        
+        def compute_block(start):
+            for item in range(start, min(start + block_size, n_items)):
+                nn_items, distances = index.get_nns_by_item(
+                    item, k + 1, search_k=search_k, include_distances=True
+                )
+                neighbors = [(nn, distance) for nn, distance in zip(nn_items, distances) if nn != item][:k]
+                row = np.full(k, -1, dtype=np.int32)
+                score_row = np.zeros(k, dtype=np.float16)
+                if neighbors:
+                    nn_row, distance_row = zip(*neighbors)
+                    row[:len(neighbors)] = nn_row
+                    # Оценка сходства в тех же единицах, что и в find_similar_tracks
+                    score_row[:len(neighbors)] = 1.0 - np.asarray(distance_row)
+                rows[item] = row
+                scores[item] = score_row
+            return min(start + block_size, n_items) - start
+        
+        max_workers = os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+        done = 0
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='annoy-neighbors') as pool:
+            for computed in pool.map(compute_block, range(0, n_items, block_size)):
+                done += computed
+                progress('neighbors', done, n_items)
+        
+        rows.flush()
+        scores.flush()
+        del rows, scores
+        os.replace(scores_tmp, scores_path)
+        os.replace(rows_tmp, neighbors_path)
+        logger.info(f"Таблица {k} соседей для {n_items} треков сохранена в {neighbors_path}")
+    
+    def precompute_neighbors(self, k=None, n_jobs=-1, progress=None):
+        """
+        Вычисляет таблицу соседей для текущего поколения индекса.
+        Остальные процессы подхватывают ее при следующей проверке поколения.
+        
+        Args:
+            k: Количество соседей на трек (по умолчанию ANNOY_NEIGHBORS_K)
+            n_jobs: Количество потоков (-1 - все ядра)
+            progress: Функция progress(stage, done, total)
+            
+        Returns:
+            bool: Успешность вычисления
+        """
+        if not self.is_loaded and not self.load_index():
+            logger.error("Индекс не загружен. Таблица соседей не может быть вычислена.")
+            return False
+        
+        k = k or self._get_neighbors_k() or self.NEIGHBORS_K
+        try:
+            with self._lock:
+                index = self.index
+                index_path = self.index_path
+            self._compute_neighbors(index, index_path, k, n_jobs, progress)
+            
+            with self._lock:
+                if self.index_path == index_path:
+                    self._open_neighbors()
+                    self._sidecar_mtimes = self._get_sidecar_mtimes()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при вычислении таблицы соседей: {str(e)}")
             return False
     
-    def _save_mappings(self):
-        """Сохраняет маппинги ID треков на индексы"""
-        mappings_path = self.index_path + '.mappings'
+    def _open_neighbors(self):
+        """Открывает таблицу предвычисленных соседей поколения через mmap"""
+        self.neighbor_rows = None
+        self.neighbor_scores = None
+        
+        if not os.path.exists(self.neighbors_path) or not os.path.exists(self.neighbor_scores_path):
+            return
+        
         try:
-            np.savez(
-                mappings_path,
-                id_to_idx=np.array(list(self.id_to_idx.items()), dtype=object),
-                idx_to_id=np.array(list(self.idx_to_id.items()), dtype=object),
-                next_idx=np.array([self.next_idx])
+            self.neighbor_scores = np.load(self.neighbor_scores_path, mmap_mode='r')
+            self.neighbor_rows = np.load(self.neighbors_path, mmap_mode='r')
+        except Exception as e:
+            logger.error(f"Ошибка при открытии таблицы соседей: {str(e)}")
+            self.neighbor_rows = None
+            self.neighbor_scores = None
+    
+    def get_precomputed_neighbors(self, track_id, limit=10, exclude_track_ids=None):
+        """
+        Возвращает похожие треки из предвычисленной таблицы соседей:
+        поиск строки по ID трека и чтение одной строки таблицы.
+        Удаленные и исключенные треки пропускаются. Треки дельта-сегмента
+        в таблице отсутствуют, поэтому они добавляются к кандидатам точным
+        скалярным произведением по матрице дельты.
+        
+        Args:
+            track_id: ID исходного трека
+            limit: Максимальное количество результатов
+            exclude_track_ids: Коллекция ID треков, исключаемых из выдачи
+            
+        Returns:
+            Список кортежей (ID трека, показатель схожести) или None, если
+            трека нет в таблице или в ней недостаточно соседей
+        """
+        neighbor_rows = self.neighbor_rows
+        neighbor_scores = self.neighbor_scores
+        if neighbor_rows is None or limit > neighbor_rows.shape[1]:
+            return None
+        
+        idx = self._get_live_idx(track_id)
+        if idx is None or idx >= len(neighbor_rows):
+            return None
+        
+        tombstones = self.tombstones
+        idx_to_id = self.idx_to_id
+        similar_tracks = []
+        for nn, score in zip(neighbor_rows[idx].tolist(), neighbor_scores[idx].tolist()):
+            if nn < 0:
+                break
+            if nn < len(tombstones) and tombstones[nn]:
+                continue
+            nn_track_id = int(idx_to_id[nn])
+            if exclude_track_ids and nn_track_id in exclude_track_ids:
+                continue
+            similar_tracks.append((nn_track_id, score))
+            if len(similar_tracks) >= limit:
+                break
+        
+        # Соседей не хватило (часть удалена или исключена) - нужен поиск по индексу
+        if len(similar_tracks) < limit:
+            return None
+        
+        if self.delta_track_ids:
+            if self.vectors is not None:
+                query = np.asarray(self.vectors[idx], dtype=np.float32)
+            else:
+                query = self._normalize(np.asarray(self.index.get_item_vector(idx), dtype=np.float32))
+            similar_tracks.extend(
+                (delta_track_id, 1.0 - distance)
+                for delta_track_id, distance in self._search_delta(query, limit + 1, None, exclude_track_ids)
+                if delta_track_id != track_id
             )
-            logger.info(f"Маппинги сохранены в {mappings_path}")
+            similar_tracks.sort(key=lambda candidate: candidate[1], reverse=True)
+        
+        return similar_tracks[:limit]
+    
+    @staticmethod
+    def _collect_local_vectors(snapshot):
+        """
+        Собирает векторы для перестроения из снимка локальной матрицы индекса
+        и дельта-сегмента. Удаленные треки в выборку не попадают.
+        
+        Args:
+            snapshot: Снимок текущего поколения (_snapshot_state)
+        
+        Returns:
+            tuple: (track_ids, matrix) - массив int64 и float32-матрица
+        """
+        base_rows = np.flatnonzero(~snapshot['tombstones'])
+        base_track_ids = np.asarray(snapshot['idx_to_id'])[base_rows]
+        delta_track_ids = np.array(snapshot['delta_track_ids'], dtype=np.int64)
+        
+        track_ids = np.concatenate([base_track_ids, delta_track_ids])
+        matrix = np.concatenate([snapshot['vectors'][base_rows], snapshot['delta_vectors']])
+        return track_ids, matrix
+    
+    def _save_vectors(self, vectors, index_path):
+        """
+        Сохраняет float32-матрицу векторов индекса (строка = ID элемента Annoy).
+        Файл записывается во временный и атомарно подменяется, поэтому
+        процессы, открывшие старую матрицу через mmap, продолжают ее читать.
+        
+        Args:
+            vectors: Нормализованная матрица векторов
+            index_path: Путь к файлу деревьев поколения
+        """
+        vectors_path = index_path + '.vectors.npy'
+        self._atomic_write(
+            vectors_path,
+            lambda f: np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+        )
+        logger.info(f"Матрица векторов сохранена в {vectors_path}")
+    
+    def _open_vectors(self, index):
+        """
+        Открывает матрицу векторов индекса через np.memmap (только чтение).
+        Страницы файла разделяются между всеми процессами через page cache.
+        В поколении режима 'quantized' матрицы нет - векторы читаются из деревьев.
+        
+        Args:
+            index: Загруженный AnnoyIndex поколения
+        
+        Returns:
+            numpy.memmap, AnnoyItemVectors или None, если векторы недоступны
+        """
+        if not os.path.exists(self.vectors_path):
+            if self.codes is not None:
+                return AnnoyItemVectors(index, self.EMBEDDING_DIM)
+            logger.warning(f"Матрица векторов не найдена: {self.vectors_path}")
+            return None
+        
+        try:
+            return np.load(self.vectors_path, mmap_mode='r')
+        except Exception as e:
+            logger.error(f"Ошибка при открытии матрицы векторов: {str(e)}")
+            return None
+    
+    def _save_codes(self, vectors, index_path):
+        """
+        Обучает скалярный квантователь и сохраняет int8-коды векторов индекса.
+        Коды кодируются и записываются блоками, поэтому матрица векторов
+        может быть открыта через mmap и не загружается в память целиком.
+        
+        Args:
+            vectors: Нормализованная матрица векторов
+            index_path: Путь к файлу деревьев поколения
+        """
+        codes_path = index_path + '.codes.npy'
+        quantizer = ScalarQuantizer().fit(vectors, block_size=self.BUILD_BATCH_SIZE)
+        self._atomic_write(index_path + '.quantizer.npz', quantizer.save)
+        
+        tmp_path = f"{codes_path}.tmp-{os.getpid()}"
+        codes = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int8, shape=vectors.shape)
+        for start in range(0, len(vectors), self.BUILD_BATCH_SIZE):
+            codes[start:start + self.BUILD_BATCH_SIZE] = quantizer.encode(vectors[start:start + self.BUILD_BATCH_SIZE])
+        codes.flush()
+        del codes
+        os.replace(tmp_path, codes_path)
+        logger.info(f"Квантованные коды векторов сохранены в {codes_path}")
+    
+    def _open_codes(self):
+        """Открывает int8-коды векторов (через mmap) и параметры квантования"""
+        self.quantizer = None
+        self.codes = None
+        
+        if not os.path.exists(self.codes_path) or not os.path.exists(self.quantizer_path):
+            return
+        
+        try:
+            self.quantizer = ScalarQuantizer.load(self.quantizer_path)
+            self.codes = np.load(self.codes_path, mmap_mode='r')
+        except Exception as e:
+            logger.error(f"Ошибка при открытии квантованных кодов: {str(e)}")
+            self.quantizer = None
+            self.codes = None
+    
+    def _save_attributes(self, track_ids, sorted_track_ids, sorted_idx, index_path):
+        """
+        Сохраняет атрибуты треков (жанр, explicit, исполнитель) по элементам Annoy.
+        Атрибуты читаются из таблицы Track одним проходом.
+        
+        Args:
+            track_ids: Массив ID треков, строка = ID элемента Annoy
+            sorted_track_ids, sorted_idx: Маппинги поколения для поиска элементов
+            index_path: Путь к файлу деревьев поколения
+        """
+        from .models import Track
+        
+        attributes_path = index_path + '.attributes.npz'
+        n_items = len(track_ids)
+        genre_codes = np.full(n_items, -1, dtype=np.int32)
+        is_explicit = np.zeros(n_items, dtype=bool)
+        artist_ids = np.full(n_items, -1, dtype=np.int64)
+        genres = {}
+        
+        tracks = Track.objects.order_by().values_list('id', 'genre', 'is_explicit', 'artist_id')
+        for track_id, genre, explicit, artist_id in tracks.iterator(chunk_size=5000):
+            idx = self._searchsorted_lookup(sorted_track_ids, sorted_idx, track_id)
+            if idx is None:
+                continue
+            if genre:
+                genre_codes[idx] = genres.setdefault(genre.strip().lower(), len(genres))
+            is_explicit[idx] = explicit
+            artist_ids[idx] = artist_id
+        
+        vocabulary = np.array(sorted(genres, key=genres.get), dtype=np.str_)
+        self._atomic_write(attributes_path, lambda f: np.savez(
+            f,
+            genre_codes=genre_codes,
+            genres=vocabulary,
+            is_explicit=is_explicit,
+            artist_ids=artist_ids
+        ))
+        logger.info(f"Атрибуты треков сохранены в {attributes_path} (жанров: {len(vocabulary)})")
+    
+    def _load_attributes(self):
+        """Загружает атрибуты треков текущего поколения и сбрасывает кэш битовых карт"""
+        self.attributes = None
+        self._bitmap_cache = {}
+        
+        if not os.path.exists(self.attributes_path):
+            return
+        
+        try:
+            with np.load(self.attributes_path) as attributes:
+                self.attributes = {name: attributes[name] for name in attributes.files}
+            self.attributes['genre_index'] = {
+                genre: code for code, genre in enumerate(self.attributes['genres'].tolist())
+            }
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке атрибутов треков: {str(e)}")
+            self.attributes = None
+    
+    def _get_attribute_bitmap(self, name, value):
+        """
+        Возвращает битовую карту элементов базового индекса с заданным значением атрибута.
+        Карты строятся один раз для поколения и кэшируются.
+        
+        Args:
+            name: Имя атрибута: 'genre', 'is_explicit' или 'artist_id'
+            value: Значение атрибута
+            
+        Returns:
+            numpy.ndarray: Булев массив по элементам Annoy
+        """
+        key = (name, value)
+        bitmap = self._bitmap_cache.get(key)
+        if bitmap is not None:
+            return bitmap
+        
+        attributes = self.attributes
+        if name == 'genre':
+            code = attributes['genre_index'].get(str(value).strip().lower(), -2)
+            bitmap = attributes['genre_codes'] == code
+        elif name == 'is_explicit':
+            bitmap = attributes['is_explicit'] == bool(value)
+        elif name == 'artist_id':
+            bitmap = attributes['artist_ids'] == int(value)
+        else:
+            raise ValueError(f"Неизвестный атрибут фильтра: {name}")
+        
+        self._bitmap_cache[key] = bitmap
+        return bitmap
+    
+    def _build_allowed_mask(self, filters=None, exclude_track_ids=None):
+        """
+        Строит маску допустимых элементов базового индекса: не удаленные,
+        подходящие под все фильтры и не входящие в исключения.
+        
+        Args:
+            filters: Словарь {атрибут: значение}
+            exclude_track_ids: Коллекция ID треков, исключаемых из выдачи
+            
+        Returns:
+            numpy.ndarray или None, если фильтров и исключений нет
+        """
+        if not filters and not exclude_track_ids:
+            return None
+        
+        allowed = ~self.tombstones
+        
+        if filters:
+            if self.attributes is None:
+                raise ValueError("Атрибуты треков недоступны, перестройте индекс для фильтрованного поиска")
+            for name, value in filters.items():
+                allowed &= self._get_attribute_bitmap(name, value)
+        
+        for excluded_track_id in exclude_track_ids or ():
+            idx = self._lookup_idx(excluded_track_id)
+            if idx is not None:
+                allowed[idx] = False
+        
+        return allowed
+    
+    @staticmethod
+    def _matches_filters(attributes, filters):
+        """Проверяет атрибуты трека дельта-сегмента на соответствие фильтрам"""
+        for name, value in (filters or {}).items():
+            if name == 'genre':
+                if (attributes.get('genre') or '').strip().lower() != str(value).strip().lower():
+                    return False
+            elif name == 'is_explicit':
+                if bool(attributes.get('is_explicit')) != bool(value):
+                    return False
+            elif name == 'artist_id':
+                if attributes.get('artist_id') != int(value):
+                    return False
+            else:
+                raise ValueError(f"Неизвестный атрибут фильтра: {name}")
+        return True
+    
+    @classmethod
+    def _get_search_mode(cls):
+        """Возвращает режим поиска в базовом индексе (ANNOY_SEARCH_MODE)"""
+        return getattr(settings, 'ANNOY_SEARCH_MODE', cls.SEARCH_MODE)
+    
+    def get_vector(self, track_id):
+        """
+        Возвращает нормализованный вектор трека из локальной матрицы индекса
+        или дельта-сегмента, без обращения к MongoDB.
+        
+        Args:
+            track_id: ID трека
+            
+        Returns:
+            numpy.ndarray (float32) или None, если трека нет в индексе
+        """
+        track_id = self._coerce_track_id(track_id)
+        idx = self._get_live_idx(track_id)
+        if idx is not None and self.vectors is not None:
+            return np.asarray(self.vectors[idx])
+        
+        delta_track_ids = self.delta_track_ids
+        if track_id in delta_track_ids:
+            return self.delta_vectors[delta_track_ids.index(track_id)]
+        
+        return None
+    
+    def _is_live(self, idx):
+        """Проверяет, что элемент базового индекса не помечен как удаленный"""
+        return idx >= len(self.tombstones) or not self.tombstones[idx]
+    
+    @staticmethod
+    def _coerce_track_id(track_id):
+        """Приводит ID трека к int (ID может прийти строкой, например из URL)"""
+        try:
+            return int(track_id)
+        except (TypeError, ValueError):
+            return None
+    
+    def _lookup_idx(self, track_id):
+        """
+        Находит ID элемента Annoy для трека бинарным поиском
+        по отсортированному массиву ID треков.
+        
+        Returns:
+            int или None, если трека нет в базовом индексе
+        """
+        return self._searchsorted_lookup(self.sorted_track_ids, self.sorted_idx, track_id)
+    
+    @classmethod
+    def _searchsorted_lookup(cls, sorted_track_ids, sorted_idx, track_id):
+        """
+        Находит ID элемента Annoy для трека по маппингам поколения.
+        
+        Returns:
+            int или None, если трека нет в маппингах
+        """
+        track_id = cls._coerce_track_id(track_id)
+        if track_id is None or len(sorted_track_ids) == 0:
+            return None
+        
+        position = int(np.searchsorted(sorted_track_ids, track_id))
+        if position < len(sorted_track_ids) and sorted_track_ids[position] == track_id:
+            return int(sorted_idx[position])
+        return None
+    
+    def _get_live_idx(self, track_id):
+        """
+        Возвращает ID элемента Annoy для трека, если трек есть
+        в базовом индексе и не удален.
+        """
+        idx = self._lookup_idx(track_id)
+        if idx is None or not self._is_live(idx):
+            return None
+        return idx
+    
+    def _save_tombstones(self):
+        """Атомарно сохраняет битовую карту удаленных элементов"""
+        try:
+            self._write_tombstones(self.tombstones_path, self.tombstones)
+            self._sidecar_mtimes = self._get_sidecar_mtimes()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении битовой карты удаленных элементов: {str(e)}")
+    
+    def _write_tombstones(self, path, tombstones):
+        """Атомарно записывает битовую карту удаленных элементов в файл path"""
+        self._atomic_write(path, lambda f: np.save(f, tombstones))
+    
+    def _load_tombstones(self):
+        """Загружает битовую карту удаленных элементов базового индекса"""
+        self.tombstones = np.zeros(self.next_idx, dtype=bool)
+        
+        if not os.path.exists(self.tombstones_path):
+            return
+        
+        try:
+            tombstones = np.load(self.tombstones_path)
+            size = min(len(tombstones), self.next_idx)
+            self.tombstones[:size] = tombstones[:size]
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке битовой карты удаленных элементов: {str(e)}")
+    
+    def get_tombstone_ratio(self):
+        """
+        Возвращает долю удаленных элементов в базовом индексе.
+        
+        Returns:
+            float: Значение от 0 до 1
+        """
+        if len(self.tombstones) == 0:
+            return 0.0
+        return float(np.count_nonzero(self.tombstones)) / len(self.tombstones)
+    
+    @classmethod
+    def _get_compaction_threshold(cls):
+        """Возвращает долю удаленных элементов, при которой запускается компактизация"""
+        return getattr(settings, 'ANNOY_COMPACTION_THRESHOLD', cls.COMPACTION_THRESHOLD)
+    
+    def _save_mappings(self, track_ids, index_path):
+        """
+        Сохраняет маппинги ID треков в виде int64-массивов .npy
+        (без pickle, пригодных для открытия через mmap).
+        
+        Args:
+            track_ids: Массив ID треков, строка = ID элемента Annoy
+            index_path: Путь к файлу деревьев поколения
+            
+        Returns:
+            tuple: (sorted_track_ids, sorted_idx) - маппинги для поиска элементов
+        """
+        try:
+            track_ids = np.ascontiguousarray(track_ids, dtype=np.int64)
+            order = np.argsort(track_ids, kind='stable').astype(np.int64)
+            sorted_track_ids = track_ids[order]
+            
+            self._atomic_write(index_path + '.ids.npy', lambda f: np.save(f, track_ids))
+            self._atomic_write(index_path + '.sorted_ids.npy', lambda f: np.save(f, sorted_track_ids))
+            self._atomic_write(index_path + '.sorted_idx.npy', lambda f: np.save(f, order))
+            logger.info(f"Маппинги сохранены для {len(track_ids)} треков")
+            return sorted_track_ids, order
         except Exception as e:
             logger.error(f"Ошибка при сохранении маппингов: {str(e)}")
+            raise
     
     def _load_mappings(self):
-        """Загружает маппинги ID треков на индексы"""
-        mappings_path = self.index_path + '.mappings.npz'
+        """
+        Открывает маппинги ID треков через mmap. Загрузка не создает Python-объектов
+        на каждый трек, поэтому время старта и память процесса не зависят от размера каталога.
+        """
         try:
-            if not os.path.exists(mappings_path):
-                logger.warning(f"Файл маппингов не найден: {mappings_path}")
+            if not os.path.exists(self.ids_path):
+                if os.path.exists(self.index_path + '.mappings.npz'):
+                    logger.warning(
+                        "Найдены маппинги устаревшего формата (.mappings.npz). "
+                        "Перестройте индекс командой build_annoy_index --force"
+                    )
+                else:
+                    logger.warning(f"Файл маппингов не найден: {self.ids_path}")
                 return False
-                
-            mappings = np.load(mappings_path, allow_pickle=True)
-            
-            # Восстанавливаем словари
-            self.id_to_idx = dict(mappings['id_to_idx'].tolist())
-            self.idx_to_id = dict(mappings['idx_to_id'].tolist())
             
-            # Конвертируем строковые ключи обратно в целые числа для idx_to_id
-            self.idx_to_id = {int(k): v for k, v in self.idx_to_id.items()}
-            
-            # Загружаем следующий доступный индекс
-            if 'next_idx' in mappings:
-                self.next_idx = int(mappings['next_idx'][0])
-            else:
-                # Для обратной совместимости
-                self.next_idx = max(self.idx_to_id.keys()) + 1 if self.idx_to_id else 0
+            self.idx_to_id = np.load(self.ids_path, mmap_mode='r')
+            self.sorted_track_ids = np.load(self.sorted_ids_path, mmap_mode='r')
+            self.sorted_idx = np.load(self.sorted_idx_path, mmap_mode='r')
+            self.next_idx = len(self.idx_to_id)
             
-            logger.info(f"Маппинги загружены из {mappings_path}")
+            logger.info(f"Маппинги загружены: {self.next_idx} треков")
             return True
         except Exception as e:
             logger.error(f"Ошибка при загрузке маппингов: {str(e)}")
@@ -200,23 +1376,43 @@ class TrackAnnoyIndex:
             logger.error("Numpy недоступен. Индекс не может быть загружен.")
             return False
             
-        if not os.path.exists(self.index_path):
-            logger.warning(f"Индекс не найден по пути: {self.index_path}")
+        generation, generation_dir = self._resolve_current_generation()
+        if generation_dir is None:
+            logger.warning(f"Индекс не найден в директории: {self.index_dir}")
             return False
             
         try:
+            # Поколение загружается в неглубокую копию экземпляра: при ошибке на
+            # любом шаге текущее состояние (деревья, маппинги, пути к файлам) не
+            # меняется, а параллельные запросы обслуживаются старым поколением.
+            # copy.copy не подходит: он вызывает __new__ и вернул бы синглтон
+            staged = object.__new__(type(self))
+            staged.__dict__.update(self.__dict__)
+            staged.generation = generation
+            staged.generation_dir = generation_dir
+            staged.index = AnnoyIndex(self.EMBEDDING_DIM, 'angular')
+            staged.index.load(staged.index_path)
+            
             # Загружаем маппинги
-            if not self._load_mappings():
+            if not staged._load_mappings():
                 return False
             
-            # Создаем и загружаем индекс
-            index = AnnoyIndex(self.EMBEDDING_DIM, 'angular')
-            index.load(self.index_path)
+            staged._open_codes()
+            staged.vectors = staged._open_vectors(staged.index)
+            staged._load_attributes()
+            staged._open_neighbors()
+            staged.is_loaded = True
             
-            self.index = index
-            self.is_loaded = True
+            with self._lock:
+                # Подгружаем удаленные элементы и треки, добавленные после построения индекса
+                staged._load_tombstones()
+                staged._load_delta()
+                staged._sidecar_mtimes = staged._get_sidecar_mtimes()
+                
+                for name in self.GENERATION_STATE:
+                    setattr(self, name, getattr(staged, name))
             
-            logger.info(f"Индекс успешно загружен из {self.index_path}")
+            logger.info(f"Индекс успешно загружен из {self.index_path} (поколение {generation})")
             return True
         except Exception as e:
             logger.error(f"Ошибка при загрузке индекса: {str(e)}")
@@ -235,6 +1431,11 @@ class TrackAnnoyIndex:
         if not NUMPY_AVAILABLE:
             logger.error("Numpy недоступен. Индекс не может быть обновлен.")
             return False
+        
+        track_id = self._coerce_track_id(track_id)
+        if track_id is None:
+            logger.error("Некорректный ID трека для добавления в индекс")
+            return False
             
         # Проверяем, загружен ли индекс
         if not self.is_loaded:
@@ -245,13 +1446,14 @@ class TrackAnnoyIndex:
                 return self.build_index(force=True)
         
         try:
-            # Проверяем, есть ли уже трек в индексе
-            if track_id in self.id_to_idx:
+            # Проверяем, есть ли уже трек в индексе. Удаленный ранее трек
+            # добавляется заново через дельта-сегмент.
+            if self._get_live_idx(track_id) is not None:
                 logger.info(f"Трек {track_id} уже есть в индексе, пропускаем.")
                 return True
             
-            # Получаем вектор трека из MongoDB
-            vector = TrackVectors.get_track_vector(track_id)
+            # Получаем вектор трека из хранилища векторов
+            vector = get_vector_store().get_track_vector(track_id)
             
             if not vector or 'embedding' not in vector:
                 logger.warning(f"Вектор для трека {track_id} не найден")
@@ -264,52 +1466,335 @@ class TrackAnnoyIndex:
                 logger.error(f"Некорректная размерность эмбеддинга для трека {track_id}: {len(embedding)}, ожидается {self.EMBEDDING_DIM}")
                 return False
             
-            # Индекс Annoy не поддерживает инкрементальное обновление после построения
-            # Мы создадим новый индекс с добавленным треком и сохраним его
+            # Annoy не поддерживает добавление элементов после build(),
+            # поэтому новый трек попадает в дельта-сегмент. Базовый индекс
+            # перестраивается в фоне, когда дельта становится слишком большой.
+            with self._sidecar_lock():
+                if self._get_live_idx(track_id) is not None:
+                    logger.info(f"Трек {track_id} уже есть в индексе, пропускаем.")
+                    return True
+                if track_id in self.delta_track_ids:
+                    logger.info(f"Трек {track_id} уже есть в дельта-сегменте, пропускаем.")
+                    return True
+                
+                vector_row = self._normalize(np.asarray(embedding, dtype=np.float32))
+                self.delta_track_ids.append(track_id)
+                self.delta_vectors = np.vstack([self.delta_vectors, vector_row[np.newaxis, :]])
+                self.delta_attributes.append(self._get_track_attributes(track_id))
+                self._save_delta()
+                delta_size = len(self.delta_track_ids)
             
-            # Создаем новый индекс
-            new_index = AnnoyIndex(self.EMBEDDING_DIM, 'angular')
+            logger.info(f"Трек {track_id} добавлен в дельта-сегмент индекса (размер дельты: {delta_size})")
             
-            # Копируем все существующие векторы
-            for idx, track_id_existing in self.idx_to_id.items():
-                # Получаем вектор из MongoDB
-                existing_vector = TrackVectors.get_track_vector(track_id_existing)
-                if existing_vector and 'embedding' in existing_vector:
-                    new_index.add_item(idx, existing_vector['embedding'])
+            if delta_size >= self._get_delta_merge_threshold():
+                self.merge_delta_async()
             
-            # Добавляем новый вектор
-            idx = self.next_idx
-            new_index.add_item(idx, embedding)
+            return True
             
-            # Обновляем маппинги
-            self.id_to_idx[track_id] = idx
-            self.idx_to_id[idx] = track_id
-            self.next_idx += 1
+        except Exception as e:
+            logger.error(f"Ошибка при добавлении трека {track_id} в индекс: {str(e)}")
+            return False
+    
+    @staticmethod
+    def _get_track_attributes(track_id):
+        """Читает атрибуты трека для фильтрации (жанр, explicit, исполнитель)"""
+        from .models import Track
+        
+        track = Track.objects.filter(pk=track_id).values('genre', 'is_explicit', 'artist_id').first()
+        return track or {'genre': '', 'is_explicit': False, 'artist_id': -1}
+    
+    @staticmethod
+    def _normalize(vector):
+        """Нормализует вектор (или строки матрицы) по L2-норме"""
+        norms = np.linalg.norm(vector, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (vector / norms).astype(np.float32)
+    
+    @classmethod
+    def _get_n_trees(cls):
+        """Возвращает количество деревьев для построения индекса (ANNOY_N_TREES)"""
+        return getattr(settings, 'ANNOY_N_TREES', cls.N_TREES)
+    
+    @classmethod
+    def _get_neighbors_k(cls):
+        """Возвращает количество предвычисляемых соседей на трек (ANNOY_NEIGHBORS_K)"""
+        return getattr(settings, 'ANNOY_NEIGHBORS_K', cls.NEIGHBORS_K)
+    
+    @classmethod
+    def _get_build_jobs(cls):
+        """Возвращает количество потоков построения деревьев (ANNOY_BUILD_JOBS)"""
+        return getattr(settings, 'ANNOY_BUILD_JOBS', cls.BUILD_JOBS)
+    
+    @classmethod
+    def _get_search_k(cls):
+        """Возвращает параметр search_k для поиска (ANNOY_SEARCH_K)"""
+        return getattr(settings, 'ANNOY_SEARCH_K', cls.SEARCH_K)
+    
+    @classmethod
+    def _get_delta_merge_threshold(cls):
+        """Возвращает размер дельта-сегмента, при котором запускается слияние"""
+        return getattr(settings, 'ANNOY_DELTA_MERGE_THRESHOLD', cls.DELTA_MERGE_THRESHOLD)
+    
+    def _save_delta(self):
+        """Сохраняет дельта-сегмент на диск"""
+        try:
+            self._write_delta(self.delta_path, self.delta_track_ids, self.delta_vectors, self.delta_attributes)
+            self._sidecar_mtimes = self._get_sidecar_mtimes()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении дельта-сегмента: {str(e)}")
+    
+    def _write_delta(self, path, track_ids, vectors, attributes):
+        """Атомарно записывает дельта-сегмент (ID треков, векторы и атрибуты) в файл path"""
+        self._atomic_write(path, lambda f: np.savez(
+            f,
+            track_ids=np.array(track_ids, dtype=np.int64),
+            vectors=vectors,
+            genres=np.array([a.get('genre') or '' for a in attributes], dtype=np.str_),
+            is_explicit=np.array([bool(a.get('is_explicit')) for a in attributes], dtype=bool),
+            artist_ids=np.array([a.get('artist_id') or -1 for a in attributes], dtype=np.int64)
+        ))
+    
+    def _load_delta(self):
+        """Загружает дельта-сегмент с диска, если он существует"""
+        self.delta_track_ids = []
+        self.delta_vectors = np.zeros((0, self.EMBEDDING_DIM), dtype=np.float32)
+        self.delta_attributes = []
+        
+        if not os.path.exists(self.delta_path):
+            return
+        
+        try:
+            delta = np.load(self.delta_path)
+            self.delta_track_ids = [int(track_id) for track_id in delta['track_ids']]
+            self.delta_vectors = delta['vectors'].astype(np.float32)
+            if 'genres' in delta.files:
+                self.delta_attributes = [
+                    {'genre': genre, 'is_explicit': bool(explicit), 'artist_id': int(artist_id)}
+                    for genre, explicit, artist_id in zip(
+                        delta['genres'].tolist(), delta['is_explicit'], delta['artist_ids']
+                    )
+                ]
+            else:
+                self.delta_attributes = [self._get_track_attributes(track_id) for track_id in self.delta_track_ids]
+            logger.info(f"Дельта-сегмент загружен: {len(self.delta_track_ids)} треков")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке дельта-сегмента: {str(e)}")
+    
+    def _retain_delta(self, keep, save=True):
+        """
+        Оставляет в дельта-сегменте только треки, для которых keep(track_id) истинно.
+        
+        Args:
+            keep: Функция-предикат от ID трека
+            save: Сохранить дельта-сегмент на диск
+        """
+        rows = [i for i, track_id in enumerate(self.delta_track_ids) if keep(track_id)]
+        self.delta_track_ids = [self.delta_track_ids[i] for i in rows]
+        self.delta_vectors = self.delta_vectors[rows]
+        self.delta_attributes = [self.delta_attributes[i] for i in rows]
+        if save:
+            self._save_delta()
+    
+    def _start_background_rebuild(self, reason):
+        """
+        Запускает фоновое перестроение индекса из локальных векторов.
+        Если перестроение уже идет, повторно не запускается.
+        
+        Args:
+            reason: Причина перестроения (для логов)
             
-            # Строим и сохраняем индекс
-            new_index.build(self.N_TREES)
-            new_index.save(self.index_path)
+        Returns:
+            bool: True, если перестроение запущено
+        """
+        # Перестроение в другом процессе перенесет текущие изменения в свое поколение
+        if self.is_rebuild_running():
+            return False
+        
+        with self._lock:
+            if self._merge_thread is not None and self._merge_thread.is_alive():
+                return False
             
-            # Сохраняем обновленные маппинги
-            self._save_mappings()
+            self._merge_thread = threading.Thread(
+                target=self.build_index,
+                kwargs={'force': True, 'source': 'local'},
+                name='annoy-rebuild',
+                daemon=True
+            )
+            self._merge_thread.start()
+        
+        logger.info(f"Запущено фоновое перестроение Annoy-индекса: {reason}")
+        return True
+    
+    def merge_delta_async(self):
+        """
+        Запускает фоновое слияние дельта-сегмента с базовым индексом.
+        
+        Returns:
+            bool: True, если слияние запущено
+        """
+        return self._start_background_rebuild("слияние дельта-сегмента")
+    
+    def compact_async(self):
+        """
+        Запускает фоновую компактизацию: перестроение индекса без удаленных элементов.
+        
+        Returns:
+            bool: True, если компактизация запущена
+        """
+        return self._start_background_rebuild(
+            f"компактизация, доля удаленных элементов {self.get_tombstone_ratio():.2%}"
+        )
+    
+    def _search_delta(self, query, limit, filters=None, exclude_track_ids=None):
+        """
+        Ищет ближайшие треки в дельта-сегменте полным перебором.
+        
+        Args:
+            query: Нормализованный вектор запроса
+            limit: Максимальное количество результатов
+            filters: Словарь {атрибут: значение} для фильтрации
+            exclude_track_ids: Коллекция ID треков, исключаемых из выдачи
             
-            # Обновляем индекс в памяти
-            self.index = new_index
+        Returns:
+            Список кортежей (ID трека, angular-расстояние) в терминах Annoy
+        """
+        delta_track_ids = self.delta_track_ids
+        delta_vectors = self.delta_vectors
+        delta_attributes = self.delta_attributes
+        if not delta_track_ids:
+            return []
+        
+        cosines = delta_vectors @ query
+        # Angular-расстояние Annoy: sqrt(2 * (1 - cos))
+        distances = np.sqrt(np.maximum(0.0, 2.0 - 2.0 * cosines))
+        
+        if filters or exclude_track_ids:
+            exclude_track_ids = exclude_track_ids or ()
+            rows = np.array([
+                i for i, track_id in enumerate(delta_track_ids)
+                if track_id not in exclude_track_ids and self._matches_filters(delta_attributes[i], filters)
+            ], dtype=np.int64)
+        else:
+            rows = np.arange(len(delta_track_ids))
+        
+        top = rows[np.argsort(distances[rows])[:limit]]
+        return [(delta_track_ids[i], float(distances[i])) for i in top]
+    
+    def _search_base(self, query, base_idx, limit, allowed=None):
+        """
+        Ищет ближайшие живые элементы в базовом Annoy-индексе.
+        
+        Удаленные элементы остаются в деревьях Annoy и занимают места в выдаче,
+        поэтому кандидатов запрашивается больше с учетом доли удаленных,
+        а если живых все равно не хватило - запрос повторяется с удвоенным
+        числом кандидатов.
+        
+        При фильтрации (allowed) кандидаты проверяются по битовой карте,
+        а запас кандидатов рассчитывается по доле подходящих треков. Если под
+        фильтр подходит меньше ANNOY_FILTER_EXACT_SCAN_RATIO треков, подходящие
+        строки перебираются точно по матрице векторов: обход деревьев Annoy
+        в этом случае вернул бы почти одни неподходящие элементы.
+        
+        В режиме ANNOY_SEARCH_MODE = 'quantized' вместо деревьев Annoy
+        используется перебор всех int8-кодов (O(N·dim) на запрос, но в памяти
+        только dim байт на трек) с точным переранжированием кандидатов по
+        векторам из файла деревьев. Если коды не построены, поиск идет по деревьям Annoy.
+        
+        Args:
+            query: Нормализованный вектор запроса
+            base_idx: ID элемента Annoy исходного трека или None
+            limit: Необходимое количество живых результатов
+            allowed: Булева маска допустимых элементов или None
             
-            logger.info(f"Трек {track_id} успешно добавлен в Annoy-индекс")
-            return True
+        Returns:
+            Список кортежей (ID трека, angular-расстояние)
+        """
+        idx_to_id = self.idx_to_id
+        excluded = self.tombstones if allowed is None else ~allowed
+        
+        if self._get_search_mode() == 'quantized' and self.codes is not None and self.vectors is not None:
+            rerank_factor = getattr(settings, 'ANNOY_RERANK_FACTOR', self.RERANK_FACTOR)
+            rows, cosines = quantized_search(
+                query, self.quantizer, self.codes, self.vectors,
+                limit, rerank_factor, excluded=excluded
+            )
+            # Переводим косинусное сходство в angular-расстояние Annoy
+            distances = np.sqrt(np.maximum(0.0, 2.0 - 2.0 * cosines))
+            return [(int(idx_to_id[row]), float(distance)) for row, distance in zip(rows, distances)]
+        
+        n_items = self.index.get_n_items()
+        search_k = self._get_search_k()
+        
+        if allowed is None:
+            live_ratio = max(1.0 - self.get_tombstone_ratio(), 0.05)
+        else:
+            live_ratio = float(np.count_nonzero(allowed)) / max(len(allowed), 1)
+            exact_scan_ratio = getattr(settings, 'ANNOY_FILTER_EXACT_SCAN_RATIO', self.FILTER_EXACT_SCAN_RATIO)
+            if live_ratio < exact_scan_ratio and self.vectors is not None:
+                return self._scan_allowed(query, limit, allowed)
+            live_ratio = max(live_ratio, 0.01)
+        
+        fetch = min(int(np.ceil(limit / live_ratio)) + 1, n_items)
+        
+        while True:
+            if base_idx is not None:
+                nn_indices, distances = self.index.get_nns_by_item(
+                    base_idx, fetch, search_k=search_k, include_distances=True
+                )
+            else:
+                nn_indices, distances = self.index.get_nns_by_vector(
+                    query.tolist(), fetch, search_k=search_k, include_distances=True
+                )
             
-        except Exception as e:
-            logger.error(f"Ошибка при добавлении трека {track_id} в индекс: {str(e)}")
-            return False
+            candidates = [
+                (int(idx_to_id[nn_idx]), distance)
+                for nn_idx, distance in zip(nn_indices, distances)
+                if nn_idx >= len(excluded) or not excluded[nn_idx]
+            ]
+            
+            if len(candidates) >= limit or fetch >= n_items:
+                return candidates
+            
+            fetch = min(fetch * 2, n_items)
     
-    def find_similar_tracks(self, track_id, limit=10):
+    def _scan_allowed(self, query, limit, allowed):
+        """
+        Точный перебор подходящих под фильтр элементов по матрице векторов.
+        Читаются только строки из битовой карты.
+        
+        Args:
+            query: Нормализованный вектор запроса
+            limit: Количество результатов
+            allowed: Булева маска допустимых элементов
+            
+        Returns:
+            Список кортежей (ID трека, angular-расстояние)
+        """
+        rows = np.flatnonzero(allowed[:len(self.vectors)])
+        if len(rows) == 0:
+            return []
+        
+        cosines = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+        if len(rows) > limit:
+            top = np.argpartition(-cosines, limit - 1)[:limit]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.argsort(-cosines[top])]
+        
+        distances = np.sqrt(np.maximum(0.0, 2.0 - 2.0 * cosines[top]))
+        return [(int(self.idx_to_id[rows[i]]), float(distance)) for i, distance in zip(top, distances)]
+    
+    def find_similar_tracks(self, track_id, limit=10, filters=None, exclude_track_ids=None):
         """
         Находит похожие треки используя Annoy-индекс.
         
         Args:
             track_id: ID исходного трека
             limit: Максимальное количество результатов
+            filters: Словарь {атрибут: значение}; поддерживаются 'genre',
+                'is_explicit' и 'artist_id'
+            exclude_track_ids: Коллекция ID треков, исключаемых из выдачи
+                (например, дизлайкнутые пользователем)
             
         Returns:
             Список кортежей (ID трека, показатель схожести)
@@ -317,6 +1802,11 @@ class TrackAnnoyIndex:
         if not NUMPY_AVAILABLE:
             logger.error("Numpy недоступен. Поиск схожих треков невозможен.")
             return []
+        
+        track_id = self._coerce_track_id(track_id)
+        if track_id is None:
+            logger.warning("Некорректный ID трека для поиска похожих треков")
+            return []
             
         if not self.is_loaded:
             if not self.load_index():
@@ -326,35 +1816,41 @@ class TrackAnnoyIndex:
                     return []
         
         try:
-            # Получаем вектор исходного трека
-            vector = TrackVectors.get_track_vector(track_id)
+            base_idx = self._get_live_idx(track_id)
             
-            if not vector or 'embedding' not in vector:
-                logger.warning(f"Вектор для трека {track_id} не найден")
-                return []
+            # Берем вектор исходного трека из индекса или дельты без обращения к MongoDB
+            embedding = self.get_vector(track_id)
+            if embedding is None and base_idx is not None:
+                embedding = self.index.get_item_vector(base_idx)
+            elif embedding is None:
+                vector = get_vector_store().get_track_vector(track_id)
+                
+                if not vector or 'embedding' not in vector:
+                    logger.warning(f"Вектор для трека {track_id} не найден")
+                    return []
+                
+                embedding = vector['embedding']
             
-            embedding = vector['embedding']
+            query = self._normalize(np.asarray(embedding, dtype=np.float32))
             
-            # Если исходный трек не в индексе, ищем по вектору
-            if track_id not in self.id_to_idx:
-                # Получаем ближайшие треки по косинусному расстоянию
-                nn_indices, distances = self.index.get_nns_by_vector(
-                    embedding, limit + 1, include_distances=True
-                )
-            else:
-                # Получаем ближайшие треки к данному треку
-                idx = self.id_to_idx[track_id]
-                nn_indices, distances = self.index.get_nns_by_item(
-                    idx, limit + 1, include_distances=True
-                )
+            if exclude_track_ids:
+                exclude_track_ids = {
+                    excluded for excluded in map(self._coerce_track_id, exclude_track_ids)
+                    if excluded is not None
+                }
+            allowed = self._build_allowed_mask(filters, exclude_track_ids)
+            
+            candidates = self._search_base(query, base_idx, limit + 1, allowed)
             
-            # Преобразуем индексы в ID треков и фильтруем исходный трек
+            # Объединяем с кандидатами из дельта-сегмента
+            candidates.extend(self._search_delta(query, limit + 1, filters, exclude_track_ids))
+            candidates.sort(key=lambda candidate: candidate[1])
+            
+            # Преобразуем расстояния в оценки и фильтруем исходный трек
             similar_tracks = []
-            for nn_idx, distance in zip(nn_indices, distances):
-                nn_track_id = self.idx_to_id.get(nn_idx)
-                
-                # Пропускаем исходный трек
-                if nn_track_id == track_id:
+            for nn_track_id, distance in candidates:
+                # Пропускаем исходный трек и удаленные элементы
+                if nn_track_id is None or nn_track_id == track_id:
                     continue
                     
                 # Косинусное сходство = 1 - косинусное расстояние
@@ -370,13 +1866,62 @@ class TrackAnnoyIndex:
             logger.error(f"Ошибка при поиске похожих треков: {str(e)}")
             return []
     
-    def find_similar_tracks_with_scores(self, track_id, limit=10):
+    def _get_query_pool(self):
+        """
+        Возвращает пул потоков для пакетных запросов. Annoy отпускает GIL
+        во время поиска, поэтому запросы выполняются параллельно на всех ядрах.
+        """
+        with self._lock:
+            if self._query_pool is None:
+                max_workers = getattr(settings, 'ANNOY_QUERY_THREADS', None) or os.cpu_count() or 1
+                self._query_pool = ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    thread_name_prefix='annoy-query'
+                )
+            return self._query_pool
+    
+    def find_similar_tracks_many(self, track_ids, limit=10, filters=None, exclude_track_ids=None):
+        """
+        Находит похожие треки сразу для нескольких исходных треков.
+        Запросы к индексу распределяются по пулу потоков.
+        
+        Args:
+            track_ids: Список ID исходных треков
+            limit: Максимальное количество результатов для каждого трека
+            filters: Словарь {атрибут: значение} для фильтрации
+            exclude_track_ids: Коллекция ID треков, исключаемых из выдачи
+            
+        Returns:
+            dict: {ID исходного трека: список кортежей (ID трека, показатель схожести)}
+        """
+        if not track_ids:
+            return {}
+        
+        # Загружаем индекс один раз до распределения запросов по потокам
+        if not self.is_loaded and not self.load_index():
+            logger.warning("Индекс не загружен. Пытаемся построить новый.")
+            if not self.build_index():
+                logger.error("Не удалось построить индекс. Поиск невозможен.")
+                return {track_id: [] for track_id in track_ids}
+        
+        unique_track_ids = list(dict.fromkeys(track_ids))
+        pool = self._get_query_pool()
+        results = pool.map(
+            lambda track_id: self.find_similar_tracks(track_id, limit, filters, exclude_track_ids),
+            unique_track_ids
+        )
+        
+        return dict(zip(unique_track_ids, results))
+    
+    def find_similar_tracks_with_scores(self, track_id, limit=10, filters=None, exclude_track_ids=None):
         """
         Находит похожие треки используя Annoy-индекс и возвращает списки ID треков и оценок сходства.
         
         Args:
             track_id: ID исходного трека
             limit: Максимальное количество результатов
+            filters: Словарь {атрибут: значение} для фильтрации
+            exclude_track_ids: Коллекция ID треков, исключаемых из выдачи
             
         Returns:
             tuple: (similar_track_ids, similarity_scores), где
@@ -384,7 +1929,7 @@ class TrackAnnoyIndex:
                    similarity_scores - список оценок сходства
         """
         # Вызываем существующий метод для получения кортежей (id, score)
-        similar_track_tuples = self.find_similar_tracks(track_id, limit)
+        similar_track_tuples = self.find_similar_tracks(track_id, limit, filters, exclude_track_ids)
         
         if not similar_track_tuples:
             return [], []
@@ -398,9 +1943,10 @@ class TrackAnnoyIndex:
     def remove_track_from_index(self, track_id):
         """
         Удаляет трек из индекса.
-        Внимание: В Annoy нельзя удалить отдельный элемент, поэтому
-        трек будет фактически удален только при следующем полном перестроении индекса.
-        Мы лишь удаляем информацию о треке из маппингов.
+        В Annoy нельзя удалить отдельный элемент, поэтому элемент помечается
+        в битовой карте удаленных (tombstone) и исключается из выдачи, а сам вектор
+        остается в деревьях до компактизации. Когда доля удаленных элементов
+        превышает ANNOY_COMPACTION_THRESHOLD, индекс перестраивается в фоне.
         
         Args:
             track_id: ID трека для удаления
@@ -408,32 +1954,153 @@ class TrackAnnoyIndex:
         Returns:
             bool: Успешность операции
         """
+        track_id = self._coerce_track_id(track_id)
+        if track_id is None:
+            logger.error("Некорректный ID трека для удаления из индекса")
+            return False
+        
         if not self.is_loaded:
             if not self.load_index():
                 logger.warning("Индекс не загружен, удаление невозможно.")
                 return False
         
         try:
-            # Проверяем, есть ли трек в индексе
-            if track_id not in self.id_to_idx:
-                logger.info(f"Трек {track_id} не найден в индексе, пропускаем удаление.")
-                return True
+            with self._sidecar_lock():
+                # Трек из дельта-сегмента удаляется сразу и полностью
+                if track_id in self.delta_track_ids:
+                    self._retain_delta(lambda delta_track_id: delta_track_id != track_id)
+                    logger.info(f"Трек {track_id} удален из дельта-сегмента индекса")
+                
+                # Запоминаем удаление, чтобы применить его к перестраиваемому индексу
+                self._note_removed_during_rebuild([track_id])
+                
+                # Проверяем, есть ли трек в базовом индексе
+                idx = self._get_live_idx(track_id)
+                if idx is None:
+                    logger.info(f"Трек {track_id} не найден в базовом индексе, пропускаем удаление.")
+                    return True
+                
+                self.tombstones[idx] = True
+                self._save_tombstones()
+                tombstone_ratio = self.get_tombstone_ratio()
             
-            # Удаляем информацию о треке из маппингов
-            idx = self.id_to_idx[track_id]
-            del self.id_to_idx[track_id]
-            del self.idx_to_id[idx]
+            logger.info(f"Трек {track_id} помечен как удаленный из индекса (доля удаленных: {tombstone_ratio:.2%})")
             
-            # Сохраняем обновленные маппинги
-            self._save_mappings()
+            if tombstone_ratio > self._get_compaction_threshold():
+                self.compact_async()
             
-            logger.info(f"Трек {track_id} помечен как удаленный из индекса (будет удален при следующем перестроении)")
             return True
             
         except Exception as e:
             logger.error(f"Ошибка при удалении трека {track_id} из индекса: {str(e)}")
             return False
     
+    def apply_changes(self, upserts=(), deletes=()):
+        """
+        Пакетно применяет изменения векторов треков: векторы читаются из хранилища
+        одним запросом, а дельта-сегмент и битовая карта удаленных сохраняются
+        один раз на пакет.
+        
+        Трек с изменившимся вектором помечается удаленным в базовом индексе
+        и добавляется в дельта-сегмент; трек с прежним вектором пропускается.
+        Во время перестроения изменения применяются к текущему поколению
+        и переносятся в новое при его публикации.
+        
+        Args:
+            upserts: ID добавленных или обновленных треков
+            deletes: ID удаленных треков
+            
+        Returns:
+            dict: Счетчики added, updated, removed, skipped или None, если изменения
+                  применить нельзя и их нужно повторить
+        """
+        if not NUMPY_AVAILABLE:
+            logger.error("Numpy недоступен. Индекс не может быть обновлен.")
+            return None
+        
+        upserts = {track_id for track_id in map(self._coerce_track_id, upserts) if track_id is not None}
+        deletes = {track_id for track_id in map(self._coerce_track_id, deletes) if track_id is not None} - upserts
+        stats = {'added': 0, 'updated': 0, 'removed': 0, 'skipped': 0}
+        
+        if not self.is_loaded:
+            if not self.load_index():
+                # Индекса еще нет: при построении он целиком загрузится из хранилища
+                stats['skipped'] = len(upserts) + len(deletes)
+                return stats
+        
+        vectors = {}
+        if upserts:
+            for track_id, embedding in get_vector_store().get_embeddings(sorted(upserts)).items():
+                if len(embedding) == self.EMBEDDING_DIM:
+                    vectors[int(track_id)] = self._normalize(embedding)
+        stats['skipped'] += len(upserts) - len(vectors)
+        
+        attributes = {}
+        if vectors:
+            from .models import Track
+            
+            for track in Track.objects.filter(pk__in=list(vectors)).values('id', 'genre', 'is_explicit', 'artist_id'):
+                attributes[track.pop('id')] = track
+        
+        # Дельта и удаленные элементы перечитываются и сохраняются под межпроцессной блокировкой
+        with self._sidecar_lock():
+            removed_from_delta = set()
+            tombstones_changed = False
+            new_rows = []
+            
+            for track_id in deletes | set(vectors):
+                vector = vectors.get(track_id)
+                current = self.get_vector(track_id)
+                if vector is not None and current is not None and np.allclose(current, vector, atol=1e-6):
+                    stats['skipped'] += 1
+                    continue
+                
+                if track_id in self.delta_track_ids:
+                    removed_from_delta.add(track_id)
+                idx = self._get_live_idx(track_id)
+                if idx is not None:
+                    self.tombstones[idx] = True
+                    tombstones_changed = True
+                
+                if vector is None:
+                    stats['removed'] += int(current is not None)
+                    continue
+                
+                stats['updated' if current is not None else 'added'] += 1
+                new_rows.append((track_id, vector))
+            
+            if removed_from_delta or new_rows:
+                self._retain_delta(lambda delta_track_id: delta_track_id not in removed_from_delta, save=False)
+                if new_rows:
+                    self.delta_track_ids.extend(track_id for track_id, _ in new_rows)
+                    self.delta_vectors = np.vstack([self.delta_vectors] + [vector[np.newaxis, :] for _, vector in new_rows])
+                    self.delta_attributes.extend(
+                        attributes.get(track_id, {'genre': '', 'is_explicit': False, 'artist_id': -1})
+                        for track_id, _ in new_rows
+                    )
+                self._save_delta()
+            if tombstones_changed:
+                self._save_tombstones()
+            
+            # Изменения, сделанные во время перестроения, переносятся в новое поколение
+            # при публикации, а удаления дополнительно запоминаются
+            self._note_removed_during_rebuild(deletes)
+            
+            delta_size = len(self.delta_track_ids)
+            tombstone_ratio = self.get_tombstone_ratio()
+        
+        logger.info(
+            f"Изменения применены к индексу: добавлено {stats['added']}, обновлено {stats['updated']}, "
+            f"удалено {stats['removed']}, пропущено {stats['skipped']}"
+        )
+        
+        if delta_size >= self._get_delta_merge_threshold():
+            self.merge_delta_async()
+        elif tombstone_ratio > self._get_compaction_threshold():
+            self.compact_async()
+        
+        return stats
+    
     def track_exists_in_index(self, track_id):
         """
         Проверяет, существует ли трек в индексе.
@@ -444,7 +2111,8 @@ class TrackAnnoyIndex:
         Returns:
             bool: True, если трек есть в индексе
         """
-        return track_id in self.id_to_idx
+        track_id = self._coerce_track_id(track_id)
+        return self._get_live_idx(track_id) is not None or track_id in self.delta_track_ids
     
     def get_index_info(self):
         """
@@ -460,17 +2128,49 @@ class TrackAnnoyIndex:
             index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
             index_size_mb = index_size / (1024 * 1024)
             
+            vectors_size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+            codes_size = os.path.getsize(self.codes_path) if os.path.exists(self.codes_path) else 0
+            n_items = max(len(self.idx_to_id), 1)
+            
             index_mtime = None
             if os.path.exists(self.index_path):
                 mtime = os.path.getmtime(self.index_path)
                 index_mtime = datetime.fromtimestamp(mtime).isoformat()
             
             return {
-                "indexed_tracks_count": len(self.id_to_idx),
-                "trees_count": self.N_TREES,
+                "indexed_tracks_count": (
+                    len(self.idx_to_id) - int(np.count_nonzero(self.tombstones)) + len(self.delta_track_ids)
+                ),
+                "tombstones_count": int(np.count_nonzero(self.tombstones)),
+                "tombstone_ratio": round(self.get_tombstone_ratio(), 4),
+                "compaction_threshold": self._get_compaction_threshold(),
+                "delta_tracks_count": len(self.delta_track_ids),
+                "delta_merge_threshold": self._get_delta_merge_threshold(),
+                "rebuild_in_progress": self.is_rebuild_running(),
+                "trees_count": self.index.get_n_trees() if self.index is not None else self._get_n_trees(),
+                "search_k": self._get_search_k(),
+                "search_mode": self._get_search_mode(),
+                "filter_attributes_available": self.attributes is not None,
+                "filter_genres_count": len(self.attributes['genres']) if self.attributes is not None else 0,
+                "codes_available": self.codes is not None,
+                "codes_file_size_mb": round(codes_size / (1024 * 1024), 2),
+                # Фактический размер файлов поколения на диске в пересчете на трек:
+                # в режиме 'quantized' int8-коды хранятся вместо float32-матрицы
+                "disk_bytes_per_track": {
+                    "index": round(index_size / n_items),
+                    "vectors": round(vectors_size / n_items),
+                    "codes": round(codes_size / n_items),
+                    "total": round((index_size + vectors_size + codes_size) / n_items),
+                },
                 "embedding_dim": self.EMBEDDING_DIM,
+                "generation": self.generation,
+                "last_build": self.last_build_stats,
+                "neighbors_k": self.neighbor_rows.shape[1] if self.neighbor_rows is not None else 0,
                 "index_file_path": self.index_path,
                 "index_file_size_mb": round(index_size_mb, 2),
+                "vectors_file_path": self.vectors_path,
+                "vectors_file_size_mb": round(vectors_size / (1024 * 1024), 2),
+                "vectors_shape": list(self.vectors.shape) if self.vectors is not None else None,
                 "last_modified": index_mtime,
                 "is_loaded": self.is_loaded,
                 "next_idx": self.next_idx
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 import logging
 
 logger = logging.getLogger(__name__)
@@ -10,26 +11,67 @@ class MusicAppConfig(AppConfig):
     
     def ready(self):
         """
-        Выполняется при запуске приложения. Используется для загрузки
-        Annoy-индекса в память при старте сервера.
+        Выполняется при запуске приложения. Индексы хранилища векторов и индекс
+        похожих треков загружаются только в процессах веб-сервера
+        (VECTOR_INDEX_WARM_UP): команды manage.py и скрипты не обращаются
+        к MongoDB при импорте Django, а загружают индекс лениво при первом запросе.
         """
         import os
+        from django.core.signals import request_started
+        
+        # Предотвращаем двойной прогрев при запуске с помощью reloader
+        if os.environ.get('RUN_MAIN') != 'true' and getattr(settings, 'VECTOR_INDEX_WARM_UP', False):
+            warm_up_vector_search()
+        
+        # Между запросами проверяем, не опубликовал ли другой процесс новое
+        # поколение индекса (проверка ограничена по частоте). Подключается во
+        # всех процессах: под runserver запросы обслуживает процесс с RUN_MAIN=true
+        request_started.connect(
+            _refresh_vector_index,
+            dispatch_uid='music_app.refresh_vector_index'
+        )
         
-        # Предотвращаем двойное выполнение при запуске с помощью reloader
-        if os.environ.get('RUN_MAIN') != 'true':
-            try:
-                # Импортируем здесь, чтобы избежать циклических импортов
-                from .annoy_index import annoy_index
-                
-                # Пытаемся загрузить Annoy-индекс
-                loaded = annoy_index.load_index()
-                if loaded:
-                    index_info = annoy_index.get_index_info()
-                    logger.info(f"Annoy-индекс успешно загружен. Треков в индексе: {index_info.get('indexed_tracks_count', 0)}")
-                else:
-                    logger.warning("Annoy-индекс не найден. Будет использован при первом запросе рекомендаций.")
-            except Exception as e:
-                logger.error(f"Ошибка при загрузке Annoy-индекса: {str(e)}")
-                
         # Импортируем сигналы
         import music_app.signals
+
+
+def warm_up_vector_search():
+    """
+    Создает индексы хранилища векторов и загружает индекс выбранного бэкенда
+    поиска похожих треков, чтобы первый запрос рекомендаций не ждал загрузки.
+    
+    Returns:
+        bool: Успешность загрузки индекса
+    """
+    try:
+        # Уникальный индекс по track_id в коллекции векторов (идемпотентно)
+        from .vector_store import get_vector_store
+        get_vector_store().ensure_indexes()
+    except Exception as e:
+        logger.error(f"Ошибка при создании индексов MongoDB: {str(e)}")
+    
+    try:
+        # Импортируем здесь, чтобы избежать циклических импортов
+        from .vector_search import get_vector_backend
+        
+        # Пытаемся загрузить индекс выбранного бэкенда поиска похожих треков
+        backend = get_vector_backend()
+        loaded = backend.load()
+        if loaded:
+            index_info = backend.stats()
+            logger.info(
+                f"Индекс похожих треков ({backend.name}) успешно загружен. "
+                f"Треков в индексе: {index_info.get('indexed_tracks_count', 0)}"
+            )
+        else:
+            logger.warning("Индекс похожих треков не найден. Будет использован при первом запросе рекомендаций.")
+        return loaded
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке Annoy-индекса: {str(e)}")
+        return False
+
+
+def _refresh_vector_index(sender, **kwargs):
+    """Подхватывает изменения индекса похожих треков из других процессов перед обработкой запроса"""
+    from .vector_search import get_vector_backend
+    get_vector_backend().refresh()
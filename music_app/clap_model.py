@@ -4,6 +4,10 @@
 """
 Модуль clap_model.py
 Интерфейс для работы с CLAP моделью для анализа аудио.
+
+Модель загружается лениво - при первом использовании или явным прогревом
+warm_up() в процессах, которые считают эмбеддинги. Импорт модуля не
+загружает веса, поэтому команды manage.py и API-воркеры стартуют быстро.
 """
 
 import os
@@ -11,6 +15,7 @@ import numpy as np
 import time
 import logging
 import random
+import threading
 from pathlib import Path
 
 # Флаг доступности CLAP модели
@@ -23,20 +28,26 @@ class CLAPModel:
     Класс для работы с CLAP (Contrastive Language-Audio Pretraining) моделью.
     Предоставляет интерфейс для генерации эмбеддингов аудио.
     """
+    ENVELOPE_BINS = 1024  # Количество отсчетов огибающей сигнала на входе проекции
+    LOAD_RETRY_SECONDS = 30  # Пауза перед повторной ленивой загрузкой после ошибки
     
     def __init__(self):
         """
-        Инициализирует CLAP модель.
+        Инициализирует CLAP модель без загрузки весов.
         """
         self._is_loaded = False
         self._model = None
         self._processor = None
+        self._projection = None
         self._model_name = "laion/clap-htsat-unfused"
         self._model_version = "1.0.0"
         self._embedding_dim = 512
         
-        # Пытаемся загрузить модель при инициализации
-        self._load_model()
+        # Состояние загрузки: not_loaded, loading, ready или failed
+        self._state = "not_loaded"
+        self._load_lock = threading.Lock()
+        self._load_seconds = None
+        self._failed_at = None
     
     def _load_model(self):
         """
@@ -45,11 +56,19 @@ class CLAPModel:
         но для примера мы просто имитируем процесс загрузки.
         """
         logger.info(f"Загрузка CLAP модели {self._model_name}")
+        self._state = "loading"
+        started = time.perf_counter()
         
         try:
             # Имитация задержки загрузки модели
             time.sleep(1.5)
             
+            # Имитация весов модели: фиксированная случайная проекция огибающей
+            # сигнала, поэтому эмбеддинг одного и того же файла воспроизводим
+            self._projection = np.random.default_rng(0).standard_normal(
+                (self.ENVELOPE_BINS, self._embedding_dim)
+            ).astype(np.float32) / np.sqrt(self.ENVELOPE_BINS)
+            
             # Имитация успешной загрузки с вероятностью 90%
             if random.random() < 0.9:
                 self._is_loaded = True
@@ -61,24 +80,87 @@ class CLAPModel:
         except Exception as e:
             self._is_loaded = False
             logger.error(f"Ошибка при загрузке CLAP модели: {str(e)}")
+        
+        self._load_seconds = time.perf_counter() - started
+        self._state = "ready" if self._is_loaded else "failed"
+        self._failed_at = None if self._is_loaded else time.monotonic()
+    
+    def _ensure_loaded(self):
+        """
+        Загружает модель при первом использовании. После неудачной загрузки
+        повторная попытка делается не чаще раза в LOAD_RETRY_SECONDS.
+        
+        Returns:
+            bool: True, если модель готова к использованию
+        """
+        if self._is_loaded:
+            return True
+        
+        with self._load_lock:
+            retry_pending = (
+                self._failed_at is not None
+                and time.monotonic() - self._failed_at < self.LOAD_RETRY_SECONDS
+            )
+            if not self._is_loaded and not retry_pending:
+                self._load_model()
+        return self._is_loaded
+    
+    def warm_up(self):
+        """
+        Явно загружает модель заранее - вызывается в процессах, которые
+        считают эмбеддинги (воркеры Celery, команды пакетной обработки).
+        
+        Returns:
+            bool: True, если модель готова к использованию
+        """
+        with self._load_lock:
+            if not self._is_loaded:
+                self._load_model()
+        return self._is_loaded
     
     def reload_model(self):
         """
         Перезагружает модель CLAP.
         """
         logger.info("Перезагрузка CLAP модели")
-        self._is_loaded = False
-        self._load_model()
+        with self._load_lock:
+            self._is_loaded = False
+            self._load_model()
     
     def is_ready(self):
         """
-        Проверяет, готова ли модель к использованию.
+        Проверяет, готова ли модель к использованию. Не загружает модель.
         
         Returns:
             bool: True, если модель загружена и готова к использованию
         """
         return self._is_loaded
     
+    def get_status(self):
+        """
+        Возвращает состояние загрузки модели, не загружая ее.
+        
+        Returns:
+            dict: Состояние (not_loaded, loading, ready, failed) и время загрузки
+        """
+        return {
+            "name": self._model_name,
+            "version": self._model_version,
+            "state": self._state,
+            "ready": self._is_loaded,
+            "load_seconds": round(self._load_seconds, 2) if self._load_seconds is not None else None,
+        }
+    
+    def model_key(self):
+        """
+        Идентификатор модели для ключей кэша эмбеддингов: эмбеддинги
+        разных моделей и версий несовместимы между собой.
+        
+        Returns:
+            str: Строка вида "<имя модели>@<версия>"
+        """
+        return f"{self._model_name}@{self._model_version}"
+    
     def get_model_info(self):
         """
         Возвращает информацию о загруженной модели.
@@ -96,6 +178,32 @@ class CLAPModel:
             "status": "ready" if self._is_loaded else "not_loaded"
         }
     
+    def embed_waveforms(self, waveforms):
+        """
+        Считает эмбеддинги для пачки декодированных сигналов.
+        
+        Args:
+            waveforms (numpy.ndarray): Сигналы float32 размера B x T
+                (см. embedding_pipeline.load_audio)
+            
+        Returns:
+            numpy.ndarray: Нормализованные эмбеддинги float32 размера B x embedding_dim
+        """
+        if not self._ensure_loaded():
+            raise RuntimeError("CLAP модель не загружена")
+        
+        # Имитация инференса: огибающая сигнала проецируется в пространство эмбеддингов
+        # В реальности здесь бы использовалась настоящая CLAP модель
+        waveforms = np.asarray(waveforms, dtype=np.float32)
+        usable = waveforms.shape[1] // self.ENVELOPE_BINS * self.ENVELOPE_BINS
+        envelope = np.abs(waveforms[:, :usable]).reshape(len(waveforms), self.ENVELOPE_BINS, -1).mean(axis=2)
+        embeddings = envelope @ self._projection
+        
+        # Нормализуем для правдоподобности
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+    
     def generate_embedding(self, audio_path):
         """
         Генерирует эмбеддинг для аудиофайла.
@@ -106,7 +214,9 @@ class CLAPModel:
         Returns:
             numpy.ndarray: Эмбеддинг аудио или None в случае ошибки
         """
-        if not self._is_loaded:
+        from .embedding_pipeline import load_audio
+        
+        if not self._ensure_loaded():
             logger.error("CLAP модель не загружена")
             return None
             
@@ -119,15 +229,7 @@ class CLAPModel:
                 
             logger.info(f"Генерация эмбеддинга для {audio_path}")
             
-            # Имитация процесса обработки аудио и генерации эмбеддинга
-            time.sleep(0.5)  # Имитация задержки обработки
-            
-            # Генерируем случайный эмбеддинг для демонстрации
-            # В реальности здесь бы использовалась настоящая CLAP модель
-            embedding = np.random.randn(self._embedding_dim)
-            
-            # Нормализуем для правдоподобности
-            embedding = embedding / np.linalg.norm(embedding)
+            embedding = self.embed_waveforms(load_audio(audio_path)[np.newaxis, :])[0]
             
             logger.info(f"Эмбеддинг успешно сгенерирован для {audio_path}")
             return embedding
@@ -136,26 +238,51 @@ class CLAPModel:
             logger.error(f"Ошибка при генерации эмбеддинга: {str(e)}")
             return None
     
-    def batch_generate_embeddings(self, audio_paths):
+    def iter_embeddings(self, audio_paths, batch_size=None, workers=None):
+        """
+        Генерирует эмбеддинги для множества файлов конвейером: декодирование
+        в пуле процессов идет параллельно с инференсом пачками. Результаты
+        отдаются по мере готовности (порядок файлов не сохраняется).
+        
+        Для статистики по стадиям используйте EmbeddingPipeline напрямую.
+        
+        Args:
+            audio_paths: Итерируемый набор путей к аудиофайлам
+            batch_size (int): Размер пачки для модели
+            workers (int): Количество процессов декодирования
+            
+        Yields:
+            tuple: (путь к файлу, эмбеддинг или None при ошибке)
+        """
+        from .embedding_pipeline import EmbeddingPipeline
+        
+        if not self._ensure_loaded():
+            logger.error("CLAP модель не загружена")
+            return
+        
+        yield from EmbeddingPipeline(self, batch_size=batch_size, workers=workers).run(audio_paths)
+    
+    def batch_generate_embeddings(self, audio_paths, batch_size=None, workers=None):
         """
         Генерирует эмбеддинги для нескольких аудиофайлов.
         
         Args:
             audio_paths (list): Список путей к аудиофайлам
+            batch_size (int): Размер пачки для модели
+            workers (int): Количество процессов декодирования
             
         Returns:
             dict: Словарь с путями к файлам в качестве ключей и их эмбеддингами в качестве значений
         """
-        if not self._is_loaded:
+        if not self._ensure_loaded():
             logger.error("CLAP модель не загружена")
             return {}
             
-        embeddings = {}
-        
-        for audio_path in audio_paths:
-            embedding = self.generate_embedding(audio_path)
-            if embedding is not None:
-                embeddings[audio_path] = embedding
+        embeddings = {
+            audio_path: embedding
+            for audio_path, embedding in self.iter_embeddings(audio_paths, batch_size, workers)
+            if embedding is not None
+        }
                 
         logger.info(f"Сгенерировано {len(embeddings)} эмбеддингов из {len(audio_paths)} файлов")
         return embeddings
@@ -171,7 +298,7 @@ class CLAPModel:
         Returns:
             float: Значение сходства между аудио и текстом или None в случае ошибки
         """
-        if not self._is_loaded:
+        if not self._ensure_loaded():
             logger.error("CLAP модель не загружена")
             return None
             
@@ -193,4 +320,5 @@ class CLAPModel:
             return None
 
 # Создаем единственный экземпляр модели для использования во всем приложении
+# (веса загружаются при первом использовании или через warm_up)
 clap_model = CLAPModel() 
\ No newline at end of file
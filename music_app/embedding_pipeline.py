@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Модуль embedding_pipeline.py
+Конвейер пакетной генерации эмбеддингов аудио.
+
+Три стадии работают одновременно:
+1. Пул процессов декодирует и ресэмплирует аудиофайлы (load_audio).
+2. Декодированные сигналы через ограниченную очередь собираются
+   в пачки фиксированного размера для модели.
+3. Модель считает эмбеддинги пачки, а результаты по мере готовности
+   отдаются генератором, поэтому вызывающий код может сохранять их сразу.
+
+Модуль не импортирует модель и Django-настройки на верхнем уровне:
+его загружают процессы пула.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+try:
+    import torchaudio
+    TORCHAUDIO_AVAILABLE = True
+except ImportError:
+    TORCHAUDIO_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 48000   # Частота дискретизации входа CLAP
+CLIP_SECONDS = 10     # Длительность фрагмента, который видит модель
+
+
+def load_audio(audio_path, sample_rate=SAMPLE_RATE, clip_seconds=CLIP_SECONDS):
+    """
+    Декодирует аудиофайл в моно-сигнал float32 фиксированной длины
+    с частотой sample_rate (короткие файлы дополняются нулями).
+
+    Без torchaudio файл читается как сырые байты - демонстрационный режим,
+    как и сама модель.
+
+    Args:
+        audio_path (str): Путь к аудиофайлу
+        sample_rate (int): Целевая частота дискретизации
+        clip_seconds (float): Длительность фрагмента в секундах
+
+    Returns:
+        numpy.ndarray: Сигнал float32 длиной sample_rate * clip_seconds
+    """
+    num_samples = int(sample_rate * clip_seconds)
+
+    if TORCHAUDIO_AVAILABLE:
+        # Декодируется только фрагмент, который увидит модель
+        source_rate = torchaudio.info(audio_path).sample_rate
+        waveform, source_rate = torchaudio.load(audio_path, num_frames=int(source_rate * clip_seconds))
+        waveform = waveform.mean(dim=0)
+        if source_rate != sample_rate:
+            waveform = torchaudio.functional.resample(waveform, source_rate, sample_rate)
+        samples = waveform.numpy().astype(np.float32, copy=False)
+    else:
+        raw = np.fromfile(audio_path, dtype=np.uint8, count=num_samples)
+        samples = (raw.astype(np.float32) - 128.0) / 128.0
+
+    clip = np.zeros(num_samples, dtype=np.float32)
+    length = min(len(samples), num_samples)
+    clip[:length] = samples[:length]
+    return clip
+
+
+def _decode(audio_path, sample_rate, clip_seconds):
+    """
+    Задача процесса пула: декодирует файл и замеряет время.
+
+    Returns:
+        tuple: (путь, сигнал или None, время декодирования, текст ошибки или None)
+    """
+    started = time.perf_counter()
+    try:
+        waveform = load_audio(audio_path, sample_rate, clip_seconds)
+        return audio_path, waveform, time.perf_counter() - started, None
+    except Exception as e:
+        return audio_path, None, time.perf_counter() - started, str(e)
+
+
+class PipelineStats:
+    """Статистика конвейера: количество файлов и время стадий"""
+
+    def __init__(self):
+        self.files = 0
+        self.failed = 0
+        self.batches = 0
+        self.decode_seconds = 0.0     # Суммарное время декодирования во всех процессах
+        self.wait_seconds = 0.0       # Время, которое модель ждала данные из очереди
+        self.inference_seconds = 0.0  # Время работы модели
+        self.elapsed_seconds = 0.0
+
+    @property
+    def files_per_second(self):
+        return self.files / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def as_dict(self):
+        return {
+            'files': self.files,
+            'failed': self.failed,
+            'batches': self.batches,
+            'files_per_second': round(self.files_per_second, 2),
+            'decode_seconds': round(self.decode_seconds, 2),
+            'wait_seconds': round(self.wait_seconds, 2),
+            'inference_seconds': round(self.inference_seconds, 2),
+            'elapsed_seconds': round(self.elapsed_seconds, 2),
+        }
+
+
+class EmbeddingPipeline:
+    """
+    Конвейер пакетной генерации эмбеддингов.
+
+    Очередь между декодированием и моделью ограничена prefetch_batches
+    пачками: если модель не успевает, процессы пула перестают получать
+    новые файлы, и память не растет. Если wait_seconds близко к нулю,
+    скорость ограничена моделью, а не чтением файлов.
+    """
+    BATCH_SIZE = 16
+    PREFETCH_BATCHES = 4
+    _DONE = object()
+
+    def __init__(self, model, batch_size=None, workers=None, prefetch_batches=None,
+                 sample_rate=SAMPLE_RATE, clip_seconds=CLIP_SECONDS):
+        """
+        Args:
+            model: Модель с методом embed_waveforms(numpy-массив B x T) -> B x D
+            batch_size: Размер пачки для модели
+            workers: Количество процессов декодирования (по умолчанию число ядер - 1)
+            prefetch_batches: Сколько пачек может ждать модель в очереди
+            sample_rate: Частота дискретизации входа модели
+            clip_seconds: Длительность фрагмента в секундах
+        """
+        self.model = model
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.prefetch_batches = prefetch_batches or self.PREFETCH_BATCHES
+        self.sample_rate = sample_rate
+        self.clip_seconds = clip_seconds
+        self.stats = PipelineStats()
+
+    def _produce(self, audio_paths, results, stop_event):
+        """
+        Стадия декодирования: отправляет файлы в пул процессов, держа в работе
+        не больше 2 * workers задач, и складывает результаты в очередь.
+        """
+        # spawn: дочерние процессы не наследуют потоки, соединения с БД и состояние модели
+        context = multiprocessing.get_context('spawn')
+        paths = iter(audio_paths)
+        in_flight = set()
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+                while not stop_event.is_set():
+                    for audio_path in paths:
+                        in_flight.add(pool.submit(_decode, audio_path, self.sample_rate, self.clip_seconds))
+                        if len(in_flight) >= 2 * self.workers:
+                            break
+                    if not in_flight:
+                        break
+
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._put(results, future.result(), stop_event)
+
+                for future in in_flight:
+                    future.cancel()
+        except Exception as e:
+            logger.error(f"Ошибка стадии декодирования конвейера эмбеддингов: {str(e)}")
+        finally:
+            self._put(results, self._DONE, stop_event)
+
+    @staticmethod
+    def _put(results, item, stop_event):
+        """Кладет элемент в ограниченную очередь, пока конвейер не остановлен"""
+        while not stop_event.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _embed(self, batch):
+        """Стадия модели: считает эмбеддинги пачки сигналов"""
+        paths = [audio_path for audio_path, _ in batch]
+        started = time.perf_counter()
+        try:
+            embeddings = self.model.embed_waveforms(np.stack([waveform for _, waveform in batch]))
+        except Exception as e:
+            logger.error(f"Ошибка модели при обработке пачки из {len(batch)} файлов: {str(e)}")
+            embeddings = [None] * len(batch)
+        self.stats.inference_seconds += time.perf_counter() - started
+        self.stats.batches += 1
+
+        for audio_path, embedding in zip(paths, embeddings):
+            if embedding is None:
+                self.stats.failed += 1
+            else:
+                self.stats.files += 1
+            yield audio_path, embedding
+
+    def run(self, audio_paths):
+        """
+        Генерирует эмбеддинги для файлов по мере готовности (порядок не сохраняется).
+
+        Args:
+            audio_paths: Итерируемый набор путей к аудиофайлам
+
+        Yields:
+            tuple: (путь к файлу, numpy-массив эмбеддинга или None при ошибке)
+        """
+        self.stats = PipelineStats()
+        started = time.perf_counter()
+        results = queue.Queue(maxsize=self.batch_size * self.prefetch_batches)
+        stop_event = threading.Event()
+        producer = threading.Thread(
+            target=self._produce, args=(audio_paths, results, stop_event),
+            name='embedding-decode', daemon=True
+        )
+        producer.start()
+
+        batch = []
+        try:
+            while True:
+                wait_started = time.perf_counter()
+                item = results.get()
+                self.stats.wait_seconds += time.perf_counter() - wait_started
+
+                if item is self._DONE:
+                    break
+
+                audio_path, waveform, decode_seconds, error = item
+                self.stats.decode_seconds += decode_seconds
+                if waveform is None:
+                    logger.error(f"Не удалось декодировать {audio_path}: {error}")
+                    self.stats.failed += 1
+                    yield audio_path, None
+                    continue
+
+                batch.append((audio_path, waveform))
+                if len(batch) >= self.batch_size:
+                    yield from self._embed(batch)
+                    batch = []
+
+            if batch:
+                yield from self._embed(batch)
+        finally:
+            # Вызывающий код мог прервать перебор: останавливаем декодирование
+            stop_event.set()
+            producer.join()
+            self.stats.elapsed_seconds = time.perf_counter() - started
+            logger.info(f"Конвейер эмбеддингов завершен: {self.stats.as_dict()}")
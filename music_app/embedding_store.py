@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Модуль embedding_store.py
+Дисковое хранилище эмбеддингов в бинарных шардах.
+
+Эмбеддинги записываются в конец шардов - файлов из записей float32
+фиксированного размера, которые можно отобразить в память (numpy.memmap).
+Небольшой манифест SQLite хранит для ключа номер шарда и позицию записи,
+поэтому получение списка, статистика и загрузка всей матрицы - это
+последовательное чтение, а не разбор тысяч JSON-файлов.
+
+Хранилище рассчитано на запись из нескольких потоков и процессов:
+запись в шард и обновление манифеста выполняются под транзакцией
+BEGIN IMMEDIATE, а конец хранилища сдвигается только после записи данных.
+"""
+
+import os
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DTYPE = np.float32
+
+
+class ShardedEmbeddingStore:
+    """
+    Хранилище эмбеддингов одной модели: шарды записей float32 и манифест SQLite.
+
+    Хранилище только дописывается: перезапись ключа добавляет новую запись,
+    удаление убирает ключ из манифеста, а старые записи остаются в шардах
+    (учитываются как garbage_records в статистике).
+    """
+    SHARD_RECORDS = 65536  # Записей в одном шарде (32 МБ на шард при размерности 128, 128 МБ при 512)
+    MANIFEST_NAME = 'manifest.sqlite3'
+    SHARD_SUFFIX = '.f32'
+
+    def __init__(self, root, shard_records=None):
+        """
+        Args:
+            root: Директория хранилища
+            shard_records: Количество записей в одном шарде
+        """
+        self.root = Path(root)
+        self.shard_records = shard_records or self.SHARD_RECORDS
+        self.manifest_path = self.root / self.MANIFEST_NAME
+        self._local = threading.local()
+
+    def _connect(self):
+        """
+        Возвращает соединение с манифестом для текущего потока
+        (после fork соединение открывается заново).
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.manifest_path), timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS records ('
+            'key TEXT PRIMARY KEY, shard INTEGER NOT NULL, position INTEGER NOT NULL, '
+            'audio_path TEXT, created_at TEXT)'
+        )
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _get_meta(conn, name, default=None):
+        row = conn.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else default
+
+    @staticmethod
+    def _set_meta(conn, name, value):
+        conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, int(value)))
+
+    def _shard_path(self, shard):
+        return self.root / f"shard-{shard:05d}{self.SHARD_SUFFIX}"
+
+    @property
+    def dim(self):
+        """Размерность эмбеддингов хранилища или None, если оно пустое"""
+        return self._get_meta(self._connect(), 'dim')
+
+    def put(self, key, embedding, audio_path=None):
+        """
+        Сохраняет эмбеддинг под ключом.
+
+        Args:
+            key (str): Ключ эмбеддинга (хэш содержимого аудиофайла)
+            embedding: Вектор эмбеддинга
+            audio_path (str): Путь к аудиофайлу (для справки)
+        """
+        self.put_many([(key, embedding, audio_path)])
+
+    def put_many(self, items):
+        """
+        Сохраняет несколько эмбеддингов одной транзакцией.
+
+        Args:
+            items: Список кортежей (ключ, эмбеддинг, путь к аудиофайлу)
+
+        Raises:
+            ValueError: Если размерность эмбеддинга не совпадает с размерностью хранилища
+        """
+        if not items:
+            return
+
+        vectors = np.stack([np.asarray(embedding, dtype=DTYPE).ravel() for _, embedding, _ in items])
+        created_at = datetime.now().isoformat()
+        conn = self._connect()
+
+        # BEGIN IMMEDIATE сериализует запись между процессами
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            dim = self._get_meta(conn, 'dim')
+            if dim is None:
+                dim = vectors.shape[1]
+                self._set_meta(conn, 'dim', dim)
+            if vectors.shape[1] != dim:
+                raise ValueError(f"Размерность эмбеддинга {vectors.shape[1]} не совпадает с размерностью хранилища {dim}")
+
+            shard = self._get_meta(conn, 'tail_shard', 0)
+            offset = self._get_meta(conn, 'tail_offset', 0)
+            record_bytes = dim * DTYPE().itemsize
+            rows = []
+
+            start = 0
+            while start < len(items):
+                count = min(len(items) - start, self.shard_records - offset)
+                path = self._shard_path(shard)
+                # Данные пишутся по позиции конца из манифеста: запись, не попавшая
+                # в манифест из-за сбоя, будет просто перезаписана
+                with open(path, 'r+b' if path.exists() else 'wb') as f:
+                    f.seek(offset * record_bytes)
+                    f.write(vectors[start:start + count].tobytes())
+                rows.extend(
+                    (key, shard, offset + i, audio_path, created_at)
+                    for i, (key, _, audio_path) in enumerate(items[start:start + count])
+                )
+                start += count
+                offset += count
+                if offset >= self.shard_records:
+                    shard, offset = shard + 1, 0
+
+            conn.executemany(
+                'INSERT OR REPLACE INTO records (key, shard, position, audio_path, created_at) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            self._set_meta(conn, 'tail_shard', shard)
+            self._set_meta(conn, 'tail_offset', offset)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get(self, key):
+        """
+        Загружает эмбеддинг по ключу.
+
+        Returns:
+            numpy.ndarray: Эмбеддинг float32 или None, если ключа нет
+        """
+        conn = self._connect()
+        row = conn.execute('SELECT shard, position FROM records WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        dim = self._get_meta(conn, 'dim')
+        shard, offset = row
+        return np.fromfile(
+            str(self._shard_path(shard)), dtype=DTYPE, count=dim, offset=offset * dim * DTYPE().itemsize
+        )
+
+    def get_metadata(self, key):
+        """
+        Возвращает метаданные записи без чтения самого эмбеддинга.
+
+        Returns:
+            dict: Ключ, путь к аудиофайлу, время создания, шард и позиция или None
+        """
+        row = self._connect().execute(
+            'SELECT key, audio_path, created_at, shard, position FROM records WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "key": row[0],
+            "audio_path": row[1],
+            "created_at": row[2],
+            "file": str(self._shard_path(row[3])),
+            "offset": row[4],
+        }
+
+    def delete(self, key):
+        """
+        Удаляет ключ из манифеста.
+
+        Returns:
+            bool: True, если ключ был в хранилище
+        """
+        cursor = self._connect().execute('DELETE FROM records WHERE key = ?', (key,))
+        return cursor.rowcount > 0
+
+    def __contains__(self, key):
+        return self._connect().execute('SELECT 1 FROM records WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def list(self):
+        """
+        Перебирает метаданные всех записей в порядке их расположения в шардах.
+
+        Yields:
+            dict: Метаданные записи (см. get_metadata)
+        """
+        rows = self._connect().execute(
+            'SELECT key, audio_path, created_at, shard, position FROM records ORDER BY shard, position'
+        )
+        for key, audio_path, created_at, shard, offset in rows:
+            yield {
+                "key": key,
+                "audio_path": audio_path,
+                "created_at": created_at,
+                "file": str(self._shard_path(shard)),
+                "offset": offset,
+            }
+
+    def load_matrix(self):
+        """
+        Загружает все эмбеддинги хранилища одной матрицей: каждый шард
+        отображается в память и читается последовательно.
+
+        Returns:
+            tuple: (список ключей, numpy-матрица float32 размера N x dim)
+        """
+        conn = self._connect()
+        dim = self._get_meta(conn, 'dim')
+        rows = conn.execute('SELECT key, shard, position FROM records ORDER BY shard, position').fetchall()
+        if not rows:
+            return [], np.empty((0, dim or 0), dtype=DTYPE)
+
+        keys = [key for key, _, _ in rows]
+        shards = np.array([shard for _, shard, _ in rows])
+        offsets = np.array([offset for _, _, offset in rows])
+        matrix = np.empty((len(rows), dim), dtype=DTYPE)
+
+        for shard in np.unique(shards):
+            path = self._shard_path(int(shard))
+            mapped = np.memmap(path, dtype=DTYPE, mode='r', shape=(path.stat().st_size // (dim * DTYPE().itemsize), dim))
+            positions = np.flatnonzero(shards == shard)
+            matrix[positions] = mapped[offsets[positions]]
+            del mapped
+
+        return keys, matrix
+
+    def stats(self):
+        """
+        Возвращает статистику хранилища.
+
+        Returns:
+            dict: Количество записей, шардов, размер на диске и число устаревших записей
+        """
+        conn = self._connect()
+        count = conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        written = (
+            self._get_meta(conn, 'tail_shard', 0) * self.shard_records
+            + self._get_meta(conn, 'tail_offset', 0)
+        )
+        shard_files = list(self.root.glob(f"shard-*{self.SHARD_SUFFIX}"))
+        shards_bytes = sum(path.stat().st_size for path in shard_files)
+        manifest_bytes = sum(
+            path.stat().st_size for path in self.root.glob(f"{self.MANIFEST_NAME}*")
+        )
+        return {
+            "count": count,
+            "dim": self._get_meta(conn, 'dim'),
+            "shards": len(shard_files),
+            "shards_bytes": shards_bytes,
+            "manifest_bytes": manifest_bytes,
+            "garbage_records": written - count,
+        }
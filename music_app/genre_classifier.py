@@ -1,5 +1,6 @@
 import logging
 import random
+import threading
 import numpy as np
 
 logger = logging.getLogger(__name__)
@@ -26,12 +27,30 @@ class GenreClassifier:
         return cls._instance
     
     def _init(self):
-        """Инициализация атрибутов класса"""
+        """Инициализация атрибутов класса (модель загружается при первом использовании)"""
+        self.model_loaded = False
+        self._load_lock = threading.Lock()
+    
+    def _load_model(self):
+        """Загружает модель классификатора жанров"""
         logger.info("Инициализирована заглушка классификатора жанров")
         self.model_loaded = True
+    
+    def warm_up(self):
+        """
+        Явно загружает модель заранее (в воркерах, которые обрабатывают треки).
+        
+        Returns:
+            bool: True, если модель загружена
+        """
+        if not self.model_loaded:
+            with self._load_lock:
+                if not self.model_loaded:
+                    self._load_model()
+        return self.model_loaded
         
     def is_model_loaded(self):
-        """Проверяет, загружена ли модель"""
+        """Проверяет, загружена ли модель (не загружает ее)"""
         return self.model_loaded
     
     def predict_genre(self, audio_path=None, embedding=None):
@@ -45,6 +64,8 @@ class GenreClassifier:
         Returns:
             dict: Словарь с предсказанными жанрами и их вероятностями
         """
+        self.warm_up()
+        
         if audio_path:
             logger.info(f"Прогнозирование жанра для аудиофайла: {audio_path}")
         elif embedding is not None:
@@ -121,4 +142,5 @@ class GenreClassifier:
         }
 
 # Создаем и экспортируем синглтон для глобального использования
+# (модель загружается при первом предсказании или через warm_up)
 genre_classifier = GenreClassifier() 
\ No newline at end of file
@@ -137,8 +137,9 @@ def main():
     # Инициализируем менеджер эмбеддингов
     embeddings_manager = TrackEmbeddings(args.embeddings_dir)
     
-    # Выводим информацию о модели
+    # Загружаем модель заранее и выводим информацию о ней
     logger.info("Запуск приложения для работы с аудио-эмбеддингами")
+    clap_model.warm_up()
     get_model_info()
     
     # Проверяем, готова ли CLAP модель
@@ -1,7 +1,7 @@
 import logging
 from django.core.management.base import BaseCommand
 from music_app.services import TrackVectorService
-from music_app.annoy_index import annoy_index
+from music_app.annoy_index import annoy_index, get_peak_rss_mb
 
 logger = logging.getLogger(__name__)
 
@@ -14,21 +14,37 @@ class Command(BaseCommand):
             action='store_true',
             help='Принудительно перестроить индекс, даже если он уже существует'
         )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=None,
+            help='Количество потоков построения деревьев (-1 - все ядра, по умолчанию ANNOY_BUILD_JOBS)'
+        )
+        parser.add_argument(
+            '--on-disk',
+            action='store_true',
+            help='Строить индекс на диске с потоковой загрузкой векторов (для каталогов больше RAM)'
+        )
 
     def handle(self, *args, **options):
         force = options.get('force', False)
-        self.stdout.write(f"Начинаем построение Annoy-индекса{'(принудительно)' if force else ''}...")
+        on_disk = options.get('on_disk', False)
+        self.stdout.write(
+            f"Начинаем построение Annoy-индекса{'(принудительно)' if force else ''}"
+            f"{' на диске' if on_disk else ''}..."
+        )
         
         try:
             # Строим индекс
-            if annoy_index.build_index(force=force):
+            if annoy_index.build_index(force=force, n_jobs=options.get('jobs'), on_disk=on_disk, progress=self._report_progress):
                 # Получаем информацию об индексе
                 index_info = annoy_index.get_index_info()
                 
                 self.stdout.write(self.style.SUCCESS(
                     f"Индекс успешно построен. "
                     f"Проиндексировано треков: {index_info.get('indexed_tracks_count', 0)}. "
-                    f"Размер индекса: {index_info.get('index_file_size_mb', 0)} МБ."
+                    f"Размер индекса: {index_info.get('index_file_size_mb', 0)} МБ. "
+                    f"Пиковое потребление памяти: {get_peak_rss_mb()} МБ."
                 ))
                 
                 # Выводим подробную информацию об индексе
@@ -41,4 +57,16 @@ class Command(BaseCommand):
                 
         except Exception as e:
             self.stdout.write(self.style.ERROR(f"Ошибка при построении индекса: {str(e)}"))
-            logger.error(f"Ошибка при построении индекса: {str(e)}", exc_info=True) 
\ No newline at end of file
+            logger.error(f"Ошибка при построении индекса: {str(e)}", exc_info=True)
+
+    def _report_progress(self, stage, done, total):
+        """Выводит ход построения индекса и текущее пиковое потребление памяти"""
+        stages = {
+            'load': 'Загрузка векторов',
+            'build': 'Построение деревьев',
+            'neighbors': 'Вычисление таблицы соседей',
+            'save': 'Сохранение файлов поколения',
+        }
+        self.stdout.write(
+            f"  {stages.get(stage, stage)}: {done}/{total} (пиковый RSS {get_peak_rss_mb()} МБ)"
+        )
@@ -0,0 +1,62 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from music_app.vector_store import STORES, get_vector_store
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Копирует векторные представления треков между хранилищами '
+        '(MongoDB и таблица TrackEmbedding основной БД)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from',
+            dest='source',
+            choices=list(STORES),
+            required=True,
+            help='Исходное хранилище'
+        )
+        parser.add_argument(
+            '--to',
+            dest='target',
+            choices=list(STORES),
+            required=True,
+            help='Целевое хранилище'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Количество треков, читаемых и записываемых одним запросом'
+        )
+
+    def handle(self, *args, **options):
+        if options['source'] == options['target']:
+            raise CommandError("Исходное и целевое хранилища совпадают")
+
+        source = get_vector_store(options['source'])
+        target = get_vector_store(options['target'])
+        batch_size = options['batch_size']
+
+        track_ids = sorted(source.existing_track_ids())
+        self.stdout.write(f"Треков с эмбеддингами в хранилище {options['source']}: {len(track_ids)}")
+
+        copied = 0
+        failed = 0
+        for start in range(0, len(track_ids), batch_size):
+            vectors = source.get_track_vectors(track_ids[start:start + batch_size])
+            batch = [{'track_id': track_id, 'vector': vector} for track_id, vector in vectors.items()]
+            result = target.bulk_upsert(batch)
+            if result is None:
+                failed += len(batch)
+            else:
+                copied += result['upserted'] + result['modified']
+            self.stdout.write(f"  Обработано {min(start + batch_size, len(track_ids))}/{len(track_ids)}")
+
+        message = f"Скопировано векторов: {copied}, ошибок: {failed}"
+        if failed:
+            raise CommandError(message)
+        self.stdout.write(self.style.SUCCESS(message))
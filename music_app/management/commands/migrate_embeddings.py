@@ -0,0 +1,106 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from music_app.mongodb import TrackVectors, encode_embedding, decode_embedding
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Конвертирует эмбеддинги в коллекции векторов треков между форматами хранения: '
+        'массив double (array, нужен для MongoDB Atlas $vectorSearch) и float32 BSON Binary '
+        'с заголовком (binary, в ~4 раза компактнее, без $vectorSearch). После конвертации '
+        'задайте тот же формат в TRACK_VECTORS_EMBEDDING_FORMAT'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--to',
+            choices=['binary', 'array'],
+            required=True,
+            help='Целевой формат хранения эмбеддингов'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Количество документов, обновляемых одним bulk_write'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только посчитать документы, которые нужно конвертировать'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            from pymongo import UpdateOne
+        except ImportError:
+            raise CommandError("PyMongo недоступен, миграция невозможна")
+
+        target = options['to']
+        batch_size = options['batch_size']
+        collection = TrackVectors.get_collection()
+
+        # Выбираем только документы в исходном формате, поэтому команду можно прерывать и перезапускать
+        source_type = 'array' if target == 'binary' else 'binData'
+        query = {'vector.embedding': {'$type': source_type}}
+
+        total = collection.count_documents(query)
+        self.stdout.write(f"Документов для конвертации в формат {target}: {total}")
+        if options['dry_run'] or total == 0:
+            return
+
+        cursor = collection.find(query, {'_id': 1, 'vector.embedding': 1}).batch_size(batch_size)
+
+        converted = 0
+        bytes_before = 0
+        bytes_after = 0
+        operations = []
+        for doc in cursor:
+            embedding = decode_embedding(doc['vector']['embedding'])
+            if embedding is None:
+                continue
+
+            if target == 'binary':
+                value = encode_embedding(embedding)
+                bytes_before += 8 * len(embedding)
+                bytes_after += len(value)
+            else:
+                value = embedding.tolist()
+                bytes_before += len(doc['vector']['embedding'])
+                bytes_after += 8 * len(embedding)
+
+            operations.append(UpdateOne({'_id': doc['_id']}, {'$set': {'vector.embedding': value}}))
+            if len(operations) >= batch_size:
+                converted += self._flush(collection, operations)
+                self.stdout.write(f"  Конвертировано {converted}/{total}")
+
+        if operations:
+            converted += self._flush(collection, operations)
+
+        TrackVectors.invalidate_matrix_cache()
+        self.stdout.write(self.style.SUCCESS(
+            f"Конвертировано документов: {converted}. Размер значений эмбеддингов: "
+            f"{bytes_before / (1024 * 1024):.1f} МБ -> {bytes_after / (1024 * 1024):.1f} МБ"
+        ))
+        self._warn_format_mismatch(target)
+
+    def _warn_format_mismatch(self, target):
+        """Предупреждает, если новые векторы будут записываться в другом формате"""
+        if TrackVectors.get_embedding_format() != target:
+            self.stdout.write(self.style.WARNING(
+                f"TRACK_VECTORS_EMBEDDING_FORMAT = {TrackVectors.get_embedding_format()}: новые векторы "
+                f"будут сохраняться в другом формате. Задайте TRACK_VECTORS_EMBEDDING_FORMAT={target}"
+            ))
+        if target == 'binary':
+            self.stdout.write(self.style.WARNING(
+                "MongoDB Atlas $vectorSearch не индексирует бинарные эмбеддинги: поиск без "
+                "индекса похожих треков будет идти полным перебором"
+            ))
+
+    def _flush(self, collection, operations):
+        """Отправляет пачку обновлений одним запросом и очищает ее"""
+        result = collection.bulk_write(operations, ordered=False)
+        operations.clear()
+        return result.modified_count
@@ -0,0 +1,46 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from music_app.annoy_index import annoy_index, get_peak_rss_mb
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Вычисляет таблицу top-K похожих треков для текущего поколения Annoy-индекса. '
+        'Запросы похожих треков читают ее вместо поиска по индексу'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--k',
+            type=int,
+            default=None,
+            help='Количество соседей на трек (по умолчанию ANNOY_NEIGHBORS_K)'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=-1,
+            help='Количество потоков (-1 - все ядра)'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Вычисляем таблицу соседей для текущего поколения индекса...")
+
+        if not annoy_index.precompute_neighbors(k=options['k'], n_jobs=options['jobs'], progress=self._report_progress):
+            raise CommandError("Не удалось вычислить таблицу соседей. Проверьте логи для получения дополнительной информации.")
+
+        index_info = annoy_index.get_index_info()
+        self.stdout.write(self.style.SUCCESS(
+            f"Таблица соседей сохранена: поколение {index_info.get('generation')}, "
+            f"соседей на трек: {index_info.get('neighbors_k')}. "
+            f"Пиковое потребление памяти: {get_peak_rss_mb()} МБ."
+        ))
+
+    def _report_progress(self, stage, done, total):
+        """Выводит ход вычисления каждые 10%"""
+        percent = done * 100 // max(total, 1)
+        if percent // 10 != getattr(self, '_last_percent', -1) // 10:
+            self._last_percent = percent
+            self.stdout.write(f"  {done}/{total} ({percent}%)")
@@ -0,0 +1,67 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from music_app.models import Track
+from music_app.vector_store import get_vector_store
+from music_app.services import TrackVectorService
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Векторизует треки и сохраняет векторы в MongoDB пачками '
+        '(один bulk_write на пачку)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'track_ids',
+            nargs='*',
+            type=int,
+            help='ID треков для обработки'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Обработать все треки с аудиофайлами'
+        )
+        parser.add_argument(
+            '--missing',
+            action='store_true',
+            help='Обработать только треки, для которых еще нет векторов в MongoDB'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Количество треков в одной пачке записи (по умолчанию TRACK_VECTORS_BATCH_SIZE)'
+        )
+
+    def handle(self, *args, **options):
+        if options['track_ids']:
+            track_ids = options['track_ids']
+        elif options['all'] or options['missing']:
+            track_ids = list(
+                Track.objects.exclude(audio_file='').exclude(audio_file__isnull=True).values_list('id', flat=True)
+            )
+        else:
+            raise CommandError("Укажите ID треков, --all или --missing")
+
+        if options['missing']:
+            existing = get_vector_store().existing_track_ids()
+            track_ids = [track_id for track_id in track_ids if track_id not in existing]
+
+        self.stdout.write(f"Треков для обработки: {len(track_ids)}")
+        stats = TrackVectorService.process_tracks(track_ids, batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Обработано: {stats['processed']}, сохранено: {stats['saved']}, "
+            f"из кэша эмбеддингов: {stats['cached']}, без эмбеддинга: {stats['skipped']}, "
+            f"ошибок: {stats['failed']}"
+        ))
+        pipeline = stats['pipeline']
+        self.stdout.write(
+            f"Конвейер эмбеддингов: {pipeline['files_per_second']} файлов/с, "
+            f"декодирование {pipeline['decode_seconds']} с, ожидание данных {pipeline['wait_seconds']} с, "
+            f"инференс {pipeline['inference_seconds']} с, всего {pipeline['elapsed_seconds']} с"
+        )
@@ -0,0 +1,82 @@
+import signal
+import logging
+import threading
+from django.core.management.base import BaseCommand
+from music_app.vector_store import get_vector_store
+from music_app.vector_sync import VectorIndexSync
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Синхронизирует индекс похожих треков с коллекцией векторов: читает change stream MongoDB '
+        'или outbox VectorChange и пакетно применяет изменения к индексу'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--name',
+            default=None,
+            help='Имя воркера, под которым сохраняется позиция (по умолчанию VECTOR_SYNC_NAME)'
+        )
+        parser.add_argument(
+            '--source',
+            choices=['auto', 'outbox', 'change_stream'],
+            default=None,
+            help='Источник изменений (по умолчанию VECTOR_SYNC_SOURCE)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Максимальное количество изменений в одном пакете'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=None,
+            help='Пауза между опросами, когда новых изменений нет (секунды)'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Применить один пакет изменений и завершиться'
+        )
+        parser.add_argument(
+            '--status',
+            action='store_true',
+            help='Показать позицию и отставание воркера'
+        )
+
+    def handle(self, *args, **options):
+        sync = VectorIndexSync(
+            name=options['name'],
+            source=options['source'],
+            batch_size=options['batch_size']
+        )
+
+        if options['status']:
+            for key, value in sync.status().items():
+                self.stdout.write(f"  {key}: {value}")
+            return
+
+        # Воркер - единственный писатель индекса: индексы хранилища создаются
+        # при его старте, а не при импорте Django в каждом процессе
+        get_vector_store().ensure_indexes()
+
+        if options['once']:
+            stats = sync.run_once()
+            if stats is None:
+                self.stdout.write(self.style.WARNING("Пакет отложен и будет повторен"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"Применено изменений: {stats['events']}"))
+            return
+
+        stop_event = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop_event.set())
+
+        self.stdout.write(f"Воркер синхронизации {sync.name} запущен (источник: {sync.source.name})")
+        sync.run(poll_interval=options['interval'], stop_event=stop_event)
+        self.stdout.write(self.style.SUCCESS("Воркер синхронизации остановлен"))
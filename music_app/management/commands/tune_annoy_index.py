@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import numpy as np
+from datetime import datetime
+from annoy import AnnoyIndex
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from music_app.annoy_index import TrackAnnoyIndex
+from music_app.vector_store import get_vector_store
+from music_app.quantization import ScalarQuantizer, quantized_search, evaluate_recall
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_int_list(value):
+    """Разбирает список целых чисел через запятую"""
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def _exact_neighbors(matrix, query_rows, k, block_size=256):
+    """
+    Находит точных k ближайших соседей (по косинусу) для строк query_rows
+    полным перебором блоками. Матрица должна быть нормализована.
+
+    Returns:
+        numpy.ndarray: Массив размера len(query_rows) x k с номерами строк
+    """
+    neighbors = np.empty((len(query_rows), k), dtype=np.int64)
+    for start in range(0, len(query_rows), block_size):
+        rows = query_rows[start:start + block_size]
+        scores = matrix[rows] @ matrix.T
+        # Сам запрос не считается соседом
+        scores[np.arange(len(rows)), rows] = -np.inf
+        top = np.argpartition(-scores, k, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        neighbors[start:start + len(rows)] = np.take_along_axis(top, order, axis=1)
+    return neighbors
+
+
+def _synthetic_embeddings(count, dim, seed):
+    """Генерирует кластеризованный набор нормализованных эмбеддингов"""
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, count // 200)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, count)
+    matrix = centers[labels] + 0.5 * rng.standard_normal((count, dim)).astype(np.float32)
+    return matrix
+
+
+class Command(BaseCommand):
+    help = (
+        'Подбирает параметры Annoy-индекса: строит индекс с разным количеством деревьев, '
+        'измеряет recall@k относительно точного косинусного поиска, задержки запросов, '
+        'время построения и размер файла, и рекомендует ANNOY_N_TREES/ANNOY_SEARCH_K'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--trees',
+            type=_parse_int_list,
+            default=[10, 25, 50, 100],
+            help='Количество деревьев через запятую (по умолчанию 10,25,50,100)'
+        )
+        parser.add_argument(
+            '--search-k',
+            type=_parse_int_list,
+            default=[-1],
+            help='Значения search_k через запятую; -1 - значение Annoy по умолчанию'
+        )
+        parser.add_argument(
+            '--k',
+            type=int,
+            default=10,
+            help='Количество соседей для recall@k'
+        )
+        parser.add_argument(
+            '--queries',
+            type=int,
+            default=500,
+            help='Количество запросов для измерений'
+        )
+        parser.add_argument(
+            '--target-recall',
+            type=float,
+            default=0.95,
+            help='Целевой recall@k для рекомендации параметров'
+        )
+        parser.add_argument(
+            '--synthetic',
+            type=int,
+            default=0,
+            help='Использовать синтетический набор из N эмбеддингов вместо векторов из MongoDB'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=42,
+            help='Зерно генератора случайных чисел'
+        )
+        parser.add_argument(
+            '--rerank-factors',
+            type=_parse_int_list,
+            default=[],
+            help='Оценить int8-квантование с точным переранжированием для указанных множителей кандидатов (например 1,5,10,20)'
+        )
+        parser.add_argument(
+            '--output-dir',
+            type=str,
+            default='reports',
+            help='Директория для сохранения отчета'
+        )
+
+    def handle(self, *args, **options):
+        k = options['k']
+        dim = TrackAnnoyIndex.EMBEDDING_DIM
+        rng = np.random.default_rng(options['seed'])
+
+        # Получаем набор эмбеддингов
+        if options['synthetic']:
+            self.stdout.write(f"Генерируем синтетический набор из {options['synthetic']} эмбеддингов...")
+            matrix = _synthetic_embeddings(options['synthetic'], dim, options['seed'])
+            dataset = 'synthetic'
+        else:
+            self.stdout.write("Загружаем эмбеддинги из MongoDB...")
+            _, matrix = get_vector_store().load_vectors_matrix(dim)
+            dataset = 'mongodb'
+
+        if len(matrix) <= k:
+            raise CommandError(f"Недостаточно эмбеддингов для измерений: {len(matrix)} (нужно больше {k})")
+
+        matrix = TrackAnnoyIndex._normalize(matrix)
+        query_rows = rng.choice(len(matrix), size=min(options['queries'], len(matrix)), replace=False)
+
+        self.stdout.write(f"Считаем точных соседей для {len(query_rows)} запросов по {len(matrix)} эмбеддингам...")
+        exact = _exact_neighbors(matrix, query_rows, k)
+
+        results = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for n_trees in options['trees']:
+                index = AnnoyIndex(dim, 'angular')
+                for idx, vector in enumerate(matrix):
+                    index.add_item(idx, vector)
+
+                started = time.perf_counter()
+                index.build(n_trees)
+                build_time = time.perf_counter() - started
+
+                index_path = os.path.join(tmp_dir, f'trees_{n_trees}.ann')
+                index.save(index_path)
+                file_size_mb = os.path.getsize(index_path) / (1024 * 1024)
+
+                for search_k in options['search_k']:
+                    latencies = []
+                    hits = 0
+                    for query_row, exact_row in zip(query_rows, exact):
+                        started = time.perf_counter()
+                        approx = index.get_nns_by_item(int(query_row), k + 1, search_k=search_k)
+                        latencies.append((time.perf_counter() - started) * 1000)
+
+                        approx = [item for item in approx if item != query_row][:k]
+                        hits += len(set(approx) & set(exact_row.tolist()))
+
+                    result = {
+                        "n_trees": n_trees,
+                        "search_k": search_k,
+                        "recall_at_k": round(hits / (len(query_rows) * k), 4),
+                        "latency_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+                        "latency_p95_ms": round(float(np.percentile(latencies, 95)), 3),
+                        "latency_p99_ms": round(float(np.percentile(latencies, 99)), 3),
+                        "build_time_s": round(build_time, 3),
+                        "file_size_mb": round(file_size_mb, 2),
+                        "bytes_per_track": round(os.path.getsize(index_path) / len(matrix)),
+                    }
+                    results.append(result)
+                    self.stdout.write(
+                        f"  trees={n_trees:<4} search_k={search_k:<7} "
+                        f"recall@{k}={result['recall_at_k']:.4f} "
+                        f"p50={result['latency_p50_ms']}мс p95={result['latency_p95_ms']}мс "
+                        f"p99={result['latency_p99_ms']}мс build={result['build_time_s']}с "
+                        f"size={result['file_size_mb']}МБ"
+                    )
+
+                index.unload()
+
+        quantization_results = []
+        if options['rerank_factors']:
+            quantization_results = self._evaluate_quantization(
+                matrix, query_rows, exact, k, options['rerank_factors']
+            )
+
+        # Рекомендация: минимальная p95-задержка среди конфигураций с нужным recall
+        suitable = [r for r in results if r['recall_at_k'] >= options['target_recall']]
+        if suitable:
+            recommended = min(suitable, key=lambda r: (r['latency_p95_ms'], r['build_time_s']))
+        else:
+            recommended = max(results, key=lambda r: r['recall_at_k'])
+
+        report = {
+            "created_at": datetime.now().isoformat(),
+            "dataset": dataset,
+            "items_count": len(matrix),
+            "queries_count": len(query_rows),
+            "k": k,
+            "target_recall": options['target_recall'],
+            "target_reached": bool(suitable),
+            "results": results,
+            "recommended": recommended,
+            "quantization": quantization_results,
+        }
+
+        report_dir = os.path.join(settings.BASE_DIR, options['output_dir'])
+        if not os.path.exists(report_dir):
+            os.makedirs(report_dir)
+        report_path = os.path.join(report_dir, f"annoy_tuning_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+        self.stdout.write(f"Отчет сохранен в {report_path}")
+
+        if suitable:
+            self.stdout.write(self.style.SUCCESS(
+                f"Рекомендуемые параметры для recall@{k} >= {options['target_recall']}: "
+                f"ANNOY_N_TREES={recommended['n_trees']}, ANNOY_SEARCH_K={recommended['search_k']}"
+            ))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f"Целевой recall@{k} не достигнут. Лучший результат {recommended['recall_at_k']} при "
+                f"ANNOY_N_TREES={recommended['n_trees']}, ANNOY_SEARCH_K={recommended['search_k']}"
+            ))
+
+    def _evaluate_quantization(self, matrix, query_rows, exact, k, rerank_factors):
+        """
+        Оценивает recall@k и задержки поиска по int8-кодам с точным переранжированием
+        относительно поиска без квантования.
+        """
+        quantizer = ScalarQuantizer().fit(matrix)
+        codes = quantizer.encode(matrix)
+        dim = matrix.shape[1]
+
+        # Коды заменяют float32-матрицу: векторы для переранжирования читаются из файла деревьев
+        codes_bytes = int(codes.itemsize * dim)
+        vectors_bytes = int(matrix.itemsize * dim)
+        self.stdout.write(
+            f"Квантование int8: коды {codes_bytes} байт на трек вместо float32-матрицы "
+            f"({vectors_bytes} байт) плюс файл деревьев Annoy, из которого читаются векторы "
+            f"кандидатов; поиск перебирает все коды (O(N·dim) на запрос)"
+        )
+
+        results = []
+        excluded = np.zeros(len(matrix), dtype=bool)
+        for rerank_factor in rerank_factors:
+            recall = evaluate_recall(matrix, quantizer, codes, query_rows, exact, k, rerank_factor)
+
+            latencies = []
+            for query_row in query_rows:
+                excluded[query_row] = True
+                started = time.perf_counter()
+                quantized_search(matrix[query_row], quantizer, codes, matrix, k, rerank_factor, excluded)
+                latencies.append((time.perf_counter() - started) * 1000)
+                excluded[query_row] = False
+
+            result = {
+                "rerank_factor": rerank_factor,
+                "recall_codes_only": recall['recall_codes_only'],
+                "recall_reranked": recall['recall_reranked'],
+                "latency_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+                "latency_p95_ms": round(float(np.percentile(latencies, 95)), 3),
+                "latency_p99_ms": round(float(np.percentile(latencies, 99)), 3),
+                "codes_bytes_per_track": codes_bytes,
+                "vectors_bytes_per_track": vectors_bytes,
+                "total_vector_bytes_per_track": codes_bytes + vectors_bytes,
+            }
+            results.append(result)
+            self.stdout.write(
+                f"  int8 rerank x{rerank_factor:<3} "
+                f"recall@{k} (коды)={result['recall_codes_only']:.4f} "
+                f"recall@{k} (переранж.)={result['recall_reranked']:.4f} "
+                f"p50={result['latency_p50_ms']}мс p95={result['latency_p95_ms']}мс"
+            )
+
+        return results
@@ -0,0 +1,43 @@
+# Generated by Django 5.2 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music_app', '0009_recommendation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VectorChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('track_id', models.BigIntegerField(db_index=True, help_text='ID трека (без внешнего ключа: трек может быть уже удален)')),
+                ('operation', models.CharField(choices=[('upsert', 'Добавление или обновление'), ('delete', 'Удаление')], help_text='Тип изменения вектора трека', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, help_text='Дата и время изменения')),
+            ],
+            options={
+                'verbose_name': 'Изменение вектора трека',
+                'verbose_name_plural': 'Изменения векторов треков',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='VectorSyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Имя воркера синхронизации (один воркер на каталог индекса)', max_length=100, unique=True)),
+                ('source', models.CharField(help_text='Источник изменений: outbox или change_stream', max_length=20)),
+                ('token', models.TextField(blank=True, default='', help_text='Токен возобновления в формате JSON')),
+                ('applied_count', models.BigIntegerField(default=0, help_text='Количество примененных изменений')),
+                ('last_event_at', models.DateTimeField(blank=True, help_text='Время последнего примененного изменения', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='Время последнего сохранения позиции')),
+            ],
+            options={
+                'verbose_name': 'Позиция синхронизации индекса',
+                'verbose_name_plural': 'Позиции синхронизации индекса',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-16 12:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('music_app', '0010_vectorchange_vectorsynccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackEmbedding',
+            fields=[
+                ('track', models.OneToOneField(help_text='Трек', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='embedding', serialize=False, to='music_app.track')),
+                ('vector', models.BinaryField(help_text='Эмбеддинг трека (float32 с заголовком)', null=True)),
+                ('dim', models.PositiveIntegerField(default=0, help_text='Размерность эмбеддинга')),
+                ('metadata', models.JSONField(blank=True, default=dict, help_text='Остальные векторные данные трека (аудио-особенности и т.д.)')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='Время последнего обновления вектора')),
+            ],
+            options={
+                'verbose_name': 'Эмбеддинг трека',
+                'verbose_name_plural': 'Эмбеддинги треков',
+            },
+        ),
+    ]
@@ -599,3 +599,112 @@ class Recommendation(models.Model):
         self.is_viewed = True
         self.is_clicked = True
         self.save(update_fields=['is_viewed', 'is_clicked'])
+
+class VectorChange(models.Model):
+    """
+    Запись outbox об изменении векторного представления трека в MongoDB.
+    Воркер синхронизации читает записи по возрастанию id и применяет их к индексу.
+    """
+    OPERATION_UPSERT = 'upsert'
+    OPERATION_DELETE = 'delete'
+    OPERATION_CHOICES = [
+        (OPERATION_UPSERT, 'Добавление или обновление'),
+        (OPERATION_DELETE, 'Удаление'),
+    ]
+    
+    track_id = models.BigIntegerField(
+        db_index=True,
+        help_text='ID трека (без внешнего ключа: трек может быть уже удален)'
+    )
+    operation = models.CharField(
+        max_length=10,
+        choices=OPERATION_CHOICES,
+        help_text='Тип изменения вектора трека'
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        db_index=True,
+        help_text='Дата и время изменения'
+    )
+    
+    class Meta:
+        ordering = ['id']
+        verbose_name = 'Изменение вектора трека'
+        verbose_name_plural = 'Изменения векторов треков'
+    
+    def __str__(self):
+        return f"{self.operation} {self.track_id} (#{self.id})"
+
+class VectorSyncCheckpoint(models.Model):
+    """Позиция воркера синхронизации индекса в потоке изменений векторов (токен возобновления)"""
+    name = models.CharField(
+        max_length=100,
+        unique=True,
+        help_text='Имя воркера синхронизации (один воркер на каталог индекса)'
+    )
+    source = models.CharField(
+        max_length=20,
+        help_text='Источник изменений: outbox или change_stream'
+    )
+    token = models.TextField(
+        blank=True,
+        default='',
+        help_text='Токен возобновления в формате JSON'
+    )
+    applied_count = models.BigIntegerField(
+        default=0,
+        help_text='Количество примененных изменений'
+    )
+    last_event_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text='Время последнего примененного изменения'
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        help_text='Время последнего сохранения позиции'
+    )
+    
+    class Meta:
+        verbose_name = 'Позиция синхронизации индекса'
+        verbose_name_plural = 'Позиции синхронизации индекса'
+    
+    def __str__(self):
+        return f"{self.name} ({self.source})"
+
+class TrackEmbedding(models.Model):
+    """
+    Векторное представление трека в основной БД (хранилище TRACK_VECTORS_STORE='sql').
+    Эмбеддинг хранится BLOB-ом: 12 байт заголовка (сигнатура, dtype, размерность) и значения float32.
+    """
+    track = models.OneToOneField(
+        Track,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='embedding',
+        help_text='Трек'
+    )
+    vector = models.BinaryField(
+        null=True,
+        help_text='Эмбеддинг трека (float32 с заголовком)'
+    )
+    dim = models.PositiveIntegerField(
+        default=0,
+        help_text='Размерность эмбеддинга'
+    )
+    metadata = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text='Остальные векторные данные трека (аудио-особенности и т.д.)'
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        help_text='Время последнего обновления вектора'
+    )
+    
+    class Meta:
+        verbose_name = 'Эмбеддинг трека'
+        verbose_name_plural = 'Эмбеддинги треков'
+    
+    def __str__(self):
+        return f"Эмбеддинг трека {self.track_id} ({self.dim})"
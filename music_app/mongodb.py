@@ -1,5 +1,16 @@
+import os
+import copy
+import json
+import time
+import uuid
+import base64
+import atexit
+import struct
 import logging
 import random
+import threading
+from datetime import datetime
+from contextlib import contextmanager
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
@@ -15,141 +26,1560 @@ except ImportError:
 try:
     import pymongo
     from pymongo import MongoClient
+    from pymongo.errors import ConnectionFailure, ExecutionTimeout, OperationFailure, DuplicateKeyError
     PYMONGO_AVAILABLE = True
+    # Ошибки, означающие недоступность MongoDB (а не ошибку конкретного запроса)
+    MONGO_OUTAGE_ERRORS = (ConnectionFailure, ExecutionTimeout)
 except ImportError:
     logger.warning("PyMongo недоступен. Функционал MongoDB будет ограничен.")
     PYMONGO_AVAILABLE = False
+    MONGO_OUTAGE_ERRORS = ()
+    
+    class OperationFailure(Exception):
+        """Ошибка выполнения операции (замена pymongo.errors.OperationFailure)"""
+    
+    class DuplicateKeyError(OperationFailure):
+        """Нарушение уникального индекса (замена pymongo.errors.DuplicateKeyError)"""
+
+try:
+    from bson import json_util
+    JSON_UTIL_AVAILABLE = True
+except ImportError:
+    JSON_UTIL_AVAILABLE = False
+
+# Бинарный формат эмбеддинга: заголовок (сигнатура, dtype NumPy, размерность)
+# и сырые значения float32. Сохраняется как BSON Binary вместо массива double.
+EMBEDDING_MAGIC = b'EMB1'
+EMBEDDING_HEADER = struct.Struct('<4s4sI')
+EMBEDDING_DTYPE = '<f4'
+
+
+def encode_embedding(embedding):
+    """
+    Кодирует эмбеддинг в бинарный формат: 12 байт заголовка и значения float32.
+    
+    Args:
+        embedding: Список или numpy-массив значений
+        
+    Returns:
+        bytes: Закодированный эмбеддинг (PyMongo сохраняет его как BSON Binary)
+    """
+    values = np.ascontiguousarray(embedding, dtype=EMBEDDING_DTYPE).ravel()
+    header = EMBEDDING_HEADER.pack(EMBEDDING_MAGIC, EMBEDDING_DTYPE.encode('ascii'), len(values))
+    return header + values.tobytes()
+
+
+def decode_embedding(value):
+    """
+    Декодирует эмбеддинг, сохраненный в любом из форматов: бинарном
+    (с заголовком) или массиве чисел.
+    
+    Args:
+        value: bytes/Binary/memoryview, список чисел или None
+        
+    Returns:
+        numpy.ndarray (float32) или None, если эмбеддинга нет
+    """
+    if value is None:
+        return None
+    
+    # memoryview - BLOB из PostgreSQL (хранилище в реляционной БД)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        magic, dtype, dim = EMBEDDING_HEADER.unpack_from(value)
+        if magic != EMBEDDING_MAGIC:
+            raise ValueError("Неизвестный бинарный формат эмбеддинга")
+        values = np.frombuffer(
+            value, dtype=dtype.rstrip(b'\x00').decode('ascii'), count=dim, offset=EMBEDDING_HEADER.size
+        )
+        return values.astype(np.float32, copy=False)
+    
+    if len(value) == 0:
+        return None
+    return np.asarray(value, dtype=np.float32)
+
+
+def cosine_to_similarity(cosines):
+    """
+    Переводит косинусное сходство нормализованных векторов в оценку сходства,
+    единую для всех путей поиска похожих треков (бэкенды индекса, $vectorSearch
+    и полный перебор по матрице хранилища): 1 - angular-расстояние Annoy, где
+    angular-расстояние = sqrt(2 * (1 - cos)). Оценка лежит в диапазоне [-1, 1],
+    1 - совпадающие направления.
+    
+    Args:
+        cosines: Косинусное сходство (число или numpy-массив)
+        
+    Returns:
+        numpy.ndarray: Оценки сходства той же формы
+    """
+    cosines = np.asarray(cosines, dtype=np.float32)
+    return 1.0 - np.sqrt(np.maximum(0.0, 2.0 - 2.0 * cosines))
+
+
+def vector_search_score_to_cosine(score):
+    """
+    Переводит vectorSearchScore индекса cosine в MongoDB Atlas ((1 + cos) / 2)
+    обратно в косинусное сходство.
+    """
+    return 2.0 * float(score) - 1.0
+
+
+class MongoUnavailableError(Exception):
+    """MongoDB недоступна: автомат защиты разомкнут после серии ошибок"""
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты для обращений к MongoDB.
+    
+    После MONGODB_CIRCUIT_FAILURE_THRESHOLD ошибок подряд автомат размыкается,
+    и обращения сразу отклоняются без ожидания таймаутов. Через
+    MONGODB_CIRCUIT_RESET_TIMEOUT секунд пропускается одно пробное обращение:
+    при успехе автомат замыкается, при ошибке снова размыкается.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    FAILURE_THRESHOLD = 5
+    RESET_TIMEOUT = 30
+    
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+    
+    def _get_failure_threshold(self):
+        return getattr(settings, 'MONGODB_CIRCUIT_FAILURE_THRESHOLD', self.FAILURE_THRESHOLD)
+    
+    def _get_reset_timeout(self):
+        return getattr(settings, 'MONGODB_CIRCUIT_RESET_TIMEOUT', self.RESET_TIMEOUT)
+    
+    def allow(self):
+        """
+        Проверяет, можно ли выполнить обращение к MongoDB.
+        
+        Returns:
+            bool: False, если автомат разомкнут
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self._get_reset_timeout():
+                # Пропускаем одно пробное обращение
+                self.state = self.HALF_OPEN
+                return True
+            return False
+    
+    @property
+    def is_open(self):
+        """Разомкнут ли автомат (обращения к MongoDB отклоняются)"""
+        return self.state != self.CLOSED
+    
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("MongoDB снова доступна, автомат защиты замкнут")
+            self.state = self.CLOSED
+            self.failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self._get_failure_threshold():
+                if self.state != self.OPEN:
+                    logger.error(
+                        f"MongoDB недоступна ({self.failures} ошибок подряд), автомат защиты разомкнут "
+                        f"на {self._get_reset_timeout()} с"
+                    )
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+    
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+        }
+
+
+mongo_circuit_breaker = CircuitBreaker()
+
+
+@contextmanager
+def mongo_guard():
+    """
+    Оборачивает обращение к MongoDB автоматом защиты: при разомкнутом автомате
+    сразу выбрасывает MongoUnavailableError, ошибки соединения и таймауты
+    учитываются как отказы.
+    """
+    if not mongo_circuit_breaker.allow():
+        raise MongoUnavailableError("MongoDB временно недоступна")
+    failed = False
+    try:
+        yield
+    except MONGO_OUTAGE_ERRORS:
+        failed = True
+        mongo_circuit_breaker.record_failure()
+        raise
+    finally:
+        # Любой ответ сервера (в том числе ошибка запроса) означает, что MongoDB доступна
+        if not failed:
+            mongo_circuit_breaker.record_success()
+
+
+class MongoDBSingleton:
+    """
+    Синглтон для работы с MongoDB.
+    
+    Клиент создается отдельно в каждом процессе: пул соединений PyMongo
+    нельзя использовать после fork, поэтому дочерние процессы gunicorn
+    и Celery получают собственный клиент.
+    """
+    _instance = None
+    _client = None
+    _db = None
+    _lock = threading.Lock()
+    
+    @classmethod
+    def get_instance(cls):
+        """Получение синглтон-экземпляра класса для текущего процесса"""
+        instance = cls._instance
+        if instance is None or instance._pid != os.getpid():
+            with cls._lock:
+                instance = cls._instance
+                if instance is None or instance._pid != os.getpid():
+                    instance = cls()
+                    cls._instance = instance
+        return instance
+    
+    @classmethod
+    def _reset_after_fork(cls):
+        """
+        Сбрасывает унаследованный от родителя клиент в дочернем процессе.
+        Клиент родителя не закрывается: его сокеты принадлежат родителю.
+        """
+        cls._instance = None
+        cls._lock = threading.Lock()
+    
+    @staticmethod
+    def _get_client_options():
+        """Параметры пула соединений и таймаутов MongoClient из настроек"""
+        return {
+            'maxPoolSize': getattr(settings, 'MONGODB_MAX_POOL_SIZE', 50),
+            'minPoolSize': getattr(settings, 'MONGODB_MIN_POOL_SIZE', 0),
+            'serverSelectionTimeoutMS': getattr(settings, 'MONGODB_SERVER_SELECTION_TIMEOUT_MS', 2000),
+            'connectTimeoutMS': getattr(settings, 'MONGODB_CONNECT_TIMEOUT_MS', 2000),
+            'socketTimeoutMS': getattr(settings, 'MONGODB_SOCKET_TIMEOUT_MS', 5000),
+            'waitQueueTimeoutMS': getattr(settings, 'MONGODB_WAIT_QUEUE_TIMEOUT_MS', 2000),
+        }
+    
+    def __init__(self):
+        """Инициализация соединения с MongoDB"""
+        self._pid = os.getpid()
+        mock_path = getattr(settings, 'MONGODB_MOCK_PATH', None) or None
+        
+        # Встроенный движок в памяти вместо MongoDB (нагрузочные тесты, CI)
+        if getattr(settings, 'MONGODB_USE_MOCK', False):
+            self._client = None
+            self._db = MockDatabase(mock_path)
+            logger.info(f"Используется встроенная заглушка MongoDB (pid {self._pid})")
+            return
+        
+        try:
+            if not PYMONGO_AVAILABLE:
+                raise ImportError("PyMongo недоступен")
+                
+            # Проверка наличия настроек MongoDB
+            mongodb_uri = getattr(settings, 'MONGODB_URI', 'mongodb://localhost:27017/')
+            mongodb_db = getattr(settings, 'MONGODB_DB', 'music_app')
+            
+            # Клиент подключается в фоне; ограниченные таймауты не дают запросам
+            # висеть по 30 секунд, если MongoDB недоступна
+            self._client = MongoClient(mongodb_uri, **self._get_client_options())
+            self._db = self._client[mongodb_db]
+            
+            logger.info(f"Успешное подключение к MongoDB: {mongodb_uri}, DB: {mongodb_db} (pid {self._pid})")
+        except Exception as e:
+            logger.error(f"Ошибка подключения к MongoDB: {str(e)}")
+            # Создаем заглушку для базы данных
+            self._client = None
+            self._db = MockDatabase(mock_path)
+            logger.warning("Создана заглушка для MongoDB")
+    
+    def get_db(self):
+        """Получение объекта базы данных"""
+        return self._db
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=MongoDBSingleton._reset_after_fork)
+
+
+class MockCursor:
+    """Заглушка для курсора MongoDB: список документов с sort/skip/limit"""
+    def __init__(self, items):
+        self.items = items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def batch_size(self, size):
+        """Имитация установки размера пачки курсора"""
+        return self
+
+    def sort(self, key_or_list, direction=1):
+        """Сортировка документов по одному или нескольким полям"""
+        keys = [(key_or_list, direction)] if isinstance(key_or_list, str) else list(key_or_list)
+        # Сортировка устойчивая, поэтому ключи применяются с последнего
+        for path, order in reversed(keys):
+            self.items.sort(key=lambda doc: _mock_sort_key(_mock_get_path(doc, path)[1]), reverse=order < 0)
+        return self
+
+    def skip(self, count):
+        """Пропуск первых count документов"""
+        self.items = self.items[count:]
+        return self
+
+    def limit(self, count):
+        """Ограничение количества документов (0 - без ограничения)"""
+        if count:
+            self.items = self.items[:count]
+        return self
+
+
+class MockInsertResult:
+    """Заглушка для результата вставки в MongoDB"""
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class MockInsertManyResult:
+    """Заглушка для результата пакетной вставки в MongoDB"""
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+
+class MockUpdateResult:
+    """Заглушка для результата обновления в MongoDB"""
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+class MockDeleteResult:
+    """Заглушка для результата удаления в MongoDB"""
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+
+class MockBulkWriteResult:
+    """Заглушка для результата bulk_write в MongoDB"""
+    def __init__(self):
+        self.inserted_count = 0
+        self.matched_count = 0
+        self.modified_count = 0
+        self.deleted_count = 0
+        self.upserted_count = 0
+        self.upserted_ids = {}
+
+
+# Псевдонимы и числовые коды BSON-типов для оператора $type
+MOCK_BSON_TYPES = {
+    1: 'double', 2: 'string', 3: 'object', 4: 'array', 5: 'binData',
+    8: 'bool', 10: 'null', 16: 'int', 18: 'long',
+}
+
+
+def _mock_bson_type(value):
+    """Возвращает имя BSON-типа значения"""
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int' if -2 ** 31 <= value < 2 ** 31 else 'long'
+    if isinstance(value, float):
+        return 'double'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, (bytes, bytearray)):
+        return 'binData'
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, (list, tuple)):
+        return 'array'
+    return type(value).__name__
+
+
+def _mock_get_path(doc, path):
+    """
+    Получает значение по пути через точку ('vector.embedding').
+
+    Returns:
+        tuple: (найдено ли поле, значение или None)
+    """
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return False, None
+    return True, value
+
+
+def _mock_set_path(doc, path, value):
+    """Устанавливает значение по пути через точку, создавая вложенные документы"""
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if not isinstance(doc.get(part), dict):
+            doc[part] = {}
+        doc = doc[part]
+    doc[parts[-1]] = value
+
+
+def _mock_unset_path(doc, path):
+    """Удаляет поле по пути через точку"""
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _mock_sort_key(value):
+    """Ключ сортировки, сравнимый для значений разных типов (порядок типов как в MongoDB)"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, bool):
+        return (5, value)
+    return (3, repr(value))
+
+
+def _mock_equals(value, target):
+    """Равенство в смысле MongoDB: для массива достаточно совпадения одного элемента"""
+    if isinstance(value, list) and not isinstance(target, list):
+        return any(_mock_equals(item, target) for item in value)
+    try:
+        return bool(value == target)
+    except (TypeError, ValueError):
+        return False
+
+
+def _mock_compare(value, target, op):
+    """Сравнение $gt/$gte/$lt/$lte (значения несравнимых типов не совпадают)"""
+    if isinstance(value, list):
+        return any(_mock_compare(item, target, op) for item in value)
+    try:
+        if op == '$gt':
+            return value > target
+        if op == '$gte':
+            return value >= target
+        if op == '$lt':
+            return value < target
+        return value <= target
+    except TypeError:
+        return False
+
+
+def _mock_match_condition(found, value, condition):
+    """Проверяет значение поля на соответствие условию запроса"""
+    if not (isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition)):
+        return _mock_equals(value, condition)
+
+    for op, arg in condition.items():
+        if op == '$eq':
+            matched = _mock_equals(value, arg)
+        elif op == '$ne':
+            matched = not _mock_equals(value, arg)
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            matched = found and _mock_compare(value, arg, op)
+        elif op == '$in':
+            matched = any(_mock_equals(value, item) for item in arg)
+        elif op == '$nin':
+            matched = not any(_mock_equals(value, item) for item in arg)
+        elif op == '$exists':
+            matched = found == bool(arg)
+        elif op == '$type':
+            types = arg if isinstance(arg, (list, tuple)) else [arg]
+            names = {MOCK_BSON_TYPES.get(name, name) for name in types}
+            actual = _mock_bson_type(value)
+            matched = found and (
+                actual in names
+                or ('number' in names and actual in ('int', 'long', 'double'))
+                # Как и в MongoDB, элементы массива тоже проверяются
+                or (actual == 'array' and any(_mock_bson_type(item) in names for item in value))
+            )
+        elif op == '$not':
+            matched = not _mock_match_condition(found, value, arg)
+        else:
+            raise OperationFailure(f"Оператор {op} не поддерживается заглушкой MongoDB")
+
+        if not matched:
+            return False
+    return True
+
+
+def mock_match(doc, query):
+    """Проверяет документ на соответствие запросу MongoDB"""
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            matched = all(mock_match(doc, sub) for sub in condition)
+        elif key == '$or':
+            matched = any(mock_match(doc, sub) for sub in condition)
+        elif key == '$nor':
+            matched = not any(mock_match(doc, sub) for sub in condition)
+        elif key.startswith('$'):
+            raise OperationFailure(f"Оператор {key} не поддерживается заглушкой MongoDB")
+        else:
+            found, value = _mock_get_path(doc, key)
+            matched = _mock_match_condition(found, value, condition)
+
+        if not matched:
+            return False
+    return True
+
+
+def mock_project(doc, projection, meta=None):
+    """
+    Применяет проекцию MongoDB (включающую или исключающую) к копии документа.
+
+    Args:
+        doc: Исходный документ
+        projection: Словарь или список полей
+        meta: Метаданные агрегации для выражений {'$meta': ...}
+    """
+    if not projection:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+
+    include_id = projection.get('_id', 1)
+    fields = {path: spec for path, spec in projection.items() if path != '_id'}
+    inclusion = any(isinstance(spec, dict) or spec for spec in fields.values())
+
+    if inclusion:
+        result = {}
+        for path, spec in fields.items():
+            if isinstance(spec, dict) and '$meta' in spec:
+                _mock_set_path(result, path, (meta or {}).get(spec['$meta']))
+            elif spec:
+                found, value = _mock_get_path(doc, path)
+                if found:
+                    _mock_set_path(result, path, copy.deepcopy(value))
+        if include_id and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+
+    result = copy.deepcopy(doc)
+    for path in fields:
+        _mock_unset_path(result, path)
+    if not include_id:
+        result.pop('_id', None)
+    return result
+
+
+def _mock_apply_update(doc, update, is_insert=False):
+    """Применяет операторы обновления ($set, $unset, $inc, $setOnInsert) или замену документа"""
+    if not any(key.startswith('$') for key in update):
+        replacement = copy.deepcopy(update)
+        if '_id' in doc:
+            replacement['_id'] = doc['_id']
+        doc.clear()
+        doc.update(replacement)
+        return
+
+    for op, fields in update.items():
+        if op == '$set' or (op == '$setOnInsert' and is_insert):
+            for path, value in fields.items():
+                _mock_set_path(doc, path, copy.deepcopy(value))
+        elif op == '$setOnInsert':
+            continue
+        elif op == '$unset':
+            for path in fields:
+                _mock_unset_path(doc, path)
+        elif op == '$inc':
+            for path, value in fields.items():
+                current = _mock_get_path(doc, path)[1] or 0
+                _mock_set_path(doc, path, current + value)
+        else:
+            raise OperationFailure(f"Оператор обновления {op} не поддерживается заглушкой MongoDB")
+
+
+def _mock_upsert_seed(query):
+    """Документ для upsert: поля с условиями равенства из запроса"""
+    doc = {}
+    for path, condition in query.items():
+        if path.startswith('$'):
+            continue
+        if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+            if '$eq' not in condition:
+                continue
+            condition = condition['$eq']
+        _mock_set_path(doc, path, copy.deepcopy(condition))
+    return doc
+
+
+def _mock_documents_equal(first, second):
+    """Сравнение документов (numpy-массивы и подобные значения считаются различными)"""
+    try:
+        return bool(first == second)
+    except (TypeError, ValueError):
+        return False
+
+
+class MockCollection:
+    """
+    Заглушка для коллекции MongoDB: полноценный движок в памяти процесса.
+
+    Поддерживает запросы с операторами сравнения, $in, $exists, $type, $and/$or,
+    проекции, операторы обновления и upsert, уникальные индексы, bulk_write
+    и агрегацию с $vectorSearch, $match, $project, $sort, $skip и $limit.
+    Позволяет запускать нагрузочные тесты рекомендаций без MongoDB Atlas.
+    """
+    def __init__(self, name, database=None):
+        self.name = name
+        self._database = database
+        self._items = {}
+        self._indexes = {}
+        self._index_keys = {}
+        self._lock = threading.RLock()
+        self._version = 0
+        self._vector_cache = {}
+        logger.info(f"Создана заглушка для коллекции MongoDB: {name}")
+
+    # --- Служебные методы ---
+
+    def _touch(self):
+        """Отмечает изменение коллекции: сбрасывает кэш векторов и помечает базу для сохранения"""
+        self._version += 1
+        if self._database is not None:
+            self._database.mark_dirty()
+
+    def _index_key(self, doc, fields):
+        """Ключ уникального индекса для документа (None, если поля индекса отсутствуют)"""
+        values = tuple(_mock_get_path(doc, field)[1] for field in fields)
+        if all(value is None for value in values):
+            return None
+        return repr(values)
+
+    def _check_unique(self, doc):
+        """Проверяет уникальные индексы перед записью документа"""
+        for name, index in self._indexes.items():
+            if not index['unique']:
+                continue
+            key = self._index_key(doc, index['fields'])
+            owner = self._index_keys[name].get(key)
+            if key is not None and owner is not None and owner != doc['_id']:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.name} index: {name}"
+                )
+
+    def _store(self, doc, previous=None):
+        """Сохраняет документ и обновляет уникальные индексы"""
+        self._check_unique(doc)
+        for name, index in self._indexes.items():
+            if not index['unique']:
+                continue
+            if previous is not None:
+                self._index_keys[name].pop(self._index_key(previous, index['fields']), None)
+            key = self._index_key(doc, index['fields'])
+            if key is not None:
+                self._index_keys[name][key] = doc['_id']
+        self._items[doc['_id']] = doc
+        self._touch()
+
+    def _discard(self, doc):
+        """Удаляет документ и его ключи из уникальных индексов"""
+        for name, index in self._indexes.items():
+            if index['unique']:
+                self._index_keys[name].pop(self._index_key(doc, index['fields']), None)
+        del self._items[doc['_id']]
+        self._touch()
+
+    def _iter_matching(self, query):
+        """Перебирает документы, подходящие под запрос (по _id - без полного перебора)"""
+        query = query or {}
+        _id = query.get('_id')
+        if _id is not None and not isinstance(_id, dict):
+            doc = self._items.get(_id)
+            candidates = [doc] if doc is not None else []
+        else:
+            candidates = list(self._items.values())
+        return [doc for doc in candidates if mock_match(doc, query)]
+
+    # --- Индексы ---
+
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        """Создание индекса; уникальные индексы проверяются при записи"""
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        fields = [field for field, _ in keys]
+        name = name or '_'.join(f"{field}_{direction}" for field, direction in keys)
+
+        with self._lock:
+            if name in self._indexes:
+                return name
+            index_keys = {}
+            if unique:
+                for doc in self._items.values():
+                    key = self._index_key(doc, fields)
+                    if key is not None and key in index_keys:
+                        raise DuplicateKeyError(
+                            f"E11000 duplicate key error collection: {self.name} index: {name}"
+                        )
+                    index_keys[key] = doc['_id']
+            self._indexes[name] = {'fields': fields, 'unique': unique}
+            self._index_keys[name] = index_keys
+            self._touch()
+        return name
+
+    def index_information(self):
+        """Описание индексов коллекции"""
+        info = {'_id_': {'key': [('_id', 1)]}}
+        for name, index in self._indexes.items():
+            info[name] = {'key': [(field, 1) for field in index['fields']], 'unique': index['unique']}
+        return info
+
+    # --- Чтение ---
+
+    def find_one(self, query=None, projection=None):
+        """Поиск одного документа"""
+        with self._lock:
+            matches = self._iter_matching(query)
+            return mock_project(matches[0], projection) if matches else None
+
+    def find(self, query=None, projection=None):
+        """Поиск документов с проекцией"""
+        with self._lock:
+            return MockCursor([mock_project(doc, projection) for doc in self._iter_matching(query)])
+
+    def count_documents(self, query):
+        """Подсчет документов"""
+        with self._lock:
+            if not query:
+                return len(self._items)
+            return len(self._iter_matching(query))
+
+    def estimated_document_count(self):
+        """Количество документов в коллекции"""
+        return len(self._items)
+
+    def distinct(self, key, query=None):
+        """Уникальные значения поля"""
+        values = []
+        with self._lock:
+            for doc in self._iter_matching(query):
+                found, value = _mock_get_path(doc, key)
+                for item in (value if isinstance(value, list) else [value]) if found else []:
+                    if item not in values:
+                        values.append(item)
+        return values
+
+    # --- Запись ---
+
+    def insert_one(self, document):
+        """Вставка одного документа"""
+        if '_id' not in document:
+            document['_id'] = uuid.uuid4().hex[:24]
+        with self._lock:
+            if document['_id'] in self._items:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+            self._store(copy.deepcopy(document))
+        return MockInsertResult(document['_id'])
+
+    def insert_many(self, documents, ordered=True):
+        """Вставка нескольких документов"""
+        return MockInsertManyResult([self.insert_one(document).inserted_id for document in documents])
+
+    def _update(self, query, update, upsert=False, multi=False):
+        """Общая реализация update_one/update_many/replace_one"""
+        with self._lock:
+            matches = self._iter_matching(query)
+            if not multi:
+                matches = matches[:1]
+
+            modified = 0
+            for doc in matches:
+                updated = copy.deepcopy(doc)
+                _mock_apply_update(updated, update)
+                if not _mock_documents_equal(updated, doc):
+                    self._store(updated, previous=doc)
+                    modified += 1
+
+            if matches or not upsert:
+                return MockUpdateResult(len(matches), modified)
+
+            doc = _mock_upsert_seed(query)
+            _mock_apply_update(doc, update, is_insert=True)
+            doc.setdefault('_id', uuid.uuid4().hex[:24])
+            self._store(doc)
+            return MockUpdateResult(0, 0, upserted_id=doc['_id'])
+
+    def update_one(self, query, update, upsert=False, **kwargs):
+        """Обновление одного документа"""
+        return self._update(query, update, upsert=upsert)
+
+    def update_many(self, query, update, upsert=False, **kwargs):
+        """Обновление всех подходящих документов"""
+        return self._update(query, update, upsert=upsert, multi=True)
+
+    def replace_one(self, query, replacement, upsert=False, **kwargs):
+        """Замена одного документа"""
+        return self._update(query, replacement, upsert=upsert)
+
+    def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=False, **kwargs):
+        """
+        Атомарное обновление одного документа. return_document=True
+        (ReturnDocument.AFTER) возвращает документ после обновления.
+        """
+        with self._lock:
+            matches = self._iter_matching(query)
+            before = matches[0] if matches else None
+            result = self._update(query, update, upsert=upsert)
+
+            if return_document:
+                _id = before['_id'] if before is not None else result.upserted_id
+                after = self._items.get(_id) if _id is not None else None
+                return mock_project(after, projection) if after is not None else None
+            return mock_project(before, projection) if before is not None else None
+
+    def delete_one(self, query):
+        """Удаление одного документа"""
+        with self._lock:
+            matches = self._iter_matching(query)[:1]
+            for doc in matches:
+                self._discard(doc)
+            return MockDeleteResult(len(matches))
+
+    def delete_many(self, query):
+        """Удаление всех подходящих документов"""
+        with self._lock:
+            matches = self._iter_matching(query)
+            for doc in matches:
+                self._discard(doc)
+            return MockDeleteResult(len(matches))
+
+    def bulk_write(self, requests, ordered=True):
+        """
+        Пакетная запись операциями PyMongo (InsertOne, UpdateOne, UpdateMany,
+        ReplaceOne, DeleteOne, DeleteMany). При ordered=False ошибки отдельных
+        операций не прерывают пакет и возвращаются после его выполнения.
+        """
+        result = MockBulkWriteResult()
+        errors = []
+
+        with self._lock:
+            for position, request in enumerate(requests):
+                kind = type(request).__name__
+                try:
+                    if kind == 'InsertOne':
+                        self.insert_one(request._doc)
+                        result.inserted_count += 1
+                    elif kind in ('UpdateOne', 'UpdateMany', 'ReplaceOne'):
+                        outcome = self._update(
+                            request._filter, request._doc,
+                            upsert=request._upsert, multi=kind == 'UpdateMany'
+                        )
+                        result.matched_count += outcome.matched_count
+                        result.modified_count += outcome.modified_count
+                        if outcome.upserted_id is not None:
+                            result.upserted_count += 1
+                            result.upserted_ids[position] = outcome.upserted_id
+                    elif kind in ('DeleteOne', 'DeleteMany'):
+                        method = self.delete_one if kind == 'DeleteOne' else self.delete_many
+                        result.deleted_count += method(request._filter).deleted_count
+                    else:
+                        raise OperationFailure(f"Операция {kind} не поддерживается заглушкой MongoDB")
+                except OperationFailure as e:
+                    if ordered:
+                        raise
+                    errors.append(f"#{position}: {str(e)}")
+
+        if errors:
+            raise OperationFailure(f"Ошибки bulk_write: {'; '.join(errors)}")
+        return result
+
+    def drop(self):
+        """Удаление всех документов и индексов коллекции"""
+        with self._lock:
+            self._items.clear()
+            self._indexes.clear()
+            self._index_keys.clear()
+            self._touch()
+
+    # --- Агрегация ---
+
+    def _get_vector_matrix(self, path, dim):
+        """
+        Нормализованная float32-матрица векторов по пути path, закэшированная
+        до следующего изменения коллекции. Документы с вектором другой
+        размерности не индексируются, как и в Atlas Vector Search.
+
+        Returns:
+            tuple: (документы, матрица N x dim)
+        """
+        key = (path, dim)
+        cache = self._vector_cache.get(key)
+        if cache is not None and cache['version'] == self._version:
+            return cache['docs'], cache['matrix']
+
+        docs = []
+        rows = []
+        for doc in self._items.values():
+            # В отличие от Atlas, понимаем и бинарный формат эмбеддингов
+            embedding = decode_embedding(_mock_get_path(doc, path)[1])
+            if embedding is not None and len(embedding) == dim:
+                docs.append(doc)
+                rows.append(embedding)
+
+        matrix = np.vstack(rows).astype(np.float32, copy=False) if rows else np.empty((0, dim), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix = matrix / norms
+
+        self._vector_cache = {key: {'version': self._version, 'docs': docs, 'matrix': matrix}}
+        return docs, matrix
+
+    def _vector_search(self, spec):
+        """
+        Стадия $vectorSearch: точный поиск по косинусному сходству одним
+        матрично-векторным умножением. Оценка, как в Atlas для similarity
+        'cosine', равна (1 + cos) / 2.
+
+        Returns:
+            list: Пары (документ, метаданные с vectorSearchScore)
+        """
+        if not NUMPY_AVAILABLE:
+            raise OperationFailure("$vectorSearch в заглушке MongoDB требует NumPy")
+
+        limit = spec.get('limit')
+        if not spec.get('path') or spec.get('queryVector') is None or not limit:
+            raise OperationFailure("$vectorSearch требует параметры path, queryVector и limit")
+        if not spec.get('exact') and spec.get('numCandidates', 0) < limit:
+            raise OperationFailure("$vectorSearch: numCandidates должен быть не меньше limit")
+
+        query = np.asarray(spec['queryVector'], dtype=np.float32)
+        norm = np.linalg.norm(query)
+
+        with self._lock:
+            docs, matrix = self._get_vector_matrix(spec['path'], len(query))
+        if not docs or norm == 0:
+            return []
+
+        scores = matrix @ (query / norm)
+        if spec.get('filter'):
+            allowed = np.fromiter((mock_match(doc, spec['filter']) for doc in docs), dtype=bool, count=len(docs))
+            scores[~allowed] = -np.inf
+
+        k = min(limit, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [
+            (docs[row], {'vectorSearchScore': float((1.0 + scores[row]) / 2.0)})
+            for row in top
+            if np.isfinite(scores[row])
+        ]
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        Агрегация: $vectorSearch (только первой стадией), $match, $project,
+        $addFields/$set, $sort, $skip, $limit и $count.
+        """
+        rows = None
+        for position, stage in enumerate(pipeline):
+            (name, spec), = stage.items()
+
+            if name == '$vectorSearch':
+                if position != 0:
+                    raise OperationFailure("$vectorSearch допускается только первой стадией")
+                rows = self._vector_search(spec)
+                continue
+
+            if rows is None:
+                with self._lock:
+                    rows = [(doc, {}) for doc in self._items.values()]
+
+            if name == '$match':
+                rows = [(doc, meta) for doc, meta in rows if mock_match(doc, spec)]
+            elif name == '$project':
+                rows = [(mock_project(doc, spec, meta), meta) for doc, meta in rows]
+            elif name in ('$addFields', '$set'):
+                projected = []
+                for doc, meta in rows:
+                    doc = copy.deepcopy(doc)
+                    for path, value in spec.items():
+                        if isinstance(value, dict) and '$meta' in value:
+                            value = meta.get(value['$meta'])
+                        _mock_set_path(doc, path, value)
+                    projected.append((doc, meta))
+                rows = projected
+            elif name == '$sort':
+                for path, order in reversed(list(spec.items())):
+                    rows.sort(key=lambda row: _mock_sort_key(_mock_get_path(row[0], path)[1]), reverse=order < 0)
+            elif name == '$skip':
+                rows = rows[spec:]
+            elif name == '$limit':
+                rows = rows[:spec]
+            elif name == '$count':
+                rows = [({spec: len(rows)}, {})]
+            else:
+                raise OperationFailure(f"Стадия {name} не поддерживается заглушкой MongoDB")
+
+        # Документы без проекции возвращаются копиями, как из настоящего курсора
+        return MockCursor([copy.deepcopy(doc) for doc, _ in (rows or [])])
+
+
+def _mock_json_default(value):
+    """
+    Сериализует значения документов заглушки, которых нет в JSON: numpy-значения
+    и (без bson.json_util) байты и даты - в виде {"$binary": ...} и {"$date": ...}.
+    """
+    if NUMPY_AVAILABLE and isinstance(value, np.ndarray):
+        return value.tolist()
+    if NUMPY_AVAILABLE and isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (bytes, bytearray)):
+        return {'$binary': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    raise TypeError(f"Значение типа {type(value).__name__} не сериализуется в JSON")
+
+
+def _mock_json_object_hook(obj):
+    """Восстанавливает байты и даты, записанные _mock_json_default"""
+    if len(obj) == 1 and '$binary' in obj:
+        return base64.b64decode(obj['$binary'])
+    if len(obj) == 1 and '$date' in obj:
+        return datetime.fromisoformat(obj['$date'])
+    return obj
+
+
+def _dump_mock_state(state):
+    """
+    Сериализует состояние заглушки MongoDB в JSON (через bson.json_util,
+    если он доступен). Файл содержит только данные, а не объекты Python,
+    поэтому его загрузка не выполняет код.
+    """
+    if JSON_UTIL_AVAILABLE:
+        return json_util.dumps(state, default=_mock_json_default)
+    return json.dumps(state, default=_mock_json_default)
+
+
+def _load_mock_state(text):
+    """Загружает состояние заглушки MongoDB из JSON (см. _dump_mock_state)"""
+    if JSON_UTIL_AVAILABLE:
+        return json_util.loads(text, json_options=json_util.JSONOptions(tz_aware=False))
+    return json.loads(text, object_hook=_mock_json_object_hook)
+
+
+class MockDatabase:
+    """
+    Заглушка для базы данных MongoDB.
+
+    Если задан путь (MONGODB_MOCK_PATH), содержимое коллекций загружается
+    из JSON-файла при создании и сохраняется в него при flush() и завершении
+    процесса. Данные хранятся в памяти каждого процесса отдельно.
+    """
+    def __init__(self, path=None):
+        self._collections = {}
+        self._path = path
+        self._dirty = False
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+            atexit.register(self.flush)
+        logger.info("Создана заглушка для базы данных MongoDB")
+
+    def __getitem__(self, name):
+        """Получение коллекции по имени"""
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MockCollection(name, database=self)
+            return self._collections[name]
+
+    def list_collection_names(self):
+        """Имена коллекций базы"""
+        return list(self._collections)
+
+    def mark_dirty(self):
+        """Отмечает, что данные изменились и их нужно сохранить"""
+        self._dirty = True
+
+    def _load(self):
+        """Загружает коллекции из файла, если он существует"""
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                state = _load_mock_state(f.read())
+            for name, data in state.get('collections', {}).items():
+                collection = MockCollection(name, database=self)
+                collection._items = {doc['_id']: doc for doc in data['documents']}
+                for index_name, index in data.get('indexes', {}).items():
+                    collection.create_index(
+                        [(field, 1) for field in index['fields']], unique=index['unique'], name=index_name
+                    )
+                self._collections[name] = collection
+            self._dirty = False
+            logger.info(f"Заглушка MongoDB загружена из {self._path}: {len(self._collections)} коллекций")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке заглушки MongoDB из {self._path}: {str(e)}")
+
+    def flush(self):
+        """Атомарно сохраняет коллекции в файл (если путь задан и есть изменения)"""
+        if not self._path or not self._dirty:
+            return False
+        try:
+            state = {'collections': {}}
+            for name, collection in list(self._collections.items()):
+                with collection._lock:
+                    state['collections'][name] = {
+                        'documents': list(collection._items.values()),
+                        'indexes': copy.deepcopy(collection._indexes),
+                    }
+
+            directory = os.path.dirname(os.path.abspath(self._path))
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self._path}.tmp{os.getpid()}"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(_dump_mock_state(state))
+            os.replace(tmp_path, self._path)
+            self._dirty = False
+            logger.info(f"Заглушка MongoDB сохранена в {self._path}")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении заглушки MongoDB в {self._path}: {str(e)}")
+            return False
+
+
+class BaseTrackVectors:
+    """
+    Общий интерфейс хранилищ векторных представлений треков.
+    
+    Хранилище - класс с методами класса: индекс похожих треков, воркер
+    синхронизации и TrackVectorService работают с любым наследником
+    (см. vector_store.get_vector_store). Наследники реализуют чтение и запись
+    векторов, кэш матрицы и точный поиск подключаются примесями
+    MatrixCacheMixin и BruteForceSearchMixin.
+    """
+    
+    @classmethod
+    def ensure_indexes(cls):
+        """
+        Создает индексы хранилища (идемпотентно).
+        
+        Returns:
+            bool: Успешность создания индексов
+        """
+        raise NotImplementedError
+    
+    @classmethod
+    def bulk_upsert(cls, docs):
+        """
+        Сохраняет или обновляет векторные представления нескольких треков.
+        
+        Args:
+            docs: Список словарей {'track_id': ..., 'vector': векторные данные}
+            
+        Returns:
+            dict: {'upserted': число новых записей, 'modified': число обновленных}
+                  или None при ошибке
+        """
+        raise NotImplementedError
+    
+    @classmethod
+    def save_track_vector(cls, track_id, vector_data):
+        """
+        Сохраняет или обновляет векторное представление одного трека.
+        
+        Args:
+            track_id: ID трека в основной базе данных
+            vector_data: Словарь с векторными данными трека
+            
+        Returns:
+            bool: Успешность сохранения
+        """
+        return cls.bulk_upsert([{'track_id': track_id, 'vector': vector_data}]) is not None
+    
+    @classmethod
+    def process_track(cls, track_id, vector_data):
+        """
+        Сохраняет или обновляет векторное представление трека.
+        
+        Returns:
+            Идентификатор записи или None при ошибке
+        """
+        raise NotImplementedError
+    
+    @classmethod
+    def delete_track_vector(cls, track_id):
+        """
+        Удаляет векторное представление трека.
+        
+        Returns:
+            bool: Успешность удаления (True, если записи уже нет)
+        """
+        raise NotImplementedError
+    
+    @staticmethod
+    def record_changes(track_ids, operation):
+        """
+        Записывает изменения векторов в outbox (VectorChange), откуда их читает
+        воркер синхронизации индекса. Так изменения из любых процессов и узлов
+        доходят до индекса.
+        
+        Ошибка записи не перехватывается: хранилище в реляционной БД откатывает
+        вместе с ней транзакцию с вектором, а вызывающий код получает ошибку
+        вместо потерянного изменения.
+        
+        Args:
+            track_ids: ID треков с измененными векторами
+            operation: 'upsert' или 'delete'
+        """
+        if not getattr(settings, 'VECTOR_SYNC_OUTBOX', True) or not track_ids:
+            return
+        
+        from .models import VectorChange
+        
+        VectorChange.objects.bulk_create([
+            VectorChange(track_id=int(track_id), operation=operation)
+            for track_id in track_ids
+        ])
+    
+    @classmethod
+    def get_track_vector(cls, track_id):
+        """
+        Возвращает векторные данные трека (эмбеддинг - список чисел) или None.
+        """
+        raise NotImplementedError
+    
+    @classmethod
+    def get_track_vectors(cls, track_ids):
+        """
+        Возвращает векторные данные нескольких треков: {ID трека: векторные данные}.
+        """
+        raise NotImplementedError
+    
+    @classmethod
+    def get_embeddings(cls, track_ids):
+        """
+        Возвращает эмбеддинги нескольких треков: {ID трека: numpy-массив float32};
+        треки без эмбеддинга отсутствуют.
+        """
+        raise NotImplementedError
+    
+    @classmethod
+    def existing_track_ids(cls):
+        """Возвращает множество ID треков, для которых сохранен эмбеддинг"""
+        raise NotImplementedError
+    
+    @classmethod
+    def iter_embeddings(cls, query=None, batch_size=1000):
+        """
+        Потоково перебирает эмбеддинги треков.
+        
+        Yields:
+            tuple: (track_id, embedding), где embedding - numpy-массив float32
+        """
+        raise NotImplementedError
+    
+    @classmethod
+    def count_vectors(cls, query=None):
+        """Возвращает количество сохраненных векторов треков"""
+        raise NotImplementedError
+    
+    @classmethod
+    def load_vectors_matrix(cls, dim, query=None, batch_size=1000):
+        """
+        Загружает эмбеддинги всех треков в одну float32-матрицу.
+        
+        Матрица выделяется заранее по числу векторов и заполняется
+        построчно прямо из iter_embeddings, поэтому пиковое потребление памяти
+        определяется размером матрицы, а не количеством записей.
+        
+        Args:
+            dim: Ожидаемая размерность эмбеддингов (остальные пропускаются)
+            query: Дополнительный фильтр хранилища
+            batch_size: Количество записей в одной пачке чтения
+            
+        Returns:
+            tuple: (track_ids, matrix), где track_ids - массив int64 длины N,
+                   matrix - массив float32 размера N x dim
+        """
+        capacity = cls.count_vectors(query)
+        
+        track_ids = np.empty(capacity, dtype=np.int64)
+        matrix = np.empty((capacity, dim), dtype=np.float32)
+        
+        count = 0
+        skipped = 0
+        for track_id, embedding in cls.iter_embeddings(query, batch_size):
+            if len(embedding) != dim:
+                skipped += 1
+                continue
+            
+            # Хранилище могло вырасти во время чтения
+            if count == capacity:
+                capacity = max(capacity * 2, batch_size)
+                track_ids = np.resize(track_ids, capacity)
+                matrix = np.resize(matrix, (capacity, dim))
+            
+            track_ids[count] = track_id
+            matrix[count] = embedding
+            count += 1
+        
+        if skipped:
+            logger.warning(f"Пропущено {skipped} эмбеддингов с размерностью, отличной от {dim}")
+        
+        return track_ids[:count], matrix[:count]
+    
+    @classmethod
+    def invalidate_matrix_cache(cls):
+        """Сбрасывает кэш векторов после записи (у хранилищ без кэша ничего не делает)"""
+    
+    @classmethod
+    def find_similar_tracks_with_scores(cls, vector, limit=5, exclude_track_id=None):
+        """
+        Находит похожие треки и возвращает их вместе с оценками сходства.
+        
+        Returns:
+            list: Список кортежей (track_id, similarity_score) в шкале cosine_to_similarity
+        """
+        raise NotImplementedError
+    
+    @classmethod
+    def find_similar_tracks(cls, vector_data, limit=10):
+        """
+        Находит треки похожие на переданный вектор с использованием
+        косинусного расстояния между векторами CLAP.
+        
+        Args:
+            vector_data: Векторные данные для поиска похожих треков
+            limit: Максимальное количество результатов
+            
+        Returns:
+            Список ID треков, отсортированный по схожести
+        """
+        # Если numpy недоступен, возвращаем случайные треки
+        if not NUMPY_AVAILABLE:
+            logger.warning("Numpy недоступен. Рекомендации будут ограничены.")
+            # Получаем список всех треков, кроме исходного
+            all_tracks = [
+                track_id for track_id in cls.existing_track_ids()
+                if track_id != vector_data.get('track_id')
+            ]
+            # Перемешиваем список
+            random.shuffle(all_tracks)
+            return all_tracks[:limit]
+        
+        # Получаем эмбеддинг исходного трека
+        if not vector_data or 'embedding' not in vector_data:
+            return []
+        
+        similar_tracks = cls.find_similar_tracks_with_scores(
+            vector_data['embedding'], limit, exclude_track_id=vector_data.get('track_id')
+        )
+        return [track_id for track_id, _ in similar_tracks]
+    
+    @staticmethod
+    def cosine_similarity(vec1, vec2):
+        """
+        Вычисляет косинусное сходство между двумя векторами.
+        
+        Args:
+            vec1: Первый вектор
+            vec2: Второй вектор
+            
+        Returns:
+            float: Значение косинусного сходства в диапазоне [0, 1]
+        """
+        try:
+            # Преобразуем в numpy arrays если нужно
+            if not isinstance(vec1, np.ndarray):
+                vec1 = np.array(vec1)
+            if not isinstance(vec2, np.ndarray):
+                vec2 = np.array(vec2)
+                
+            # Вычисляем косинусное сходство
+            dot_product = np.dot(vec1, vec2)
+            norm1 = np.linalg.norm(vec1)
+            norm2 = np.linalg.norm(vec2)
+            
+            # Защищаемся от деления на ноль
+            if norm1 == 0 or norm2 == 0:
+                return 0
+                
+            return dot_product / (norm1 * norm2)
+            
+        except Exception as e:
+            logger.error(f"Ошибка при вычислении косинусного сходства: {str(e)}")
+            return 0
 
-class MongoDBSingleton:
+
+class MatrixCacheMixin:
     """
-    Синглтон для работы с MongoDB.
+    Примесь хранилища векторов: кэш нормализованной матрицы всех векторов
+    для поиска без индекса. У каждого класса-хранилища собственный кэш.
     """
-    _instance = None
-    _client = None
-    _db = None
+    MATRIX_TTL = 60  # Время жизни кэша матрицы векторов в секундах
+    MATRIX_FALLBACK_ERRORS = ()  # Ошибки загрузки, при которых используется устаревшая матрица
+    
+    _matrix_cache = None
+    _matrix_lock = threading.Lock()
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Кэши разных хранилищ не должны смешиваться
+        cls._matrix_cache = None
+        cls._matrix_lock = threading.Lock()
     
     @classmethod
-    def get_instance(cls):
-        """Получение синглтон-экземпляра класса"""
-        if cls._instance is None:
-            cls._instance = cls()
-        return cls._instance
+    def invalidate_matrix_cache(cls):
+        """
+        Помечает кэш матрицы векторов устаревшим после изменения хранилища.
+        Матрица перезагрузится при следующем поиске, а пока хранилище
+        недоступно, останется запасным вариантом.
+        """
+        with cls._matrix_lock:
+            if cls._matrix_cache is not None:
+                cls._matrix_cache['loaded_at'] = float('-inf')
     
-    def __init__(self):
-        """Инициализация соединения с MongoDB"""
-        try:
-            if not PYMONGO_AVAILABLE:
-                raise ImportError("PyMongo недоступен")
-                
-            # Проверка наличия настроек MongoDB
-            mongodb_uri = getattr(settings, 'MONGODB_URI', 'mongodb://localhost:27017/')
-            mongodb_db = getattr(settings, 'MONGODB_DB', 'music_app')
+    @classmethod
+    def get_normalized_matrix(cls, dim):
+        """
+        Возвращает закэшированную нормализованную float32-матрицу всех векторов хранилища.
+        
+        Кэш сбрасывается при записи векторов в этом процессе, а изменения из других
+        процессов подхватываются по истечении TRACK_VECTORS_MATRIX_TTL секунд.
+        Если при загрузке возникла ошибка из MATRIX_FALLBACK_ERRORS (хранилище
+        недоступно), возвращается последняя загруженная матрица.
+        
+        Args:
+            dim: Размерность эмбеддингов
             
-            # Попытка подключения
-            self._client = MongoClient(mongodb_uri)
-            self._db = self._client[mongodb_db]
+        Returns:
+            tuple: (track_ids, matrix) - массив int64 и нормализованная матрица float32
+        """
+        ttl = getattr(settings, 'TRACK_VECTORS_MATRIX_TTL', cls.MATRIX_TTL)
+        
+        with cls._matrix_lock:
+            cache = cls._matrix_cache
+            if cache is not None and cache['dim'] == dim and time.monotonic() - cache['loaded_at'] < ttl:
+                return cache['track_ids'], cache['matrix']
             
-            logger.info(f"Успешное подключение к MongoDB: {mongodb_uri}, DB: {mongodb_db}")
-        except Exception as e:
-            logger.error(f"Ошибка подключения к MongoDB: {str(e)}")
-            # Создаем заглушку для базы данных
-            self._client = None
-            self._db = MockDatabase()
-            logger.warning("Создана заглушка для MongoDB")
-    
-    def get_db(self):
-        """Получение объекта базы данных"""
-        return self._db
+            try:
+                track_ids, matrix = cls.load_vectors_matrix(dim)
+            except cls.MATRIX_FALLBACK_ERRORS:
+                # Пока хранилище недоступно, поиск работает по устаревшей матрице
+                if cache is not None and cache['dim'] == dim:
+                    logger.warning(f"Хранилище {cls.__name__} недоступно, используем устаревшую матрицу векторов")
+                    return cache['track_ids'], cache['matrix']
+                raise
+            
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix /= norms
+            
+            cls._matrix_cache = {
+                'dim': dim,
+                'track_ids': track_ids,
+                'matrix': matrix,
+                'loaded_at': time.monotonic(),
+            }
+            logger.info(f"Матрица векторов закэширована: {len(track_ids)} треков")
+            return track_ids, matrix
 
-class MockCollection:
-    """Заглушка для коллекции MongoDB"""
-    def __init__(self, name):
-        self.name = name
-        self._items = {}
-        logger.info(f"Создана заглушка для коллекции MongoDB: {name}")
+
+class BruteForceSearchMixin:
+    """
+    Примесь хранилища векторов: точный поиск похожих треков полным перебором
+    по закэшированной нормализованной матрице (нужна MatrixCacheMixin).
+    """
     
-    def insert_one(self, document):
-        """Имитация вставки одного документа"""
-        if '_id' not in document:
-            document['_id'] = str(random.randint(1, 1000000))
-        self._items[document['_id']] = document
-        logger.info(f"Заглушка MongoDB: документ добавлен в коллекцию {self.name}")
-        return MockInsertResult(document['_id'])
+    @classmethod
+    def find_similar_tracks_with_scores(cls, vector, limit=5, exclude_track_id=None):
+        """
+        Находит похожие треки полным перебором по закэшированной
+        нормализованной матрице векторов хранилища.
+        
+        Returns:
+            list: Список кортежей (track_id, similarity_score) в шкале cosine_to_similarity
+        """
+        if not NUMPY_AVAILABLE or vector is None or len(vector) == 0:
+            return []
+        try:
+            return cls._find_similar_brute_force(vector, limit, exclude_track_id)
+        except Exception as e:
+            logger.error(f"Ошибка при поиске похожих треков в хранилище {cls.__name__}: {str(e)}")
+            return []
     
-    def find_one(self, query):
-        """Имитация поиска одного документа"""
-        if not query:
-            return None
+    @classmethod
+    def _find_similar_brute_force(cls, vector, limit, exclude_track_id=None):
+        """
+        Точный поиск по косинусному сходству: одно матрично-векторное умножение
+        по закэшированной нормализованной матрице и выбор top-k через argpartition.
         
-        # Поиск по track_id
-        if 'track_id' in query:
-            track_id = query['track_id']
-            for item in self._items.values():
-                if item.get('track_id') == track_id:
-                    logger.info(f"Заглушка MongoDB: найден документ по track_id: {track_id}")
-                    return item
+        Returns:
+            list: Список кортежей (track_id, similarity_score) по убыванию сходства,
+                  оценка в шкале cosine_to_similarity
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        track_ids, matrix = cls.get_normalized_matrix(len(query))
+        if len(track_ids) == 0:
+            return []
         
-        # Поиск по _id
-        if '_id' in query and query['_id'] in self._items:
-            logger.info(f"Заглушка MongoDB: найден документ по _id: {query['_id']}")
-            return self._items[query['_id']]
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
         
-        logger.info(f"Заглушка MongoDB: документ не найден для запроса: {query}")
-        return None
-    
-    def find(self, query=None):
-        """Имитация поиска документов"""
-        if query is None:
-            logger.info(f"Заглушка MongoDB: возвращаем все документы из коллекции {self.name}")
-            return list(self._items.values())
+        scores = matrix @ (query / norm)
         
-        # Обработка запроса на исключение по track_id
-        if query.get('track_id', {}).get('$ne'):
-            track_id_to_exclude = query['track_id']['$ne']
-            results = [doc for doc in self._items.values() if doc.get('track_id') != track_id_to_exclude]
-            logger.info(f"Заглушка MongoDB: найдено {len(results)} документов (исключая track_id: {track_id_to_exclude})")
-            return MockCursor(results)
+        # Исключаемый трек не должен попасть в выдачу
+        if exclude_track_id is not None:
+            try:
+                scores[track_ids == int(exclude_track_id)] = -np.inf
+            except (TypeError, ValueError):
+                pass
         
-        # Поиск по остальным условиям - упрощенный вариант
-        logger.info(f"Заглушка MongoDB: поиск документов для запроса: {query}")
-        return MockCursor([])
-
-class MockCursor:
-    """Заглушка для курсора MongoDB"""
-    def __init__(self, items):
-        self.items = items
-    
-    def __iter__(self):
-        return iter(self.items)
-    
-    def __len__(self):
-        return len(self.items)
-    
-    def __getitem__(self, index):
-        return self.items[index]
-
-class MockInsertResult:
-    """Заглушка для результата вставки в MongoDB"""
-    def __init__(self, inserted_id):
-        self.inserted_id = inserted_id
+        k = min(limit, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        
+        top = top[np.isfinite(scores[top])]
+        similarities = cosine_to_similarity(scores[top])
+        return [
+            (int(track_ids[row]), float(similarity))
+            for row, similarity in zip(top, similarities)
+        ]
 
-class MockDatabase:
-    """Заглушка для базы данных MongoDB"""
-    def __init__(self):
-        self._collections = {}
-        logger.info("Создана заглушка для базы данных MongoDB")
-    
-    def __getitem__(self, name):
-        """Получение коллекции по имени"""
-        if name not in self._collections:
-            self._collections[name] = MockCollection(name)
-        return self._collections[name]
 
-class TrackVectors:
+class TrackVectors(MatrixCacheMixin, BruteForceSearchMixin, BaseTrackVectors):
     """
     Сервис для работы с векторными представлениями треков в MongoDB.
     """
     COLLECTION_NAME = 'track_vectors'
+    EMBEDDING_FORMAT = 'array'  # Формат хранения эмбеддингов: 'array' (Atlas $vectorSearch) или 'binary'
+    
+    # Пока MongoDB недоступна, поиск без $vectorSearch работает по устаревшей матрице
+    MATRIX_FALLBACK_ERRORS = (MongoUnavailableError,) + MONGO_OUTAGE_ERRORS
     
     @classmethod
     def get_collection(cls):
@@ -162,10 +1592,146 @@ class TrackVectors:
         db = MongoDBSingleton.get_instance().get_db()
         return db[cls.COLLECTION_NAME]
     
+    @classmethod
+    def get_embedding_format(cls):
+        """
+        Возвращает формат хранения эмбеддингов (TRACK_VECTORS_EMBEDDING_FORMAT):
+        'array' - массив double (по умолчанию, нужен для MongoDB Atlas $vectorSearch),
+        'binary' - float32 BSON Binary с заголовком (включается явно: Atlas
+        не индексирует такие эмбеддинги).
+        """
+        return getattr(settings, 'TRACK_VECTORS_EMBEDDING_FORMAT', cls.EMBEDDING_FORMAT)
+    
+    @classmethod
+    def _encode_vector_data(cls, vector_data):
+        """Приводит эмбеддинг в векторных данных к формату хранения"""
+        embedding = vector_data.get('embedding')
+        if not NUMPY_AVAILABLE or embedding is None or len(embedding) == 0:
+            return vector_data
+        
+        vector_data = dict(vector_data)
+        if cls.get_embedding_format() == 'binary':
+            vector_data['embedding'] = encode_embedding(embedding)
+        else:
+            vector_data['embedding'] = np.asarray(embedding, dtype=np.float32).tolist()
+        return vector_data
+    
+    @classmethod
+    def ensure_indexes(cls):
+        """
+        Создает уникальный индекс по track_id (идемпотентно). Вызывается при старте
+        приложения: по нему работают поиск вектора трека и upsert без дубликатов.
+        
+        Returns:
+            bool: Успешность создания индекса
+        """
+        try:
+            collection = cls.get_collection()
+            if not hasattr(collection, 'create_index'):
+                return False
+            with mongo_guard():
+                collection.create_index('track_id', unique=True, name='track_id_unique')
+            return True
+        except Exception as e:
+            logger.error(
+                f"Не удалось создать уникальный индекс по track_id: {str(e)}. "
+                f"Проверьте коллекцию {cls.COLLECTION_NAME} на дубликаты track_id"
+            )
+            return False
+    
+    @classmethod
+    def _upsert_operation(cls, track_id, vector_data):
+        """Формирует операцию upsert векторного представления трека"""
+        from pymongo import UpdateOne
+        
+        return UpdateOne(
+            {'track_id': track_id},
+            {'$set': {'vector': cls._encode_vector_data(vector_data)}},
+            upsert=True
+        )
+    
+    @classmethod
+    def _record_saved_changes(cls, track_ids, operation):
+        """
+        Записывает в outbox изменения, уже сохраненные в MongoDB. Запись в MongoDB
+        и в outbox не атомарна: без записи outbox изменение не дойдет до индекса,
+        поэтому операция сообщается вызывающему коду как неудачная. Ее повтор
+        безопасен - upsert и удаление идемпотентны.
+        
+        Returns:
+            bool: True, если изменения записаны в outbox
+        """
+        try:
+            cls.record_changes(track_ids, operation)
+            return True
+        except Exception as e:
+            logger.error(
+                f"Изменения векторов треков {list(track_ids)} сохранены в MongoDB, но не записаны в outbox "
+                f"и не попадут в индекс без повтора операции: {str(e)}"
+            )
+            return False
+    
+    @classmethod
+    def bulk_upsert(cls, docs):
+        """
+        Сохраняет или обновляет векторные представления нескольких треков
+        одним запросом bulk_write с UpdateOne(upsert=True).
+        
+        Args:
+            docs: Список словарей {'track_id': ..., 'vector': векторные данные}
+            
+        Returns:
+            dict: {'upserted': число новых документов, 'modified': число обновленных}
+                  или None при ошибке
+        """
+        if not docs:
+            return {'upserted': 0, 'modified': 0}
+        
+        try:
+            operations = [cls._upsert_operation(doc['track_id'], doc['vector']) for doc in docs]
+            with mongo_guard():
+                result = cls.get_collection().bulk_write(operations, ordered=False)
+            cls.invalidate_matrix_cache()
+            if not cls._record_saved_changes([doc['track_id'] for doc in docs], 'upsert'):
+                return None
+            
+            logger.info(
+                f"Сохранены векторные представления {len(docs)} треков: "
+                f"новых {result.upserted_count}, обновлено {result.modified_count}"
+            )
+            return {'upserted': result.upserted_count, 'modified': result.modified_count}
+        except Exception as e:
+            logger.error(f"Ошибка при пакетном сохранении векторных представлений: {str(e)}")
+            return None
+    
+    @classmethod
+    def delete_track_vector(cls, track_id):
+        """
+        Удаляет векторное представление трека.
+        
+        Args:
+            track_id: ID трека в основной базе данных
+            
+        Returns:
+            bool: Успешность удаления (True, если документа уже нет)
+        """
+        try:
+            with mongo_guard():
+                cls.get_collection().delete_one({'track_id': track_id})
+            cls.invalidate_matrix_cache()
+            if not cls._record_saved_changes([track_id], 'delete'):
+                return False
+            logger.info(f"Векторное представление трека {track_id} удалено")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при удалении векторного представления трека {track_id}: {str(e)}")
+            return False
+    
     @classmethod
     def process_track(cls, track_id, vector_data):
         """
-        Сохраняет или обновляет векторное представление трека в MongoDB.
+        Сохраняет или обновляет векторное представление трека в MongoDB
+        за один запрос (upsert).
         
         Args:
             track_id: ID трека в основной базе данных
@@ -175,23 +1741,22 @@ class TrackVectors:
             ID добавленного/обновленного документа
         """
         try:
-            collection = cls.get_collection()
-            
-            # Проверяем, существует ли уже документ для этого трека
-            existing_doc = collection.find_one({'track_id': track_id})
+            from pymongo import ReturnDocument
             
-            if existing_doc:
-                # Если документ существует, обновляем его
-                logger.info(f"Обновление векторного представления трека {track_id}")
-                return existing_doc['_id']
-            else:
-                # Если документа нет, создаем новый
-                logger.info(f"Добавление нового векторного представления трека {track_id}")
-                result = collection.insert_one({
-                    'track_id': track_id,
-                    'vector': vector_data
-                })
-                return result.inserted_id
+            collection = cls.get_collection()
+            with mongo_guard():
+                doc = collection.find_one_and_update(
+                    {'track_id': track_id},
+                    {'$set': {'vector': cls._encode_vector_data(vector_data)}},
+                    projection={'_id': 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            cls.invalidate_matrix_cache()
+            if not cls._record_saved_changes([track_id], 'upsert'):
+                return None
+            logger.info(f"Векторное представление трека {track_id} сохранено")
+            return doc['_id']
                 
         except Exception as e:
             logger.error(f"Ошибка при сохранении векторного представления трека {track_id}: {str(e)}")
@@ -206,77 +1771,145 @@ class TrackVectors:
             track_id: ID трека в основной базе данных
             
         Returns:
-            Словарь с векторными данными или None, если не найден
+            Словарь с векторными данными или None, если не найден.
+            Эмбеддинг возвращается списком чисел независимо от формата хранения.
         """
         collection = cls.get_collection()
-        result = collection.find_one({'track_id': track_id})
-        return result.get('vector') if result else None
+        with mongo_guard():
+            result = collection.find_one({'track_id': track_id})
+        if not result:
+            return None
+        
+        vector = result.get('vector')
+        if vector and 'embedding' in vector:
+            embedding = decode_embedding(vector['embedding'])
+            vector = dict(vector, embedding=embedding.tolist() if embedding is not None else [])
+        return vector
     
     @classmethod
-    def find_similar_tracks(cls, vector_data, limit=10):
+    def get_track_vectors(cls, track_ids):
         """
-        Находит треки похожие на переданный вектор с использованием
-        косинусного расстояния между векторами CLAP.
+        Получает векторные данные нескольких треков одним запросом.
         
         Args:
-            vector_data: Векторные данные для поиска похожих треков
-            limit: Максимальное количество результатов
+            track_ids: ID треков
             
         Returns:
-            Список ID треков, отсортированный по схожести
+            dict: {ID трека: векторные данные}; эмбеддинг - список чисел
         """
         collection = cls.get_collection()
+        vectors = {}
+        with mongo_guard():
+            for doc in collection.find({'track_id': {'$in': list(track_ids)}}, {'_id': 0, 'track_id': 1, 'vector': 1}):
+                vector = doc.get('vector') or {}
+                if 'embedding' in vector:
+                    embedding = decode_embedding(vector['embedding'])
+                    vector = dict(vector, embedding=embedding.tolist() if embedding is not None else [])
+                vectors[doc['track_id']] = vector
+        return vectors
+    
+    @classmethod
+    def get_embeddings(cls, track_ids):
+        """
+        Получает эмбеддинги нескольких треков одним запросом.
         
-        # Если numpy недоступен, возвращаем случайные треки
-        if not NUMPY_AVAILABLE:
-            logger.warning("Numpy недоступен. Рекомендации будут ограничены.")
-            # Получаем список всех треков, кроме исходного
-            all_tracks = list(collection.find({'track_id': {'$ne': vector_data.get('track_id')}}))
-            # Перемешиваем список
-            random.shuffle(all_tracks)
-            return [track['track_id'] for track in all_tracks[:limit]]
+        Args:
+            track_ids: ID треков
+            
+        Returns:
+            dict: {ID трека: numpy-массив float32}; треки без эмбеддинга отсутствуют
+        """
+        track_ids = list(track_ids)
+        if not track_ids:
+            return {}
+        return dict(cls.iter_embeddings({'track_id': {'$in': track_ids}}))
+    
+    @classmethod
+    def existing_track_ids(cls):
+        """Возвращает множество ID треков, для которых сохранен эмбеддинг"""
+        with mongo_guard():
+            cursor = cls.get_collection().find(
+                {'vector.embedding': {'$exists': True}}, {'_id': 0, 'track_id': 1}
+            )
+            return {doc.get('track_id') for doc in cursor}
+    
+    @classmethod
+    def iter_embeddings(cls, query=None, batch_size=1000):
+        """
+        Потоково перебирает эмбеддинги треков из MongoDB.
         
-        # Получаем эмбеддинг исходного трека
-        if not vector_data or 'embedding' not in vector_data:
-            return []
+        Запрашивает только track_id и эмбеддинг (без метаданных трека),
+        а документы читаются с сервера пачками по batch_size.
         
-        # В заглушке просто возвращаем случайные ID
-        return [str(random.randint(1, 100)) for _ in range(limit)]
-
+        Args:
+            query: Дополнительный фильтр MongoDB
+            batch_size: Количество документов в одной пачке курсора
+            
+        Yields:
+            tuple: (track_id, embedding), где embedding - numpy-массив float32
+        """
+        collection = cls.get_collection()
+        with mongo_guard():
+            cursor = collection.find(
+                query or {},
+                {'_id': 0, 'track_id': 1, 'vector.embedding': 1}
+            ).batch_size(batch_size)
+            
+            for doc in cursor:
+                embedding = decode_embedding((doc.get('vector') or {}).get('embedding'))
+                if embedding is not None:
+                    yield doc.get('track_id'), embedding
+    
+    @classmethod
+    def count_vectors(cls, query=None):
+        """
+        Возвращает количество документов с векторами треков.
+        
+        Args:
+            query: Дополнительный фильтр MongoDB
+            
+        Returns:
+            int: Количество документов
+        """
+        with mongo_guard():
+            return cls.get_collection().count_documents(query or {})
+    
     @classmethod
     def find_similar_tracks_with_scores(cls, vector, limit=5, exclude_track_id=None):
         """
         Находит похожие треки на основе векторных представлений и возвращает их вместе с оценками сходства.
         
+        Сначала используется $vectorSearch (MongoDB Atlas). Если он недоступен,
+        все векторы оцениваются одним умножением закэшированной нормализованной
+        матрицы на вектор запроса, а top-k выбирается через argpartition.
+        
         Args:
             vector: Векторное представление трека
             limit: Максимальное количество похожих треков
             exclude_track_id: ID трека, который необходимо исключить из результатов
             
         Returns:
-            list: Список кортежей (track_id, similarity_score)
+            list: Список кортежей (track_id, similarity_score); оценка в шкале
+                  cosine_to_similarity (1 - angular-расстояние), как у бэкендов индекса
         """
         try:
+            # Преобразуем numpy array в list если необходимо
+            if hasattr(vector, 'tolist'):
+                vector = vector.tolist()
+                
             # Убедимся, что вектор в формате list и имеет корректную длину
             if not vector or not isinstance(vector, list):
                 logger.error(f"Некорректный формат вектора: {type(vector)}")
                 return []
-                
-            # Проверяем подключение к MongoDB
-            if not cls.check_connection():
-                logger.error("Не удалось подключиться к MongoDB")
-                return []
-                
-            # Преобразуем numpy array в list если необходимо
-            if hasattr(vector, 'tolist'):
-                vector = vector.tolist()
+            
+            collection = cls.get_collection()
                 
             # Создаем агрегационный пайплайн для поиска похожих треков
             pipeline = [
                 {
                     "$vectorSearch": {
                         "index": "vector_index",
-                        "path": "embedding",
+                        "path": "vector.embedding",
                         "queryVector": vector,
                         "numCandidates": limit * 3,  # Просматриваем больше кандидатов для лучшего результата
                         "limit": limit + 1 if exclude_track_id else limit  # +1 для учета исключения
@@ -284,7 +1917,7 @@ class TrackVectors:
                 },
                 {
                     "$project": {
-                        "_id": 1,
+                        "_id": 0,
                         "track_id": 1,
                         "score": {
                             "$meta": "vectorSearchScore"  # Получаем оценку сходства
@@ -293,88 +1926,36 @@ class TrackVectors:
                 }
             ]
             
-            # Выполняем поиск
-            results = list(cls.db[cls.COLLECTION_NAME].aggregate(pipeline))
+            # Выполняем поиск (без Atlas Search или в заглушке $vectorSearch недоступен)
+            # Отказы соединения учитываются автоматом защиты, а поиск продолжается
+            # по закэшированной матрице векторов
+            try:
+                with mongo_guard():
+                    results = list(collection.aggregate(pipeline))
+            except Exception as e:
+                logger.debug(f"MongoDB $vectorSearch недоступен: {str(e)}")
+                results = []
             
-            # Формируем список похожих треков с оценками сходства
+            # Формируем список похожих треков: vectorSearchScore ((1 + cos) / 2)
+            # переводится в общую для всех путей поиска шкалу cosine_to_similarity
             similar_tracks_with_scores = []
             for doc in results:
-                # Преобразуем ObjectId в строку, если необходимо
-                track_id = str(doc['track_id']) if isinstance(doc['track_id'], ObjectId) else doc['track_id']
+                track_id = doc['track_id']
                 
                 # Исключаем исходный трек, если указан
-                if exclude_track_id and track_id == exclude_track_id:
+                if exclude_track_id is not None and str(track_id) == str(exclude_track_id):
                     continue
-                    
-                # Нормализуем оценку сходства в диапазон [0, 1]
-                similarity_score = min(1.0, max(0.0, doc['score']))
                 
-                similar_tracks_with_scores.append((track_id, similarity_score))
+                cosine = vector_search_score_to_cosine(doc['score'])
+                similar_tracks_with_scores.append((track_id, float(cosine_to_similarity(cosine))))
                 
             # Если MongoDB не поддерживает $vectorSearch или не вернула результаты, используем косинусное сходство
-            if not similar_tracks_with_scores:
+            if not similar_tracks_with_scores and NUMPY_AVAILABLE:
                 logger.info("MongoDB $vectorSearch не сработал, используем косинусное сходство")
-                # Получаем все векторы из коллекции
-                all_vectors = list(cls.db[cls.COLLECTION_NAME].find({}, {'track_id': 1, 'embedding': 1}))
-                
-                # Вычисляем косинусное сходство для каждого вектора
-                similarity_results = []
-                for doc in all_vectors:
-                    doc_vector = doc.get('embedding')
-                    doc_track_id = str(doc['track_id']) if isinstance(doc['track_id'], ObjectId) else doc['track_id']
-                    
-                    # Пропускаем исключаемый трек
-                    if exclude_track_id and doc_track_id == exclude_track_id:
-                        continue
-                        
-                    # Пропускаем документы без векторов или с некорректными векторами
-                    if not doc_vector or not isinstance(doc_vector, list) or len(doc_vector) != len(vector):
-                        continue
-                        
-                    # Вычисляем косинусное сходство
-                    similarity = cls.cosine_similarity(vector, doc_vector)
-                    similarity_results.append((doc_track_id, similarity))
-                
-                # Сортируем по убыванию сходства и берем top-limit
-                similarity_results.sort(key=lambda x: x[1], reverse=True)
-                similar_tracks_with_scores = similarity_results[:limit]
+                similar_tracks_with_scores = cls._find_similar_brute_force(vector, limit, exclude_track_id)
             
-            return similar_tracks_with_scores
+            return similar_tracks_with_scores[:limit]
             
         except Exception as e:
             logger.error(f"Ошибка при поиске похожих треков с оценками: {str(e)}")
             return []
-
-    @staticmethod
-    def cosine_similarity(vec1, vec2):
-        """
-        Вычисляет косинусное сходство между двумя векторами.
-        
-        Args:
-            vec1: Первый вектор
-            vec2: Второй вектор
-            
-        Returns:
-            float: Значение косинусного сходства в диапазоне [0, 1]
-        """
-        try:
-            # Преобразуем в numpy arrays если нужно
-            if not isinstance(vec1, np.ndarray):
-                vec1 = np.array(vec1)
-            if not isinstance(vec2, np.ndarray):
-                vec2 = np.array(vec2)
-                
-            # Вычисляем косинусное сходство
-            dot_product = np.dot(vec1, vec2)
-            norm1 = np.linalg.norm(vec1)
-            norm2 = np.linalg.norm(vec2)
-            
-            # Защищаемся от деления на ноль
-            if norm1 == 0 or norm2 == 0:
-                return 0
-                
-            return dot_product / (norm1 * norm2)
-            
-        except Exception as e:
-            logger.error(f"Ошибка при вычислении косинусного сходства: {str(e)}")
-            return 0 
\ No newline at end of file
@@ -0,0 +1,210 @@
+"""
+Модуль quantization.py
+Скалярное квантование эмбеддингов в int8 для приближенного поиска
+по компактным кодам с точным переранжированием по float32-векторам.
+"""
+
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ScalarQuantizer:
+    """
+    Покомпонентное скалярное квантование float32-векторов в int8.
+
+    Для каждой размерности запоминаются минимум и шаг квантования, после чего
+    значение кодируется одним байтом. Код занимает в 4 раза меньше памяти, чем
+    float32, и в 8 раз меньше, чем float64. Переранжирование читает исходные
+    float32-векторы только для кандидатов, поэтому их можно хранить вне памяти
+    (в индексе - в файле деревьев Annoy).
+    """
+
+    LEVELS = 255  # Количество уровней квантования (int8: от -128 до 127)
+
+    def __init__(self, offset=None, scale=None):
+        """
+        Args:
+            offset: Минимальное значение по каждой размерности
+            scale: Шаг квантования по каждой размерности
+        """
+        self.offset = offset
+        self.scale = scale
+
+    @property
+    def is_fitted(self):
+        """Проверяет, обучен ли квантователь"""
+        return self.offset is not None and self.scale is not None
+
+    def fit(self, matrix, block_size=65536):
+        """
+        Вычисляет параметры квантования по матрице векторов.
+        Матрица читается блоками, поэтому может быть открыта через mmap.
+
+        Args:
+            matrix: Матрица float32 размера N x dim
+            block_size: Количество строк в блоке
+
+        Returns:
+            ScalarQuantizer: self
+        """
+        minimum = np.full(matrix.shape[1], np.inf, dtype=np.float32)
+        maximum = np.full(matrix.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(matrix), block_size):
+            block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+            np.minimum(minimum, block.min(axis=0), out=minimum)
+            np.maximum(maximum, block.max(axis=0), out=maximum)
+
+        scale = (maximum - minimum) / self.LEVELS
+        scale[scale == 0] = 1.0
+
+        self.offset = minimum.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+        return self
+
+    def encode(self, matrix):
+        """
+        Кодирует векторы в int8.
+
+        Args:
+            matrix: Матрица float32 размера N x dim
+
+        Returns:
+            numpy.ndarray: Коды int8 размера N x dim
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        levels = np.rint((matrix - self.offset) / self.scale)
+        return (np.clip(levels, 0, self.LEVELS) - 128).astype(np.int8)
+
+    def decode(self, codes):
+        """
+        Восстанавливает приближенные float32-векторы из кодов.
+
+        Args:
+            codes: Коды int8 размера N x dim
+
+        Returns:
+            numpy.ndarray: Матрица float32 размера N x dim
+        """
+        return (codes.astype(np.float32) + 128) * self.scale + self.offset
+
+    def score(self, query, codes, block_size=65536):
+        """
+        Вычисляет скалярные произведения запроса со всеми закодированными векторами
+        без полной декомпрессии: q·x = (q*scale)·(c+128) + q·offset.
+        Коды обрабатываются блоками, чтобы не создавать float32-копию всей матрицы.
+
+        Args:
+            query: Вектор запроса float32
+            codes: Коды int8 размера N x dim
+            block_size: Количество строк в блоке
+
+        Returns:
+            numpy.ndarray: Оценки float32 длины N
+        """
+        query = np.asarray(query, dtype=np.float32)
+        scaled_query = query * self.scale
+        bias = 128.0 * scaled_query.sum() + float(query @ self.offset)
+
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), block_size):
+            block = codes[start:start + block_size].astype(np.float32)
+            scores[start:start + block_size] = block @ scaled_query + bias
+        return scores
+
+    def save(self, f):
+        """Сохраняет параметры квантования в файл .npz"""
+        np.savez(f, offset=self.offset, scale=self.scale)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Загружает параметры квантования из файла .npz.
+
+        Returns:
+            ScalarQuantizer
+        """
+        params = np.load(path)
+        return cls(offset=params['offset'], scale=params['scale'])
+
+
+def quantized_search(query, quantizer, codes, vectors, limit, rerank_factor=10, excluded=None):
+    """
+    Ищет ближайшие векторы по int8-кодам и переранжирует лучших кандидатов
+    точно по float32-векторам. Оцениваются все коды (O(N·dim) на запрос),
+    а из float32-векторов читаются только строки кандидатов.
+
+    Args:
+        query: Нормализованный вектор запроса float32
+        quantizer: Обученный ScalarQuantizer
+        codes: Коды int8 размера N x dim
+        vectors: Нормализованные float32-векторы размера N x dim: матрица, memmap
+            или любой объект, возвращающий строки по vectors[rows]
+        limit: Количество результатов
+        rerank_factor: Во сколько раз больше кандидатов переранжировать точно
+        excluded: Булева маска длины N для исключаемых строк
+
+    Returns:
+        tuple: (rows, cosines) - номера строк и точные косинусные сходства по убыванию
+    """
+    scores = quantizer.score(query, codes)
+    if excluded is not None:
+        scores[excluded[:len(scores)]] = -np.inf
+
+    n_candidates = min(len(scores), max(limit, limit * rerank_factor))
+    if n_candidates == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    if n_candidates < len(scores):
+        candidates = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+    else:
+        candidates = np.arange(len(scores))
+    candidates = candidates[np.isfinite(scores[candidates])]
+
+    # Точное переранжирование: читаются только строки кандидатов
+    candidates = np.sort(candidates)
+    exact = np.asarray(vectors[candidates], dtype=np.float32) @ query
+    order = np.argsort(-exact)[:limit]
+    return candidates[order], exact[order]
+
+
+def evaluate_recall(matrix, quantizer, codes, query_rows, exact_neighbors, k, rerank_factor):
+    """
+    Измеряет recall@k квантованного поиска относительно точного поиска.
+
+    Args:
+        matrix: Нормализованная матрица float32
+        quantizer: Обученный ScalarQuantizer
+        codes: Коды int8 для matrix
+        query_rows: Номера строк-запросов
+        exact_neighbors: Точные соседи для query_rows (без самого запроса)
+        k: Количество соседей
+        rerank_factor: Во сколько раз больше кандидатов переранжировать точно
+
+    Returns:
+        dict: recall@k без переранжирования (только коды) и с переранжированием
+    """
+    excluded = np.zeros(len(matrix), dtype=bool)
+    hits_codes = 0
+    hits_rerank = 0
+
+    for query_row, exact_row in zip(query_rows, exact_neighbors):
+        excluded[query_row] = True
+        query = matrix[query_row]
+        exact_set = set(exact_row.tolist())
+
+        scores = quantizer.score(query, codes)
+        scores[query_row] = -np.inf
+        codes_top = np.argpartition(-scores, k)[:k]
+        hits_codes += len(exact_set & set(codes_top.tolist()))
+
+        rows, _ = quantized_search(query, quantizer, codes, matrix, k, rerank_factor, excluded)
+        hits_rerank += len(exact_set & set(rows.tolist()))
+        excluded[query_row] = False
+
+    total = len(query_rows) * k
+    return {
+        "recall_codes_only": round(hits_codes / total, 4),
+        "recall_reranked": round(hits_rerank / total, 4),
+    }
@@ -1,33 +1,44 @@
 from .models import Track
-from .mongodb import TrackVectors
-from .clap_model import CLAPModel, CLAP_AVAILABLE
-from .annoy_index import annoy_index
+from .mongodb import MongoUnavailableError, mongo_circuit_breaker
+from .vector_store import get_vector_store
+from .clap_model import clap_model, CLAP_AVAILABLE
+from .vector_search import get_vector_backend, filters_to_lookups
 import json
+import hashlib
 import logging
 import os
 from django.conf import settings
+from django.core.cache import cache
 
 logger = logging.getLogger(__name__)
 
 class TrackVectorService:
     """
     Сервис для работы с векторными представлениями треков,
-    хранящимися в MongoDB.
+    хранящимися в MongoDB или в основной БД (TRACK_VECTORS_STORE).
     """
+    RECOMMENDATIONS_CACHE_TIMEOUT = 60 * 60  # Время хранения последнего успешного ответа (секунды)
+    FILTER_TOP_UP_FACTOR = 8  # Во сколько раз больше limit можно запросить у индекса при доборе выдачи
+    _track_embeddings = None
     
-    @staticmethod
-    def extract_track_features(track):
+    @classmethod
+    def get_track_embeddings(cls):
         """
-        Извлекает особенности трека для создания вектора с помощью CLAP.
-        
-        Args:
-            track: объект модели Track
-            
-        Returns:
-            Словарь с векторными данными трека
+        Возвращает общий кэш эмбеддингов по хэшу содержимого аудиофайлов
+        (директория EMBEDDINGS_CACHE_DIR, бюджет памяти EMBEDDINGS_MEMORY_CACHE_MB).
         """
-        # Базовая информация о треке
-        features = {
+        if cls._track_embeddings is None:
+            from .track_embeddings import TrackEmbeddings
+            cls._track_embeddings = TrackEmbeddings(
+                getattr(settings, 'EMBEDDINGS_CACHE_DIR', 'embeddings'),
+                cache_max_bytes=getattr(settings, 'EMBEDDINGS_MEMORY_CACHE_MB', 256) * 1024 * 1024
+            )
+        return cls._track_embeddings
+    
+    @staticmethod
+    def _base_features(track):
+        """Базовая информация о треке без эмбеддинга"""
+        return {
             "track_id": track.id,
             "title": track.title,
             "artist_id": track.artist_id,
@@ -40,16 +51,21 @@ class TrackVectorService:
             # Пустой эмбеддинг по умолчанию
             "embedding": []
         }
-        
-        # Если CLAP недоступен, возвращаем базовые данные без векторизации
+    
+    @staticmethod
+    def _audio_path(track):
+        """
+        Возвращает полный путь к аудиофайлу трека или None,
+        если CLAP недоступен или файла нет.
+        """
+        # Если CLAP недоступен, трек сохраняется без векторизации
         if not CLAP_AVAILABLE:
             logger.warning(f"CLAP недоступен, трек {track.id} будет сохранен без векторизации")
-            return features
+            return None
             
-        # Получаем путь к аудиофайлу
         if not track.audio_file:
             logger.error(f"У трека {track.id} отсутствует аудиофайл")
-            return features
+            return None
             
         # Получаем полный путь к файлу
         audio_path = os.path.join(settings.MEDIA_ROOT, track.audio_file.name)
@@ -57,17 +73,34 @@ class TrackVectorService:
         # Проверяем существование файла
         if not os.path.exists(audio_path):
             logger.error(f"Файл не найден: {audio_path}")
-            return features
+            return None
+        
+        return audio_path
+    
+    @classmethod
+    def extract_track_features(cls, track):
+        """
+        Извлекает особенности трека для создания вектора с помощью CLAP.
+        
+        Args:
+            track: объект модели Track
+            
+        Returns:
+            Словарь с векторными данными трека
+        """
+        features = cls._base_features(track)
         
-        # Получаем CLAP модель
-        clap_model = CLAPModel.get_instance()
+        audio_path = cls._audio_path(track)
+        if audio_path is None:
+            return features
         
-        # Получаем векторное представление аудио
-        embedding = clap_model.get_audio_embedding(audio_path)
+        # Получаем векторное представление аудио: сначала из кэша по хэшу
+        # содержимого, модель вызывается только для нового содержимого
+        embedding = cls.get_track_embeddings().get_or_create_embedding(audio_path)
         
         if embedding is not None:
-            # Преобразуем numpy в список для JSON
-            features["embedding"] = embedding.tolist()
+            # Эмбеддинг остается numpy-массивом: в MongoDB он кодируется в бинарный float32
+            features["embedding"] = embedding
         else:
             logger.error(f"Не удалось получить эмбеддинг для трека {track.id}")
         
@@ -90,25 +123,103 @@ class TrackVectorService:
             # Извлечение особенностей с помощью CLAP
             features = cls.extract_track_features(track)
             
-            # Сохранение в MongoDB
-            TrackVectors.save_track_vector(track_id, features)
+            # Сохранение в MongoDB (upsert: повторная векторизация обновляет вектор)
+            if not get_vector_store().save_track_vector(track_id, features):
+                return False
             
-            # Обновляем Annoy-индекс, только если есть валидный эмбеддинг
-            if features.get('embedding') and len(features['embedding']) > 0:
-                # Используем инкрементальное обновление индекса
-                result = annoy_index.add_track_to_index(track_id)
-                if result:
-                    logger.info(f"Трек {track_id} успешно добавлен в Annoy-индекс")
-                else:
-                    logger.warning(f"Не удалось добавить трек {track_id} в Annoy-индекс")
-            else:
-                logger.warning(f"Трек {track_id} не имеет эмбеддинга, не добавляем в индекс")
+            # Индекс похожих треков обновляет воркер синхронизации: запись вектора
+            # попадает в поток изменений, а файлы индекса изменяет только он
+            if features.get('embedding') is None or len(features['embedding']) == 0:
+                logger.warning(f"Трек {track_id} не имеет эмбеддинга, в индекс он не попадет")
             
             return True
         except Exception as e:
             logger.error(f"Ошибка при обработке трека {track_id}: {str(e)}")
             return False
     
+    @classmethod
+    def process_tracks(cls, track_ids, batch_size=None):
+        """
+        Обрабатывает несколько треков: берет эмбеддинги уже встречавшегося
+        содержимого из кэша, остальные считает конвейером
+        EmbeddingPipeline (декодирование в пуле процессов параллельно
+        с инференсом пачками) и сохраняет их в хранилище векторов пачками -
+        одна пакетная запись на пачку вместо запросов на каждый трек.
+        
+        Args:
+            track_ids: Список ID треков
+            batch_size: Размер пачки записи (по умолчанию TRACK_VECTORS_BATCH_SIZE)
+            
+        Returns:
+            dict: Количество обработанных, сохраненных, пропущенных треков,
+                  эмбеддингов из кэша ('cached') и статистика конвейера ('pipeline')
+        """
+        from .embedding_pipeline import EmbeddingPipeline
+        
+        batch_size = batch_size or getattr(settings, 'TRACK_VECTORS_BATCH_SIZE', 200)
+        stats = {'processed': 0, 'saved': 0, 'skipped': 0, 'failed': 0, 'cached': 0}
+        batch = []
+        
+        def flush():
+            # Индекс обновляет воркер синхронизации по потоку изменений хранилища
+            if get_vector_store().bulk_upsert(batch) is None:
+                stats['failed'] += len(batch)
+            else:
+                stats['saved'] += len(batch)
+            batch.clear()
+        
+        def add(features, embedding):
+            features['embedding'] = embedding
+            batch.append({'track_id': features['track_id'], 'vector': features})
+            if len(batch) >= batch_size:
+                flush()
+        
+        # Эмбеддинги уже встречавшегося содержимого берутся из кэша, остальные
+        # треки ждут конвейера: базовые данные по пути к аудиофайлу
+        track_embeddings = cls.get_track_embeddings()
+        pending = {}
+        for track in Track.objects.filter(pk__in=track_ids).iterator(chunk_size=batch_size):
+            stats['processed'] += 1
+            audio_path = cls._audio_path(track)
+            if audio_path is None:
+                stats['skipped'] += 1
+                continue
+            
+            embedding = track_embeddings.load_embedding(audio_path)
+            if embedding is not None:
+                stats['cached'] += 1
+                add(cls._base_features(track), embedding)
+            else:
+                pending.setdefault(audio_path, []).append(cls._base_features(track))
+        
+        # Модель загружается здесь, только если есть что векторизовать
+        if pending and not clap_model.warm_up():
+            logger.error("CLAP модель не загружена, треки не будут векторизованы")
+            stats['failed'] += sum(len(items) for items in pending.values())
+            pending = {}
+        
+        pipeline = EmbeddingPipeline(
+            clap_model,
+            batch_size=getattr(settings, 'CLAP_BATCH_SIZE', EmbeddingPipeline.BATCH_SIZE),
+            workers=getattr(settings, 'CLAP_DECODE_WORKERS', None)
+        )
+        for audio_path, embedding in pipeline.run(list(pending)):
+            if embedding is not None:
+                track_embeddings.save_embedding(audio_path, embedding)
+            for features in pending.pop(audio_path, []):
+                if embedding is None:
+                    logger.error(f"Не удалось получить эмбеддинг для трека {features['track_id']}")
+                    stats['failed'] += 1
+                else:
+                    add(features, embedding)
+        
+        if batch:
+            flush()
+        
+        stats['pipeline'] = pipeline.stats.as_dict()
+        logger.info(f"Пакетная обработка треков завершена: {stats}")
+        return stats
+    
     @classmethod
     def get_track_recommendations(cls, track_id, limit=5):
         """
@@ -122,45 +233,35 @@ class TrackVectorService:
             Список объектов Track
         """
         try:
-            # Сначала пробуем быстрый поиск через Annoy-индекс
-            if annoy_index.is_loaded:
-                similar_track_ids = []
+            # Сначала пробуем быстрый поиск через индекс похожих треков
+            backend = get_vector_backend()
+            if backend.is_ready:
+                similar_track_pairs = backend.query(track_id, limit=limit)
+                similar_track_ids = [similar_id for similar_id, _ in similar_track_pairs]
                 
-                # Проверяем, загружен ли индекс, если нет - загружаем или строим
-                if not annoy_index.load_index():
-                    logger.warning("Не удалось загрузить Annoy-индекс, пытаемся построить")
-                    if not annoy_index.build_index():
-                        logger.warning("Не удалось построить Annoy-индекс, используем обычный поиск")
-                    else:
-                        similar_track_pairs = annoy_index.find_similar_tracks(track_id, limit=limit)
-                        similar_track_ids = [track_id for track_id, _ in similar_track_pairs]
-                else:
-                    similar_track_pairs = annoy_index.find_similar_tracks(track_id, limit=limit)
-                    similar_track_ids = [track_id for track_id, _ in similar_track_pairs]
-                
-                # Если нашли результаты через Annoy
+                # Если нашли результаты через индекс
                 if similar_track_ids:
                     similar_tracks = Track.objects.filter(pk__in=similar_track_ids)
-                    logger.info(f"Найдено {len(similar_tracks)} похожих треков через Annoy-индекс")
+                    logger.info(f"Найдено {len(similar_tracks)} похожих треков через бэкенд {backend.name}")
                     return similar_tracks
             
-            # Если Annoy не доступен или не вернул результаты, используем обычный поиск
-            logger.info("Используем обычный поиск в MongoDB")
+            # Если индекс не доступен или не вернул результаты, используем обычный поиск
+            logger.info("Используем обычный поиск в хранилище векторов")
             
-            # Получаем вектор трека из MongoDB
-            vector = TrackVectors.get_track_vector(track_id)
+            # Получаем вектор трека из хранилища векторов
+            vector = get_vector_store().get_track_vector(track_id)
             
             if not vector:
                 # Если вектора нет, обрабатываем трек
                 cls.process_track(track_id)
-                vector = TrackVectors.get_track_vector(track_id)
+                vector = get_vector_store().get_track_vector(track_id)
                 
                 # Если вектор все еще не найден
                 if not vector:
                     return []
             
             # Получаем похожие треки на основе вектора
-            similar_track_ids = TrackVectors.find_similar_tracks(vector, limit=limit)
+            similar_track_ids = get_vector_store().find_similar_tracks(vector, limit=limit)
             
             # Загружаем объекты треков из основной PostgreSQL базы
             similar_tracks = Track.objects.filter(pk__in=similar_track_ids)
@@ -172,78 +273,204 @@ class TrackVectorService:
             return []
     
     @classmethod
-    def get_track_recommendations_with_scores(cls, track_id, limit=10):
+    def get_track_recommendations_with_scores(cls, track_id, limit=10, filters=None, exclude_track_ids=None):
         """
         Получает рекомендации треков с оценками сходства.
         
         Args:
             track_id: ID трека, для которого нужны рекомендации
             limit: максимальное количество рекомендаций
+            filters: словарь {атрибут: значение}; поддерживаются 'genre',
+                'is_explicit' и 'artist_id'
+            exclude_track_ids: ID треков, исключаемых из рекомендаций
             
         Returns:
-            tuple: (scores, tracks), где scores - список оценок сходства, 
-                   tracks - список объектов Track
+            tuple: (scores, tracks), где scores - словарь {ID трека: оценка сходства}, 
+                   tracks - список объектов Track в порядке убывания сходства
         """
         try:
             track = Track.objects.get(id=track_id)
         except Track.DoesNotExist:
             logger.error(f"Трек с ID {track_id} не найден")
-            return [], []
+            return {}, []
         
-        # Проверяем, загружен ли индекс Annoy
-        if annoy_index.is_loaded:
-            logger.info(f"Используем Annoy индекс для поиска похожих треков к {track.title}")
-            
-            # Пытаемся найти похожие треки через Annoy индекс
-            similar_track_ids, similarity_scores = annoy_index.find_similar_tracks_with_scores(track_id, limit)
+        # Проверяем, готов ли индекс похожих треков
+        backend = get_vector_backend()
+        if backend.is_ready:
+            logger.info(f"Используем бэкенд {backend.name} для поиска похожих треков к {track.title}")
             
-            # Если результаты найдены через Annoy
-            if similar_track_ids:
-                tracks = list(Track.objects.filter(id__in=similar_track_ids))
-                
-                # Сортируем треки в том же порядке, что и ID треков
-                id_to_index = {str(track_id): i for i, track_id in enumerate(similar_track_ids)}
-                tracks.sort(key=lambda t: id_to_index.get(str(t.id), 999))
-                
-                logger.info(f"Найдено {len(tracks)} похожих треков через Annoy индекс")
-                return similarity_scores, tracks
+            similar_track_pairs = cls._query_backend(backend, track_id, limit, filters, exclude_track_ids)
         else:
-            logger.warning("Annoy индекс не загружен, используем MongoDB для поиска по эмбеддингам")
+            logger.warning("Индекс похожих треков не загружен, используем хранилище векторов для поиска по эмбеддингам")
+            similar_track_pairs = []
         
-        # Отказываемся на поиск по MongoDB коллекции
-        from music_app.embeddings import find_similar_tracks_by_embedding
+        cache_key = cls._get_recommendations_cache_key(track_id, limit, filters, exclude_track_ids)
+        source = f"бэкенд {backend.name}"
+        if not similar_track_pairs:
+            # Откатываемся на поиск по хранилищу векторов. При разомкнутом автомате
+            # защиты он сразу возвращает пустой результат без ожидания таймаутов
+            similar_track_pairs = cls._find_similar_in_store(track_id, limit, filters, exclude_track_ids)
+            source = "хранилище векторов"
+        if not similar_track_pairs and mongo_circuit_breaker.is_open:
+            # MongoDB недоступна: отдаем последний успешный ответ
+            similar_track_pairs = cache.get(cache_key) or []
+            source = "кэш (MongoDB недоступна)"
         
-        embeddings_result = find_similar_tracks_by_embedding(track_id, limit)
-        if not embeddings_result:
-            logger.warning(f"Не удалось найти похожие треки для {track.title} в MongoDB")
-            return [], []
+        if not similar_track_pairs:
+            logger.warning(f"Не удалось найти похожие треки для {track.title}")
+            return {}, []
         
-        similar_track_ids = [result["track_id"] for result in embeddings_result]
-        similarity_scores = [result["similarity"] for result in embeddings_result]
+        cache.set(cache_key, similar_track_pairs, cls.RECOMMENDATIONS_CACHE_TIMEOUT)
         
-        tracks = list(Track.objects.filter(id__in=similar_track_ids))
+        similar_track_ids = [similar_id for similar_id, _ in similar_track_pairs]
+        # Фильтры проверяются и при загрузке треков: ответ из кэша мог устареть
+        tracks = list(Track.objects.filter(id__in=similar_track_ids, **filters_to_lookups(filters)))
         
         # Сортируем треки в том же порядке, что и ID треков
         id_to_index = {str(track_id): i for i, track_id in enumerate(similar_track_ids)}
         tracks.sort(key=lambda t: id_to_index.get(str(t.id), 999))
         
-        logger.info(f"Найдено {len(tracks)} похожих треков через MongoDB")
-        return similarity_scores, tracks
+        logger.info(f"Найдено {len(tracks)} похожих треков через {source}")
+        return dict(similar_track_pairs), tracks
+    
+    @classmethod
+    def _query_backend(cls, backend, track_id, limit, filters=None, exclude_track_ids=None):
+        """
+        Ищет похожие треки в индексе с проверкой фильтров по таблице Track.
+        
+        Фильтры применяются внутри индекса по атрибутам, сохраненным при его
+        построении. Трек, у которого с тех пор сменились жанр, explicit или
+        исполнитель, отсеивается, а выдача добирается запросом большего числа
+        кандидатов (не более FILTER_TOP_UP_FACTOR * limit).
+        
+        Returns:
+            Список кортежей (ID трека, показатель схожести)
+        """
+        if not filters:
+            return backend.query(track_id, limit, filters, exclude_track_ids)
+        
+        lookups = filters_to_lookups(filters)
+        fetch = limit
+        while True:
+            candidates = backend.query(track_id, fetch, filters, exclude_track_ids)
+            allowed = set(
+                Track.objects.filter(id__in=[similar_id for similar_id, _ in candidates], **lookups)
+                .values_list('id', flat=True)
+            )
+            verified = [(similar_id, score) for similar_id, score in candidates if similar_id in allowed]
+            
+            if len(verified) >= limit or len(candidates) < fetch or fetch >= limit * cls.FILTER_TOP_UP_FACTOR:
+                if len(verified) < len(candidates):
+                    logger.info(
+                        f"Отсеяно {len(candidates) - len(verified)} треков с устаревшими атрибутами в индексе"
+                    )
+                return verified[:limit]
+            fetch = min(fetch * 2, limit * cls.FILTER_TOP_UP_FACTOR)
+    
+    @staticmethod
+    def _get_recommendations_cache_key(track_id, limit, filters, exclude_track_ids):
+        """
+        Ключ кэша последнего успешного ответа с рекомендациями. Исключенные
+        треки входят в ключ хэшем отсортированного множества ID: разные наборы
+        исключений одного размера не должны делить запись кэша.
+        """
+        filters_key = ','.join(f"{name}={value}" for name, value in sorted((filters or {}).items()))
+        exclude_ids = ','.join(str(track_id) for track_id in sorted({int(track_id) for track_id in exclude_track_ids or ()}))
+        exclude_key = hashlib.sha256(exclude_ids.encode('ascii')).hexdigest()
+        return f"similar_tracks:{track_id}:{limit}:{filters_key}:{exclude_key}"
+    
+    @classmethod
+    def _find_similar_in_store(cls, track_id, limit, filters=None, exclude_track_ids=None):
+        """
+        Ищет похожие треки по векторам в хранилище (без локального индекса).
+        Фильтры и исключения применяются к найденным трекам, поэтому
+        кандидатов запрашивается с запасом.
+        
+        Returns:
+            Список кортежей (ID трека, показатель схожести)
+        """
+        try:
+            vector = get_vector_store().get_track_vector(track_id)
+        except MongoUnavailableError:
+            logger.warning(f"MongoDB недоступна, поиск похожих треков для {track_id} пропущен")
+            return []
+        except Exception as e:
+            logger.error(f"Ошибка при получении вектора трека {track_id} из хранилища: {str(e)}")
+            return []
+        
+        if not vector or not vector.get('embedding'):
+            logger.warning(f"Вектор для трека {track_id} не найден в хранилище векторов")
+            return []
+        
+        fetch = limit * 5 if filters or exclude_track_ids else limit
+        candidates = get_vector_store().find_similar_tracks_with_scores(
+            vector['embedding'], fetch, exclude_track_id=track_id
+        )
+        if not candidates:
+            return []
+        
+        # Без индекса фильтры применяются к найденным трекам
+        allowed = Track.objects.filter(
+            id__in=[similar_id for similar_id, _ in candidates], **filters_to_lookups(filters)
+        )
+        if exclude_track_ids:
+            allowed = allowed.exclude(id__in=exclude_track_ids)
+        allowed_ids = set(allowed.values_list('id', flat=True))
+        
+        return [
+            (int(similar_id), score)
+            for similar_id, score in candidates
+            if int(similar_id) in allowed_ids
+        ][:limit]
+    
+    @classmethod
+    def get_track_recommendations_many(cls, track_ids, limit=10):
+        """
+        Получает рекомендации с оценками сходства сразу для нескольких треков.
+        Все найденные треки загружаются одним запросом к базе данных.
+        
+        Args:
+            track_ids: Список ID исходных треков
+            limit: максимальное количество рекомендаций для каждого трека
+            
+        Returns:
+            dict: {ID исходного трека: список кортежей (объект Track, оценка сходства)}
+        """
+        similar_by_seed = get_vector_backend().query_many(track_ids, limit)
+        
+        all_similar_ids = {
+            similar_id
+            for similar_tracks in similar_by_seed.values()
+            for similar_id, _ in similar_tracks
+        }
+        tracks_by_id = Track.objects.in_bulk(list(all_similar_ids))
+        
+        recommendations = {}
+        for seed_id, similar_tracks in similar_by_seed.items():
+            recommendations[seed_id] = [
+                (tracks_by_id[similar_id], score)
+                for similar_id, score in similar_tracks
+                if similar_id in tracks_by_id
+            ]
+        
+        logger.info(f"Получены рекомендации для {len(recommendations)} треков, загружено {len(tracks_by_id)} похожих треков")
+        return recommendations
     
     @classmethod
     def rebuild_annoy_index(cls):
         """
-        Перестраивает Annoy-индекс для всех треков.
+        Перестраивает индекс похожих треков (бэкенд VECTOR_SEARCH_BACKEND) для всех треков.
         
         Returns:
             dict: Информация о построенном индексе
         """
         try:
             # Форсируем перестроение индекса
-            success = annoy_index.build_index(force=True)
+            backend = get_vector_backend()
+            success = backend.build(force=True)
             
             if success:
-                return annoy_index.get_index_info()
+                return backend.stats()
             else:
                 return {"error": "Не удалось построить индекс", "success": False}
                 
@@ -2,7 +2,7 @@ from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from .models import Track, User, Playlist
 from music_streaming.celery import app
-from .annoy_index import annoy_index
+from .vector_store import get_vector_store
 import logging
 from .services import TrackVectorService
 
@@ -59,20 +59,21 @@ def track_post_save(sender, instance, created, **kwargs):
 def track_post_delete(sender, instance, **kwargs):
     """
     Обработчик события удаления трека.
-    Удаляет трек из Annoy-индекса.
+    Удаляет вектор трека; из индекса трек убирает воркер синхронизации.
     """
     try:
-        # Удаляем трек из Annoy-индекса
         track_id = instance.id
-        logger.info(f"Трек {track_id} удален, удаляем из Annoy-индекса...")
+        logger.info(f"Трек {track_id} удален, удаляем его вектор...")
         
-        # Удаляем трек из Annoy-индекса
-        result = annoy_index.remove_track_from_index(track_id)
+        # Удаляем вектор трека: удаление попадет в поток изменений, и воркер
+        # синхронизации - единственный процесс, изменяющий файлы индекса, -
+        # уберет трек из индекса
+        result = get_vector_store().delete_track_vector(track_id)
         
         if result:
-            logger.info(f"Сигнал post_delete: Трек {track_id} удален из индекса")
+            logger.info(f"Сигнал post_delete: Вектор трека {track_id} удален, трек будет убран из индекса")
         else:
-            logger.warning(f"Сигнал post_delete: Не удалось удалить трек {track_id} из индекса")
+            logger.warning(f"Сигнал post_delete: Не удалось удалить вектор трека {track_id}")
     except Exception as e:
         logger.error(f"Ошибка в обработчике post_delete для трека {instance.id}: {str(e)}")
 
@@ -1,3 +1,1612 @@
-from django.test import TestCase
+"""
+Тесты поиска похожих треков и хранения эмбеддингов.
 
-# Create your tests here.
+Индекс Annoy в тестах строится во временной директории по векторам из
+хранилища в памяти (FakeVectorStore), а заглушка MongoDB работает в процессе.
+Запуск: python manage.py test music_app.tests
+"""
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+from io import StringIO
+from unittest import mock
+
+import numpy as np
+from django.apps import apps
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from pymongo import DeleteOne, UpdateOne
+from rest_framework.test import APIClient
+from pymongo.errors import ServerSelectionTimeoutError
+
+from .annoy_index import AnnoyItemVectors, TrackAnnoyIndex
+from .clap_model import CLAPModel, clap_model
+from .embedding_pipeline import EmbeddingPipeline
+from .embedding_store import ShardedEmbeddingStore
+from .genre_classifier import GenreClassifier
+from .quantization import ScalarQuantizer, quantized_search
+from .serializers import TrackSerializer
+from .services import TrackVectorService
+from .track_embeddings import EmbeddingLRUCache, TrackEmbeddings
+from .models import Album, Artist, Track, TrackEmbedding, User, VectorChange, VectorSyncCheckpoint
+from .mongodb import (
+    EMBEDDING_HEADER, CircuitBreaker, DuplicateKeyError, MockCollection, MockDatabase, MongoUnavailableError,
+    OperationFailure, TrackVectors, cosine_to_similarity, decode_embedding, encode_embedding, mongo_guard
+)
+from .vector_search import AnnoyBackend, ExactBackend
+from .vector_store import SQLTrackVectors
+from .vector_sync import OutboxSource, VectorIndexSync
+
+EMBEDDING_DIM = TrackAnnoyIndex.EMBEDDING_DIM
+
+
+def random_vectors(track_ids, seed=0):
+    """Случайные эмбеддинги треков {ID трека: float32-вектор}"""
+    rng = np.random.default_rng(seed)
+    return {track_id: rng.standard_normal(EMBEDDING_DIM).astype(np.float32) for track_id in track_ids}
+
+
+def normalize(vector):
+    return vector / np.linalg.norm(vector)
+
+
+def create_tracks(track_ids, artist_count=1, genre=None, is_explicit=None):
+    """
+    Создает треки с заданными ID через bulk_create, который не вызывает сигналы
+    сохранения трека (извлечение эмбеддинга). Треки распределяются по artist_count
+    исполнителям по остатку от деления ID; genre и is_explicit - функции от ID трека.
+
+    Returns:
+        list: Созданные исполнители
+    """
+    artists = [Artist.objects.create(name=f'Artist {n}', slug=f'artist-{n}') for n in range(artist_count)]
+    albums = [
+        Album.objects.create(title=f'Album {n}', artist=artist, slug=f'album-{n}')
+        for n, artist in enumerate(artists)
+    ]
+    Track.objects.bulk_create([
+        Track(
+            id=track_id, title=f'Track {track_id}',
+            artist=artists[track_id % artist_count], album=albums[track_id % artist_count],
+            audio_file=f'tracks/{track_id}.mp3', slug=f'track-{track_id}', track_number=track_id,
+            genre=genre(track_id) if genre else '', is_explicit=bool(is_explicit and is_explicit(track_id))
+        )
+        for track_id in track_ids
+    ])
+    return artists
+
+
+class FakeVectorStore:
+    """Хранилище векторов в памяти с методами, которые использует индекс"""
+
+    def __init__(self, vectors):
+        self.vectors = dict(vectors)
+
+    def load_vectors_matrix(self, dim):
+        track_ids = np.array(sorted(self.vectors), dtype=np.int64)
+        matrix = np.stack([self.vectors[track_id] for track_id in track_ids]).astype(np.float32)
+        return track_ids, matrix
+
+    def count_vectors(self):
+        return len(self.vectors)
+
+    def iter_embeddings(self, batch_size=1000):
+        for track_id in sorted(self.vectors):
+            yield track_id, self.vectors[track_id]
+
+    def get_embeddings(self, track_ids):
+        return {track_id: self.vectors[track_id] for track_id in track_ids if track_id in self.vectors}
+
+    def get_track_vector(self, track_id):
+        vector = self.vectors.get(track_id)
+        return {'embedding': vector.tolist()} if vector is not None else None
+
+
+class AnnoyIndexTestCase(TestCase):
+    """
+    Индекс в отдельной временной директории. Каждый экземпляр TrackAnnoyIndex,
+    созданный через new_index(), ведет себя как индекс в отдельном процессе.
+    """
+    TRACK_IDS = range(1, 51)
+
+    def setUp(self):
+        self.index_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_root, ignore_errors=True)
+
+        self.store = FakeVectorStore(random_vectors(self.TRACK_IDS))
+        patcher = mock.patch('music_app.annoy_index.get_vector_store', return_value=self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Фоновые слияние и компактизация в тестах не запускаются
+        settings_override = override_settings(
+            BASE_DIR=self.index_root,
+            ANNOY_N_TREES=10,
+            ANNOY_NEIGHBORS_K=5,
+            ANNOY_DELTA_MERGE_THRESHOLD=10 ** 6,
+            ANNOY_COMPACTION_THRESHOLD=1.0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def new_index(self):
+        """Новый экземпляр индекса в обход синглтона"""
+        index = object.__new__(TrackAnnoyIndex)
+        index._init()
+        return index
+
+    def build_index(self):
+        index = self.new_index()
+        self.assertTrue(index.build_index(force=True))
+        return index
+
+
+class DeltaSegmentTests(AnnoyIndexTestCase):
+    """Дельта-сегмент: треки, добавленные после построения индекса"""
+
+    def test_added_track_is_searchable_without_rebuild(self):
+        index = self.build_index()
+        generation = index.generation
+
+        self.store.vectors[100] = self.store.vectors[1] + 0.01
+        self.assertTrue(index.add_track_to_index(100))
+
+        self.assertEqual(index.generation, generation)
+        self.assertEqual(index.delta_track_ids, [100])
+        self.assertTrue(index.track_exists_in_index(100))
+        self.assertEqual(index.find_similar_tracks(1, limit=3)[0][0], 100)
+        self.assertEqual(index.find_similar_tracks(100, limit=3)[0][0], 1)
+
+    def test_delta_is_visible_to_other_processes(self):
+        index = self.build_index()
+        self.store.vectors.update(random_vectors([100, 101], seed=1))
+        index.apply_changes(upserts=[100, 101])
+
+        other = self.new_index()
+        self.assertTrue(other.load_index())
+        self.assertEqual(sorted(other.delta_track_ids), [100, 101])
+        np.testing.assert_allclose(other.get_vector(101), normalize(self.store.vectors[101]), atol=1e-6)
+
+    def test_changes_from_two_processes_are_both_kept(self):
+        first = self.build_index()
+        second = self.new_index()
+        second.load_index()
+        self.store.vectors.update(random_vectors([100, 101], seed=1))
+
+        self.assertTrue(first.add_track_to_index(100))
+        self.assertTrue(second.add_track_to_index(101))
+
+        reader = self.new_index()
+        reader.load_index()
+        self.assertEqual(sorted(reader.delta_track_ids), [100, 101])
+
+    def test_upsert_without_vector_is_skipped(self):
+        index = self.build_index()
+        stats = index.apply_changes(upserts=[999])
+        self.assertEqual(stats['skipped'], 1)
+        self.assertFalse(index.track_exists_in_index(999))
+
+
+class TombstoneTests(AnnoyIndexTestCase):
+    """Удаленные элементы базового индекса (битовая карта tombstones)"""
+
+    def test_removed_track_is_not_returned(self):
+        index = self.build_index()
+        neighbor = index.find_similar_tracks(1, limit=1)[0][0]
+
+        self.assertTrue(index.remove_track_from_index(neighbor))
+
+        self.assertFalse(index.track_exists_in_index(neighbor))
+        self.assertTrue(index.tombstones[index._lookup_idx(neighbor)])
+        self.assertAlmostEqual(index.get_tombstone_ratio(), 1 / len(self.TRACK_IDS))
+        similar = index.find_similar_tracks(1, limit=len(self.TRACK_IDS))
+        self.assertNotIn(neighbor, [track_id for track_id, _ in similar])
+        self.assertEqual(len(similar), len(self.TRACK_IDS) - 2)
+
+    def test_updated_track_moves_to_delta(self):
+        index = self.build_index()
+        idx = index._lookup_idx(3)
+
+        self.store.vectors[3] = random_vectors([3], seed=5)[3]
+        stats = index.apply_changes(upserts=[3])
+
+        self.assertEqual(stats['updated'], 1)
+        self.assertTrue(index.tombstones[idx])
+        self.assertEqual(index.delta_track_ids, [3])
+        np.testing.assert_allclose(index.get_vector(3), normalize(self.store.vectors[3]), atol=1e-6)
+
+    def test_unchanged_vector_is_skipped(self):
+        index = self.build_index()
+        stats = index.apply_changes(upserts=[3])
+        self.assertEqual(stats, {'added': 0, 'updated': 0, 'removed': 0, 'skipped': 1})
+        self.assertFalse(index.tombstones.any())
+
+    def test_tombstones_are_visible_to_other_processes(self):
+        index = self.build_index()
+        other = self.new_index()
+        other.load_index()
+
+        index.remove_track_from_index(5)
+        other.apply_changes(deletes=[6])
+
+        reader = self.new_index()
+        reader.load_index()
+        self.assertFalse(reader.track_exists_in_index(5))
+        self.assertFalse(reader.track_exists_in_index(6))
+
+    def test_compaction_drops_removed_items(self):
+        index = self.build_index()
+        for track_id in (5, 6, 7):
+            index.remove_track_from_index(track_id)
+
+        self.assertTrue(index.build_index(force=True, source='local'))
+
+        self.assertEqual(index.get_tombstone_ratio(), 0.0)
+        self.assertEqual(index.index.get_n_items(), len(self.TRACK_IDS) - 3)
+        self.assertFalse(index.track_exists_in_index(5))
+        self.assertTrue(index.track_exists_in_index(8))
+
+
+class GenerationTests(AnnoyIndexTestCase):
+    """Публикация построений поколениями и перестроение при параллельных изменениях"""
+
+    def test_build_publishes_new_generation(self):
+        index = self.build_index()
+        first = index.generation
+        reader = self.new_index()
+        reader.load_index()
+
+        self.assertTrue(index.build_index(force=True))
+
+        self.assertNotEqual(index.generation, first)
+        self.assertEqual(os.path.realpath(index.current_link), os.path.realpath(index.generation_dir))
+        self.assertTrue(os.path.exists(os.path.join(index.generation_dir, TrackAnnoyIndex.MANIFEST_FILE)))
+        self.assertTrue(reader.refresh_if_stale(force=True))
+        self.assertEqual(reader.generation, index.generation)
+
+    def test_changes_during_rebuild_are_carried_over(self):
+        index = self.build_index()
+        other = self.new_index()
+        other.load_index()
+        build_generation = index._build_generation
+
+        def build_with_concurrent_changes(snapshot, *args):
+            self.store.vectors[200] = random_vectors([200], seed=2)[200]
+            self.assertIsNotNone(other.apply_changes(upserts=[200], deletes=[7]))
+            self.assertTrue(other.is_rebuild_running())
+            # Второе построение в той же директории отклоняется
+            self.assertFalse(self.new_index().build_index(force=True))
+            return build_generation(snapshot, *args)
+
+        index._build_generation = build_with_concurrent_changes
+        self.assertTrue(index.build_index(force=True, source='local'))
+
+        self.assertFalse(index.is_rebuild_running())
+        reader = self.new_index()
+        reader.load_index()
+        self.assertEqual(reader.generation, index.generation)
+        self.assertFalse(reader.track_exists_in_index(7))
+        self.assertEqual(reader.delta_track_ids, [200])
+
+    def test_track_removed_during_rebuild_is_not_resurrected(self):
+        index = self.build_index()
+        other = self.new_index()
+        other.load_index()
+        self.store.vectors[300] = random_vectors([300], seed=3)[300]
+        save_attributes = index._save_attributes
+
+        def save_after_concurrent_delete(*args):
+            # Трек удаляется после того, как построение прочитало его вектор
+            other.apply_changes(deletes=[300])
+            return save_attributes(*args)
+
+        index._save_attributes = save_after_concurrent_delete
+        self.assertTrue(index.build_index(force=True))
+
+        self.assertFalse(index.track_exists_in_index(300))
+        self.assertTrue(index.track_exists_in_index(1))
+
+    def test_failed_build_keeps_current_generation(self):
+        index = self.build_index()
+        generation = index.generation
+
+        with mock.patch.object(index, '_write_manifest', side_effect=OSError('disk full')):
+            self.assertFalse(index.build_index(force=True))
+
+        self.assertEqual(index.generation, generation)
+        generations_root = os.path.join(index.index_dir, TrackAnnoyIndex.GENERATIONS_DIR)
+        self.assertEqual(os.listdir(generations_root), [generation])
+
+    def test_failed_load_keeps_previous_generation_and_retries(self):
+        index = self.build_index()
+        reader = self.new_index()
+        reader.load_index()
+        first, first_dir = reader.generation, reader.generation_dir
+
+        self.assertTrue(index.build_index(force=True))
+        os.rename(index.ids_path, index.ids_path + '.bak')
+
+        self.assertFalse(reader.refresh_if_stale(force=True))
+        self.assertEqual(reader.generation, first)
+        self.assertEqual(reader.generation_dir, first_dir)
+        self.assertTrue(reader.is_loaded)
+        self.assertEqual(len(reader.find_similar_tracks(1, limit=3)), 3)
+
+        # Следующая проверка снова видит новое поколение и повторяет загрузку
+        os.rename(index.ids_path + '.bak', index.ids_path)
+        self.assertTrue(reader.refresh_if_stale(force=True))
+        self.assertEqual(reader.generation, index.generation)
+
+
+class IdMappingTests(AnnoyIndexTestCase):
+    """Маппинги ID треков и элементов Annoy (int64-массивы и np.searchsorted)"""
+    TRACK_IDS = (42, 7, 1000003, 15, 99)
+
+    def test_searchsorted_lookup(self):
+        sorted_track_ids = np.array([3, 10, 42], dtype=np.int64)
+        sorted_idx = np.array([2, 0, 1], dtype=np.int64)
+        lookup = TrackAnnoyIndex._searchsorted_lookup
+
+        self.assertEqual(lookup(sorted_track_ids, sorted_idx, 10), 0)
+        self.assertEqual(lookup(sorted_track_ids, sorted_idx, '42'), 1)
+        self.assertIsNone(lookup(sorted_track_ids, sorted_idx, 11))
+        self.assertIsNone(lookup(sorted_track_ids, sorted_idx, 43))
+        self.assertIsNone(lookup(sorted_track_ids, sorted_idx, 'abc'))
+        self.assertIsNone(lookup(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 10))
+
+    def test_mappings_round_trip_after_build(self):
+        index = self.build_index()
+
+        for track_id in self.TRACK_IDS:
+            idx = index._lookup_idx(track_id)
+            self.assertIsNotNone(idx)
+            self.assertEqual(int(index.idx_to_id[idx]), track_id)
+        self.assertIsNone(index._lookup_idx(8))
+
+    def test_mappings_are_plain_int64_arrays(self):
+        index = self.build_index()
+        reader = self.new_index()
+        reader.load_index()
+
+        for path in (index.ids_path, index.sorted_ids_path, index.sorted_idx_path):
+            mapping = np.load(path, allow_pickle=False)
+            self.assertEqual(mapping.dtype, np.int64)
+            self.assertEqual(len(mapping), len(self.TRACK_IDS))
+        self.assertIsInstance(reader.idx_to_id, np.memmap)
+        self.assertEqual(list(np.load(index.sorted_ids_path)), sorted(self.TRACK_IDS))
+
+
+class ScalarQuantizerTests(TestCase):
+    """Скалярное квантование int8 и поиск по кодам с точным переранжированием"""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        matrix = rng.standard_normal((500, 64)).astype(np.float32)
+        self.matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.quantizer = ScalarQuantizer().fit(self.matrix, block_size=128)
+        self.codes = self.quantizer.encode(self.matrix)
+
+    def test_decode_error_is_within_half_a_step(self):
+        self.assertEqual(self.codes.dtype, np.int8)
+        error = np.abs(self.quantizer.decode(self.codes) - self.matrix)
+        self.assertTrue(np.all(error <= self.quantizer.scale / 2 + 1e-6))
+
+    def test_score_matches_decoded_dot_product(self):
+        query = self.matrix[3]
+        expected = self.quantizer.decode(self.codes) @ query
+        np.testing.assert_allclose(self.quantizer.score(query, self.codes, block_size=100), expected, atol=1e-4)
+
+    def test_search_returns_exact_top_k_after_rerank(self):
+        query = self.matrix[10]
+        exact = self.matrix @ query
+        expected = np.argsort(-exact)[:10]
+
+        rows, cosines = quantized_search(query, self.quantizer, self.codes, self.matrix, 10, rerank_factor=5)
+
+        self.assertEqual(list(rows), list(expected))
+        np.testing.assert_allclose(cosines, exact[expected], atol=1e-6)
+
+    def test_search_skips_excluded_rows(self):
+        excluded = np.zeros(len(self.matrix), dtype=bool)
+        excluded[10] = True
+
+        rows, _ = quantized_search(self.matrix[10], self.quantizer, self.codes, self.matrix, 5, excluded=excluded)
+
+        self.assertNotIn(10, rows)
+        self.assertEqual(len(rows), 5)
+
+    def test_save_and_load(self):
+        path = os.path.join(tempfile.mkdtemp(), 'quantizer.npz')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.quantizer.save(path)
+
+        loaded = ScalarQuantizer.load(path)
+
+        np.testing.assert_array_equal(loaded.encode(self.matrix), self.codes)
+
+
+class QuantizedIndexTests(AnnoyIndexTestCase):
+    """Коды int8 строятся и используются только в режиме ANNOY_SEARCH_MODE = 'quantized'"""
+
+    def test_default_mode_writes_no_codes(self):
+        index = self.build_index()
+        self.assertFalse(os.path.exists(index.codes_path))
+        self.assertIsNone(index.codes)
+        self.assertEqual(index.get_index_info()['disk_bytes_per_track']['codes'], 0)
+
+    @override_settings(ANNOY_SEARCH_MODE='quantized')
+    def test_quantized_mode_matches_exact_search(self):
+        index = self.build_index()
+        self.assertIsNotNone(index.codes)
+
+        matrix = np.stack([normalize(self.store.vectors[track_id]) for track_id in self.TRACK_IDS])
+        exact = np.argsort(-(matrix @ matrix[0]))[1:6]
+        similar = index.find_similar_tracks(self.TRACK_IDS[0], limit=5)
+
+        self.assertEqual([track_id for track_id, _ in similar], [self.TRACK_IDS[row] for row in exact])
+
+    @override_settings(ANNOY_SEARCH_MODE='quantized')
+    def test_codes_replace_float_matrix(self):
+        for on_disk in (False, True):
+            index = self.new_index()
+            self.assertTrue(index.build_index(force=True, on_disk=on_disk))
+
+            self.assertFalse(os.path.exists(index.vectors_path))
+            self.assertIsInstance(index.vectors, AnnoyItemVectors)
+            disk = index.get_index_info()['disk_bytes_per_track']
+            self.assertEqual(disk['vectors'], 0)
+            self.assertLess(disk['codes'], EMBEDDING_DIM + 16)
+
+            # Точные векторы читаются из файла деревьев
+            np.testing.assert_allclose(index.get_vector(7), normalize(self.store.vectors[7]), atol=1e-6)
+
+    @override_settings(ANNOY_SEARCH_MODE='quantized', ANNOY_FILTER_EXACT_SCAN_RATIO=1.0)
+    def test_local_rebuild_and_exact_scan_without_float_matrix(self):
+        index = self.build_index()
+        index.remove_track_from_index(2)
+        self.assertTrue(index.build_index(force=True, source='local'))
+        self.assertFalse(index.track_exists_in_index(2))
+        self.assertEqual(len(index.idx_to_id), len(self.TRACK_IDS) - 1)
+
+        # Точный перебор по исключениям читает строки из деревьев
+        query = normalize(self.store.vectors[1])
+        allowed = np.ones(len(index.vectors), dtype=bool)
+        rows = index._scan_allowed(query, 3, allowed)
+        self.assertEqual(rows[0][0], 1)
+
+
+class PrecomputedNeighborsTests(AnnoyIndexTestCase):
+    """Предвычисленная таблица top-K соседей поколения"""
+
+    def test_table_matches_index_search(self):
+        index = self.build_index()
+        self.assertEqual(index.neighbor_rows.shape, (len(self.TRACK_IDS), 5))
+
+        precomputed = index.get_precomputed_neighbors(1, limit=3)
+        searched = index.find_similar_tracks(1, limit=3)
+
+        self.assertEqual([track_id for track_id, _ in precomputed], [track_id for track_id, _ in searched])
+        np.testing.assert_allclose(
+            [score for _, score in precomputed], [score for _, score in searched], atol=1e-2
+        )
+
+    def test_removed_and_excluded_neighbors_are_skipped(self):
+        index = self.build_index()
+        first, second = [track_id for track_id, _ in index.get_precomputed_neighbors(1, limit=2)]
+
+        index.remove_track_from_index(first)
+        neighbors = index.get_precomputed_neighbors(1, limit=3, exclude_track_ids={second})
+
+        self.assertNotIn(first, [track_id for track_id, _ in neighbors])
+        self.assertNotIn(second, [track_id for track_id, _ in neighbors])
+
+    def test_falls_back_when_table_has_too_few_neighbors(self):
+        index = self.build_index()
+        self.assertIsNone(index.get_precomputed_neighbors(1, limit=6))
+        self.assertIsNone(index.get_precomputed_neighbors(999, limit=3))
+
+    def test_delta_tracks_are_merged(self):
+        index = self.build_index()
+        before = index.get_precomputed_neighbors(1, limit=3)
+
+        self.store.vectors[300] = self.store.vectors[1] * 2
+        index.apply_changes(upserts=[300])
+        after = index.get_precomputed_neighbors(1, limit=3)
+
+        self.assertEqual(after[0][0], 300)
+        self.assertAlmostEqual(after[0][1], 1.0, places=3)
+        self.assertEqual(after[1:], before[:2])
+        excluded = index.get_precomputed_neighbors(1, limit=3, exclude_track_ids={300})
+        self.assertEqual(excluded, before)
+
+    def test_backend_query_uses_table_with_delta(self):
+        index = self.build_index()
+        self.store.vectors[300] = self.store.vectors[1] * 2
+        index.apply_changes(upserts=[300])
+
+        backend = AnnoyBackend.__new__(AnnoyBackend)
+        backend.index = index
+        with mock.patch.object(index, 'find_similar_tracks') as find_similar_tracks:
+            similar = backend.query(1, limit=3)
+
+        find_similar_tracks.assert_not_called()
+        self.assertEqual(similar[0][0], 300)
+
+
+@override_settings(VECTOR_SEARCH_EXACT_BLOCK_SIZE=7)
+def rock_or_jazz(track_id):
+    return 'Rock' if track_id % 2 else 'jazz'
+
+
+def every_fifth(track_id):
+    return track_id % 5 == 0
+
+
+class FilteredSearchTests(AnnoyIndexTestCase):
+    """Фильтры по атрибутам треков: битовые карты базового индекса и атрибуты дельты"""
+
+    def setUp(self):
+        super().setUp()
+        # Трек 100 существует, но его вектор появится только после построения индекса
+        self.artists = create_tracks(
+            list(self.TRACK_IDS) + [100], artist_count=10, genre=rock_or_jazz, is_explicit=every_fifth
+        )
+        self.index = self.build_index()
+
+    def expected(self, track_id, limit, predicate):
+        """Эталон полным перебором по подходящим трекам"""
+        query = normalize(self.store.vectors[track_id])
+        scored = sorted(
+            (
+                (other_id, float(cosine_to_similarity(normalize(vector) @ query)))
+                for other_id, vector in self.store.vectors.items()
+                if other_id != track_id and predicate(other_id)
+            ),
+            key=lambda item: -item[1]
+        )
+        return scored[:limit]
+
+    @override_settings(ANNOY_FILTER_EXACT_SCAN_RATIO=0.0)
+    def test_bitmap_filters(self):
+        results = self.index.find_similar_tracks(1, limit=5, filters={'genre': 'rock'})
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(track_id % 2 for track_id, _ in results))
+
+        results = self.index.find_similar_tracks(1, limit=5, filters={'is_explicit': True, 'genre': 'jazz'})
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(track_id % 10 == 0 for track_id, _ in results))
+
+        results = self.index.find_similar_tracks(1, limit=5, filters={'genre': 'blues'})
+        self.assertEqual(results, [])
+
+    @override_settings(ANNOY_FILTER_EXACT_SCAN_RATIO=0.0)
+    def test_over_fetch_follows_filter_selectivity(self):
+        self.index.index = mock.Mock(wraps=self.index.index)
+        self.index.find_similar_tracks(1, limit=5, filters={'genre': 'rock'})
+
+        # Под фильтр подходит половина треков: для limit + 1 = 6 запрашивается 6 / 0.5 + 1
+        first_call = self.index.index.get_nns_by_item.call_args_list[0]
+        self.assertEqual(first_call.args[1], 13)
+
+    @override_settings(ANNOY_FILTER_EXACT_SCAN_RATIO=0.2)
+    def test_rare_filter_uses_exact_scan(self):
+        artist_id = self.artists[3].id
+        with mock.patch.object(self.index, '_scan_allowed', wraps=self.index._scan_allowed) as scan:
+            results = self.index.find_similar_tracks(1, limit=3, filters={'artist_id': artist_id})
+            scan.assert_called_once()
+
+            self.index.find_similar_tracks(1, limit=3, filters={'genre': 'rock'})
+            scan.assert_called_once()
+
+        expected = self.expected(1, 3, lambda track_id: track_id % 10 == 3)
+        self.assertEqual([track_id for track_id, _ in results], [track_id for track_id, _ in expected])
+        np.testing.assert_allclose([score for _, score in results], [score for _, score in expected], atol=1e-4)
+
+    def test_delta_tracks_are_filtered_by_their_attributes(self):
+        self.store.vectors[100] = self.store.vectors[1] + 0.01
+        self.index.apply_changes(upserts=[100])
+
+        jazz = self.index.find_similar_tracks(1, limit=3, filters={'genre': 'jazz'})
+        self.assertEqual(jazz[0][0], 100)
+        rock = self.index.find_similar_tracks(1, limit=3, filters={'genre': 'rock'})
+        self.assertNotIn(100, [track_id for track_id, _ in rock])
+
+        excluded = self.index.find_similar_tracks(1, limit=3, filters={'genre': 'jazz'}, exclude_track_ids={100})
+        self.assertNotIn(100, [track_id for track_id, _ in excluded])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_service_rechecks_stale_index_attributes(self):
+        backend = object.__new__(AnnoyBackend)
+        backend.index = self.index
+        filters = {'is_explicit': False}
+        stale = self.index.find_similar_tracks(1, limit=5, filters=filters)[0][0]
+
+        # Атрибуты в индексе - снимок на момент построения; вектор трека не менялся
+        Track.objects.filter(id=stale).update(is_explicit=True)
+        with mock.patch('music_app.services.get_vector_backend', return_value=backend):
+            scores, tracks = TrackVectorService.get_track_recommendations_with_scores(1, limit=5, filters=filters)
+
+        self.assertEqual(len(tracks), 5)
+        self.assertNotIn(stale, [track.id for track in tracks])
+        self.assertFalse(any(track.is_explicit for track in tracks))
+
+
+class SimilarTracksBatchTests(TestCase):
+    """Пакетные рекомендации: TrackVectorService.get_track_recommendations_many и /similar/batch/"""
+
+    def setUp(self):
+        create_tracks(range(1, 6))
+        self.backend = mock.Mock()
+        # Трек 3 похож на оба исходных трека; трека 99 нет в базе данных
+        self.backend.query_many.return_value = {
+            1: [(3, 0.9), (4, 0.8), (99, 0.7)],
+            2: [(3, 0.6), (5, 0.5)],
+        }
+        patcher = mock.patch('music_app.services.get_vector_backend', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = User.objects.create_user(email='listener@example.com', username='listener', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def test_similar_tracks_are_loaded_with_one_query(self):
+        with self.assertNumQueries(1):
+            recommendations = TrackVectorService.get_track_recommendations_many([1, 2], limit=3)
+
+        self.backend.query_many.assert_called_once_with([1, 2], 3)
+        self.assertEqual([(track.id, score) for track, score in recommendations[1]], [(3, 0.9), (4, 0.8)])
+        self.assertEqual([(track.id, score) for track, score in recommendations[2]], [(3, 0.6), (5, 0.5)])
+        self.assertIs(recommendations[1][0][0], recommendations[2][0][0])
+
+    def test_batch_endpoint_serializes_each_track_once(self):
+        with mock.patch('music_app.views.TrackSerializer', wraps=TrackSerializer) as serializer:
+            response = self.client.post('/api/similar/batch/', {'track_ids': [1, 2], 'limit': 3}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(serializer.call_count, 3)
+        self.assertEqual([track['id'] for track in response.data['1']], [3, 4])
+        self.assertEqual([track['similarity_score'] for track in response.data['1']], [0.9, 0.8])
+        self.assertEqual([track['similarity_score'] for track in response.data['2']], [0.6, 0.5])
+
+    def test_batch_endpoint_validates_request(self):
+        for payload in (
+            {},
+            {'track_ids': []},
+            {'track_ids': 1},
+            {'track_ids': list(range(101))},
+            {'track_ids': ['abc']},
+            {'track_ids': [1], 'limit': 0},
+            {'track_ids': [1], 'limit': -5},
+            {'track_ids': [1], 'limit': 'many'},
+        ):
+            with self.subTest(payload=payload):
+                response = self.client.post('/api/similar/batch/', payload, format='json')
+                self.assertEqual(response.status_code, 400)
+        self.backend.query_many.assert_not_called()
+
+        # Слишком большой limit ограничивается, а не отклоняется
+        response = self.client.post('/api/similar/batch/', {'track_ids': [1], 'limit': 500}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.backend.query_many.assert_called_once_with([1], 50)
+
+
+class ExactBackendTests(TestCase):
+    """Точный бэкенд: блочное матричное умножение по всем векторам"""
+
+    def setUp(self):
+        self.store = FakeVectorStore(random_vectors(range(1, 31)))
+        patcher = mock.patch('music_app.vector_search.get_vector_store', return_value=self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = ExactBackend()
+        self.assertTrue(self.backend.load())
+
+    def expected(self, track_id, limit, excluded=()):
+        """Эталон полным перебором: (ID трека, оценка) по убыванию сходства"""
+        query = normalize(self.store.vectors[track_id])
+        scored = [
+            (other_id, float(normalize(vector) @ query))
+            for other_id, vector in self.store.vectors.items()
+            if other_id != track_id and other_id not in excluded
+        ]
+        scored.sort(key=lambda item: -item[1])
+        return [(other_id, float(cosine_to_similarity(cosine))) for other_id, cosine in scored[:limit]]
+
+    def assertSameResults(self, actual, expected):
+        self.assertEqual([track_id for track_id, _ in actual], [track_id for track_id, _ in expected])
+        np.testing.assert_allclose([score for _, score in actual], [score for _, score in expected], atol=1e-5)
+
+    def test_query_matches_brute_force(self):
+        self.assertSameResults(self.backend.query(4, limit=5), self.expected(4, 5))
+
+    def test_refresh_loads_unloaded_backend(self):
+        backend = ExactBackend()
+        self.assertFalse(backend.is_ready)
+
+        self.assertTrue(backend.refresh())
+        backend._reload_thread.join()
+        self.assertTrue(backend.is_ready)
+        self.assertSameResults(backend.query(4, limit=5), self.expected(4, 5))
+        self.assertFalse(backend.refresh())
+
+    def test_failed_first_load_is_retried_later(self):
+        backend = ExactBackend()
+        with mock.patch.object(self.store, 'load_vectors_matrix', side_effect=RuntimeError('store')):
+            self.assertTrue(backend.refresh())
+            backend._reload_thread.join()
+        self.assertFalse(backend.is_ready)
+        self.assertFalse(backend.refresh())
+
+        backend._load_started_at -= ExactBackend.LOAD_RETRY_SECONDS
+        self.assertTrue(backend.refresh())
+        backend._reload_thread.join()
+        self.assertTrue(backend.is_ready)
+
+    def test_query_many_and_exclusions(self):
+        results = self.backend.query_many([4, 9, 4], limit=3, exclude_track_ids={1, 2, 3})
+        self.assertEqual(list(results), [4, 9])
+        self.assertSameResults(results[9], self.expected(9, 3, excluded={1, 2, 3}))
+
+    def test_add_update_and_remove(self):
+        self.store.vectors[100] = self.store.vectors[4] * 3
+        self.store.vectors[5] = -self.store.vectors[4]
+        stats = self.backend.apply_changes(upserts=[100, 5, 999], deletes=[6])
+
+        self.assertEqual(stats, {'added': 1, 'updated': 1, 'removed': 1, 'skipped': 1})
+        del self.store.vectors[6]
+        similar = self.backend.query(4, limit=40)
+        self.assertEqual(similar[0][0], 100)
+        self.assertEqual(similar[-1][0], 5)
+        self.assertNotIn(6, [track_id for track_id, _ in similar])
+        self.assertSameResults(similar, self.expected(4, 40))
+
+    def test_unknown_seed_is_read_from_store(self):
+        self.store.vectors[200] = self.store.vectors[4] + 0.01
+        self.assertEqual(self.backend.query(200, limit=1)[0][0], 4)
+        self.assertEqual(self.backend.query(404, limit=1), [])
+
+
+class SimilarityScaleTests(AnnoyIndexTestCase):
+    """Бэкенды индекса и точный поиск возвращают оценки в одной шкале"""
+
+    def test_exact_and_annoy_scores_agree(self):
+        index = self.build_index()
+        with mock.patch('music_app.vector_search.get_vector_store', return_value=self.store):
+            exact = ExactBackend()
+            exact.load()
+            exact_results = exact.query(1, limit=5)
+
+        annoy_results = index.find_similar_tracks(1, limit=5)
+
+        self.assertEqual([track_id for track_id, _ in annoy_results], [track_id for track_id, _ in exact_results])
+        np.testing.assert_allclose(
+            [score for _, score in annoy_results], [score for _, score in exact_results], atol=1e-4
+        )
+
+
+class EmbeddingEncodingTests(TestCase):
+    """Бинарный формат эмбеддинга: заголовок и значения float32"""
+
+    def test_round_trip(self):
+        embedding = np.random.default_rng(0).standard_normal(EMBEDDING_DIM)
+
+        encoded = encode_embedding(embedding)
+        decoded = decode_embedding(encoded)
+
+        self.assertEqual(len(encoded), EMBEDDING_HEADER.size + EMBEDDING_DIM * 4)
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_array_equal(decoded, embedding.astype(np.float32))
+
+    def test_decodes_blob_buffers(self):
+        encoded = encode_embedding([1.0, 2.5, -3.0])
+        for value in (bytearray(encoded), memoryview(encoded)):
+            np.testing.assert_array_equal(decode_embedding(value), [1.0, 2.5, -3.0])
+
+    def test_decodes_legacy_arrays(self):
+        decoded = decode_embedding([0.5, 1.5])
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_array_equal(decoded, [0.5, 1.5])
+
+    def test_missing_embedding(self):
+        self.assertIsNone(decode_embedding(None))
+        self.assertIsNone(decode_embedding([]))
+
+    def test_unknown_binary_format(self):
+        with self.assertRaises(ValueError):
+            decode_embedding(b'XXXX' + encode_embedding([1.0])[4:])
+
+
+class MockMongoTestCase(TestCase):
+    """TrackVectors поверх отдельной коллекции заглушки MongoDB"""
+
+    def setUp(self):
+        self.collection = MockCollection(TrackVectors.COLLECTION_NAME)
+        patcher = mock.patch.object(TrackVectors, 'get_collection', return_value=self.collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        TrackVectors._matrix_cache = None
+        self.addCleanup(setattr, TrackVectors, '_matrix_cache', None)
+
+    def upsert(self, vectors):
+        return TrackVectors.bulk_upsert([
+            {'track_id': track_id, 'vector': {'embedding': vector.tolist(), 'model': 'clap'}}
+            for track_id, vector in vectors.items()
+        ])
+
+
+class TrackVectorsUpsertTests(MockMongoTestCase):
+    """Пакетный upsert и удаление векторов в MongoDB"""
+
+    def test_bulk_upsert_inserts_then_updates(self):
+        vectors = random_vectors([1, 2, 3])
+        self.assertEqual(self.upsert(vectors), {'upserted': 3, 'modified': 0})
+
+        vectors[2] = vectors[2] * 2
+        vectors[4] = vectors[1]
+        self.assertEqual(self.upsert({2: vectors[2], 4: vectors[4]}), {'upserted': 1, 'modified': 1})
+
+        self.assertEqual(TrackVectors.count_vectors(), 4)
+        np.testing.assert_allclose(TrackVectors.get_embeddings([2])[2], vectors[2])
+
+    @override_settings(TRACK_VECTORS_EMBEDDING_FORMAT='binary')
+    def test_binary_format_is_opt_in(self):
+        vector = random_vectors([1])[1]
+        self.upsert({1: vector})
+
+        stored = self.collection.find_one({'track_id': 1})['vector']['embedding']
+        self.assertIsInstance(stored, bytes)
+        self.assertEqual(TrackVectors.get_track_vector(1), {'embedding': vector.tolist(), 'model': 'clap'})
+
+    def test_array_format_by_default_for_atlas_vector_search(self):
+        vector = random_vectors([1])[1]
+        self.upsert({1: vector})
+
+        stored = self.collection.find_one({'track_id': 1})['vector']['embedding']
+        self.assertIsInstance(stored, list)
+        np.testing.assert_allclose(stored, vector)
+
+    def test_migrate_embeddings_warns_about_format_setting(self):
+        vectors = random_vectors([1, 2])
+        self.upsert(vectors)
+
+        output = StringIO()
+        call_command('migrate_embeddings', '--to', 'binary', stdout=output)
+
+        self.assertIsInstance(self.collection.find_one({'track_id': 2})['vector']['embedding'], bytes)
+        np.testing.assert_allclose(TrackVectors.get_embeddings([2])[2], vectors[2])
+        self.assertIn('TRACK_VECTORS_EMBEDDING_FORMAT=binary', output.getvalue())
+
+    def test_unique_index_on_track_id(self):
+        self.assertTrue(TrackVectors.ensure_indexes())
+        self.upsert(random_vectors([1]))
+
+        with self.assertRaises(DuplicateKeyError):
+            self.collection.insert_one({'track_id': 1, 'vector': {}})
+        self.assertEqual(TrackVectors.count_vectors(), 1)
+
+    def test_changes_are_recorded_in_outbox(self):
+        self.upsert(random_vectors([1, 2]))
+        self.assertTrue(TrackVectors.delete_track_vector(1))
+
+        self.assertIsNone(TrackVectors.get_track_vector(1))
+        self.assertEqual(
+            list(VectorChange.objects.order_by('id').values_list('track_id', 'operation')),
+            [(1, 'upsert'), (2, 'upsert'), (1, 'delete')]
+        )
+
+    def test_outbox_failure_is_reported_to_caller(self):
+        vectors = random_vectors([1, 2])
+        with mock.patch.object(VectorChange.objects, 'bulk_create', side_effect=DatabaseError('outbox')):
+            self.assertIsNone(self.upsert(vectors))
+            self.assertIsNone(TrackVectors.process_track(2, {'embedding': vectors[2].tolist()}))
+            self.assertFalse(TrackVectors.delete_track_vector(1))
+        self.assertFalse(VectorChange.objects.exists())
+
+        # Повтор операции записывает потерянное изменение
+        self.assertTrue(TrackVectors.delete_track_vector(1))
+        self.assertEqual(list(VectorChange.objects.values_list('track_id', 'operation')), [(1, 'delete')])
+
+
+@override_settings(MONGODB_CIRCUIT_FAILURE_THRESHOLD=3, MONGODB_CIRCUIT_RESET_TIMEOUT=10)
+class CircuitBreakerTests(TestCase):
+    """Автомат защиты обращений к MongoDB"""
+
+    def setUp(self):
+        self.breaker = CircuitBreaker()
+        self.now = 1000.0
+        for patcher in (
+            mock.patch('music_app.mongodb.mongo_circuit_breaker', self.breaker),
+            mock.patch('music_app.mongodb.time.monotonic', side_effect=lambda: self.now),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fail(self):
+        with self.assertRaises(ServerSelectionTimeoutError):
+            with mongo_guard():
+                raise ServerSelectionTimeoutError('timeout')
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail()
+        self.fail()
+        self.assertFalse(self.breaker.is_open)
+        self.fail()
+        self.assertTrue(self.breaker.is_open)
+
+        body = mock.Mock()
+        with self.assertRaises(MongoUnavailableError):
+            with mongo_guard():
+                body()
+        body.assert_not_called()
+
+    def test_success_resets_failure_count(self):
+        self.fail()
+        self.fail()
+        with mongo_guard():
+            pass
+        self.fail()
+        self.assertFalse(self.breaker.is_open)
+
+    def test_query_errors_are_not_outages(self):
+        for _ in range(5):
+            with self.assertRaises(OperationFailure):
+                with mongo_guard():
+                    raise OperationFailure('bad query')
+        self.assertFalse(self.breaker.is_open)
+
+    def test_half_open_probe(self):
+        for _ in range(3):
+            self.fail()
+
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        # Неудачная проба снова размыкает автомат, удачная - замыкает
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.now += 10
+        with mongo_guard():
+            pass
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+
+class StaleMatrixFallbackTests(MockMongoTestCase):
+    """Поиск без $vectorSearch продолжает работать по матрице, пока MongoDB недоступна"""
+
+    @override_settings(TRACK_VECTORS_MATRIX_TTL=0)
+    def test_stale_matrix_is_used_during_outage(self):
+        self.upsert(random_vectors([1, 2, 3]))
+        track_ids, _ = TrackVectors.get_normalized_matrix(EMBEDDING_DIM)
+
+        with mock.patch.object(TrackVectors, 'load_vectors_matrix', side_effect=MongoUnavailableError()):
+            stale_ids, _ = TrackVectors.get_normalized_matrix(EMBEDDING_DIM)
+        self.assertEqual(list(stale_ids), list(track_ids))
+
+        TrackVectors._matrix_cache = None
+        with mock.patch.object(TrackVectors, 'load_vectors_matrix', side_effect=MongoUnavailableError()):
+            with self.assertRaises(MongoUnavailableError):
+                TrackVectors.get_normalized_matrix(EMBEDDING_DIM)
+
+
+class MockVectorSearchTests(MockMongoTestCase):
+    """$vectorSearch и bulk_write в заглушке MongoDB"""
+
+    def setUp(self):
+        super().setUp()
+        self.vectors = random_vectors(range(1, 21))
+        self.upsert(self.vectors)
+
+    def vector_search(self, query, limit, **spec):
+        pipeline = [
+            {'$vectorSearch': dict({
+                'index': 'vector_index', 'path': 'vector.embedding', 'queryVector': query.tolist(),
+                'numCandidates': limit * 3, 'limit': limit,
+            }, **spec)},
+            {'$project': {'_id': 0, 'track_id': 1, 'score': {'$meta': 'vectorSearchScore'}}},
+        ]
+        return list(self.collection.aggregate(pipeline))
+
+    def test_results_are_exact_and_ordered(self):
+        query = self.vectors[7]
+        results = self.vector_search(query, 5)
+
+        matrix = np.vstack([normalize(self.vectors[i]) for i in range(1, 21)])
+        cosines = matrix @ normalize(query)
+        expected = [int(i) + 1 for i in np.argsort(-cosines)[:5]]
+
+        self.assertEqual([doc['track_id'] for doc in results], expected)
+        self.assertEqual(results[0]['track_id'], 7)
+        for doc in results:
+            self.assertAlmostEqual(doc['score'], (1 + cosines[doc['track_id'] - 1]) / 2, places=5)
+
+    def test_filter_and_limit(self):
+        results = self.vector_search(self.vectors[7], 3, filter={'track_id': {'$gt': 10}})
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(doc['track_id'] > 10 for doc in results))
+
+    def test_num_candidates_below_limit(self):
+        with self.assertRaises(OperationFailure):
+            self.vector_search(self.vectors[1], 5, numCandidates=2)
+
+    def test_scores_match_brute_force_scale(self):
+        query = self.vectors[3]
+        with_atlas = TrackVectors.find_similar_tracks_with_scores(query, limit=5, exclude_track_id=3)
+        brute_force = TrackVectors._find_similar_brute_force(query.tolist(), 5, 3)
+
+        self.assertEqual([tid for tid, _ in with_atlas], [tid for tid, _ in brute_force])
+        for (_, atlas_score), (_, brute_score) in zip(with_atlas, brute_force):
+            self.assertAlmostEqual(atlas_score, brute_score, places=5)
+
+    def test_bulk_write_counts(self):
+        result = self.collection.bulk_write([
+            UpdateOne({'track_id': 1}, {'$set': {'vector.model': 'other'}}),
+            UpdateOne({'track_id': 100}, {'$set': {'vector.model': 'clap'}}, upsert=True),
+            DeleteOne({'track_id': 2}),
+            DeleteOne({'track_id': 200}),
+        ])
+        self.assertEqual(result.matched_count, 1)
+        self.assertEqual(result.modified_count, 1)
+        self.assertEqual(result.upserted_count, 1)
+        self.assertEqual(result.deleted_count, 1)
+        self.assertEqual(self.collection.find_one({'track_id': 1})['vector']['model'], 'other')
+        self.assertIsNone(self.collection.find_one({'track_id': 2}))
+
+    def test_unordered_bulk_write_applies_valid_operations(self):
+        self.collection.create_index([('track_id', 1)], unique=True)
+        with self.assertRaises(OperationFailure):
+            self.collection.bulk_write([
+                UpdateOne({'track_id': 100}, {'$set': {'track_id': 1}}, upsert=True),
+                DeleteOne({'track_id': 2}),
+            ], ordered=False)
+        self.assertIsNone(self.collection.find_one({'track_id': 2}))
+
+
+class MockDatabasePersistenceTests(TestCase):
+    """Сохранение заглушки MongoDB в JSON-файл"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.path = os.path.join(self.root, 'mock.json')
+
+    def test_round_trip(self):
+        embedding = encode_embedding(random_vectors([1])[1])
+        created_at = datetime(2024, 5, 1, 12, 30)
+
+        database = MockDatabase(self.path)
+        database['track_vectors'].create_index([('track_id', 1)], unique=True)
+        database['track_vectors'].insert_one(
+            {'track_id': 1, 'vector': {'embedding': embedding}, 'created_at': created_at}
+        )
+        self.assertTrue(database.flush())
+        self.assertFalse(database.flush())
+
+        reloaded = MockDatabase(self.path)['track_vectors']
+        doc = reloaded.find_one({'track_id': 1})
+        self.assertEqual(doc['vector']['embedding'], embedding)
+        self.assertEqual(doc['created_at'], created_at)
+        with self.assertRaises(DuplicateKeyError):
+            reloaded.insert_one({'track_id': 1})
+
+    def test_missing_file_starts_empty(self):
+        database = MockDatabase(self.path)
+        self.assertEqual(database.list_collection_names(), [])
+        self.assertFalse(database.flush())
+        self.assertFalse(os.path.exists(self.path))
+
+
+class OutboxSourceTests(TestCase):
+    """Чтение outbox с учетом пропусков id незавершенных транзакций"""
+
+    def setUp(self):
+        self.source = OutboxSource()
+
+    def add_change(self, change_id, track_id, operation=VectorChange.OPERATION_UPSERT):
+        VectorChange.objects.create(id=change_id, track_id=track_id, operation=operation)
+
+    def test_gaps_are_reread(self):
+        self.add_change(1, 10)
+        self.add_change(3, 30)
+        events, token = self.source.read(self.source.initial_token(), 100)
+        self.assertEqual([event[1] for event in events], [10, 30])
+        self.assertEqual(token['outbox_id'], 3)
+        self.assertEqual([gap[0] for gap in token['gaps']], [2])
+        self.assertEqual(self.source.pending(token)['pending'], 0)
+
+        events, same_token = self.source.read(token, 100)
+        self.assertEqual(events, [])
+        self.assertEqual(same_token, token)
+
+        # Транзакция с id=2 зафиксировалась позже id=3
+        self.add_change(2, 20, VectorChange.OPERATION_DELETE)
+        self.add_change(4, 40)
+        self.assertEqual(self.source.pending(token)['pending'], 2)
+
+        events, token = self.source.read(token, 100)
+        self.assertEqual([(event[0], event[1]) for event in events], [('delete', 20), ('upsert', 40)])
+        self.assertEqual(token, {'outbox_id': 4, 'gaps': []})
+
+    @override_settings(VECTOR_SYNC_OUTBOX_GAP_TIMEOUT=10)
+    def test_gaps_expire(self):
+        self.add_change(5, 1)
+        with mock.patch('music_app.vector_sync.time.time', return_value=1000.0):
+            _, token = self.source.read({'outbox_id': 3}, 10)
+        self.assertEqual(token['gaps'], [[4, 1000.0]])
+
+        with mock.patch('music_app.vector_sync.time.time', return_value=1011.0):
+            events, token = self.source.read(token, 10)
+        self.assertEqual(events, [])
+        self.assertEqual(token, {'outbox_id': 5, 'gaps': []})
+
+    def test_legacy_integer_token(self):
+        self.add_change(1, 10)
+        self.add_change(2, 20)
+        events, token = self.source.read({'outbox_id': 1}, 10)
+        self.assertEqual([event[1] for event in events], [20])
+        self.assertEqual(token, {'outbox_id': 2, 'gaps': []})
+
+
+class FakeIndexBackend:
+    """Бэкенд индекса, записывающий примененные изменения"""
+    name = 'fake'
+
+    def __init__(self, deferred=False):
+        self.deferred = deferred
+        self.calls = []
+
+    def apply_changes(self, upserts, deletes):
+        self.calls.append((sorted(upserts), sorted(deletes)))
+        return None if self.deferred else {'upserted': len(upserts), 'deleted': len(deletes)}
+
+
+class VectorIndexSyncTests(TestCase):
+    """Применение пакетов outbox к индексу"""
+
+    def create_sync(self, backend):
+        return VectorIndexSync(name='test', source='outbox', backend=backend)
+
+    def test_changes_are_collapsed_per_track(self):
+        VectorChange.objects.create(track_id=1, operation=VectorChange.OPERATION_UPSERT)
+        VectorChange.objects.create(track_id=2, operation=VectorChange.OPERATION_UPSERT)
+        VectorChange.objects.create(track_id=1, operation=VectorChange.OPERATION_DELETE)
+
+        backend = FakeIndexBackend()
+        stats = self.create_sync(backend).run_once()
+
+        self.assertEqual(backend.calls, [([2], [1])])
+        self.assertEqual(stats['events'], 3)
+        checkpoint = VectorSyncCheckpoint.objects.get(name='test')
+        self.assertEqual(checkpoint.applied_count, 3)
+
+        self.assertEqual(self.create_sync(backend).run_once(), {'events': 0})
+        self.assertEqual(len(backend.calls), 1)
+
+    def test_deferred_batch_keeps_checkpoint(self):
+        VectorChange.objects.create(track_id=1, operation=VectorChange.OPERATION_UPSERT)
+
+        sync = self.create_sync(FakeIndexBackend(deferred=True))
+        token = VectorSyncCheckpoint.objects.get(name='test').token
+        self.assertIsNone(sync.run_once())
+        self.assertEqual(VectorSyncCheckpoint.objects.get(name='test').token, token)
+
+        backend = FakeIndexBackend()
+        sync.backend = backend
+        self.assertEqual(sync.run_once()['events'], 1)
+        self.assertEqual(backend.calls, [([1], [])])
+
+
+class SQLTrackVectorsTests(TestCase):
+    """Хранилище векторов в реляционной БД"""
+
+    def setUp(self):
+        create_tracks(range(1, 11))
+        SQLTrackVectors._matrix_cache = None
+        self.addCleanup(setattr, SQLTrackVectors, '_matrix_cache', None)
+
+    def upsert(self, vectors):
+        return SQLTrackVectors.bulk_upsert([
+            {'track_id': track_id, 'vector': {'embedding': vector.tolist(), 'model': 'clap'}}
+            for track_id, vector in vectors.items()
+        ])
+
+    def test_bulk_upsert(self):
+        vectors = random_vectors([1, 2, 3, 999])
+        self.assertEqual(self.upsert(vectors), {'upserted': 3, 'modified': 0})
+        self.assertFalse(TrackEmbedding.objects.filter(track_id=999).exists())
+
+        vectors[2] = vectors[2] * 3
+        self.assertEqual(self.upsert({2: vectors[2], 4: vectors[1]}), {'upserted': 1, 'modified': 1})
+
+        self.assertEqual(SQLTrackVectors.count_vectors(), 4)
+        np.testing.assert_allclose(SQLTrackVectors.get_embeddings([2])[2], vectors[2])
+        self.assertEqual(SQLTrackVectors.get_track_vector(3)['model'], 'clap')
+        self.assertEqual(
+            sorted(VectorChange.objects.values_list('track_id', flat=True)), [1, 2, 2, 3, 4]
+        )
+
+    def test_delete_track_vector(self):
+        self.upsert(random_vectors([1, 2]))
+        self.assertTrue(SQLTrackVectors.delete_track_vector(1))
+
+        self.assertEqual(SQLTrackVectors.existing_track_ids(), {2})
+        self.assertIsNone(SQLTrackVectors.get_track_vector(1))
+        change = VectorChange.objects.latest('id')
+        self.assertEqual((change.track_id, change.operation), (1, VectorChange.OPERATION_DELETE))
+
+    def test_outbox_failure_rolls_back_vector(self):
+        self.upsert(random_vectors([1]))
+        failure = mock.patch.object(VectorChange.objects, 'bulk_create', side_effect=DatabaseError('outbox'))
+
+        with failure:
+            self.assertIsNone(self.upsert(random_vectors([2])))
+            self.assertFalse(SQLTrackVectors.delete_track_vector(1))
+
+        self.assertEqual(SQLTrackVectors.existing_track_ids(), {1})
+        self.assertEqual(list(VectorChange.objects.values_list('track_id', flat=True)), [1])
+
+    def test_similar_tracks_and_matrix_cache(self):
+        vectors = random_vectors(range(1, 11))
+        self.upsert(vectors)
+
+        results = SQLTrackVectors.find_similar_tracks_with_scores(vectors[5], limit=3, exclude_track_id=5)
+        cosines = {
+            track_id: float(normalize(vector) @ normalize(vectors[5]))
+            for track_id, vector in vectors.items() if track_id != 5
+        }
+        expected = sorted(cosines, key=cosines.get, reverse=True)[:3]
+        self.assertEqual([track_id for track_id, _ in results], expected)
+        self.assertAlmostEqual(results[0][1], cosine_to_similarity(cosines[expected[0]]), places=5)
+
+        # У каждого хранилища свой кэш матрицы, запись помечает устаревшим только его
+        self.assertIsNot(SQLTrackVectors._matrix_lock, TrackVectors._matrix_lock)
+        self.assertIsNone(TrackVectors._matrix_cache)
+
+        self.upsert({1: vectors[2]})
+        results = SQLTrackVectors.find_similar_tracks_with_scores(vectors[2], limit=1, exclude_track_id=2)
+        self.assertEqual(results[0][0], 1)
+        self.assertAlmostEqual(results[0][1], 1.0, places=3)
+        self.assertIsNone(TrackVectors._matrix_cache)
+
+
+class ShardedEmbeddingStoreTests(TestCase):
+    """Дисковое хранилище эмбеддингов в шардах"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.store = ShardedEmbeddingStore(self.root, shard_records=2)
+        self.vectors = random_vectors(['a', 'b', 'c', 'd', 'e'])
+
+    def test_put_and_get(self):
+        self.store.put('a', self.vectors['a'], audio_path='a.mp3')
+
+        np.testing.assert_array_equal(self.store.get('a'), self.vectors['a'])
+        self.assertIsNone(self.store.get('missing'))
+        self.assertEqual(self.store.dim, EMBEDDING_DIM)
+        self.assertEqual(self.store.get_metadata('a')['audio_path'], 'a.mp3')
+
+    def test_put_many_spans_shards(self):
+        self.store.put('a', self.vectors['a'])
+        self.store.put_many([(key, self.vectors[key], None) for key in 'bcde'])
+
+        for key in 'abcde':
+            np.testing.assert_array_equal(self.store.get(key), self.vectors[key])
+        self.assertEqual(len(self.store), 5)
+        self.assertEqual(self.store.stats()['shards'], 3)
+
+        keys, matrix = self.store.load_matrix()
+        self.assertEqual(keys, list('abcde'))
+        np.testing.assert_array_equal(matrix, np.vstack([self.vectors[key] for key in 'abcde']))
+        self.assertEqual([record['key'] for record in self.store.list()], keys)
+
+    def test_overwrite_and_delete(self):
+        self.store.put_many([(key, self.vectors[key], None) for key in 'abc'])
+        self.store.put('a', self.vectors['d'])
+        np.testing.assert_array_equal(self.store.get('a'), self.vectors['d'])
+
+        self.assertTrue(self.store.delete('b'))
+        self.assertFalse(self.store.delete('b'))
+        self.assertNotIn('b', self.store)
+        self.assertIn('c', self.store)
+
+        stats = self.store.stats()
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['garbage_records'], 2)
+        self.assertEqual(self.store.load_matrix()[0], ['c', 'a'])
+
+    def test_dimension_mismatch(self):
+        self.store.put('a', self.vectors['a'])
+        with self.assertRaises(ValueError):
+            self.store.put('b', np.zeros(EMBEDDING_DIM // 2, dtype=np.float32))
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.store.stats()['garbage_records'], 0)
+
+    def test_empty_store(self):
+        keys, matrix = self.store.load_matrix()
+        self.assertEqual(keys, [])
+        self.assertEqual(matrix.shape, (0, 0))
+        self.assertIsNone(self.store.dim)
+
+
+class FakeEmbeddingModel:
+    """Модель для конвейера: эмбеддинг - первые отсчеты сигнала; запоминает размеры пачек"""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def embed_waveforms(self, waveforms):
+        self.batch_sizes.append(len(waveforms))
+        return waveforms[:, :4].copy()
+
+
+class EmbeddingPipelineTests(TestCase):
+    """Конвейер EmbeddingPipeline (без torchaudio файлы читаются как сырые байты)"""
+
+    def setUp(self):
+        self.audio_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.audio_dir, ignore_errors=True)
+        self.model = FakeEmbeddingModel()
+
+    def write_audio(self, name, value):
+        path = os.path.join(self.audio_dir, name)
+        with open(path, 'wb') as f:
+            f.write(bytes([value] * 8))
+        return path
+
+    def pipeline(self, batch_size):
+        return EmbeddingPipeline(self.model, batch_size=batch_size, workers=1, sample_rate=8, clip_seconds=1)
+
+    def test_decode_failures_are_reported_per_file(self):
+        paths = [self.write_audio(f'{n}.raw', 100 + n) for n in range(3)]
+        missing = os.path.join(self.audio_dir, 'missing.raw')
+        pipeline = self.pipeline(batch_size=2)
+
+        results = dict(pipeline.run(paths[:2] + [missing] + paths[2:]))
+
+        self.assertIsNone(results[missing])
+        for n, path in enumerate(paths):
+            np.testing.assert_allclose(results[path], np.full(4, (100 + n - 128) / 128))
+        self.assertEqual((pipeline.stats.files, pipeline.stats.failed), (3, 1))
+
+    def test_partial_last_batch_is_embedded(self):
+        paths = [self.write_audio(f'{n}.raw', n) for n in range(5)]
+        pipeline = self.pipeline(batch_size=2)
+
+        results = dict(pipeline.run(paths))
+
+        self.assertEqual(set(results), set(paths))
+        self.assertEqual(sorted(self.model.batch_sizes), [1, 2, 2])
+        self.assertEqual(pipeline.stats.batches, 3)
+
+    def test_closing_generator_stops_decoding(self):
+        path = self.write_audio('track.raw', 1)
+        consumed = []
+
+        def audio_paths():
+            for n in range(1000):
+                consumed.append(n)
+                yield path
+
+        pipeline = self.pipeline(batch_size=2)
+        results = pipeline.run(audio_paths())
+        next(results)
+        results.close()
+
+        self.assertFalse(any(thread.name == 'embedding-decode' for thread in threading.enumerate()))
+        self.assertLess(len(consumed), 1000)
+        self.assertLess(pipeline.stats.files, 1000)
+
+
+class ContentHashCacheTests(TestCase):
+    """Эмбеддинги TrackEmbeddings по хэшу содержимого аудиофайла и ключу модели"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.embeddings_dir = os.path.join(self.root, 'embeddings')
+        self.embeddings = TrackEmbeddings(self.embeddings_dir)
+        self.embedding = random_vectors([1])[1]
+
+    def write_audio(self, relative_path, content):
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_renamed_identical_file_is_a_hit(self):
+        original = self.write_audio('uploads/song.mp3', b'audio' * 100)
+        self.assertTrue(self.embeddings.save_embedding(original, self.embedding))
+        renamed = self.write_audio('library/renamed.mp3', b'audio' * 100)
+
+        # Новый экземпляр без кэша в памяти читает эмбеддинг из хранилища
+        for embeddings in (self.embeddings, TrackEmbeddings(self.embeddings_dir)):
+            np.testing.assert_array_equal(embeddings.load_embedding(renamed), self.embedding)
+
+    def test_different_file_with_same_name_is_a_miss(self):
+        first = self.write_audio('a/track.mp3', b'first' * 100)
+        self.assertTrue(self.embeddings.save_embedding(first, self.embedding))
+
+        second = self.write_audio('b/track.mp3', b'second' * 100)
+        self.assertIsNone(self.embeddings.load_embedding(second))
+
+        # Перезаписанный по тому же пути файл хэшируется заново
+        self.write_audio('a/track.mp3', b'rewritten' * 100)
+        self.assertIsNone(self.embeddings.load_embedding(first))
+
+    def test_model_key_is_part_of_the_key(self):
+        path = self.write_audio('track.mp3', b'audio' * 100)
+        self.assertTrue(self.embeddings.save_embedding(path, self.embedding))
+
+        with mock.patch.object(clap_model, 'model_key', return_value='other-model@2'):
+            self.assertIsNone(self.embeddings.load_embedding(path))
+        np.testing.assert_array_equal(self.embeddings.load_embedding(path), self.embedding)
+
+    def test_process_tracks_reuses_embeddings_of_renamed_files(self):
+        create_tracks([1, 2])
+        self.write_audio('tracks/1.mp3', b'known' * 100)
+        self.write_audio('tracks/2.mp3', b'new' * 100)
+        self.embeddings.save_embedding(self.write_audio('uploads/original.mp3', b'known' * 100), self.embedding)
+        # process_tracks очищает пачку после записи, поэтому пачки копируются
+        upserts = []
+        store = mock.Mock()
+        store.bulk_upsert.side_effect = lambda items: upserts.append(
+            {item['track_id']: item['vector']['embedding'] for item in items}
+        ) or len(items)
+
+        with override_settings(MEDIA_ROOT=self.root, CLAP_DECODE_WORKERS=1), \
+                mock.patch('music_app.services.get_vector_store', return_value=store), \
+                mock.patch('music_app.services.CLAP_AVAILABLE', True), \
+                mock.patch.object(TrackVectorService, '_track_embeddings', self.embeddings), \
+                mock.patch.object(clap_model, 'warm_up', return_value=True), \
+                mock.patch.object(clap_model, 'embed_waveforms',
+                                  side_effect=lambda waveforms: np.ones((len(waveforms), EMBEDDING_DIM))) as embed:
+            first = TrackVectorService.process_tracks([1, 2])
+            second = TrackVectorService.process_tracks([1, 2])
+
+        self.assertEqual((first['cached'], first['saved']), (1, 2))
+        self.assertEqual((second['cached'], second['saved']), (2, 2))
+        self.assertEqual(embed.call_count, 1)
+        np.testing.assert_array_equal(upserts[0][1], self.embedding)
+
+
+class EmbeddingLRUCacheTests(TestCase):
+    """LRU-кэш эмбеддингов с бюджетом по байтам"""
+
+    VECTOR_BYTES = EMBEDDING_DIM * 4
+
+    def setUp(self):
+        self.cache = EmbeddingLRUCache(max_bytes=3 * self.VECTOR_BYTES)
+        self.vectors = random_vectors(['a', 'b', 'c', 'd'])
+
+    def test_evicts_least_recently_used(self):
+        for key in 'abc':
+            self.cache.put(key, self.vectors[key])
+        self.cache.get('a')
+        self.cache.put('d', self.vectors['d'])
+
+        self.assertNotIn('b', self.cache)
+        self.assertEqual([key for key in 'abcd' if key in self.cache], ['a', 'c', 'd'])
+        self.assertEqual(self.cache.stats()['bytes'], 3 * self.VECTOR_BYTES)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_overwrite_keeps_byte_count(self):
+        self.cache.put('a', self.vectors['a'])
+        self.cache.put('a', self.vectors['b'])
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.current_bytes, self.VECTOR_BYTES)
+        np.testing.assert_array_equal(self.cache.get('a'), self.vectors['b'])
+
+    def test_cached_copies_are_read_only(self):
+        source = self.vectors['a'].astype(np.float64)
+        cached = self.cache.put('a', source)
+        source[0] = 100.0
+
+        self.assertEqual(cached.dtype, np.float32)
+        self.assertNotEqual(self.cache.get('a')[0], 100.0)
+        with self.assertRaises(ValueError):
+            self.cache.get('a')[0] = 1.0
+
+    def test_oversized_entry_is_not_cached(self):
+        cache = EmbeddingLRUCache(max_bytes=self.VECTOR_BYTES - 1)
+        returned = cache.put('a', self.vectors['a'])
+        np.testing.assert_array_equal(returned, self.vectors['a'])
+        self.assertEqual(len(cache), 0)
+
+    def test_pop_clear_and_stats(self):
+        self.cache.put('a', self.vectors['a'])
+        self.cache.put('b', self.vectors['b'])
+        self.cache.get('a')
+        self.cache.get('missing')
+
+        self.assertIsNotNone(self.cache.pop('a'))
+        self.assertIsNone(self.cache.pop('a'))
+        self.assertEqual(self.cache.current_bytes, self.VECTOR_BYTES)
+
+        self.cache.clear()
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['bytes']), (0, 0))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+
+class LazyModelLoadingTests(TestCase):
+    """Ленивая загрузка моделей и прогрев при старте"""
+
+    def setUp(self):
+        self.random = mock.Mock(return_value=0.0)
+        for patcher in (
+            mock.patch('music_app.clap_model.time.sleep'),
+            mock.patch('music_app.clap_model.random.random', self.random),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_clap_model_loads_on_first_use(self):
+        model = CLAPModel()
+        self.assertFalse(model.is_ready())
+        self.assertEqual(model.get_status()['state'], 'not_loaded')
+
+        with mock.patch.object(model, '_load_model', wraps=model._load_model) as load:
+            embeddings = model.embed_waveforms(np.ones((2, 4096), dtype=np.float32))
+            model.embed_waveforms(np.ones((1, 4096), dtype=np.float32))
+        load.assert_called_once()
+
+        self.assertEqual(embeddings.shape, (2, 512))
+        self.assertEqual(model.get_status()['state'], 'ready')
+
+    def test_failed_load_retry_is_throttled(self):
+        model = CLAPModel()
+        self.random.return_value = 0.95
+        self.assertFalse(model._ensure_loaded())
+        self.assertEqual(model.get_status()['state'], 'failed')
+
+        self.random.return_value = 0.0
+        self.assertFalse(model._ensure_loaded())
+        with self.assertRaises(RuntimeError):
+            model.embed_waveforms(np.ones((1, 4096), dtype=np.float32))
+
+        model._failed_at -= CLAPModel.LOAD_RETRY_SECONDS
+        self.assertTrue(model._ensure_loaded())
+
+    def test_explicit_warm_up(self):
+        model = CLAPModel()
+        self.assertTrue(model.warm_up())
+        self.assertTrue(model.is_ready())
+
+        classifier = object.__new__(GenreClassifier)
+        classifier._init()
+        self.assertFalse(classifier.is_model_loaded())
+        self.assertTrue(classifier.warm_up())
+        self.assertTrue(classifier.is_model_loaded())
+
+    def test_app_ready_skips_vector_warm_up_by_default(self):
+        config = apps.get_app_config('music_app')
+        with mock.patch('music_app.apps.warm_up_vector_search') as warm_up:
+            with override_settings(VECTOR_INDEX_WARM_UP=False):
+                config.ready()
+            warm_up.assert_not_called()
+
+            with override_settings(VECTOR_INDEX_WARM_UP=True):
+                config.ready()
+            warm_up.assert_called_once()
+
+    @override_settings(VECTOR_INDEX_WARM_UP=True)
+    def test_refresh_hook_is_connected_under_runserver(self):
+        dispatch_uid = 'music_app.refresh_vector_index'
+        request_started.disconnect(dispatch_uid=dispatch_uid)
+
+        config = apps.get_app_config('music_app')
+        with mock.patch('music_app.apps.warm_up_vector_search') as warm_up:
+            with mock.patch.dict(os.environ, {'RUN_MAIN': 'true'}):
+                config.ready()
+                # Процесс reloader-а обслуживает запросы, но не прогревает индекс повторно
+                warm_up.assert_not_called()
+                self.assertTrue(request_started.disconnect(dispatch_uid=dispatch_uid))
+                config.ready()
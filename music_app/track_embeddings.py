@@ -4,33 +4,177 @@
 """
 Модуль track_embeddings.py
 Класс для работы с эмбеддингами аудиотреков.
+
+Эмбеддинги хранятся по хэшу содержимого аудиофайла в директории
+модели (имя и версия), поэтому повторная загрузка, переименование
+или перенос того же файла стоят одного хэширования, а не инференса,
+а одинаково названные разные файлы не пересекаются.
+
+Сами векторы лежат в бинарных шардах ShardedEmbeddingStore (записи
+float32 и манифест SQLite), по одному хранилищу на модель.
 """
 
 import os
+import re
 import json
+import hashlib
 import numpy as np
 import logging
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from datetime import datetime
 from .clap_model import clap_model
+from .embedding_store import ShardedEmbeddingStore
 
 logger = logging.getLogger(__name__)
 
+HASH_CHUNK_SIZE = 1024 * 1024  # Размер блока чтения при хэшировании аудиофайла
+
+
+def content_hash(audio_path, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Считает SHA-256 содержимого аудиофайла, читая его блоками.
+    
+    Args:
+        audio_path (str): Путь к аудиофайлу
+        chunk_size (int): Размер блока чтения в байтах
+        
+    Returns:
+        str: Шестнадцатеричный хэш содержимого
+    """
+    digest = hashlib.sha256()
+    with open(audio_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingLRUCache:
+    """
+    Потокобезопасный LRU-кэш эмбеддингов в памяти с ограничением по байтам.
+    
+    Эмбеддинги хранятся копиями float32 только для чтения: вызывающий код
+    не может испортить закэшированный вектор. При превышении бюджета
+    вытесняются давно не использовавшиеся записи.
+    """
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # 256 МБ - около 130 тыс. эмбеддингов размерности 512
+    
+    def __init__(self, max_bytes=None):
+        """
+        Args:
+            max_bytes (int): Бюджет памяти кэша в байтах
+        """
+        self.max_bytes = self.DEFAULT_MAX_BYTES if max_bytes is None else max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key):
+        """
+        Возвращает эмбеддинг из кэша и отмечает его как недавно использованный.
+        
+        Returns:
+            numpy.ndarray: Эмбеддинг float32 или None, если его нет в кэше
+        """
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+    
+    def put(self, key, embedding):
+        """
+        Добавляет эмбеддинг в кэш, вытесняя старые записи сверх бюджета.
+        
+        Returns:
+            numpy.ndarray: Закэшированная копия эмбеддинга float32
+        """
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.flags.writeable = False
+        if embedding.nbytes > self.max_bytes:
+            return embedding
+        
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes
+            self._entries[key] = embedding
+            self.current_bytes += embedding.nbytes
+            
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+        return embedding
+    
+    def pop(self, key):
+        """Удаляет эмбеддинг из кэша"""
+        with self._lock:
+            embedding = self._entries.pop(key, None)
+            if embedding is not None:
+                self.current_bytes -= embedding.nbytes
+            return embedding
+    
+    def clear(self):
+        """Очищает кэш (счетчики попаданий сохраняются)"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+    
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+    
+    def stats(self):
+        """
+        Возвращает статистику кэша.
+        
+        Returns:
+            dict: Количество записей, занятые байты, бюджет и счетчики
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
+
+
 class TrackEmbeddings:
     """
     Класс для работы с эмбеддингами музыкальных треков.
     Позволяет сохранять и загружать эмбеддинги, а также сравнивать их.
     """
+    HASH_MEMO_SIZE = 10000  # Сколько хэшей файлов помнить по пути, размеру и времени изменения
     
-    def __init__(self, embeddings_dir="embeddings"):
+    def __init__(self, embeddings_dir="embeddings", cache_max_bytes=None):
         """
         Инициализирует экземпляр для работы с эмбеддингами треков.
         
         Args:
             embeddings_dir (str): Директория для хранения эмбеддингов
+            cache_max_bytes (int): Бюджет памяти кэша эмбеддингов в байтах
         """
         self.embeddings_dir = Path(embeddings_dir)
-        self.embeddings_cache = {}  # Кэш эмбеддингов в памяти
+        # Кэш эмбеддингов в памяти по (модель, хэш содержимого)
+        self.embeddings_cache = EmbeddingLRUCache(cache_max_bytes)
+        self._hash_memo = {}  # Путь -> (размер, время изменения, хэш содержимого)
+        self._stores = {}  # Директория модели -> ShardedEmbeddingStore
         
         # Создаем директорию для эмбеддингов, если она не существует
         if not self.embeddings_dir.exists():
@@ -39,21 +183,103 @@ class TrackEmbeddings:
                 logger.info(f"Создана директория для эмбеддингов: {self.embeddings_dir}")
             except Exception as e:
                 logger.error(f"Не удалось создать директорию для эмбеддингов: {str(e)}")
+        
+        self._migrate_json_embeddings()
     
-    def _get_embedding_path(self, audio_path):
+    def _content_key(self, audio_path):
         """
-        Получает путь к файлу эмбеддинга для аудиофайла.
+        Получает хэш содержимого аудиофайла. Пока размер и время изменения
+        файла не меняются, хэш берется из памяти без повторного чтения.
         
         Args:
             audio_path (str): Путь к аудиофайлу
             
         Returns:
-            Path: Путь к файлу эмбеддинга
+            str: Хэш содержимого или None, если файл не удалось прочитать
         """
-        # Получаем имя файла без расширения и добавляем .json
-        audio_file = Path(audio_path)
-        embedding_filename = f"{audio_file.stem}.json"
-        return self.embeddings_dir / embedding_filename
+        try:
+            stat = os.stat(audio_path)
+            memo = self._hash_memo.get(audio_path)
+            if memo is not None and memo[:2] == (stat.st_size, stat.st_mtime_ns):
+                return memo[2]
+            
+            digest = content_hash(audio_path)
+        except OSError as e:
+            logger.error(f"Не удалось прочитать аудиофайл {audio_path}: {str(e)}")
+            return None
+        
+        if len(self._hash_memo) >= self.HASH_MEMO_SIZE:
+            self._hash_memo.clear()
+        self._hash_memo[audio_path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+    
+    def _model_dir(self):
+        """
+        Получает директорию эмбеддингов текущей модели и ее версии.
+        
+        Returns:
+            Path: Директория эмбеддингов модели
+        """
+        return self.embeddings_dir / re.sub(r'[^\w.-]', '_', clap_model.model_key())
+    
+    def _store(self, model_dir=None):
+        """
+        Получает хранилище эмбеддингов модели.
+        
+        Args:
+            model_dir (Path): Директория модели (по умолчанию - текущей модели)
+            
+        Returns:
+            ShardedEmbeddingStore: Хранилище эмбеддингов
+        """
+        model_dir = Path(model_dir) if model_dir is not None else self._model_dir()
+        store = self._stores.get(model_dir)
+        if store is None:
+            store = self._stores[model_dir] = ShardedEmbeddingStore(model_dir)
+        return store
+    
+    def _model_stores(self):
+        """
+        Получает хранилища всех моделей в директории эмбеддингов.
+        
+        Returns:
+            list: Список ShardedEmbeddingStore
+        """
+        return [
+            self._store(manifest.parent)
+            for manifest in sorted(self.embeddings_dir.glob(f"*/{ShardedEmbeddingStore.MANIFEST_NAME}"))
+        ]
+    
+    def _migrate_json_embeddings(self):
+        """
+        Переносит эмбеддинги из JSON-файлов (<модель>/<хэш>.json) прежнего
+        формата в бинарные хранилища моделей и удаляет перенесенные файлы.
+        """
+        for model_dir in sorted(path for path in self.embeddings_dir.glob("*") if path.is_dir()):
+            json_files = list(model_dir.glob("*.json"))
+            if not json_files:
+                continue
+            
+            items = []
+            migrated = []
+            for json_file in json_files:
+                try:
+                    with open(json_file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    items.append((data.get("content_hash") or json_file.stem, data["embedding"], data.get("audio_path")))
+                    migrated.append(json_file)
+                except Exception as e:
+                    logger.error(f"Ошибка при чтении файла эмбеддинга {json_file}: {str(e)}")
+            
+            try:
+                self._store(model_dir).put_many(items)
+            except Exception as e:
+                logger.error(f"Ошибка при переносе эмбеддингов из {model_dir}: {str(e)}")
+                continue
+            
+            for json_file in migrated:
+                json_file.unlink()
+            logger.info(f"Перенесено {len(items)} эмбеддингов из JSON-файлов в хранилище {model_dir}")
     
     def generate_embedding(self, audio_path):
         """
@@ -81,8 +307,6 @@ class TrackEmbeddings:
             embedding_saved = self.save_embedding(audio_path, embedding)
             
             if embedding_saved:
-                # Добавляем эмбеддинг в кэш
-                self.embeddings_cache[audio_path] = embedding
                 logger.info(f"Эмбеддинг успешно сгенерирован и сохранен для {audio_path}")
                 return embedding
             else:
@@ -95,7 +319,7 @@ class TrackEmbeddings:
     
     def save_embedding(self, audio_path, embedding):
         """
-        Сохраняет эмбеддинг в файл.
+        Сохраняет эмбеддинг в хранилище модели.
         
         Args:
             audio_path (str): Путь к аудиофайлу
@@ -104,31 +328,26 @@ class TrackEmbeddings:
         Returns:
             bool: True, если сохранение прошло успешно
         """
-        embedding_path = self._get_embedding_path(audio_path)
+        digest = self._content_key(audio_path)
+        if digest is None:
+            return False
         
         try:
-            # Подготавливаем данные для сохранения
-            embedding_data = {
-                "audio_path": audio_path,
-                "embedding": embedding.tolist(),  # Преобразуем numpy массив в список
-                "created_at": datetime.now().isoformat(),
-                "model_info": clap_model.get_model_info() if clap_model.is_ready() else None
-            }
+            self._store().put(digest, embedding, audio_path=audio_path)
             
-            # Сохраняем в JSON файл
-            with open(embedding_path, 'w', encoding='utf-8') as f:
-                json.dump(embedding_data, f, ensure_ascii=False, indent=2)
+            # Добавляем эмбеддинг в кэш
+            self.embeddings_cache.put((clap_model.model_key(), digest), embedding)
                 
-            logger.info(f"Эмбеддинг сохранен в {embedding_path}")
+            logger.info(f"Эмбеддинг {audio_path} сохранен в хранилище {self._model_dir()}")
             return True
             
         except Exception as e:
-            logger.error(f"Ошибка при сохранении эмбеддинга в {embedding_path}: {str(e)}")
+            logger.error(f"Ошибка при сохранении эмбеддинга {audio_path}: {str(e)}")
             return False
     
     def load_embedding(self, audio_path):
         """
-        Загружает эмбеддинг из файла.
+        Загружает эмбеддинг из хранилища.
         
         Args:
             audio_path (str): Путь к аудиофайлу
@@ -136,39 +355,45 @@ class TrackEmbeddings:
         Returns:
             numpy.ndarray: Загруженный эмбеддинг или None при ошибке
         """
+        digest = self._content_key(audio_path)
+        if digest is None:
+            return None
+        cache_key = (clap_model.model_key(), digest)
+        
         # Проверяем, есть ли эмбеддинг в кэше
-        if audio_path in self.embeddings_cache:
+        embedding = self.embeddings_cache.get(cache_key)
+        if embedding is not None:
             logger.debug(f"Эмбеддинг для {audio_path} найден в кэше")
-            return self.embeddings_cache[audio_path]
-            
-        embedding_path = self._get_embedding_path(audio_path)
-        
-        if not embedding_path.exists():
-            logger.warning(f"Файл эмбеддинга не найден: {embedding_path}")
-            return None
+            return embedding
             
         try:
-            # Загружаем эмбеддинг из JSON файла
-            with open(embedding_path, 'r', encoding='utf-8') as f:
-                embedding_data = json.load(f)
-                
-            # Преобразуем список обратно в numpy массив
-            embedding = np.array(embedding_data.get("embedding", []))
+            embedding = self._store().get(digest)
             
-            if embedding.size == 0:
-                logger.error(f"Загруженный эмбеддинг пустой: {embedding_path}")
+            if embedding is None:
+                # Промах кэша - обычная ситуация для нового содержимого
+                logger.debug(f"Эмбеддинг для {audio_path} не найден в хранилище")
                 return None
                 
             # Добавляем в кэш
-            self.embeddings_cache[audio_path] = embedding
+            embedding = self.embeddings_cache.put(cache_key, embedding)
             
-            logger.info(f"Эмбеддинг загружен из {embedding_path}")
+            logger.info(f"Эмбеддинг для {audio_path} загружен из хранилища")
             return embedding
             
         except Exception as e:
-            logger.error(f"Ошибка при загрузке эмбеддинга из {embedding_path}: {str(e)}")
+            logger.error(f"Ошибка при загрузке эмбеддинга для {audio_path}: {str(e)}")
             return None
     
+    def load_all_embeddings(self):
+        """
+        Загружает все эмбеддинги текущей модели одной матрицей
+        (последовательное чтение шардов).
+        
+        Returns:
+            tuple: (список хэшей содержимого, numpy-матрица float32 N x dim)
+        """
+        return self._store().load_matrix()
+    
     def get_or_create_embedding(self, audio_path):
         """
         Получает эмбеддинг из кэша или файла, а если не существует - создает новый.
@@ -199,27 +424,29 @@ class TrackEmbeddings:
         Returns:
             dict: Метаданные эмбеддинга или None при ошибке
         """
-        embedding_path = self._get_embedding_path(audio_path)
-        
-        if not embedding_path.exists():
-            logger.warning(f"Файл эмбеддинга не найден: {embedding_path}")
+        digest = self._content_key(audio_path)
+        if digest is None:
             return None
             
         try:
-            # Загружаем метаданные из JSON файла
-            with open(embedding_path, 'r', encoding='utf-8') as f:
-                embedding_data = json.load(f)
-                
-            # Удаляем сам эмбеддинг из метаданных чтобы не занимать много места
-            if "embedding" in embedding_data:
-                embedding_shape = np.array(embedding_data["embedding"]).shape
-                embedding_data["embedding_shape"] = embedding_shape
-                del embedding_data["embedding"]
-                
-            return embedding_data
+            store = self._store()
+            metadata = store.get_metadata(digest)
+            if metadata is None:
+                logger.warning(f"Эмбеддинг для {audio_path} не найден в хранилище")
+                return None
+            
+            # Сам эмбеддинг не читается: размер известен из хранилища
+            return {
+                "audio_path": metadata["audio_path"],
+                "content_hash": digest,
+                "model_key": clap_model.model_key(),
+                "created_at": metadata["created_at"],
+                "model_info": clap_model.get_model_info() if clap_model.is_ready() else None,
+                "embedding_shape": (store.dim,),
+            }
             
         except Exception as e:
-            logger.error(f"Ошибка при загрузке метаданных эмбеддинга из {embedding_path}: {str(e)}")
+            logger.error(f"Ошибка при загрузке метаданных эмбеддинга для {audio_path}: {str(e)}")
             return None
     
     def list_embeddings(self):
@@ -227,23 +454,20 @@ class TrackEmbeddings:
         Получает список всех сохраненных эмбеддингов.
         
         Returns:
-            list: Список путей к файлам эмбеддингов
+            list: Список метаданных эмбеддингов всех моделей
         """
         try:
-            embedding_files = list(self.embeddings_dir.glob("*.json"))
             embeddings_list = []
             
-            for embedding_file in embedding_files:
-                try:
-                    with open(embedding_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        embeddings_list.append({
-                            "file": str(embedding_file),
-                            "audio_path": data.get("audio_path", "Неизвестно"),
-                            "created_at": data.get("created_at", "Неизвестно")
-                        })
-                except Exception as e:
-                    logger.error(f"Ошибка при чтении файла эмбеддинга {embedding_file}: {str(e)}")
+            for store in self._model_stores():
+                for record in store.list():
+                    embeddings_list.append({
+                        "file": record["file"],
+                        "audio_path": record["audio_path"] or "Неизвестно",
+                        "content_hash": record["key"],
+                        "model_key": store.root.name,
+                        "created_at": record["created_at"] or "Неизвестно"
+                    })
             
             return embeddings_list
             
@@ -300,25 +524,24 @@ class TrackEmbeddings:
         Returns:
             bool: True, если удаление прошло успешно
         """
-        embedding_path = self._get_embedding_path(audio_path)
-        
-        if not embedding_path.exists():
-            logger.warning(f"Файл эмбеддинга не найден: {embedding_path}")
+        digest = self._content_key(audio_path)
+        if digest is None:
             return False
             
         try:
-            # Удаляем файл
-            embedding_path.unlink()
+            # Запись остается в шарде, ключ удаляется из манифеста
+            if not self._store().delete(digest):
+                logger.warning(f"Эмбеддинг для {audio_path} не найден в хранилище")
+                return False
             
             # Удаляем из кэша, если есть
-            if audio_path in self.embeddings_cache:
-                del self.embeddings_cache[audio_path]
+            self.embeddings_cache.pop((clap_model.model_key(), digest))
                 
-            logger.info(f"Эмбеддинг удален: {embedding_path}")
+            logger.info(f"Эмбеддинг удален: {audio_path}")
             return True
             
         except Exception as e:
-            logger.error(f"Ошибка при удалении эмбеддинга {embedding_path}: {str(e)}")
+            logger.error(f"Ошибка при удалении эмбеддинга для {audio_path}: {str(e)}")
             return False
     
     def clear_cache(self):
@@ -336,17 +559,17 @@ class TrackEmbeddings:
             dict: Статистика по эмбеддингам
         """
         try:
-            embedding_files = list(self.embeddings_dir.glob("*.json"))
-            total_size = 0
-            
-            for embedding_file in embedding_files:
-                total_size += embedding_file.stat().st_size
+            stores_stats = [store.stats() for store in self._model_stores()]
+            total_size = sum(stats["shards_bytes"] + stats["manifest_bytes"] for stats in stores_stats)
                 
             return {
-                "count": len(embedding_files),
+                "count": sum(stats["count"] for stats in stores_stats),
                 "total_size_bytes": total_size,
                 "total_size_mb": total_size / (1024 * 1024),
+                "shards": sum(stats["shards"] for stats in stores_stats),
+                "garbage_records": sum(stats["garbage_records"] for stats in stores_stats),
                 "cache_size": len(self.embeddings_cache),
+                "cache": self.embeddings_cache.stats(),
                 "embeddings_dir": str(self.embeddings_dir)
             }
             
@@ -357,6 +580,7 @@ class TrackEmbeddings:
                 "total_size_bytes": 0,
                 "total_size_mb": 0,
                 "cache_size": len(self.embeddings_cache),
+                "cache": self.embeddings_cache.stats(),
                 "embeddings_dir": str(self.embeddings_dir),
                 "error": str(e)
             } 
\ No newline at end of file
@@ -5,7 +5,7 @@ from .views import (
     ArtistViewSet, AlbumViewSet, TrackViewSet, UserViewSet,
     TrackPlayViewSet, PlaylistViewSet, LikeViewSet, DislikeViewSet, 
     SkipViewSet, RecommendationViewSet, RegisterView, LoginView, statistics_view,
-    similar_tracks
+    similar_tracks, similar_tracks_batch
 )
 
 # Маршруты для API
@@ -21,6 +21,7 @@ urlpatterns = [
     path('dashboard/', statistics_view, name='dashboard'),
 
     # Similar tracks
+    path('similar/batch/', similar_tracks_batch, name='similar_tracks_batch'),
     path('similar/<str:track_id>/', similar_tracks, name='similar_tracks'),
 ]
 
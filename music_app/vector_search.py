@@ -0,0 +1,518 @@
+"""
+Модуль vector_search.py
+Единый интерфейс бэкендов поиска похожих треков по векторам.
+
+Бэкенд выбирается настройкой VECTOR_SEARCH_BACKEND:
+- 'annoy' - приближенный поиск по Annoy-индексу (по умолчанию);
+- 'exact' - точный поиск блочным матричным умножением NumPy;
+- путь к классу-наследнику VectorSearchBackend (например 'myapp.search.MyBackend').
+"""
+
+import time
+import logging
+import threading
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .mongodb import cosine_to_similarity
+from .vector_store import get_vector_store
+
+logger = logging.getLogger(__name__)
+
+
+def filters_to_lookups(filters):
+    """
+    Преобразует фильтры поиска похожих треков в условия Django ORM для модели Track.
+
+    Args:
+        filters: Словарь {атрибут: значение}; поддерживаются 'genre',
+            'is_explicit' и 'artist_id'
+
+    Returns:
+        dict: Условия для Track.objects.filter()
+    """
+    lookups = {}
+    for name, value in (filters or {}).items():
+        if name == 'genre':
+            lookups['genre__iexact'] = value
+        elif name in ('is_explicit', 'artist_id'):
+            lookups[name] = value
+        else:
+            raise ValueError(f"Неизвестный атрибут фильтра: {name}")
+    return lookups
+
+
+class VectorSearchBackend:
+    """
+    Базовый класс бэкенда поиска похожих треков.
+
+    Все методы поиска возвращают оценки сходства в одних единицах
+    (1 - angular-расстояние), поэтому бэкенды взаимозаменяемы.
+    """
+    name = None
+
+    @property
+    def is_ready(self):
+        """Готов ли бэкенд отвечать на запросы"""
+        raise NotImplementedError
+
+    def load(self):
+        """
+        Загружает состояние бэкенда для поиска.
+
+        Returns:
+            bool: Успешность загрузки
+        """
+        raise NotImplementedError
+
+    def refresh(self):
+        """Подхватывает изменения, сделанные другими процессами (вызывается перед запросом)"""
+        return False
+
+    def build(self, force=False, **options):
+        """
+        Строит индекс по всем векторам треков.
+
+        Args:
+            force: Перестроить, даже если индекс уже существует
+            options: Параметры, специфичные для бэкенда
+
+        Returns:
+            bool: Успешность построения
+        """
+        raise NotImplementedError
+
+    def add(self, track_id):
+        """Добавляет или обновляет трек в индексе"""
+        raise NotImplementedError
+
+    def remove(self, track_id):
+        """Удаляет трек из индекса"""
+        raise NotImplementedError
+
+    def apply_changes(self, upserts=(), deletes=()):
+        """
+        Применяет пакет изменений векторов треков (из воркера синхронизации).
+
+        Args:
+            upserts: ID добавленных или обновленных треков
+            deletes: ID удаленных треков
+
+        Returns:
+            dict: Счетчики примененных изменений или None, если пакет нужно повторить позже
+        """
+        stats = {'added': 0, 'updated': 0, 'removed': 0, 'skipped': 0}
+        for track_id in deletes:
+            stats['removed' if self.remove(track_id) else 'skipped'] += 1
+        for track_id in upserts:
+            stats['updated' if self.add(track_id) else 'skipped'] += 1
+        return stats
+
+    def query(self, track_id, limit=10, filters=None, exclude_track_ids=None):
+        """
+        Находит похожие треки.
+
+        Args:
+            track_id: ID исходного трека
+            limit: Максимальное количество результатов
+            filters: Словарь {атрибут: значение} ('genre', 'is_explicit', 'artist_id')
+            exclude_track_ids: Коллекция ID треков, исключаемых из выдачи
+
+        Returns:
+            Список кортежей (ID трека, показатель схожести) по убыванию сходства
+        """
+        raise NotImplementedError
+
+    def query_many(self, track_ids, limit=10, filters=None, exclude_track_ids=None):
+        """
+        Находит похожие треки сразу для нескольких исходных треков.
+
+        Returns:
+            dict: {ID исходного трека: список кортежей (ID трека, показатель схожести)}
+        """
+        return {
+            track_id: self.query(track_id, limit, filters, exclude_track_ids)
+            for track_id in dict.fromkeys(track_ids)
+        }
+
+    def stats(self):
+        """
+        Возвращает информацию о состоянии бэкенда.
+
+        Returns:
+            dict: Информация об индексе
+        """
+        raise NotImplementedError
+
+
+class AnnoyBackend(VectorSearchBackend):
+    """Приближенный поиск по Annoy-индексу (синглтон annoy_index)"""
+    name = 'annoy'
+
+    def __init__(self):
+        from .annoy_index import annoy_index
+        self.index = annoy_index
+
+    @property
+    def is_ready(self):
+        return self.index.is_loaded
+
+    def load(self):
+        return self.index.load_index()
+
+    def refresh(self):
+        return self.index.refresh_if_stale()
+
+    def build(self, force=False, **options):
+        return self.index.build_index(force=force, **options)
+
+    def add(self, track_id):
+        return self.index.add_track_to_index(track_id)
+
+    def remove(self, track_id):
+        return self.index.remove_track_from_index(track_id)
+
+    def apply_changes(self, upserts=(), deletes=()):
+        return self.index.apply_changes(upserts, deletes)
+
+    def query(self, track_id, limit=10, filters=None, exclude_track_ids=None):
+        # Без фильтров ответ берется из предвычисленной таблицы соседей поколения
+        # (с треками дельта-сегмента); поиск по индексу нужен только для треков,
+        # которых в ней еще нет
+        if not filters:
+            precomputed = self.index.get_precomputed_neighbors(track_id, limit, exclude_track_ids)
+            if precomputed is not None:
+                return precomputed
+        return self.index.find_similar_tracks(track_id, limit, filters, exclude_track_ids)
+
+    def query_many(self, track_ids, limit=10, filters=None, exclude_track_ids=None):
+        return self.index.find_similar_tracks_many(track_ids, limit, filters, exclude_track_ids)
+
+    def stats(self):
+        info = self.index.get_index_info()
+        info['backend'] = self.name
+        return info
+
+
+class ExactBackend(VectorSearchBackend):
+    """
+    Точный поиск по нормализованной float32-матрице всех векторов в памяти.
+
+    Запросы считаются блочным матричным умножением (блоки по
+    VECTOR_SEARCH_EXACT_BLOCK_SIZE строк) с выбором top-K через argpartition,
+    пакетные запросы обрабатываются одним умножением на блок. Добавление
+    и удаление трека - изменение одной строки матрицы.
+
+    Подходит для каталогов до ~50 тыс. треков: результаты точные и служат
+    эталоном для приближенных бэкендов. Изменения из других процессов
+    подхватываются перезагрузкой матрицы из MongoDB раз в
+    VECTOR_SEARCH_EXACT_REFRESH_INTERVAL секунд. Без прогрева при старте
+    матрица загружается в фоне при первом refresh().
+    """
+    name = 'exact'
+
+    EMBEDDING_DIM = 512
+    BLOCK_SIZE = 16384       # Количество строк матрицы в одном блоке умножения
+    REFRESH_INTERVAL = 300   # Интервал перезагрузки матрицы из MongoDB (секунды)
+    LOAD_RETRY_SECONDS = 30  # Пауза перед повторной первой загрузкой после ошибки
+
+    def __init__(self):
+        self.track_ids = np.zeros(0, dtype=np.int64)
+        self.matrix = np.zeros((0, self.EMBEDDING_DIM), dtype=np.float32)
+        self.count = 0
+        self.rows = {}  # ID трека -> номер строки матрицы
+        self.loaded_at = None
+        self._lock = threading.RLock()
+        self._reload_thread = None
+        self._load_started_at = float('-inf')
+
+    @property
+    def is_ready(self):
+        return self.loaded_at is not None
+
+    @staticmethod
+    def _normalize(matrix):
+        """Нормализует строки матрицы по L2-норме"""
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (matrix / norms).astype(np.float32)
+
+    @classmethod
+    def _get_block_size(cls):
+        """Возвращает количество строк в блоке умножения (VECTOR_SEARCH_EXACT_BLOCK_SIZE)"""
+        return getattr(settings, 'VECTOR_SEARCH_EXACT_BLOCK_SIZE', cls.BLOCK_SIZE)
+
+    def load(self):
+        try:
+            track_ids, matrix = get_vector_store().load_vectors_matrix(self.EMBEDDING_DIM)
+            matrix = self._normalize(matrix)
+            rows = {int(track_id): row for row, track_id in enumerate(track_ids.tolist())}
+
+            with self._lock:
+                self.track_ids = track_ids
+                self.matrix = matrix
+                self.count = len(track_ids)
+                self.rows = rows
+                self.loaded_at = time.monotonic()
+
+            logger.info(f"Точный индекс загружен: {len(track_ids)} треков")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке точного индекса: {str(e)}")
+            return False
+
+    def refresh(self):
+        interval = getattr(settings, 'VECTOR_SEARCH_EXACT_REFRESH_INTERVAL', self.REFRESH_INTERVAL)
+        now = time.monotonic()
+        if self.loaded_at is not None and now - self.loaded_at < interval:
+            return False
+
+        with self._lock:
+            if self._reload_thread is not None and self._reload_thread.is_alive():
+                return False
+            if self.loaded_at is not None:
+                # Перезагрузка идет в фоне, запросы обслуживаются текущей матрицей
+                self.loaded_at = now
+            elif now - self._load_started_at < self.LOAD_RETRY_SECONDS:
+                # Первая загрузка не удалась - повторяем ее не чаще раза в LOAD_RETRY_SECONDS
+                return False
+            self._load_started_at = now
+            self._reload_thread = threading.Thread(
+                target=self.load, name='exact-index-reload', daemon=True
+            )
+            self._reload_thread.start()
+        return True
+
+    def build(self, force=False, **options):
+        return self.load()
+
+    def add(self, track_id):
+        vector = get_vector_store().get_track_vector(track_id)
+        if not vector or not vector.get('embedding'):
+            logger.warning(f"Вектор для трека {track_id} не найден")
+            return False
+
+        return self._put(track_id, vector['embedding'])
+
+    def _put(self, track_id, embedding):
+        """Записывает нормализованный вектор трека в его строку матрицы (или новую строку)"""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if embedding.shape != (self.EMBEDDING_DIM,):
+            logger.warning(f"Некорректная размерность эмбеддинга трека {track_id}: {embedding.shape}")
+            return False
+
+        row_vector = self._normalize(embedding[np.newaxis, :])[0]
+        track_id = int(track_id)
+
+        with self._lock:
+            row = self.rows.get(track_id)
+            if row is None:
+                if self.count == len(self.matrix):
+                    # Матрица растет удвоением, чтобы добавление оставалось амортизированно O(1)
+                    capacity = max(2 * len(self.matrix), 1024)
+                    matrix = np.zeros((capacity, self.EMBEDDING_DIM), dtype=np.float32)
+                    matrix[:self.count] = self.matrix[:self.count]
+                    track_ids = np.zeros(capacity, dtype=np.int64)
+                    track_ids[:self.count] = self.track_ids[:self.count]
+                    self.matrix, self.track_ids = matrix, track_ids
+                row = self.count
+                self.track_ids[row] = track_id
+                self.rows[track_id] = row
+                self.count += 1
+            self.matrix[row] = row_vector
+
+        return True
+
+    def remove(self, track_id):
+        track_id = int(track_id)
+        with self._lock:
+            row = self.rows.pop(track_id, None)
+            if row is None:
+                return False
+
+            # На место удаленной строки переносится последняя
+            last = self.count - 1
+            if row != last:
+                moved_track_id = int(self.track_ids[last])
+                self.matrix[row] = self.matrix[last]
+                self.track_ids[row] = moved_track_id
+                self.rows[moved_track_id] = row
+            self.count = last
+
+        return True
+
+    def apply_changes(self, upserts=(), deletes=()):
+        # Векторы всех обновленных треков читаются из хранилища одним запросом
+        upserts = [int(track_id) for track_id in upserts]
+        stats = {'added': 0, 'updated': 0, 'removed': 0, 'skipped': 0}
+
+        for track_id in deletes:
+            stats['removed' if self.remove(track_id) else 'skipped'] += 1
+
+        found = set()
+        if upserts:
+            for track_id, embedding in get_vector_store().get_embeddings(upserts).items():
+                existed = int(track_id) in self.rows
+                if self._put(track_id, embedding):
+                    found.add(int(track_id))
+                    stats['updated' if existed else 'added'] += 1
+        stats['skipped'] += len(set(upserts) - found)
+        return stats
+
+    def _allowed_mask(self, track_ids, filters, exclude_track_ids):
+        """
+        Строит маску строк, подходящих под фильтры и не входящих в исключения.
+
+        Returns:
+            numpy.ndarray или None, если фильтров и исключений нет
+        """
+        if not filters and not exclude_track_ids:
+            return None
+
+        allowed = np.ones(len(track_ids), dtype=bool)
+        if filters:
+            from .models import Track
+
+            matching = Track.objects.filter(**filters_to_lookups(filters)).values_list('id', flat=True)
+            allowed &= np.isin(track_ids, np.fromiter(matching, dtype=np.int64))
+        if exclude_track_ids:
+            allowed &= ~np.isin(track_ids, np.fromiter(exclude_track_ids, dtype=np.int64))
+        return allowed
+
+    def _search(self, queries, query_rows, limit, allowed):
+        """
+        Находит top-K строк для каждого запроса блочным матричным умножением.
+
+        Args:
+            queries: Нормализованные векторы запросов (m x dim)
+            query_rows: Строки матрицы исходных треков (-1, если трека нет в матрице)
+            limit: Количество результатов на запрос
+            allowed: Маска допустимых строк или None
+
+        Returns:
+            tuple: (rows, cosines) - массивы m x limit, отсортированные по убыванию сходства
+        """
+        with self._lock:
+            matrix = self.matrix
+            count = self.count
+
+        n_queries = len(queries)
+        best_rows = np.full((n_queries, 0), -1, dtype=np.int64)
+        best_scores = np.full((n_queries, 0), -np.inf, dtype=np.float32)
+        block_size = self._get_block_size()
+
+        for start in range(0, count, block_size):
+            end = min(start + block_size, count)
+            scores = queries @ matrix[start:end].T
+
+            # Исходный трек не считается похожим на себя
+            in_block = (query_rows >= start) & (query_rows < end)
+            scores[np.flatnonzero(in_block), query_rows[in_block] - start] = -np.inf
+            if allowed is not None:
+                scores[:, ~allowed[start:end]] = -np.inf
+
+            candidate_rows = np.concatenate(
+                [best_rows, np.broadcast_to(np.arange(start, end), scores.shape)], axis=1
+            )
+            candidate_scores = np.concatenate([best_scores, scores], axis=1)
+
+            k = min(limit, candidate_scores.shape[1])
+            top = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+            best_rows = np.take_along_axis(candidate_rows, top, axis=1)
+            best_scores = np.take_along_axis(candidate_scores, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def query(self, track_id, limit=10, filters=None, exclude_track_ids=None):
+        return self.query_many([track_id], limit, filters, exclude_track_ids).get(track_id, [])
+
+    def query_many(self, track_ids, limit=10, filters=None, exclude_track_ids=None):
+        if not track_ids:
+            return {}
+        if not self.is_ready and not self.load():
+            return {track_id: [] for track_id in track_ids}
+
+        try:
+            unique_track_ids = list(dict.fromkeys(track_ids))
+
+            with self._lock:
+                index_track_ids = self.track_ids[:self.count].copy()
+                seed_rows = [self.rows.get(int(track_id), -1) for track_id in unique_track_ids]
+                seed_vectors = [self.matrix[row].copy() if row >= 0 else None for row in seed_rows]
+
+            # Векторы треков, которых нет в матрице, берем из MongoDB
+            queries = []
+            for track_id, seed_vector in zip(unique_track_ids, seed_vectors):
+                if seed_vector is None:
+                    vector = get_vector_store().get_track_vector(track_id)
+                    if vector and vector.get('embedding'):
+                        seed_vector = self._normalize(np.asarray(vector['embedding'], dtype=np.float32)[np.newaxis, :])[0]
+                queries.append(seed_vector)
+
+            found = [i for i, query in enumerate(queries) if query is not None]
+            results = {track_id: [] for track_id in unique_track_ids}
+            if not found or len(index_track_ids) == 0:
+                return results
+
+            allowed = self._allowed_mask(index_track_ids, filters, exclude_track_ids)
+            rows, cosines = self._search(
+                np.stack([queries[i] for i in found]),
+                np.array([seed_rows[i] for i in found], dtype=np.int64),
+                limit,
+                allowed
+            )
+            similarities = cosine_to_similarity(cosines)
+
+            for position, i in enumerate(found):
+                results[unique_track_ids[i]] = [
+                    (int(index_track_ids[row]), float(similarity))
+                    for row, cosine, similarity in zip(rows[position], cosines[position], similarities[position])
+                    if np.isfinite(cosine)
+                ]
+            return results
+        except Exception as e:
+            logger.error(f"Ошибка при точном поиске похожих треков: {str(e)}")
+            return {track_id: [] for track_id in track_ids}
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "indexed_tracks_count": self.count,
+            "embedding_dim": self.EMBEDDING_DIM,
+            "matrix_size_mb": round(self.count * self.EMBEDDING_DIM * 4 / (1024 * 1024), 2),
+            "block_size": self._get_block_size(),
+            "loaded": self.is_ready,
+        }
+
+
+BACKENDS = {
+    AnnoyBackend.name: AnnoyBackend,
+    ExactBackend.name: ExactBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_vector_backend(name=None):
+    """
+    Возвращает экземпляр бэкенда поиска похожих треков (один на процесс).
+
+    Args:
+        name: Имя бэкенда или путь к классу (по умолчанию VECTOR_SEARCH_BACKEND)
+
+    Returns:
+        VectorSearchBackend
+    """
+    name = name or getattr(settings, 'VECTOR_SEARCH_BACKEND', AnnoyBackend.name)
+    backend = _backends.get(name)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(name)
+            if backend is None:
+                backend_class = BACKENDS.get(name) or import_string(name)
+                backend = backend_class()
+                _backends[name] = backend
+    return backend
@@ -0,0 +1,220 @@
+"""
+Хранилища векторных представлений треков.
+
+TrackVectors хранит векторы в MongoDB, SQLTrackVectors - в таблице TrackEmbedding
+основной реляционной БД (SQLite или PostgreSQL). У хранилищ общий интерфейс BaseTrackVectors,
+поэтому индекс похожих треков и TrackVectorService работают с любым из них.
+Хранилище выбирается настройкой TRACK_VECTORS_STORE.
+"""
+import logging
+from django.conf import settings
+from django.db import OperationalError, transaction
+from django.utils.module_loading import import_string
+
+from .mongodb import (
+    BaseTrackVectors, BruteForceSearchMixin, MatrixCacheMixin, TrackVectors,
+    encode_embedding, decode_embedding, NUMPY_AVAILABLE
+)
+
+logger = logging.getLogger(__name__)
+
+
+class SQLTrackVectors(MatrixCacheMixin, BruteForceSearchMixin, BaseTrackVectors):
+    """
+    Хранилище векторов треков в основной реляционной БД.
+
+    Эмбеддинги хранятся float32 BLOB-ами в том же формате, что и бинарные
+    эмбеддинги MongoDB, поэтому рекомендации и построение индекса обходятся
+    одним соединением с БД метаданных треков. Запись векторов и outbox
+    изменений выполняется в одной транзакции. Поиск без индекса работает
+    полным перебором по закэшированной нормализованной матрице (BruteForceSearchMixin).
+    """
+    BATCH_SIZE = 500  # Количество строк в одном INSERT при пакетной записи
+
+    # Пока БД недоступна, поиск без индекса работает по устаревшей матрице
+    MATRIX_FALLBACK_ERRORS = (OperationalError,)
+
+    @classmethod
+    def ensure_indexes(cls):
+        # Первичный ключ по треку создается миграцией
+        return True
+
+    @staticmethod
+    def _to_row(track_id, vector_data):
+        """Формирует строку TrackEmbedding из векторных данных трека"""
+        from .models import TrackEmbedding
+
+        metadata = dict(vector_data)
+        embedding = metadata.pop('embedding', None)
+        metadata.pop('track_id', None)
+
+        has_embedding = NUMPY_AVAILABLE and embedding is not None and len(embedding) > 0
+        return TrackEmbedding(
+            track_id=track_id,
+            vector=encode_embedding(embedding) if has_embedding else None,
+            dim=len(embedding) if has_embedding else 0,
+            metadata=metadata
+        )
+
+    @classmethod
+    def bulk_upsert(cls, docs):
+        """
+        Сохраняет или обновляет векторные представления нескольких треков
+        пакетными INSERT ... ON CONFLICT DO UPDATE (SQLite и PostgreSQL).
+        Векторы несуществующих треков пропускаются.
+
+        Args:
+            docs: Список словарей {'track_id': ..., 'vector': векторные данные}
+
+        Returns:
+            dict: {'upserted': число новых строк, 'modified': число обновленных}
+                  или None при ошибке
+        """
+        if not docs:
+            return {'upserted': 0, 'modified': 0}
+
+        try:
+            from .models import Track, TrackEmbedding
+
+            # Последняя запись трека в пачке побеждает, как и при bulk_write
+            rows = {int(doc['track_id']): doc['vector'] for doc in docs}
+            valid_ids = set(Track.objects.filter(pk__in=list(rows)).values_list('pk', flat=True))
+            if len(valid_ids) < len(rows):
+                logger.warning(f"Пропущены векторы {len(rows) - len(valid_ids)} несуществующих треков")
+
+            with transaction.atomic():
+                existing = set(
+                    TrackEmbedding.objects.filter(track_id__in=valid_ids).values_list('track_id', flat=True)
+                )
+                TrackEmbedding.objects.bulk_create(
+                    [cls._to_row(track_id, rows[track_id]) for track_id in valid_ids],
+                    batch_size=cls.BATCH_SIZE,
+                    update_conflicts=True,
+                    unique_fields=['track'],
+                    update_fields=['vector', 'dim', 'metadata', 'updated_at']
+                )
+                cls.record_changes(list(valid_ids), 'upsert')
+            cls.invalidate_matrix_cache()
+
+            result = {'upserted': len(valid_ids - existing), 'modified': len(existing)}
+            logger.info(
+                f"Сохранены векторные представления {len(valid_ids)} треков в БД: "
+                f"новых {result['upserted']}, обновлено {result['modified']}"
+            )
+            return result
+        except Exception as e:
+            logger.error(f"Ошибка при пакетном сохранении векторных представлений в БД: {str(e)}")
+            return None
+
+    @classmethod
+    def process_track(cls, track_id, vector_data):
+        return track_id if cls.bulk_upsert([{'track_id': track_id, 'vector': vector_data}]) is not None else None
+
+    @classmethod
+    def delete_track_vector(cls, track_id):
+        try:
+            from .models import TrackEmbedding
+
+            with transaction.atomic():
+                TrackEmbedding.objects.filter(track_id=track_id).delete()
+                cls.record_changes([track_id], 'delete')
+            cls.invalidate_matrix_cache()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при удалении векторного представления трека {track_id} из БД: {str(e)}")
+            return False
+
+    @staticmethod
+    def _to_vector(metadata, blob):
+        """Собирает векторные данные трека из метаданных и BLOB-а эмбеддинга"""
+        embedding = decode_embedding(blob)
+        return dict(metadata or {}, embedding=embedding.tolist() if embedding is not None else [])
+
+    @classmethod
+    def get_track_vector(cls, track_id):
+        from .models import TrackEmbedding
+
+        row = TrackEmbedding.objects.filter(track_id=track_id).values_list('metadata', 'vector').first()
+        if row is None:
+            return None
+        return cls._to_vector(*row)
+
+    @classmethod
+    def get_track_vectors(cls, track_ids):
+        from .models import TrackEmbedding
+
+        rows = TrackEmbedding.objects.filter(track_id__in=list(track_ids)).values_list('track_id', 'metadata', 'vector')
+        return {track_id: cls._to_vector(metadata, blob) for track_id, metadata, blob in rows}
+
+    @classmethod
+    def get_embeddings(cls, track_ids):
+        from .models import TrackEmbedding
+
+        rows = (
+            TrackEmbedding.objects
+            .filter(track_id__in=list(track_ids), vector__isnull=False)
+            .values_list('track_id', 'vector')
+        )
+        return {track_id: decode_embedding(blob) for track_id, blob in rows}
+
+    @classmethod
+    def existing_track_ids(cls):
+        from .models import TrackEmbedding
+
+        return set(TrackEmbedding.objects.filter(vector__isnull=False).values_list('track_id', flat=True))
+
+    @classmethod
+    def iter_embeddings(cls, query=None, batch_size=1000):
+        """
+        Потоково перебирает эмбеддинги треков из БД. В PostgreSQL строки
+        читаются серверным курсором пачками по batch_size.
+
+        Yields:
+            tuple: (track_id, embedding), где embedding - numpy-массив float32
+        """
+        from .models import TrackEmbedding
+
+        if query:
+            raise ValueError("Хранилище векторов в реляционной БД не поддерживает запросы MongoDB")
+
+        rows = (
+            TrackEmbedding.objects
+            .filter(vector__isnull=False)
+            .order_by('track_id')
+            .values_list('track_id', 'vector')
+            .iterator(chunk_size=batch_size)
+        )
+        for track_id, blob in rows:
+            embedding = decode_embedding(blob)
+            if embedding is not None:
+                yield track_id, embedding
+
+    @classmethod
+    def count_vectors(cls, query=None):
+        from .models import TrackEmbedding
+
+        if query:
+            raise ValueError("Хранилище векторов в реляционной БД не поддерживает запросы MongoDB")
+        return TrackEmbedding.objects.filter(vector__isnull=False).count()
+
+
+STORES = {
+    'mongodb': TrackVectors,
+    'sql': SQLTrackVectors,
+}
+
+
+def get_vector_store(name=None):
+    """
+    Возвращает хранилище векторов треков по имени (по умолчанию TRACK_VECTORS_STORE).
+
+    Args:
+        name: 'mongodb', 'sql' или путь к классу хранилища
+
+    Returns:
+        Класс хранилища - наследник BaseTrackVectors
+    """
+    name = name or getattr(settings, 'TRACK_VECTORS_STORE', 'mongodb')
+    if name in STORES:
+        return STORES[name]
+    return import_string(name)
@@ -0,0 +1,450 @@
+"""
+Синхронизация индекса похожих треков с коллекцией векторов треков.
+
+Воркер читает поток изменений коллекции track_vectors - change streams MongoDB,
+если они доступны (replica set), иначе таблицу outbox VectorChange, которую
+хранилище векторов заполняет при каждой записи. Изменения применяются к индексу
+пакетами, а позиция в потоке (токен возобновления) сохраняется в
+VectorSyncCheckpoint после каждого пакета. Поэтому изменения из любых
+процессов и узлов доходят до индекса с ограниченной и измеримой задержкой.
+
+Применение изменений идемпотентно: upsert перечитывает актуальный вектор
+из хранилища, поэтому повтор пакета после сбоя безопасен.
+"""
+import json
+import time
+import logging
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .mongodb import TrackVectors, MockCollection, mongo_guard
+from .vector_search import get_vector_backend
+from .vector_store import get_vector_store
+
+logger = logging.getLogger(__name__)
+
+try:
+    from bson import json_util
+    JSON_UTIL_AVAILABLE = True
+except ImportError:
+    JSON_UTIL_AVAILABLE = False
+
+
+class OutboxSource:
+    """
+    Источник изменений - таблица outbox VectorChange.
+
+    Токен - последний прочитанный id и список пропусков: id ниже него, которых
+    еще не было видно при чтении. id выделяются при вставке, а фиксируются
+    транзакции в другом порядке, поэтому запись с меньшим id может стать
+    видна позже записей с большими. Пропуски перечитываются при каждом
+    чтении, пока запись не появится или не истечет VECTOR_SYNC_OUTBOX_GAP_TIMEOUT
+    (транзакция откатилась или id пропущен последовательностью).
+    """
+    name = 'outbox'
+
+    GAP_TIMEOUT = 300  # Сколько секунд ждать запись на месте пропуска id
+    MAX_GAPS = 10000   # Максимальное количество отслеживаемых пропусков
+
+    def available(self):
+        return True
+
+    @staticmethod
+    def _parse_token(token):
+        """Возвращает последний прочитанный id и пропуски {id: время обнаружения}"""
+        token = token or {}
+        return token.get('outbox_id', 0), {int(gap_id): seen_at for gap_id, seen_at in token.get('gaps', [])}
+
+    def read(self, token, limit):
+        """
+        Читает следующую пачку изменений после позиции token вместе
+        с появившимися записями на месте пропусков.
+
+        Returns:
+            tuple: (список (операция, ID трека, время изменения) по возрастанию id, новый токен)
+        """
+        from .models import VectorChange
+
+        after, gaps = self._parse_token(token)
+        now = time.time()
+
+        timeout = getattr(settings, 'VECTOR_SYNC_OUTBOX_GAP_TIMEOUT', self.GAP_TIMEOUT)
+        expired = [gap_id for gap_id, seen_at in gaps.items() if now - seen_at > timeout]
+        if expired:
+            logger.warning(f"Записи outbox {sorted(expired)} не появились за {timeout} с, пропуски закрыты")
+            for gap_id in expired:
+                del gaps[gap_id]
+
+        columns = ('id', 'operation', 'track_id', 'created_at')
+        rows = list(VectorChange.objects.filter(id__in=list(gaps)).values_list(*columns)) if gaps else []
+        for row in rows:
+            del gaps[row[0]]
+
+        new_rows = list(VectorChange.objects.filter(id__gt=after).order_by('id').values_list(*columns)[:limit])
+        expected = after + 1
+        for row in new_rows:
+            # Длинный разрыв (например, после очистки outbox) отслеживается только у своего конца
+            gaps.update((gap_id, now) for gap_id in range(max(expected, row[0] - self.MAX_GAPS), row[0]))
+            expected = row[0] + 1
+        rows.extend(new_rows)
+
+        if len(gaps) > self.MAX_GAPS:
+            dropped = sorted(gaps)[:len(gaps) - self.MAX_GAPS]
+            logger.warning(f"Слишком много пропусков id в outbox, закрыто {len(dropped)} самых старых")
+            for gap_id in dropped:
+                del gaps[gap_id]
+
+        new_token = {
+            'outbox_id': new_rows[-1][0] if new_rows else after,
+            'gaps': sorted([gap_id, seen_at] for gap_id, seen_at in gaps.items()),
+        }
+        if not rows:
+            return [], new_token if (token or {}).get('gaps', []) != new_token['gaps'] else token
+
+        rows.sort()
+        events = [(operation, track_id, created_at) for _, operation, track_id, created_at in rows]
+        return events, new_token
+
+    def rewind(self):
+        """Позиция хранится только в токене, сбрасывать нечего"""
+
+    def initial_token(self):
+        """Новый воркер проходит всю сохраненную историю outbox (повтор изменений безопасен)"""
+        return {'outbox_id': 0, 'gaps': []}
+
+    def pending(self, token):
+        """
+        Возвращает отставание воркера: количество непримененных изменений
+        (включая появившиеся на месте пропусков) и время самого старого из них.
+        """
+        from .models import VectorChange
+
+        after, gaps = self._parse_token(token)
+        queryset = VectorChange.objects.filter(Q(id__gt=after) | Q(id__in=list(gaps)))
+        oldest = queryset.order_by('id').values_list('created_at', flat=True).first()
+        return {'pending': queryset.count(), 'oldest_pending_at': oldest}
+
+    def prune(self, retention_days):
+        """
+        Удаляет записи outbox старше retention_days дней. Воркер, простоявший
+        дольше этого срока, пропустит изменения - индекс нужно перестроить.
+
+        Returns:
+            int: Количество удаленных записей
+        """
+        from .models import VectorChange
+
+        deleted, _ = VectorChange.objects.filter(
+            created_at__lt=timezone.now() - timedelta(days=retention_days)
+        ).delete()
+        return deleted
+
+
+class ChangeStreamSource:
+    """
+    Источник изменений - change stream коллекции track_vectors
+    (токен - resume token MongoDB). Требует replica set или sharded cluster.
+    """
+    name = 'change_stream'
+
+    MAX_AWAIT_MS = 1000
+
+    PIPELINE = [
+        {'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}},
+    ]
+
+    def __init__(self):
+        self._stream = None
+        # _id документа -> ID трека: событие удаления содержит только _id
+        self._track_ids_by_doc = None
+
+    def available(self):
+        """Проверяет, поддерживает ли MongoDB change streams (заглушка и standalone - нет)"""
+        if get_vector_store() is not TrackVectors:
+            return False
+        collection = TrackVectors.get_collection()
+        if isinstance(collection, MockCollection) or not hasattr(collection, 'watch'):
+            return False
+        try:
+            with mongo_guard():
+                with collection.watch(max_await_time_ms=1) as stream:
+                    stream.try_next()
+            return True
+        except Exception as e:
+            logger.info(f"Change streams MongoDB недоступны: {str(e)}")
+            return False
+
+    def _open(self, token):
+        """Открывает change stream с позиции token (None - с текущего момента)"""
+        collection = TrackVectors.get_collection()
+        with mongo_guard():
+            if self._track_ids_by_doc is None:
+                self._track_ids_by_doc = {
+                    doc['_id']: doc.get('track_id')
+                    for doc in collection.find({}, {'track_id': 1})
+                }
+            self._stream = collection.watch(
+                self.PIPELINE,
+                full_document='updateLookup',
+                resume_after=token,
+                max_await_time_ms=self.MAX_AWAIT_MS
+            )
+
+    def _to_event(self, change):
+        """Преобразует событие change stream в (операция, ID трека, время) или None"""
+        operation = change['operationType']
+        doc_id = change['documentKey']['_id']
+        cluster_time = change.get('clusterTime')
+        changed_at = cluster_time.as_datetime() if cluster_time is not None else timezone.now()
+
+        if operation == 'delete':
+            track_id = self._track_ids_by_doc.pop(doc_id, None)
+            if track_id is None:
+                logger.warning(f"Удален неизвестный документ вектора {doc_id}, пропускаем")
+                return None
+            return 'delete', track_id, changed_at
+
+        if operation == 'update':
+            description = change.get('updateDescription') or {}
+            fields = list(description.get('updatedFields') or {}) + list(description.get('removedFields') or [])
+            if not any(field == 'vector' or field.startswith('vector.') for field in fields):
+                return None
+
+        document = change.get('fullDocument') or {}
+        track_id = document.get('track_id', self._track_ids_by_doc.get(doc_id))
+        if track_id is None:
+            # Документ удален до чтения события, удаление придет следующим событием
+            return None
+        self._track_ids_by_doc[doc_id] = track_id
+        return 'upsert', track_id, changed_at
+
+    def read(self, token, limit):
+        if self._stream is None:
+            self._open(token)
+
+        events = []
+        with mongo_guard():
+            while len(events) < limit:
+                change = self._stream.try_next()
+                if change is None:
+                    break
+                event = self._to_event(change)
+                if event is not None:
+                    events.append(event)
+            resume_token = self._stream.resume_token
+
+        return events, resume_token if resume_token is not None else token
+
+    def rewind(self):
+        """Закрывает поток: следующее чтение начнется с сохраненного токена"""
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except Exception:
+                pass
+        self._stream = None
+
+    def initial_token(self):
+        return None
+
+    def pending(self, token):
+        return {}
+
+    def prune(self, retention_days):
+        return 0
+
+
+SOURCES = {
+    OutboxSource.name: OutboxSource,
+    ChangeStreamSource.name: ChangeStreamSource,
+}
+
+
+def get_change_source(name=None):
+    """
+    Возвращает источник изменений по имени (по умолчанию VECTOR_SYNC_SOURCE).
+    'auto' выбирает change streams, если они доступны, иначе outbox.
+    """
+    name = name or getattr(settings, 'VECTOR_SYNC_SOURCE', 'auto')
+    if name == 'auto':
+        source = ChangeStreamSource()
+        return source if source.available() else OutboxSource()
+
+    if name not in SOURCES:
+        raise ValueError(f"Неизвестный источник изменений векторов: {name}")
+    return SOURCES[name]()
+
+
+class VectorIndexSync:
+    """
+    Воркер синхронизации индекса похожих треков с коллекцией векторов.
+
+    На один каталог индекса нужен один воркер (имя VECTOR_SYNC_NAME): он
+    обновляет файлы индекса, а процессы веб-сервера подхватывают их через
+    refresh(). Бэкенд exact хранит матрицу в памяти процесса, поэтому для
+    него воркер обновляет только собственную копию.
+    """
+    BATCH_SIZE = 500          # Максимальное количество изменений в одном пакете
+    POLL_INTERVAL = 1.0       # Пауза между опросами, когда новых изменений нет (секунды)
+    RETRY_INTERVAL = 5.0      # Пауза после ошибки или отложенного пакета (секунды)
+    OUTBOX_RETENTION_DAYS = 7  # Срок хранения записей outbox
+    PRUNE_INTERVAL = 3600     # Интервал очистки outbox (секунды)
+
+    def __init__(self, name=None, source=None, backend=None, batch_size=None):
+        from .models import VectorSyncCheckpoint
+
+        self.name = name or getattr(settings, 'VECTOR_SYNC_NAME', 'default')
+        self.source = get_change_source(source)
+        self.backend = backend or get_vector_backend()
+        self.batch_size = batch_size or getattr(settings, 'VECTOR_SYNC_BATCH_SIZE', self.BATCH_SIZE)
+        self._last_prune = 0.0
+
+        self.checkpoint, created = VectorSyncCheckpoint.objects.get_or_create(
+            name=self.name,
+            defaults={'source': self.source.name, 'token': self._dump_token(self.source.initial_token())}
+        )
+        if not created and self.checkpoint.source != self.source.name:
+            # Токены разных источников несовместимы: начинаем новый источник с начала
+            logger.warning(
+                f"Источник синхронизации {self.name} сменился с {self.checkpoint.source} на {self.source.name}. "
+                f"Изменения между ними могли быть пропущены - рекомендуется перестроить индекс"
+            )
+            self.checkpoint.source = self.source.name
+            self.checkpoint.token = self._dump_token(self.source.initial_token())
+            self.checkpoint.save(update_fields=['source', 'token', 'updated_at'])
+
+        logger.info(f"Воркер синхронизации индекса {self.name}: источник {self.source.name}, бэкенд {self.backend.name}")
+
+    @staticmethod
+    def _dump_token(token):
+        """Сериализует токен в JSON (resume token MongoDB может содержать BSON-типы)"""
+        if token is None:
+            return ''
+        return json_util.dumps(token) if JSON_UTIL_AVAILABLE else json.dumps(token)
+
+    @staticmethod
+    def _load_token(value):
+        """Десериализует токен из JSON"""
+        if not value:
+            return None
+        return json_util.loads(value) if JSON_UTIL_AVAILABLE else json.loads(value)
+
+    def run_once(self):
+        """
+        Читает и применяет к индексу один пакет изменений.
+
+        Изменения одного трека внутри пакета схлопываются до последнего.
+        Позиция сохраняется только после успешного применения пакета.
+
+        Returns:
+            dict: Статистика пакета или None, если пакет отложен и будет повторен
+        """
+        token = self._load_token(self.checkpoint.token)
+        events, new_token = self.source.read(token, self.batch_size)
+
+        if not events:
+            # Change stream продвигает токен и без событий
+            if new_token != token:
+                self._save_checkpoint(new_token)
+            return {'events': 0}
+
+        final = {}
+        for operation, track_id, _ in events:
+            final[int(track_id)] = operation
+        upserts = [track_id for track_id, operation in final.items() if operation == 'upsert']
+        deletes = [track_id for track_id, operation in final.items() if operation == 'delete']
+
+        result = self.backend.apply_changes(upserts, deletes)
+        if result is None:
+            self.source.rewind()
+            return None
+
+        last_event_at = events[-1][2]
+        self._save_checkpoint(new_token, len(events), last_event_at)
+
+        stats = dict(result, events=len(events), lag_seconds=self.get_lag_seconds(last_event_at))
+        logger.info(
+            f"Синхронизация индекса {self.name}: изменений {len(events)}, "
+            f"отставание {stats['lag_seconds']:.1f} с"
+        )
+        return stats
+
+    def _save_checkpoint(self, token, applied=0, last_event_at=None):
+        """Сохраняет позицию воркера"""
+        self.checkpoint.token = self._dump_token(token)
+        fields = ['token', 'updated_at']
+        if applied:
+            self.checkpoint.applied_count += applied
+            self.checkpoint.last_event_at = last_event_at
+            fields += ['applied_count', 'last_event_at']
+        self.checkpoint.save(update_fields=fields)
+
+    @staticmethod
+    def get_lag_seconds(event_at):
+        """Возвращает задержку применения изменения в секундах"""
+        if event_at is None:
+            return 0.0
+        return max(0.0, (timezone.now() - event_at).total_seconds())
+
+    def _prune_if_due(self):
+        """Периодически удаляет старые записи outbox"""
+        now = time.monotonic()
+        if now - self._last_prune < self.PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        retention_days = getattr(settings, 'VECTOR_SYNC_OUTBOX_RETENTION_DAYS', self.OUTBOX_RETENTION_DAYS)
+        deleted = self.source.prune(retention_days)
+        if deleted:
+            logger.info(f"Удалено {deleted} записей outbox старше {retention_days} дней")
+
+    def run(self, poll_interval=None, stop_event=None):
+        """
+        Применяет изменения в цикле до установки stop_event.
+
+        Args:
+            poll_interval: Пауза между опросами, когда новых изменений нет
+            stop_event: threading.Event для остановки воркера
+        """
+        poll_interval = poll_interval or getattr(settings, 'VECTOR_SYNC_POLL_INTERVAL', self.POLL_INTERVAL)
+        stop_event = stop_event or threading.Event()
+
+        while not stop_event.is_set():
+            try:
+                self._prune_if_due()
+                stats = self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка синхронизации индекса {self.name}: {str(e)}")
+                self.source.rewind()
+                stop_event.wait(self.RETRY_INTERVAL)
+                continue
+
+            if stats is None:
+                stop_event.wait(self.RETRY_INTERVAL)
+            elif stats['events'] < self.batch_size:
+                # Полный пакет означает, что изменения еще есть - читаем сразу
+                stop_event.wait(poll_interval)
+
+    def status(self):
+        """
+        Возвращает состояние синхронизации: позицию, число примененных
+        изменений и отставание от потока изменений.
+        """
+        self.checkpoint.refresh_from_db()
+        token = self._load_token(self.checkpoint.token)
+        info = {
+            'name': self.name,
+            'source': self.source.name,
+            'backend': self.backend.name,
+            'applied_count': self.checkpoint.applied_count,
+            'last_event_at': self.checkpoint.last_event_at,
+            'updated_at': self.checkpoint.updated_at,
+        }
+        info.update(self.source.pending(token))
+
+        # Отставание - возраст самого старого непримененного изменения
+        oldest = info.get('oldest_pending_at')
+        info['lag_seconds'] = self.get_lag_seconds(oldest) if oldest is not None else 0.0
+        return info
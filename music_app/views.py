@@ -987,14 +987,15 @@ class TrackViewSet(viewsets.ModelViewSet):
         force = request.data.get('force', True)
         
         try:
-            from .annoy_index import annoy_index
+            from .vector_search import get_vector_backend
             
-            # Строим индекс
-            success = annoy_index.build_index(force=force)
+            # Строим индекс выбранного бэкенда
+            backend = get_vector_backend()
+            success = backend.build(force=force)
             
             if success:
                 # Получаем информацию об индексе
-                index_info = annoy_index.get_index_info()
+                index_info = backend.stats()
                 index_info['success'] = True
                 
                 return Response(
@@ -1023,14 +1024,15 @@ class TrackViewSet(viewsets.ModelViewSet):
         Возвращает информацию о текущем состоянии Annoy-индекса.
         """
         try:
-            from .annoy_index import annoy_index
+            from .vector_search import get_vector_backend
             
             # Загружаем индекс, если он еще не загружен
-            if not annoy_index.is_loaded:
-                annoy_index.load_index()
+            backend = get_vector_backend()
+            if not backend.is_ready:
+                backend.load()
             
             # Получаем информацию об индексе
-            index_info = annoy_index.get_index_info()
+            index_info = backend.stats()
             
             return Response(index_info, status=status.HTTP_200_OK)
         except Exception as e:
@@ -1039,7 +1041,21 @@ class TrackViewSet(viewsets.ModelViewSet):
                 {"status": "error", "message": f"Ошибка при получении информации об индексе: {str(e)}"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
-    
+
+    @action(detail=False, methods=['get'])
+    def models_status(self, request):
+        """
+        Возвращает состояние загрузки моделей (CLAP и классификатора жанров),
+        не загружая их.
+        """
+        from .clap_model import clap_model
+        from .genre_classifier import genre_classifier
+
+        return Response({
+            "clap": clap_model.get_status(),
+            "genre_classifier": {"ready": genre_classifier.is_model_loaded()},
+        }, status=status.HTTP_200_OK)
+
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def play(self, request, slug=None):
         """
@@ -2005,6 +2021,10 @@ def similar_tracks(request, track_id):
     Параметры:
     - track_id: ID трека, для которого нужно получить рекомендации
     - limit: Количество рекомендаций (по умолчанию 10)
+    - genre: Только треки указанного жанра
+    - explicit: Только треки с ненормативной лексикой (true) или без нее (false)
+    - artist_id: Только треки указанного исполнителя
+    - exclude_disliked: Исключить треки, которые не понравились пользователю (true/false)
     
     Возвращает список похожих треков с их метаданными и оценкой релевантности.
     """
@@ -2018,9 +2038,26 @@ def similar_tracks(request, track_id):
         # Ограничиваем максимальное количество рекомендаций
         if limit > 50:
             limit = 50
+        
+        # Фильтры по атрибутам треков применяются внутри поиска по индексу
+        filters = {}
+        if request.query_params.get('genre'):
+            filters['genre'] = request.query_params['genre']
+        if request.query_params.get('explicit') is not None:
+            filters['is_explicit'] = request.query_params['explicit'].lower() in ('true', '1', 'yes')
+        if request.query_params.get('artist_id'):
+            filters['artist_id'] = int(request.query_params['artist_id'])
+        
+        exclude_track_ids = None
+        if request.query_params.get('exclude_disliked', 'false').lower() in ('true', '1', 'yes'):
+            exclude_track_ids = set(
+                Dislike.objects.filter(user=request.user).values_list('track_id', flat=True)
+            )
             
         # Получаем рекомендации с оценками схожести
-        similarity_scores, similar_tracks = TrackVectorService.get_track_recommendations_with_scores(track_id, limit)
+        similarity_scores, similar_tracks = TrackVectorService.get_track_recommendations_with_scores(
+            track_id, limit, filters, exclude_track_ids
+        )
         
         if not similar_tracks:
             return Response({"detail": "No similar tracks found"}, status=404)
@@ -2029,7 +2066,7 @@ def similar_tracks(request, track_id):
         result = []
         for track in similar_tracks:
             track_data = TrackSerializer(track).data
-            track_data['similarity_score'] = round(similarity_scores.get(str(track.id), 0), 3)  # Округляем до 3 знаков
+            track_data['similarity_score'] = round(similarity_scores.get(track.id, 0), 3)  # Округляем до 3 знаков
             result.append(track_data)
             
         return Response(result)
@@ -2041,3 +2078,51 @@ def similar_tracks(request, track_id):
     except Exception as e:
         logging.error(f"Error getting similar tracks: {str(e)}")
         return Response({"detail": "Failed to retrieve similar tracks"}, status=500)
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def similar_tracks_batch(request):
+    """
+    Получение похожих треков сразу для нескольких треков за один запрос.
+    
+    Тело запроса:
+    - track_ids: Список ID треков (не более 100)
+    - limit: Количество рекомендаций для каждого трека (по умолчанию 10, не более 50)
+    
+    Возвращает словарь {ID трека: список похожих треков с оценкой релевантности}.
+    """
+    try:
+        track_ids = request.data.get('track_ids')
+        if not isinstance(track_ids, list) or not track_ids:
+            return Response({"detail": "track_ids must be a non-empty list"}, status=400)
+        
+        if len(track_ids) > 100:
+            return Response({"detail": "Too many track_ids (max 100)"}, status=400)
+        
+        track_ids = [int(track_id) for track_id in track_ids]
+        limit = min(int(request.data.get('limit', 10)), 50)
+        if limit < 1:
+            return Response({"detail": "limit must be a positive integer"}, status=400)
+        
+        recommendations = TrackVectorService.get_track_recommendations_many(track_ids, limit)
+        
+        # Каждый трек сериализуется один раз, даже если он похож на несколько исходных
+        serialized = {}
+        result = {}
+        for seed_id, similar in recommendations.items():
+            result[str(seed_id)] = []
+            for track, score in similar:
+                if track.id not in serialized:
+                    serialized[track.id] = TrackSerializer(track).data
+                track_data = dict(serialized[track.id])
+                track_data['similarity_score'] = round(score, 3)
+                result[str(seed_id)].append(track_data)
+        
+        return Response(result)
+        
+    except (TypeError, ValueError) as e:
+        return Response({"detail": str(e)}, status=400)
+    except Exception as e:
+        logging.error(f"Error getting similar tracks batch: {str(e)}")
+        return Response({"detail": "Failed to retrieve similar tracks"}, status=500)
@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 
 # Установка переменной окружения для настроек Django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'music_streaming.settings')
@@ -13,6 +14,21 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Автоматическое обнаружение и регистрация задач из приложений
 app.autodiscover_tasks()
 
+@worker_process_init.connect
+def warm_up_models(**kwargs):
+    """
+    Прогревает модели в процессах воркера, который считает эмбеддинги
+    (EMBEDDING_WORKER_WARM_UP), чтобы первая задача не ждала загрузки весов.
+    """
+    from django.conf import settings
+
+    if getattr(settings, 'EMBEDDING_WORKER_WARM_UP', False):
+        from music_app.clap_model import clap_model
+        from music_app.genre_classifier import genre_classifier
+
+        clap_model.warm_up()
+        genre_classifier.warm_up()
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}') 
\ No newline at end of file
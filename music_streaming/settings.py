@@ -167,6 +167,87 @@ MONGODB_SETTINGS = {
     'URI': MONGODB_URI,
     'NAME': MONGODB_NAME,
 }
+# Пул соединений и таймауты MongoClient (мс): при недоступной MongoDB запросы
+# завершаются за секунды, а не за 30 с стандартного server selection timeout
+MONGODB_MAX_POOL_SIZE = env.int('MONGODB_MAX_POOL_SIZE', default=50)
+MONGODB_MIN_POOL_SIZE = env.int('MONGODB_MIN_POOL_SIZE', default=0)
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = env.int('MONGODB_SERVER_SELECTION_TIMEOUT_MS', default=2000)
+MONGODB_CONNECT_TIMEOUT_MS = env.int('MONGODB_CONNECT_TIMEOUT_MS', default=2000)
+MONGODB_SOCKET_TIMEOUT_MS = env.int('MONGODB_SOCKET_TIMEOUT_MS', default=5000)
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = env.int('MONGODB_WAIT_QUEUE_TIMEOUT_MS', default=2000)
+# Автомат защиты: количество ошибок подряд до размыкания и время (с) до пробного обращения
+MONGODB_CIRCUIT_FAILURE_THRESHOLD = env.int('MONGODB_CIRCUIT_FAILURE_THRESHOLD', default=5)
+MONGODB_CIRCUIT_RESET_TIMEOUT = env.float('MONGODB_CIRCUIT_RESET_TIMEOUT', default=30.0)
+# Встроенная заглушка MongoDB в памяти процесса (с $vectorSearch на NumPy) вместо сервера
+MONGODB_USE_MOCK = env.bool('MONGODB_USE_MOCK', default=False)
+# Файл для сохранения данных заглушки между запусками (пусто - без сохранения)
+MONGODB_MOCK_PATH = env.str('MONGODB_MOCK_PATH', default='')
+# Хранилище векторов треков: 'mongodb' - коллекция track_vectors, 'sql' - таблица TrackEmbedding основной БД
+# (SQLite/PostgreSQL, без MongoDB). Перенос векторов: `python manage.py copy_track_vectors --from mongodb --to sql`
+TRACK_VECTORS_STORE = env.str('TRACK_VECTORS_STORE', default='mongodb')
+# Формат хранения эмбеддингов в MongoDB: 'array' - массив double (по умолчанию, нужен для MongoDB Atlas
+# $vectorSearch), 'binary' - float32 BSON Binary с заголовком (в ~4 раза компактнее, но без $vectorSearch:
+# поиск без индекса идет полным перебором). Включается явно вместе с конвертацией существующих документов:
+# `python manage.py migrate_embeddings --to binary`
+TRACK_VECTORS_EMBEDDING_FORMAT = env.str('TRACK_VECTORS_EMBEDDING_FORMAT', default='array')
+# Количество векторов треков, сохраняемых в MongoDB одним bulk_write при пакетной обработке
+TRACK_VECTORS_BATCH_SIZE = env.int('TRACK_VECTORS_BATCH_SIZE', default=200)
+# Конвейер эмбеддингов CLAP при пакетной обработке: размер пачки для модели
+# и количество процессов декодирования аудио (пусто - число ядер - 1)
+CLAP_BATCH_SIZE = env.int('CLAP_BATCH_SIZE', default=16)
+CLAP_DECODE_WORKERS = env.int('CLAP_DECODE_WORKERS', default=0) or None
+# Кэш эмбеддингов по хэшу содержимого аудиофайла, имени и версии модели:
+# повторно загруженные или перемещенные файлы не отправляются в модель
+EMBEDDINGS_CACHE_DIR = env.str('EMBEDDINGS_CACHE_DIR', default=os.path.join(BASE_DIR, 'embeddings'))
+# Бюджет памяти LRU-кэша эмбеддингов в процессе (МБ): ограничивает память долгоживущих воркеров
+EMBEDDINGS_MEMORY_CACHE_MB = env.int('EMBEDDINGS_MEMORY_CACHE_MB', default=256)
+# Синхронизация индекса похожих треков с коллекцией векторов (`python manage.py sync_vector_index`):
+# запись изменений векторов в outbox, источник ('auto' - change streams MongoDB, если доступны, иначе outbox),
+# имя воркера (одно на каталог индекса), размер пакета, пауза между опросами (с) и срок хранения outbox (дни)
+VECTOR_SYNC_OUTBOX = env.bool('VECTOR_SYNC_OUTBOX', default=True)
+VECTOR_SYNC_SOURCE = env.str('VECTOR_SYNC_SOURCE', default='auto')
+VECTOR_SYNC_NAME = env.str('VECTOR_SYNC_NAME', default='default')
+VECTOR_SYNC_BATCH_SIZE = env.int('VECTOR_SYNC_BATCH_SIZE', default=500)
+VECTOR_SYNC_POLL_INTERVAL = env.float('VECTOR_SYNC_POLL_INTERVAL', default=1.0)
+VECTOR_SYNC_OUTBOX_RETENTION_DAYS = env.int('VECTOR_SYNC_OUTBOX_RETENTION_DAYS', default=7)
+# Сколько секунд воркер перечитывает пропущенный id outbox (транзакция записи еще не зафиксирована),
+# прежде чем считать пропуск окончательным (транзакция откатилась)
+VECTOR_SYNC_OUTBOX_GAP_TIMEOUT = env.float('VECTOR_SYNC_OUTBOX_GAP_TIMEOUT', default=300.0)
+# Время жизни (в секундах) кэша матрицы векторов для поиска похожих треков без $vectorSearch
+TRACK_VECTORS_MATRIX_TTL = env.float('TRACK_VECTORS_MATRIX_TTL', default=60.0)
+
+# Бэкенд поиска похожих треков: 'annoy' - приближенный поиск по Annoy-индексу,
+# 'exact' - точный поиск NumPy (для каталогов до ~50 тыс. треков), либо путь к классу бэкенда
+VECTOR_SEARCH_BACKEND = env.str('VECTOR_SEARCH_BACKEND', default='annoy')
+# Количество строк матрицы в одном блоке умножения точного бэкенда
+VECTOR_SEARCH_EXACT_BLOCK_SIZE = env.int('VECTOR_SEARCH_EXACT_BLOCK_SIZE', default=16384)
+# Интервал (в секундах) перезагрузки матрицы точного бэкенда из MongoDB
+VECTOR_SEARCH_EXACT_REFRESH_INTERVAL = env.float('VECTOR_SEARCH_EXACT_REFRESH_INTERVAL', default=300.0)
+
+# Настройки Annoy-индекса похожих треков
+# Количество деревьев и search_k (-1 - значение Annoy по умолчанию).
+# Подбираются командой `python manage.py tune_annoy_index` под целевой recall.
+ANNOY_N_TREES = env.int('ANNOY_N_TREES', default=50)
+ANNOY_SEARCH_K = env.int('ANNOY_SEARCH_K', default=-1)
+# Количество потоков построения деревьев (-1 - все ядра)
+ANNOY_BUILD_JOBS = env.int('ANNOY_BUILD_JOBS', default=-1)
+# Количество соседей на трек в предвычисленной таблице поколения (0 - не вычислять при построении)
+ANNOY_NEIGHBORS_K = env.int('ANNOY_NEIGHBORS_K', default=50)
+# Режим поиска: 'annoy' - деревья Annoy, 'quantized' - перебор int8-кодов с точным переранжированием
+# (в режиме 'quantized' int8-коды записываются вместо float32-матрицы, точные векторы читаются из деревьев)
+ANNOY_SEARCH_MODE = env.str('ANNOY_SEARCH_MODE', default='annoy')
+# Во сколько раз больше кандидатов переранжировать точно в режиме 'quantized'
+ANNOY_RERANK_FACTOR = env.int('ANNOY_RERANK_FACTOR', default=10)
+# Количество треков в дельта-сегменте, после которого он сливается с базовым индексом
+ANNOY_DELTA_MERGE_THRESHOLD = env.int('ANNOY_DELTA_MERGE_THRESHOLD', default=1000)
+# Доля удаленных элементов индекса, после которой запускается фоновая компактизация
+ANNOY_COMPACTION_THRESHOLD = env.float('ANNOY_COMPACTION_THRESHOLD', default=0.2)
+# Минимальный интервал (в секундах) между проверками нового поколения индекса в каждом процессе
+ANNOY_RELOAD_CHECK_INTERVAL = env.float('ANNOY_RELOAD_CHECK_INTERVAL', default=2.0)
+# Количество потоков для пакетного поиска похожих треков (по умолчанию - число ядер)
+ANNOY_QUERY_THREADS = env.int('ANNOY_QUERY_THREADS', default=0) or None
+# Доля подходящих под фильтр треков, ниже которой они перебираются точно вместо обхода деревьев Annoy
+ANNOY_FILTER_EXACT_SCAN_RATIO = env.float('ANNOY_FILTER_EXACT_SCAN_RATIO', default=0.05)
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -263,3 +344,11 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+# Прогрев CLAP и классификатора жанров при старте процессов воркера Celery.
+# Включается только для воркеров, которые считают эмбеддинги; остальные
+# процессы загружают модели лениво при первом использовании
+EMBEDDING_WORKER_WARM_UP = env.bool('EMBEDDING_WORKER_WARM_UP', default=False)
+# Создание индексов хранилища векторов и загрузка индекса похожих треков при старте
+# процессов веб-сервера. Команды manage.py и скрипты не включают прогрев и не обращаются
+# к MongoDB при запуске; индекс загружается лениво при первом запросе рекомендаций
+VECTOR_INDEX_WARM_UP = env.bool('VECTOR_INDEX_WARM_UP', default=False)
@@ -5,5 +5,11 @@ echo "Запуск Django-сервера на порту 8000..."
 # Обновляем файл frontend/views.py, устанавливая debug=True
 sed -i 's/'"'"'debug'"'"': False/'"'"'debug'"'"': True/g' frontend/views.py
 
+# Запускаем воркер синхронизации индекса похожих треков - единственный процесс,
+# который применяет к индексу загрузки и удаления треков
+python manage.py sync_vector_index &
+SYNC_PID=$!
+trap 'kill $SYNC_PID 2>/dev/null' EXIT
+
 # Запускаем Django сервер
 python manage.py runserver